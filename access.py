@@ -31,12 +31,15 @@ DEALINGS IN THE SOFTWARE.
 
 __version__ = "0.29"
 
-import glob, os, string, socket, struct, sys, threading, time, types, select
+import os, string, socket, struct, sys, threading, time, types, select
+import collections
+import heapq
+import bisect
 import subprocess
 import getopt
 import errno
 import ctypes
-import functools
+import atexit
 
 if sys.version_info > (3,):
 
@@ -65,10 +68,31 @@ DEFAULT_SUFFIX = DEFAULT_FILETYPE_SEPARATOR + "fff"
 #DEFAULT_SUFFIX = ""
 DEFAULT_SHARE_DELAY = 30.0
 DEFAULT_PRINTER_DELAY = 30.0
-TIDY_DELAY = 60.0
 
 NO_PAD = 1
 
+# Precompiled structures for the little endian numbers used in messages,
+# indexed by their size in bytes.
+NUMBER_STRUCTS = {
+    1: struct.Struct("<B"),
+    2: struct.Struct("<H"),
+    4: struct.Struct("<I"),
+    8: struct.Struct("<Q")
+    }
+
+NUMBER_MASKS = {
+    1: 0xff,
+    2: 0xffff,
+    4: 0xffffffff,
+    8: 0xffffffffffffffff
+    }
+
+WORD = NUMBER_STRUCTS[4]
+
+# The zeros used to pad strings in messages to a whole number of words,
+# indexed by the length of the string modulo 4.
+PADDING = (b"", b"\x00\x00\x00", b"\x00\x00", b"\x00")
+
 # Find the number of centiseconds between 1900 and 1970.
 between_epochs = ((365 * 70) + 17) * 24 * long(360000)
 
@@ -83,12 +107,111 @@ RECV_GET_SIZE = 8192
 # to data corruption
 RECV_PGET_SIZE = 8192
 
+# The largest number of datagrams to read from a socket each time it is
+# ready, and the size of the receive buffer to request for each socket, or
+# None to use the system's default. The system limits the size requested,
+# to net.core.rmem_max on Linux.
+RECV_BATCH_SIZE = 16
+RECV_BUFFER_SIZE = 1024*1024
+
 # Amounts the remote client can receive
 SEND_SIZE = 16384
 SEND_GET_SIZE = 4096
 SEND_PGET_SIZE = 8192
 SEND_PPUT_SIZE = 16384
 
+# Windowed downloads: the largest number of blocks to keep in flight, the
+# number initially in flight, the time to wait for progress on
+# a block before asking for it again and the number of times to ask.
+PGET_WINDOW_SIZE = 32
+PGET_INITIAL_WINDOW = 4
+PGET_BLOCK_TIMEOUT = 1.0
+PGET_BLOCK_TRIES = 5
+
+# The number of blocks of a local file to read ahead when uploading it.
+READ_AHEAD_BLOCKS = 8
+
+# The largest number of blocks to send to another client before waiting for
+# it to ask for more when it reads a file from one of our shares. The window
+# used for each client is reduced if it has to ask for data again.
+SEND_WINDOW_SIZE = 8
+
+# The number of transfers each client can run at once, or 0 for no limit.
+# Transfers waiting to run are started for the clients running the fewest
+# transfers first.
+TRANSFERS_PER_HOST = 0
+
+# The number of threads used to run transfers, and the largest number of
+# bytes requested by a transfer run before larger ones which are waiting.
+TRANSFER_THREADS = 16
+TRANSFER_BULK_SIZE = 65536
+
+# The smallest file opened for reading to send from buffers of its own for
+# each block, so that blocks can be sent without copying them, and the
+# smallest amount of data in a message to send from the buffer holding it
+# rather than copying it into the encoded message.
+DIRECT_READ_SIZE = 256*1024
+SCATTER_SIZE = 1024
+
+# The largest amount of data received for a file to hold before writing it,
+# when to synchronise written data with the disk ("never", after each
+# "flush" of the data held or on "close"), and whether to reserve space for
+# data about to be received where the system supports it.
+WRITE_BEHIND_SIZE = 256*1024
+WRITE_SYNC = "never"
+WRITE_ALLOCATE = True
+
+# The largest amount of encoded catalogue data to keep for each share, and
+# the time since a directory was last modified after which its catalogue
+# can be kept, allowing for filesystems with coarse modification times.
+CATALOGUE_CACHE_SIZE = 4*1024*1024
+CATALOGUE_CACHE_SETTLE = 2
+
+# The largest amount of encoded catalogue data to keep for clients reading
+# catalogues in more than one chunk, and the time after which a catalogue
+# not read any further is discarded.
+LISTING_CACHE_SIZE = 1024*1024
+LISTING_CACHE_TTL = 60.0
+
+# The number of directories whose names are indexed, and of paths whose
+# permissions are checked, when resolving paths for each share, and the time
+# after which the result of checking a path's permissions is discarded.
+RESOLVE_CACHE_SIZE = 1024
+RESOLVE_CACHE_TTL = 1.0
+
+# The time to wait after a change to a catalogued directory for any further
+# changes before notifying other clients about them.
+WATCH_COALESCE_DELAY = 0.25
+
+# The number of source addresses for which the decision to accept or drop
+# their messages is remembered.
+ADDRESS_CACHE_SIZE = 4096
+
+# The time to wait for a reply from another client before sending a request
+# again, until round trip times to it have been measured, and the shortest
+# and longest times to wait once they have.
+RETRANSMIT_INITIAL = 1.0
+RETRANSMIT_MIN = 0.05
+RETRANSMIT_MAX = 4.0
+
+# The number of bits of each file handle used to index the table of handles
+# and to tag the handles allocated by each worker process. The remaining
+# bits count the number of times each slot has been used.
+HANDLE_SLOT_BITS = 16
+HANDLE_TAG_BITS = 4
+HANDLE_SLOT_MASK = (1 << HANDLE_SLOT_BITS) - 1
+HANDLE_GENERATION_SHIFT = HANDLE_SLOT_BITS + HANDLE_TAG_BITS
+HANDLE_GENERATIONS = (1 << (32 - HANDLE_GENERATION_SHIFT)) - 1
+
+# The number of slots in the table recording which worker process owns the
+# transfers of each path, the longest time a worker waits for a slot before
+# checking whether it should stop waiting or the owner has exited, and the
+# time between checks made by each worker for changes to the catalogued
+# directories it is not watching.
+WORKER_TRANSFER_SLOTS = 1024
+WORKER_CLAIM_WAIT = 0.5
+WORKER_POLL_DELAY = 30.0
+
 # Local user permissions
 USER_READ = os.path.stat.S_IRUSR
 USER_WRITE = os.path.stat.S_IWUSR
@@ -140,16 +263,71 @@ LOG_PROTOCOL = 0  # Low level network packets
 LOG_LEVEL = LOG_API
 LOG_FILE = "/var/log/accesspluspython/log.txt"
 
-def logging_on(level):
+# The size at which the log file is replaced by a new one, the number of
+# old log files to keep, the longest time to keep records before they are
+# written and the number of lines to write at a time.
+LOG_MAX_SIZE = 4*1024*1024
+LOG_BACKUPS = 3
+LOG_FLUSH_DELAY = 0.5
+LOG_BATCH_LINES = 4096
+
+# The largest number of records to queue for writing. The oldest records
+# are discarded if the log cannot be written as quickly as they arrive.
+LOG_QUEUE_SIZE = 65536
+
+def logging_on(level, capture = None):
 
+    """logging_on(level, capture = None)
+    
+    Log events at the level given and above to LOG_FILE. If a capture path
+    is given then all messages sent and received are also captured to a
+    pcap file.
+    """
+    
     global DEBUG, LOG_LEVEL
     DEBUG = 1
     LOG_LEVEL = max(0, level)
+    
+    if capture is not None:
+    
+        capture_on(capture)
 
 def logging_off():
 
     global DEBUG
     DEBUG = 0
+    
+    # Write any records still queued and stop capturing messages.
+    Log.flush()
+    capture_off()
+
+def capture_on(path):
+
+    """capture_on(path)
+    
+    Capture all messages sent and received on the Access ports to a pcap
+    file at the path given, replacing any capture already in progress.
+    """
+    
+    capture_off()
+    Ports.capture = Capture(path)
+
+def capture_off():
+
+    """capture_off()
+    
+    Stop capturing messages, writing those captured so far.
+    """
+    
+    capture = Ports.capture
+    Ports.capture = None
+    
+    if capture is not None:
+    
+        capture.close()
+
+# Write any messages still buffered when the program exits.
+atexit.register(capture_off)
 
 
 # Host name configuration
@@ -171,10 +349,6 @@ if at != -1:
 
     Hostname = Hostname[:at]
 
-# Keep track of usable handles
-available_handles = []
-max_available_handle = 3
-
 def make_subnet(addr, netmask):
 
     ip = struct.unpack("!I", socket.inet_aton(addr))[0]
@@ -203,30 +377,22 @@ def get_subnet_from_address(addr, netmask):
 def split_subnet_netmask(cidr):
 
     pos = cidr.find("/")
-    elts = []
 
     if pos != -1:
 
         addr = cidr[:pos]
         try:
 
-            prefixlen = int(cidr[pos+1:], 10)
+            prefixlen = min(32, max(0, int(cidr[pos+1:], 10)))
 
         except:
 
             prefixlen = 0
 
-        # The netmask is a binary number with prefixlen 1s
-        # This code gets the netmask backwards, but that's OK.  It will
-        # be reversed in the following for loop
-        mask = (1 << prefixlen) - 1
+        # The netmask is a binary number with prefixlen 1s followed by 0s.
+        mask = (0xffffffff << (32 - prefixlen)) & 0xffffffff
 
-        for i in range(4):
-
-            elts.append(mask % 256)
-            mask = mask >> 8
-
-        netmask = "%d.%d.%d.%d" % (elts[0], elts[1], elts[2], elts[3])
+        netmask = socket.inet_ntoa(struct.pack("!I", mask))
 
     else:
 
@@ -249,6 +415,7 @@ def setup_net(interface):
     global Hostaddr
     global Broadcast_addr
     global Subnet
+    global Netmask
 
     Hostaddr = None
     Broadcast_addr = None
@@ -266,6 +433,7 @@ def setup_net(interface):
             elts = line.strip().split(" ")
             (Hostaddr, netmask) = split_subnet_netmask(elts[1])
             Subnet = make_subnet(Hostaddr, netmask)
+            Netmask = netmask
             Broadcast_addr = elts[3]
 
             break
@@ -287,26 +455,6 @@ def jenkins_one_at_a_time_hash(path):
 
     return hsh.value
 
-def get_next_handle():
-    global max_available_handle
-
-    if len(available_handles) == 0:
-        max_available_handle = max_available_handle + 1
-        handle = max_available_handle
-    else:
-        handle = available_handles.pop()
-
-    return handle
-
-def free_handle(handle):
-    global available_handles
- 
-    try:
-        if available_handles.index(handle) == -1:
-            available_handles.push(handle)
-    except ValueError:
-        pass
-
 def round_up(val, up_to):
     return (val + up_to - 1) & ~(up_to - 1)
 
@@ -381,7 +529,16 @@ class Common:
         return s
 
     def str2num(self, size, s):
-        """Convert a string of decimal digits to an positive integer."""
+        """Convert a little endian string of bytes to a positive integer."""
+
+        try:
+
+            return NUMBER_STRUCTS[size].unpack_from(s)[0]
+
+        except (KeyError, struct.error, TypeError):
+
+            # Unusual sizes and character strings are decoded by hand.
+            pass
 
         i = 0
         n = long(0)
@@ -403,34 +560,24 @@ class Common:
     
         """Convert a number to a little endian string of bytes for writing to a binary file."""
         
-        # Little endian writing
+        try:
 
+            return NUMBER_STRUCTS[size].pack(n & NUMBER_MASKS[size])
 
-        s = ""
+        except KeyError:
+
+            pass
+
+        # Little endian writing of unusual sizes, such as reply IDs.
         ba = bytearray()
         
         while size > 0:
         
-            i = n % 256
-
-            if sys.version_info > (3,):
-
-                ba.append(i)
-
-            else:
-
-                s = s + chr(i)
-    
+            ba.append(n % 256)
             n = n >> 8
             size = size - 1
         
-        if sys.version_info > (3,):
-
-            return bytes(ba)
-
-        else:
-
-            return s
+        return bytes(ba)
     
     def read_string(self, data, offset = 0, length = None, ending = None, include = 1):
 
@@ -512,50 +659,44 @@ class Common:
             sys.stderr.write(error_msg + "\n")
             raise raise_exception("Failed to coerce %s using %s." % (args, fn))
     
+    # Map bytes to themselves if they are printable, or to "." otherwise.
+    printable = bytes(bytearray(
+        [(c > 31 and c < 127) and c or 46 for c in range(256)]
+        ))
+    
     def interpret(self, data):
     
         lines = []
-
-        i = 0
         
-        while i < len(data):
+        if type(data) == str and str is not bytes:
+        
+            data = data.encode("latin-1")
         
-            # Print the data in big-endian word form.
-            words = []
-            j = i
+        for i in range(0, len(data), 16):
+        
+            row = data[i:i+16]
             
-            while j < len(data) and j < (i + 16):
+            # Print the data in little-endian word form, with any trailing
+            # bytes as a shorter number.
+            n = len(row) >> 2
+            words = ["%08x" % word for word in struct.unpack_from("<%iI" % n, row)]
             
-                if j <= len(data) - 4:
-                
-                    word = self.str2num(4, data[j:j+4])
-                
-                else:
-                
-                    word = self.str2num(len(data) - j, data[j:])
-                
-                words.append("%08x" % word)
-                
-                j = j + 4
+            if len(row) & 3:
+            
+                words.append("%08x" % self.str2num(len(row) & 3, row[n*4:]))
             
             words = " ".join(words)
             
             if len(words) < 35: words = words + (35 - len(words)) * " "
             
-            s = ""
             # Show the data in string form.
-            for c in data[i:i+16]:
+            s = bytes(row).translate(self.printable)
             
-                if type(c) == str and ord(c) > 31 and ord(c) < 127:
-                    s = s + c
-                elif type(c) == int and c > 31 and c < 127:
-                    s = s + chr(c)
-                else:
-                    s = s + "."
+            if str is not bytes:
             
-            lines.append("%s : %s" % (words, s))
+                s = s.decode("latin-1")
             
-            i = i + 16
+            lines.append("%s : %s" % (words, s))
         
         return lines
     
@@ -643,4435 +784,9180 @@ class Common:
 
 
 
-# Sockets and ports
-
-class Ports(Common):
+# Decoded messages
 
-    # Define a dictionary to relate port numbers to the sockets
-    # to use. Use the class attributes to ensure that these are
-    # only defined once.
-    broadcasters = {32770: None, 32771: None, 49171: None}
-    ports = {32770: None, 32771: None, 49171: None}
+class Packet(object):
 
-    # structures to handle data for select.poll() or select.select()
-    socket_poll = None
-    socket_select_rlist = None
+    """Packet
     
-    access_plus = None
+    A datagram received on the share port, decoded with a single call to
+    its precompiled layout. The command character, reply ID and code word
+    are read from the header of each request; subclasses name the words
+    which follow the header and give the offset of any trailing string.
+    """
     
-    def __init__(self, access_plus = 1):
+    __slots__ = ("command", "reply_id", "code", "data")
     
-        # This class is subclassed by many other classes and its
-        # functionality used by many instances, yet all share the
-        # same socket objects, therefore we must record the options
-        # set when the class is first instantiated and prevent
-        # subsequent operations from overriding them.
+    layout = struct.Struct("<c3sI")
+    fields = ()
+    string_offset = None
+    
+    def __init__(self, data, values):
+    
+        self.data = data
         
-        if Ports.access_plus is None:
+        command, reply_id = values[:2]
         
-            Ports.access_plus = access_plus
+        if str is not bytes:
         
+            command = command.decode("latin-1")
+            reply_id = reply_id.decode("latin-1")
         
-        try:
-
-            self.socket_poll = select.poll()
-
-        except:
-
-            self.socket_select_rlist = []
-
-        # Create sockets to use for polling.
-        self._create_poll_sockets()
+        self.command = command
+        self.reply_id = reply_id
+        self.code = values[2]
         
-        if Ports.access_plus == 1:
+        for name, value in zip(self.fields, values[3:]):
         
-            # Create sockets to use for listening.
-            self._create_listener_sockets()
+            setattr(self, name, value)
+    
+    def string(self):
+    
+        """Return the string following the words in the message."""
         
-        self.access_plus = access_plus
+        value = self.data[self.string_offset:]
         
-        # Create sockets to use for share details.
-        self._create_share_sockets()
+        if type(value) != str:
         
-        if DEBUG == 1 and not hasattr(self, "_log"): Ports._log = []
-    
-    def _register_socket_for_select(self, s):
+            value = value.decode("UTF-8")
+        
+        return value
 
-        if self.socket_poll != None:
+class PathRequest(Packet):
 
-            self.socket_poll.register(s.fileno(), select.POLLIN)
+    # Open, create and delete requests: an unused word then a path.
+    __slots__ = ()
+    layout = struct.Struct("<c3sI4x")
+    string_offset = 12
 
-        else:
+class ValuePathRequest(Packet):
 
-            self.socket_select_rlist.append(s.fileno())
+    # Access attribute and rename requests: a value, an unused word, then
+    # a path.
+    __slots__ = ("value",)
+    layout = struct.Struct("<c3sII4x")
+    fields = ("value",)
+    string_offset = 16
 
-    def _create_poll_sockets(self):
-    
-        if self.broadcasters[32770] is None:
-        
-            self._poll_s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            
-            # Allow the socket to broadcast packets.
-            self._poll_s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            
-            # Set the socket to be non-blocking.
-            self._poll_s.setblocking(0)
-            
-            if sys.platform.startswith('win32'):
+class HandleRequest(Packet):
 
-                self._poll_s.bind((Hostaddr, 32770))
+    # Close and free space requests.
+    __slots__ = ("handle",)
+    layout = struct.Struct("<c3sII")
+    fields = ("handle",)
 
-            else:
+class TransferRequest(Packet):
 
-                self._poll_s.bind((Broadcast_addr, 32770))
-            
-            Ports.broadcasters[32770] = self._poll_s
+    # Data requests: a handle, a position in the file and an amount.
+    __slots__ = ("handle", "pos", "length")
+    layout = struct.Struct("<c3sIIII")
+    fields = ("handle", "pos", "length")
 
-            self._register_socket_for_select(Ports.broadcasters[32770])
-        
-        if self.ports[32770] is None:
-        
-            if sys.platform.startswith('win32'):
+class LengthRequest(Packet):
 
-                # Windows (tested with Windows XP) needs to use
-                # the same socket as the broadcaster and the listener
-                Ports.ports[32770] = Ports.broadcasters[32770]
+    # Requests to set the length of a file.
+    __slots__ = ("handle", "length")
+    layout = struct.Struct("<c3sIII")
+    fields = ("handle", "length")
 
-            else:
+class FiletypeRequest(Packet):
 
-                # Create a socket for listening.
-                self._poll_l = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            
-                # Set the socket to be non-blocking.
-                self._poll_l.setblocking(0)
-            
-                self._poll_l.bind((Hostaddr, 32770))
-            
-                Ports.ports[32770] = self._poll_l
+    # Requests to set the filetype and date stamp of a file.
+    __slots__ = ("handle", "filetype_word", "date_word")
+    layout = struct.Struct("<c3sIIII")
+    fields = ("handle", "filetype_word", "date_word")
 
-                self._register_socket_for_select(Ports.ports[32770])
+class CatalogueRequest(Packet):
+
+    # Catalogue requests: two unused words then a path.
+    __slots__ = ()
+    layout = struct.Struct("<c3sI8x")
+    string_offset = 16
+
+class ChunkRequest(Packet):
+
+    # Requests for the next chunk of a catalogue.
+    __slots__ = ("dir_handle", "marker", "blocksize")
+    layout = struct.Struct("<c3sIIII")
+    fields = ("dir_handle", "marker", "blocksize")
+
+class Reply(Packet):
+
+    # Replies to our own requests. These have no code word so the data is
+    # passed on to the object waiting for it.
+    __slots__ = ()
+    layout = struct.Struct("<c3s")
     
-    def _create_listener_sockets(self):
+    def __init__(self, data, values):
     
-        if self.broadcasters[32771] is None:
+        Packet.__init__(self, data, values + (None,))
+
+class ObjectInfo(Packet):
+
+    # Replies describing an object: its filetype and date words, length,
+    # access attributes, object type and, optionally, a handle.
+    __slots__ = ("filetype_word", "date_word", "length", "access_attr",
+                 "object_type", "handle")
+    layout = struct.Struct("<c3sIIIII")
+    fields = ("filetype_word", "date_word", "length", "access_attr",
+              "object_type")
+    
+    def __init__(self, data, values):
+    
+        Packet.__init__(self, data, values[:2] + (None,) + values[2:])
         
-            self._listen_s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            
-            # Allow the socket to broadcast packets.
-            self._listen_s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            
-            # Set the socket to be non-blocking.
-            self._listen_s.setblocking(0)
-            
-            if sys.platform.startswith('win32'):
+        if len(data) >= 28:
+        
+            self.handle = WORD.unpack_from(data, 24)[0]
+        
+        else:
+        
+            self.handle = None
 
-                self._listen_s.bind((Hostaddr, 32771))
+class CatalogueEntry(object):
 
-            else:
+    """CatalogueEntry
+    
+    An entry in a catalogue: the filetype and date words, length, access
+    attributes and object type of an object followed by its zero-terminated
+    name, padded to a word boundary.
+    """
+    
+    __slots__ = ("filetype_word", "date_word", "length", "access_attr",
+                 "object_type", "name", "end")
+    
+    layout = struct.Struct("<IIIII")
+    
+    def __init__(self, data, offset):
+    
+        (self.filetype_word, self.date_word, self.length, self.access_attr,
+         self.object_type) = self.layout.unpack_from(data, offset)
+        
+        offset = offset + self.layout.size
+        end = data.find(b"\x00", offset)
+        
+        if end == -1:
+        
+            end = len(data)
+        
+        self.name = data[offset:end]
+        
+        if type(self.name) != str:
+        
+            self.name = self.name.decode("latin-1")
+        
+        
+        # Record the offset of the following entry.
+        self.end = round_up(end + 1, 4)
 
-                self._listen_s.bind((Broadcast_addr, 32771))
-            
-            Ports.broadcasters[32771] = self._listen_s
+# The layouts of the messages received on the share port, indexed by the
+# command character and code word as they appear in the datagram. Replies
+# are indexed by their command character alone.
 
-            self._register_socket_for_select(Ports.broadcasters[32771])
+SHARE_PACKETS = {}
+
+def _register_packets(command, codes, cls):
+
+    for code in codes:
+    
+        if code is None:
         
-        if self.ports[32771] is None:
+            key = (command.encode("latin-1"), None)
         
-            if sys.platform.startswith('win32'):
+        else:
+        
+            key = (command.encode("latin-1"), WORD.pack(code))
+        
+        SHARE_PACKETS[key] = cls
 
-                # Windows (tested with Windows XP) needs to use
-                # the same socket as the broadcaster and the listener
-                Ports.ports[32771] = Ports.broadcasters[32771]
+_register_packets("A", (0x1, 0x2, 0x4, 0x5, 0x6), PathRequest)
+_register_packets("A", (0x7, 0x9), ValuePathRequest)
+_register_packets("A", (0x8, 0xa, 0x16), HandleRequest)
+_register_packets("A", (0xb, 0xc, 0x14), TransferRequest)
+_register_packets("A", (0xe, 0xf), LengthRequest)
+_register_packets("A", (0x10,), FiletypeRequest)
+_register_packets("A", (0xd,), ChunkRequest)
+_register_packets("B", (0x3,), CatalogueRequest)
+_register_packets("B", (0xb,), TransferRequest)
+_register_packets("B", (0xd,), ChunkRequest)
 
-            else:
+# Resource updated messages ("F") are not registered and are ignored.
+for command in "DRSEdrw":
 
-                # Linux either needs separate sockets for broadcaster
-                # and listener, or it needs to bind to Hostaddr ''
-                # otherwise it will totally fail to receive broadcast messages
-                # Create a socket for listening.
-                self._listen_l = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            
-                # Set the socket to be non-blocking.
-                self._listen_l.setblocking(0)
-            
-                self._listen_l.bind((Hostaddr, 32771))
-            
-                Ports.ports[32771] = self._listen_l
+    _register_packets(command, (None,), Reply)
 
-                self._register_socket_for_select(Ports.ports[32771])
+def decode_packet(data, cls = None):
+
+    """packet = decode_packet(data, cls = None)
     
-    def _create_share_sockets(self):
+    Decode the datagram given using the layout registered for its command
+    and code, or the layout of the class given. Return None if the message
+    is unknown or too short for its layout.
+    """
     
-        if self.broadcasters[49171] is None:
+    if cls is None:
+    
+        cls = SHARE_PACKETS.get((data[:1], data[4:8]))
         
-            self._share_s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            
-            # Allow the socket to broadcast packets.
-            self._share_s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        if cls is None:
+        
+            cls = SHARE_PACKETS.get((data[:1], None))
             
-            # Set the socket to be non-blocking.
-            self._share_s.setblocking(0)
+            if cls is None:
             
-            if sys.platform.startswith('win32'):
+                return None
+    
+    try:
+    
+        return cls(data, cls.layout.unpack_from(data))
+    
+    except struct.error:
+    
+        return None
 
-                self._share_s.bind((Hostaddr, 49171))
 
-            else:
 
-                self._share_s.bind((Broadcast_addr, 49171))
-            
-            Ports.broadcasters[49171] = self._share_s
+# Logging
 
-            self._register_socket_for_select(Ports.broadcasters[49171])
-        
-        if self.ports[49171] is None:
-        
-            if sys.platform.startswith('win32'):
-
-                # Windows (tested with Windows XP) needs to use
-                # the same socket as the broadcaster and the listener
-                Ports.ports[49171] = Ports.broadcasters[49171]
-
-            else:
-
-                # Create a socket for listening.
-                self._share_l = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            
-                # Set the socket to be non-blocking.
-                self._share_l.setblocking(0)
-            
-                self._share_l.bind((Hostaddr, 49171))
-            
-                Ports.ports[49171] = self._share_l
+class Capture:
 
-                self._register_socket_for_select(Ports.ports[49171])
+    """Capture(path)
     
-    def _encode(self, l):
+    Write messages sent and received to a file in the pcap format, giving
+    each message IPv4 and UDP headers so that the file can be read by
+    standard tools.
+    """
     
-        """
-        string = _encode(self, list)
-        
-        Join together the elements in the list supplied to form a string
-        which is acceptable to the other Access+ clients.
-        """
+    # The pcap file header: magic number, version 2.4, time zone, timestamp
+    # accuracy, maximum length of each packet and the raw IP link type.
+    HEADER = struct.Struct("<IHHiIII")
+    LINKTYPE_RAW = 101
     
-        output = []
-        
-        for item in l:
-        
-            if type(item) == int:
-            
-                output.append(self.number(4, item))
-            
-            elif type(item) == longtype:
-            
-                output.append(self.number(4, item))
-
-            elif type(item) == tuple:
-
-                if item[0] == NO_PAD:
-
-                    # This is a chunk of file being sent to a client.
-                    # Don't pad it
-
-                    output.append(item[1])
-
-            else:
-            
-                # Pad the string to fit an integer number of words.
-                # If the string is to be terminated by a particular
-                # character, it should have been included with the
-                # string.
-                
-                padding = 4 - (len(item) % 4)
-                
-                if padding == 4: padding = 0
-                
-                if type(item) == str:
-
-                    padded = item + (padding * "\000")
-
-                    if sys.version_info > (3,):
-
-                        padded = bytes(padded, "latin-1")
-
-                else:
-
-                    padded = item + (padding * b"\000")
-                
-                output.append(padded)
-        
-        s = b"".join(output)
-
-        return s
+    # The record header: timestamp in seconds and microseconds, and the
+    # length of the packet captured and of the original packet.
+    RECORD = struct.Struct("<IIII")
     
-#    def _decode(self, s, format):
-#    
-#        """
-#        list = _decode(self, string, format)
-#        
-#        Extract the elements from the string supplied using the format
-#        list to a list.
-#        """
-#    
-#        output = []
-#        c = 0
-#        
-#        for i in range(0, len(format)):
-#        
-#            if type(format[i]item) == types.IntType:
-#            
-#                output.append(self.number(4, item))
-#            
-#            else:
-#            
-#                # Pad the string to fit an integer number of words.
-#                padding = 4 - (len(item) % 4)
-#                
-#                if padding == 4: padding = 0
-#                
-#                padded = item + (padding * "\000")
-#                
-#                output.append(padded)
-#        
-#        return "".join(output)
+    IPV4 = struct.Struct("!BBHHHBBH4s4s")
+    UDP = struct.Struct("!HHHH")
     
-    def _allowed_host(self, addr):
-
-        if addr in self.remote_nets:
-
-            return True
-
-        return False
-
-    def _recvfrom(self, s, bufsize):
+    def __init__(self, path):
     
-        """string, address = _recvfrom(self, socket, bufsize)
+        self.path = path
+        self.f = open(path, "wb", 65536)
+        self.f.write(
+            self.HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, 65535, self.LINKTYPE_RAW)
+            )
         
-        Receive data of maximum length given by "bufsize" from the socket in
-        a string and determine the address it originated from, filtering out
-        data from machines not on the local subnet.
-        """
+        # Messages are written by the threads sending and receiving them.
+        self.lock = threading.Lock()
+        self.addresses = {}
+    
+    def _address(self, host):
+    
+        try:
         
-        data, addr = s.recvfrom(bufsize)
+            return self.addresses[host]
+        
+        except KeyError:
+            pass
         
-        host = socket.gethostbyname(addr[0])
+        try:
         
-        if host_on_same_subnet(host, Subnet) or self._allowed_host(host):
+            address = socket.inet_aton(host)
         
-            return data, addr
+        except (socket.error, TypeError):
         
-        else:
+            address = b"\x00\x00\x00\x00"
         
-            return None, None
+        self.addresses[host] = address
+        return address
     
-    def _send_list(self, l, s, to_addr):
+    def write(self, t, source, destination, data):
     
-        """send_list(self, list, socket, to_addr)
+        """write(self, time, source, destination, data)
         
-        Encode the list as a string suitable for other Access+ clients
-        using the _encode method then send it on the socket provided.
+        Write a message sent from the source address to the destination
+        address at the time given. Addresses are (host, port) tuples.
         """
         
-        self.log("sent", l, to_addr, level = LOG_PROTOCOL)
+        # Truncate messages too long for a single IPv4 packet.
+        data = data[:65535 - self.IPV4.size - self.UDP.size]
+        length = self.IPV4.size + self.UDP.size + len(data)
         
-        sent = False
-        count = 5
-
-        while sent == False and count > 0:
-
-            try:
-
-                s.sendto(self._encode(l), to_addr)
-                sent = True
-
-            except socket.error as excpt:
-
-                if excpt.errno == errno.EAGAIN or \
-                    (sys.platform.startswith('win32') and excpt.errno == errno.WSAEWOULDBLOCK):
-
-                    count -= 1
-
-            except:
-
-                break
-    
-    def _send_and_expect_reply(self, _socket, msg, host, new_id, commands,
-                      tries = 5, delay = 2):
-    
-        # Add an entry to the Messages object so that replies to this message
-        # can be collected rather than being discarded. This requires that
-        # the derived class has an attribute called "share_messages" which
-        # refers to a Messages instance.
-        self.share_messages.add_entry(host, new_id)
-
-        # Send the request.
-        self._send_list(msg, _socket, (host, 49171))
-
-        replied = 0
+        header = self.IPV4.pack(
+            0x45, 0, length, 0, 0, 64, socket.IPPROTO_UDP, 0,
+            self._address(source[0]), self._address(destination[0])
+            )
         
-        # Keep a record of the time of the previous request.
-        t0 = time.time()
+        # Fill in the header checksum.
+        words = struct.unpack("!10H", header)
+        checksum = sum(words)
+        checksum = (checksum & 0xffff) + (checksum >> 16)
+        checksum = (checksum & 0xffff) + (checksum >> 16)
+        header = header[:10] + struct.pack("!H", ~checksum & 0xffff) + header[12:]
         
-        while tries > 0:
+        # Leave the UDP checksum empty.
+        udp = self.UDP.pack(
+            source[1], destination[1], self.UDP.size + len(data), 0
+            )
         
-            if self.share_messages.wait_for_event(host, new_id, 1.0):
-
-                # See if the response has arrived.
-                replied, data = \
-                    self.share_messages._scan_messages(host, new_id, commands)
-
-                # If a message was found or an error occurred then return
-                # immediately.
-                if replied != 0:
-            
-                    # Remove the entry in the Messages object for replies to this
-                    # message.
-                    self.share_messages.remove_entry(host, new_id)
-                
-                    return replied, data
-
-            else:
+        seconds = int(t)
+        record = self.RECORD.pack(
+            seconds, int((t - seconds) * 1000000), length, length
+            )
+        
+        self.lock.acquire()
+        
+        try:
+        
+            if self.f is not None:
             
-                # Send the request again.
-                self._send_list(msg, _socket, (host, 49171))
-                
-                tries = tries - 1
+                self.f.write(record + header + udp)
+                self.f.write(data)
         
-        # Remove the entry in the Messages object for replies to this
-        # message.
-        self.share_messages.remove_entry(host, new_id)
+        finally:
         
-        # Return a negative result.
-        return 0, (0, "The machine containing the shared disc does not respond")
+            self.lock.release()
     
-    def new_id(self):
+    def flush(self):
     
-        if not hasattr(self, "_id"):
+        self.lock.acquire()
         
-            self._id = 1
+        try:
         
-        else:
+            if self.f is not None:
+            
+                self.f.flush()
         
-            self._id = self._id + 0x1001
-            if self._id > 0xffffff:
-                self._id = 1
+        finally:
         
-        return "%s" % (self.replyid2str(self.number(3, self._id)))
+            self.lock.release()
     
-    def _send_request(self, msg, host, commands, new_id = None, tries = 5,
-                      delay = 2):
+    def close(self):
     
-        """replied, data = _send_reqest(self, msg)
-        
-        Send a message via the non-broadcast share port to a remote client
-        and wait for a reply.
-        """
-        # Use the non-broadcast socket.
-        if not 49171 in self.ports:
-        
-            print("No socket to use for port %i" % 49171)
-            return 0, []
+        self.lock.acquire()
         
-        s = self.ports[49171]
+        try:
         
-        if new_id is None:
+            if self.f is not None:
+            
+                self.f.close()
+                self.f = None
         
-            # Use a new ID for this message.
-            new_id = self.new_id()
+        finally:
         
-        # Create the command to send. The three bytes following the
-        # command character are used to identify the response from the
-        # other client (it passes them back in its response).
-        msg[0] = msg[0] + new_id
+            self.lock.release()
+
+class LogWriter(Common):
+
+    """LogWriter(path = None, max_size = LOG_MAX_SIZE, backups = LOG_BACKUPS,
+                 queue_size = LOG_QUEUE_SIZE)
+    
+    Write log records queued by any thread to a file in a background thread.
+    Queuing a record only appends it to a deque; records are formatted when
+    they are written, in batches. At most queue_size records are queued,
+    the oldest being discarded and counted when more arrive. The file is
+    renamed with a numeric suffix when it grows beyond the maximum size,
+    keeping the number of older files given. If no path is given then
+    LOG_FILE is used.
+    """
+    
+    def __init__(self, path = None, max_size = LOG_MAX_SIZE,
+                 backups = LOG_BACKUPS, queue_size = LOG_QUEUE_SIZE):
+    
+        self.path = path
+        self.max_size = max_size
+        self.backups = backups
+        self.queue_size = queue_size
         
-        # Wait for a reply.
-        replied, data = \
-            self._send_and_expect_reply(s, msg, host, new_id, commands, tries, delay)
+        # Records are (time, direction, data, address) tuples. The number
+        # of records discarded is reported when the next batch is written.
+        self.records = collections.deque(maxlen = queue_size)
+        self.dropped = 0
         
-        #if replied == 1:
-        #
-        #    self.log("received", data, (host, 49171))
-        #
-        #else:
-        #
-        #    # The data value is a tuple if an error occurs.
-        #    self.log("received", data[1], (host, 49171))
+        # The lock is held while writing a batch of records.
+        self.lock = threading.Lock()
+        self.event = threading.Event()
         
-        return replied, data
+        self.f = None
+        self.f_path = None
+        self.thread = None
     
-    def log(self, direction, data, address, level = 0):
+    def record(self, direction, data, address):
     
-        if DEBUG == 0: return
-        if LOG_LEVEL > level: return
-        
-        if direction[0] == "s" and type(data) == list:
-        
-            lines = ["Sent to %s:%i" % address] + \
-                self.interpret(self._encode(data))
-                
-            Ports._log = Ports._log + lines
+        """record(self, direction, data, address)
         
-        elif direction[0] == "s" and type(data) == str:
+        Queue a record for writing. The direction is "sent" or "received"
+        for messages, given as strings of bytes, or "comment" for text.
+        """
         
-            lines = ["Sent to %s:%i" % address] + \
-                self.interpret(data)
-                
-            Ports._log = Ports._log + lines
+        records = self.records
         
-        elif direction[0] == "r":
+        # Wake the writing thread early when the queue is half full, and
+        # count the record discarded when it is full.
+        if len(records) >= self.queue_size // 2:
         
-            lines = ["Received from %s:%i" % address] + \
-                self.interpret(data)
+            if len(records) >= self.queue_size:
             
-            Ports._log = Ports._log + lines
+                self.dropped += 1
+            
+            self.event.set()
         
-        else:
+        records.append((time.time(), direction, data, address))
         
-            Ports._log.append(data)
+        if self.thread is None:
         
-        Ports._log.append("")
-
-        self.write_log(LOG_FILE)
+            self._start()
     
-    def write_log(self, path):
+    def _start(self):
     
+        self.lock.acquire()
+        
         try:
-
-            with open(path, "a") as f:
-
-                f.writelines(map(lambda x: str(x) + "\n", Ports._log))
-
-        except:
-
-            pass
-
-        Ports._log = []
-
-
-
-class Files:
-
-    def __init__(self):
-    
-        # Keep a dictionary of local file handles in use but limit its length.
-        self.max_handles = 100
-        self.handles = {}
-    
-    def __getitem__(self, item):
-    
-        # Return the item as in a normal dictionary.
-        return self.handles[item]
-    
-    def __setitem__(self, item, value):
-    
-        # Add an entry as in a normal handles.
-        self.handles[item] = value
-    
-    def __delitem__(self, item):
-    
-        del self.handles[item]
-    
-    def __cmp__(self, other):
-    
-        if isinstance(other, Match):
         
-            return self.handles == other.handles
+            if self.thread is not None:
+            
+                return
+            
+            # Don't let the thread keep the program running; pending
+            # records are written when the program exits.
+            self.thread = threading.Thread(
+                group = None, target = self._write_records, name = "Log writer"
+                )
+            self.thread.daemon = True
+            self.thread.start()
+            
+            atexit.register(self.flush)
         
-        else:
+        finally:
         
-            return self == other
-    
-    def clear(self):
-    
-        return self.handles.clear()
-    
-    def copy(self):
-    
-        return self.handles.copy()
-    
-    def get(self, item, default = None):
-    
-        return self.handles(item, default)
+            self.lock.release()
     
-    def has_key(self, item):
+    def _write_records(self):
     
-        return item in self.handles
+        while 1:
+        
+            self.event.wait(LOG_FLUSH_DELAY)
+            self.event.clear()
+            self.flush()
     
-    def items(self):
+    def reset(self):
     
-        return self.handles.items()
+        """reset(self)
+        
+        Forget the writing thread and the records queued, as in a newly
+        forked process where the thread is not running and another process
+        owns the records.
+        """
+        
+        self.records = collections.deque(maxlen = self.queue_size)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.f = None
+        self.thread = None
     
-    def keys(self):
+    def flush(self):
     
-        return self.handles.keys()
+        """flush(self)
+        
+        Write all the records queued so far.
+        """
+        
+        self.lock.acquire()
+        
+        try:
+        
+            self._write_batch()
+        
+        finally:
+        
+            self.lock.release()
     
-    def popitem(self):
+    def _write_batch(self):
     
-        return self.handles.popitem()
+        lines = []
+        records = self.records
+        
+        dropped = self.dropped
+        
+        if dropped:
+        
+            self.dropped -= dropped
+            lines.append("%i log records were discarded\n" % dropped)
+        
+        while records:
+        
+            t, direction, data, address = records.popleft()
+            
+            if direction[0] == "s":
+            
+                lines.append("Sent to %s:%i" % address)
+                lines.extend(self.interpret(data))
+            
+            elif direction[0] == "r":
+            
+                lines.append("Received from %s:%i" % address)
+                lines.extend(self.interpret(data))
+            
+            else:
+            
+                lines.append(str(data))
+            
+            lines.append("")
+            
+            # Write long batches in parts.
+            if len(lines) >= LOG_BATCH_LINES:
+            
+                self._write_lines(lines)
+                lines = []
+        
+        if lines:
+        
+            self._write_lines(lines)
     
-    def setdefault(self, item, default = None):
+    def _write_lines(self, lines):
     
-        return self.handles.setdefault(item, default)
+        path = self.path or LOG_FILE
+        
+        try:
+        
+            if self.f is None or self.f_path != path:
+            
+                self._close_file()
+                self.f = open(path, "a")
+                self.f_path = path
+            
+            self.f.write("\n".join(lines) + "\n")
+            self.f.flush()
+            
+            if self.f.tell() > self.max_size:
+            
+                self._rotate()
+        
+        except (IOError, OSError):
+        
+            # Discard the records if the log cannot be written.
+            self._close_file()
     
-    def update(self, dict):
+    def _close_file(self):
     
-        return self.handles.update(dict)
+        if self.f is not None:
+        
+            self.f.close()
+            self.f = None
     
-    def values(self):
+    def _rotate(self):
     
-        return self.handles.values()
+        # Rename each old file to the next numbered file, discarding the
+        # oldest, and start a new file.
+        path = self.f_path
+        self._close_file()
+        
+        for i in range(self.backups - 1, 0, -1):
+        
+            old = "%s.%i" % (path, i)
+            
+            if os.path.exists(old):
+            
+                os.rename(old, "%s.%i" % (path, i + 1))
+        
+        if self.backups > 0:
+        
+            os.rename(path, path + ".1")
+        
+        else:
+        
+            os.remove(path)
 
+# The log writer used by all objects.
+Log = LogWriter()
 
-class Messages(Common):
 
-    def __init__(self):
-    
-        self.messages = {}
-        self.events = {}
-        self.lock = threading.Semaphore()
-    
-    def __getitem__(self, item):
-    
-        # Return the item as in a normal dictionary.
-        return self.messages[item]
+# Sockets and ports
+
+class AddressFilter:
+
+    """AddressFilter()
     
-    def __setitem__(self, item, value):
+    Decide whether to accept messages from a source address: those from
+    hosts on the local subnet and on any remote networks added are accepted.
+    Networks are held as integers in a set for each prefix length and the
+    decision for each address is remembered, so that most messages only
+    cost a dictionary lookup. The number of messages accepted by each
+    filter and the number dropped are counted.
+    """
     
-        # Add an entry as in a normal messages.
-        self.messages[item] = value
+    LOCAL = "local"
+    DROPPED = "dropped"
     
-    def __delitem__(self, item):
+    def __init__(self):
     
-        del self.messages[item]
+        # Network addresses for each prefix length, longest first, and the
+        # text used to add each network.
+        self.networks = {}
+        self.prefixes = []
+        self.names = {}
+        
+        # The filter which accepted each address, or DROPPED.
+        self.cache = {}
+        self.counters = {self.LOCAL: 0, self.DROPPED: 0}
+        self.lock = threading.Lock()
     
-    def __cmp__(self, other):
+    def add(self, network):
     
-        if isinstance(other, Match):
+        """add(self, network)
         
-            return self.messages == other.messages
+        Accept messages from the host or network given as an address, a
+        host name or an address with a prefix length, as in a.b.c.d/n.
+        """
+        
+        if "/" in network:
+        
+            addr, netmask = split_subnet_netmask(network)
         
         else:
         
-            return self == other
-    
-    def __len__(self):
-    
-        return len(self.messages)
-    
-    def clear(self):
+            addr, netmask = socket.gethostbyname(network), "255.255.255.255"
+        
+        mask = struct.unpack("!I", socket.inet_aton(netmask))[0]
+        subnet = struct.unpack("!I", socket.inet_aton(addr))[0] & mask
+        
+        self.lock.acquire()
+        
+        try:
+        
+            self.networks.setdefault(mask, set()).add(subnet)
+            self.prefixes = sorted(self.networks.keys(), reverse = True)
+            self.names[(mask, subnet)] = network
+            self.counters.setdefault(network, 0)
+            
+            # Decisions already made may no longer hold.
+            self.cache.clear()
+        
+        finally:
+        
+            self.lock.release()
     
-        return self.messages.clear()
+    def accept(self, host):
     
-    def copy(self):
+        """accept = accept(self, host)
+        
+        Return whether messages from the host address given should be
+        accepted.
+        """
+        
+        try:
+        
+            name = self.cache[host]
+        
+        except KeyError:
+        
+            name = self._classify(host)
+            
+            if len(self.cache) >= ADDRESS_CACHE_SIZE:
+            
+                self.cache.clear()
+            
+            self.cache[host] = name
+        
+        self.counters[name] += 1
+        
+        return name != self.DROPPED
     
-        return self.messages.copy()
+    def _classify(self, host):
     
-    def get(self, item, default = None):
+        try:
+        
+            ip = struct.unpack("!I", socket.inet_aton(host))[0]
+        
+        except (socket.error, TypeError):
+        
+            return self.DROPPED
+        
+        if ip & self._local_mask() == Subnet:
+        
+            return self.LOCAL
+        
+        for mask in self.prefixes:
+        
+            if ip & mask in self.networks[mask]:
+            
+                return self.names[(mask, ip & mask)]
+        
+        return self.DROPPED
     
-        return self.messages(item, default)
+    def _local_mask(self):
     
-    def has_key(self, item):
+        return struct.unpack("!I", socket.inet_aton(Netmask))[0]
     
-        return item in self.messages
+    def clear(self):
     
-    def items(self):
+        """clear(self)
+        
+        Forget the decisions made for each address, such as after the
+        local network settings have changed.
+        """
+        
+        self.cache.clear()
     
-        return self.messages.items()
+    def counts(self):
     
-    def keys(self):
+        """counts = counts(self)
+        
+        Return a dictionary mapping the name of each filter, "local" for the
+        local subnet and the text given for each remote network, to the
+        number of messages it accepted, with the number of messages dropped
+        under "dropped".
+        """
+        
+        return dict(self.counters)
+
+
+class RoundTrip(object):
+
+    # The round trip time estimates and counters kept for each host.
+    __slots__ = ("srtt", "rttvar", "timeout", "samples", "requests",
+                 "retransmitted", "lost")
     
-        return self.messages.keys()
+    def __init__(self, timeout):
     
-    def popitem(self):
+        self.srtt = None
+        self.rttvar = None
+        self.timeout = timeout
+        self.samples = 0
+        self.requests = 0
+        self.retransmitted = 0
+        self.lost = 0
+
+class RoundTripTimer:
+
+    """RoundTripTimer(initial = RETRANSMIT_INITIAL, minimum = RETRANSMIT_MIN,
+                      maximum = RETRANSMIT_MAX)
     
-        return self.messages.popitem()
+    Estimate the round trip time to each host from the time taken for its
+    replies to arrive, and derive the time to wait before sending a request
+    again from the smoothed time and its variation, as described in RFC 6298.
+    Times are only measured for requests answered without being sent again,
+    and the time to wait is doubled each time a request is sent again until
+    a new measurement is made. The number of requests sent to each host, the
+    number sent again and the number never answered are counted.
+    """
     
-    def setdefault(self, item, default = None):
+    def __init__(self, initial = RETRANSMIT_INITIAL, minimum = RETRANSMIT_MIN,
+                 maximum = RETRANSMIT_MAX):
     
-        return self.messages.setdefault(item, default)
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.hosts = {}
+        self.lock = threading.Lock()
     
-    def update(self, dict):
+    def _host(self, host):
     
-        return self.messages.update(dict)
+        entry = self.hosts.get(host)
+        
+        if entry is None:
+        
+            entry = self.hosts[host] = RoundTrip(self.initial)
+        
+        return entry
     
-    def values(self):
+    def start(self, host):
     
-        return self.messages.values()
+        """timeout = start(self, host)
+        
+        Count a new request to the host given and return the time to wait
+        for a reply before sending it again.
+        """
+        
+        self.lock.acquire()
+        
+        try:
+        
+            entry = self._host(host)
+            entry.requests += 1
+            return entry.timeout
+        
+        finally:
+        
+            self.lock.release()
     
-    def append(self, hostdata):
+    def measure(self, host, rtt):
     
-        (host, data) = hostdata
-        # Take the first word of the message and store the message under
-        # that entry in the dictionary if it exists.
-        key = self.replyid2str(data[1:4])
+        """measure(self, host, rtt)
         
-        if key != "":
+        Update the estimates for the host given with the time taken for a
+        reply to a request which was only sent once.
+        """
         
-            self.lock.acquire()
-
-            try:
+        self.lock.acquire()
+        
+        try:
+        
+            entry = self._host(host)
             
-                self.messages[(host, key)].append(data)
-
-                self.lock.release()
-
-                self.signal_event(host, key)
+            if entry.srtt is None:
             
-            except KeyError:
+                entry.srtt = rtt
+                entry.rttvar = rtt / 2.0
             
-                self.lock.release()
+            else:
+            
+                entry.rttvar = 0.75 * entry.rttvar + 0.25 * abs(entry.srtt - rtt)
+                entry.srtt = 0.875 * entry.srtt + 0.125 * rtt
+            
+            entry.samples += 1
+            entry.timeout = min(max(entry.srtt + 4 * entry.rttvar,
+                                    self.minimum), self.maximum)
+        
+        finally:
+        
+            self.lock.release()
     
-    def remove(self, hostdata):
+    def back_off(self, host):
     
-        (host, data) = hostdata
-        # Take the first word of the message and remove the message from
-        # that entry in the dictionary if it exists.
-        key = self.replyid2str(data[1:4])
+        """timeout = back_off(self, host)
         
-        if key != "":
+        Count a request sent again to the host given and return the longer
+        time to wait for a reply to it.
+        """
+        
+        self.lock.acquire()
+        
+        try:
+        
+            entry = self._host(host)
+            entry.retransmitted += 1
+            entry.timeout = min(entry.timeout * 2, self.maximum)
+            return entry.timeout
+        
+        finally:
         
-            self.lock.acquire()
-
-            try:
-            
-                self.messages[(host, key)].remove(data)
-            
-            except KeyError:
-            
-                pass
-
             self.lock.release()
     
-    def add_entry(self, host, new_id):
+    def lose(self, host):
     
-        # Add a dictionary entry for expected messages with this ID.
-
+        # Count a request which was never answered.
         self.lock.acquire()
-
-        self.messages[(host, new_id)] = []
-        self.events[(host, new_id)] = threading.Event()
-
+        self._host(host).lost += 1
         self.lock.release()
     
-    def remove_entry(self, host, new_id):
+    def statistics(self):
     
-        # Remove dictionary entries for messages which are no longer valid.
-
+        """stats = statistics(self)
+        
+        Return a dictionary mapping each host to a dictionary of its
+        estimates and counters. Times are given in seconds and are None
+        until a round trip time has been measured.
+        """
+        
         self.lock.acquire()
+        
+        try:
+        
+            stats = {}
+            
+            for host, entry in self.hosts.items():
+            
+                stats[host] = dict([(name, getattr(entry, name))
+                                    for name in RoundTrip.__slots__])
+            
+            return stats
+        
+        finally:
+        
+            self.lock.release()
 
-        del self.messages[(host, new_id)]
-        del self.events[(host, new_id)]
+class _IOVec(ctypes.Structure):
 
-        self.lock.release()
+    _fields_ = [("base", ctypes.c_void_p), ("length", ctypes.c_size_t)]
 
-    def wait_for_event(self, host, new_id, delay):
+class _SockAddrIn(ctypes.Structure):
 
-        self.lock.acquire()
-
-        evt = self.events[(host, new_id)]
+    _fields_ = [
+        ("family", ctypes.c_ushort), ("port", ctypes.c_ushort),
+        ("addr", ctypes.c_ubyte * 4), ("zero", ctypes.c_ubyte * 8)
+        ]
 
-        self.lock.release()
+class _MsgHdr(ctypes.Structure):
 
-        if not evt.isSet():
+    _fields_ = [
+        ("name", ctypes.c_void_p), ("namelen", ctypes.c_uint),
+        ("iov", ctypes.POINTER(_IOVec)), ("iovlen", ctypes.c_size_t),
+        ("control", ctypes.c_void_p), ("controllen", ctypes.c_size_t),
+        ("flags", ctypes.c_int)
+        ]
 
-            evt.wait(delay)
+class _MMsgHdr(ctypes.Structure):
 
-        return evt.isSet()
+    _fields_ = [("hdr", _MsgHdr), ("length", ctypes.c_uint)]
 
-    def signal_event(self, host, new_id):
- 
-        self.lock.acquire()
 
-        self.events[(host, new_id)].set()
+class DatagramBatch:
 
-        self.lock.release()
- 
-    def _scan_messages(self, host, new_id, commands):
+    """DatagramBatch(batch = RECV_BATCH_SIZE, size = RECV_SIZE)
     
-
-        self.lock.acquire()
-
-        for data in self.messages[(host, new_id)]:
-        
-            for command in commands:
-            
-                if self.cmd2str(data[0]) == command and self.replyid2str(data[1:4]) == new_id:
-                
-                    # Remove the claimed message from the list.
-                    self.messages[(host, new_id)].remove(data)
-                    
-                    #self.data = data
-                    
-                    self.lock.release()
-
-                    # Reply indicating that valid data was received.
-                    return 1, data
-                
-            if data[:4] == "E"+new_id:
-            
-                #print('Error: "%s"' % data[8:])
-                self.messages[(host, new_id)].remove(data)
-                
-                self.lock.release()
-
-                return -1, (self.str2num(4, data[4:8]), data[8:])
-        
-        self.lock.release()
-
-        # Return a negative result.
-        return 0, (0, "The machine containing the shared disc does not respond")
+    Receive and send datagrams in batches. On Linux, recvmmsg and sendmmsg
+    are called through ctypes to move a batch of datagrams in one system
+    call, receiving them into buffers allocated once. Elsewhere, a socket is
+    drained with recvfrom_into calls into a single buffer and datagrams are
+    sent one at a time by the caller.
+    """
     
-    def _all_messages(self, host, new_id, commands):
+    # The C library, loaded when the first instance is created, or None if
+    # the calls are not available.
+    libc = False
     
-        self.lock.acquire()
-
-        try:
+    def __init__(self, batch = RECV_BATCH_SIZE, size = RECV_SIZE):
+    
+        self.batch = batch
+        self.size = size
         
-            reply_messages = self.messages[(host, new_id)]
+        if DatagramBatch.libc is False:
         
-        except KeyError:
+            DatagramBatch.libc = self._load()
         
-            reply_messages = []
+        self.libc = DatagramBatch.libc
         
-        messages = []
+        # The receive buffers are allocated when first used as only the
+        # listening thread receives datagrams.
+        self.buffer = None
+    
+    def _load(self):
+    
+        if not sys.platform.startswith("linux"):
+        
+            return None
         
-        for data in reply_messages:
+        try:
         
-            for command in commands:
+            import ctypes.util
             
-                if data[:4] == command + new_id:
-                
-                    # Remove the claimed message from the list.
-                    self.messages[(host, new_id)].remove(data)
-                    
-                    # Add it to the list of messages found.
-                    messages.append(data)
+            libc = ctypes.CDLL(
+                ctypes.util.find_library("c") or "libc.so.6", use_errno = True
+                )
+            
+            libc.recvmmsg.argtypes = [
+                ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint,
+                ctypes.c_int, ctypes.c_void_p
+                ]
+            libc.sendmmsg.argtypes = [
+                ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint,
+                ctypes.c_int
+                ]
         
-        self.lock.release()
-
-        return messages
+        except (OSError, AttributeError):
+        
+            return None
+        
+        return libc
     
-
-
-
-class ConfigError(Exception):
-
-    pass
-
-
-
-class File:
-
-    def __init__(self, path, share, user, mode="r+b"):
+    def _allocate(self):
     
-        self.pieces = []
-        self.ptr = 0
-        self.path = path
+        if self.libc is None:
         
-        # Record the current user of this file (their host).
-        self.user = user
+            self.buffer = bytearray(self.size)
+            self.view = memoryview(self.buffer)
+            return
         
-        # The share the file is stored in.
-        self.share = share
+        # Point each message header at its own part of one large buffer and
+        # at its own source address structure.
+        self.buffer = bytearray(self.batch * self.size)
+        self.view = memoryview(self.buffer)
+        self.c_buffer = (ctypes.c_char * len(self.buffer)).from_buffer(
+            self.buffer
+            )
+        base = ctypes.addressof(self.c_buffer)
         
-        if not os.path.exists(path):
+        self.iovecs = (_IOVec * self.batch)()
+        self.addresses = (_SockAddrIn * self.batch)()
+        self.messages = (_MMsgHdr * self.batch)()
         
-            if mode == "r+b":
-
-                # Create the object.
-                open(path, "wb").write("")
+        for i in range(self.batch):
         
-        # Open the file.
-        self.fh = open(path, mode)
-    
-    def tell(self):
-    
-        return self.fh.tell()
-    
-    def seek(self, ptr, from_end):
-    
-        self.fh.seek(ptr, from_end)
-    
-    def read(self, length):
-    
-        return self.fh.read(length)
-    
-    def write(self, data):
-    
-        self.fh.write(data)
-        self.fh.flush()
-    
-    def length(self):
-    
-        # Determine the actual file's length.
-        return os.path.getsize(self.path)
+            self.iovecs[i].base = base + i * self.size
+            self.iovecs[i].length = self.size
+            
+            hdr = self.messages[i].hdr
+            hdr.name = ctypes.addressof(self.addresses[i])
+            hdr.iov = ctypes.pointer(self.iovecs[i])
+            hdr.iovlen = 1
     
-    def close(self):
+    def receive(self, s):
     
-        # Ensure that no data is still to be read or written.
-        self.fh.flush()
+        """list = receive(self, socket)
         
-        # Close the file descriptor.
-        self.fh.close()
-    
-    def truncate(self, length = None):
-    
-        if length is None:
+        Return a list of (string, address) tuples for the datagrams waiting
+        on the non-blocking socket given, up to the batch size, or an empty
+        list if there are none.
+        """
         
-            length = self.fh.tell()
+        if self.buffer is None:
         
-        self.fh.truncate(length)
-
-
-class Buffer:
-
-    def __init__(self):
-    
-        self.pieces = []
-        self.ptr = 0
-        self._length = 0
-    
-    def read(self):
-    
-        # Assume data fragments in the buffer do not overlap.
-        self.pieces.sort()
+            self._allocate()
         
-        data = functools.reduce(lambda x, y: x + y[1], self.pieces, "")
+        if self.libc is None:
         
-        return data
-    
-    def write(self, data):
-    
-        self.pieces.append( (self.ptr, str(data)) )
-        self.ptr = self.ptr + len(data)
-        self._length = max(self.ptr, self._length)
-    
-    def seek(self, ptr, from_end):
-    
-        if from_end == 0:
+            return self._receive_each(s)
         
-            self.ptr = ptr
+        messages = self.messages
         
-        elif from_end == 1:
+        # The address lengths are updated by each call.
+        for i in range(self.batch):
         
-            self.ptr = self.ptr + ptr
+            messages[i].hdr.namelen = ctypes.sizeof(_SockAddrIn)
         
-        else:
+        n = self.libc.recvmmsg(
+            s.fileno(), messages, self.batch, socket.MSG_DONTWAIT, None
+            )
         
-            self.ptr = self._length - ptr
-    
-    def length(self):
-    
-        return self._length
-    
-    def set_length(self, length):
-    
-        self._length = length
-    
-    def close(self):
+        if n < 0:
+        
+            if ctypes.get_errno() == errno.ENOSYS:
+            
+                # The kernel does not provide the call, so drain the
+                # socket with recvfrom_into calls from now on.
+                self.libc = None
+                self._allocate()
+                return self._receive_each(s)
+            
+            return []
+        
+        received = []
+        
+        for i in range(n):
+        
+            start = i * self.size
+            data = self.view[start:start + messages[i].length].tobytes()
+            
+            address = self.addresses[i]
+            host = "%i.%i.%i.%i" % tuple(address.addr)
+            received.append((data, (host, socket.ntohs(address.port))))
+        
+        return received
     
-        # Do nothing.
-        return
-
-class Directory:
-
-    def __init__(self, path, share, user):
+    def _receive_each(self, s):
     
-        if not os.path.exists(path):
+        received = []
+        
+        while len(received) < self.batch:
         
             try:
             
-                os.mkdir(path)
-                os.chmod(path, share.mode | DIR_EXEC)
-                self.log(
-                    "comment",
-                    "Created %s with permissions: %s" % \
-                        (path, oct(share.mode | DIR_EXEC)),
-                    "",
-                    level = LOG_INFO
-                    )
+                n, address = s.recvfrom_into(self.buffer)
             
-            except OSError:
+            except socket.error:
             
-                pass
+                # No more datagrams are waiting.
+                break
+            
+            received.append((self.view[:n].tobytes(), address))
         
-        self.path = path
-        self.share = share
-        self.user = user
-    
-    def length(self):
-    
-        return ROS_DIR_LENGTH
+        return received
     
-    def close(self):
-    
-        pass
-
-
-
-class Unused(Common):
-
-    def _read_port(self, port):
+    def send(self, s, datagrams, to_addr):
     
-        if not self.ports.has_key(port):
+        """count = send(self, socket, datagrams, to_addr)
         
-            print("No socket to use for port %i" % port)
-            return []
+        Send the datagrams given to the address on the socket provided in as
+        few calls as possible, returning the number sent. Each datagram is a
+        string or a list of buffers to be sent together as one datagram. The
+        caller should send any remaining datagrams itself.
+        """
         
-        s = self.ports[port]
+        if self.libc is None or not datagrams:
+        
+            return 0
         
         try:
         
-            data, address = self._recvfrom(s, RECV_SIZE)
+            addr = bytearray(socket.inet_aton(to_addr[0]))
+        
+        except (socket.error, TypeError):
+        
+            return 0
+        
+        n = len(datagrams)
+        
+        name = _SockAddrIn()
+        name.family = socket.AF_INET
+        name.port = socket.htons(to_addr[1])
+        name.addr[:] = list(addr)
+        
+        parts = []
+        
+        for datagram in datagrams:
+        
+            if type(datagram) is list:
             
-            #lines = ["From: %s:%i" % address]
-            #lines = lines + self.interpret(data)
+                parts.append(datagram)
+            
+            else:
+            
+                parts.append([datagram])
         
-        except socket.error:
+        iovecs = (_IOVec * sum(map(len, parts)))()
+        messages = (_MMsgHdr * n)()
         
-            lines = []
+        # The objects giving access to the memory used by buffers, which
+        # must be kept until the datagrams are sent.
+        holders = []
+        j = 0
         
-        return lines
-    
-    def read_port(self, ports = [32770, 32771, 49171]):
-    
-        t0 = time.time()
+        for i in range(n):
         
-        log = []
+            hdr = messages[i].hdr
+            hdr.name = ctypes.addressof(name)
+            hdr.namelen = ctypes.sizeof(name)
+            hdr.iov = ctypes.pointer(iovecs[j])
+            hdr.iovlen = len(parts[i])
+            
+            for part in parts[i]:
+            
+                # The vectors point into the strings and buffers themselves,
+                # which the caller keeps until they have been sent.
+                iovecs[j].base = self._address(part, holders)
+                iovecs[j].length = len(part)
+                j += 1
         
-        try:
+        sent = 0
+        tries = 5
         
-            while 1:
+        while sent < n and tries > 0:
+        
+            count = self.libc.sendmmsg(
+                s.fileno(),
+                ctypes.cast(
+                    ctypes.addressof(messages) + sent * ctypes.sizeof(_MMsgHdr),
+                    ctypes.POINTER(_MMsgHdr)
+                    ),
+                n - sent, 0
+                )
             
-                t = int(time.time() - t0)
+            if count < 0:
+            
+                if ctypes.get_errno() != errno.EAGAIN:
                 
-                for port in ports:
+                    break
                 
-                    lines = self._read_port(port)
-                    
-                    if lines != []:
-                    
-                        for line in lines:
-                        
-                            print(line)
-                            log.append(line)
-                        
-                        print("")
-                        log.append("")
+                tries -= 1
+            
+            else:
+            
+                sent += count
         
-        except KeyboardInterrupt:
+        return sent
+    
+    def _address(self, data, holders):
+    
+        # Return the address of the contents of a string or buffer, adding
+        # any object needed to keep it valid to the list of holders.
+        if type(data) is not bytes:
         
-            pass
+            try:
+            
+                holder = (ctypes.c_char * len(data)).from_buffer(data)
+                holders.append(holder)
+                return ctypes.addressof(holder)
+            
+            except (TypeError, ValueError):
+            
+                # Copy buffers which cannot be written to.
+                data = bytes(memoryview(data).tobytes())
         
-        return log
+        holders.append(data)
+        return ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p).value
 
 
+class Ports(Common):
 
-class ShareError(Exception):
-
-    pass
-
-class PasswordError(Exception):
+    # Define a dictionary to relate port numbers to the sockets
+    # to use. Use the class attributes to ensure that these are
+    # only defined once.
+    broadcasters = {32770: None, 32771: None, 49171: None}
+    ports = {32770: None, 32771: None, 49171: None}
 
-    pass
+    # structures to handle data for select.poll() or select.select()
+    socket_poll = None
+    socket_select_rlist = None
+    
+    access_plus = None
+    
+    # Compiled structures for runs of words in messages, indexed by the
+    # number of words. Messages only hold a limited number of words, so
+    # these are kept.
+    _word_structs = {}
+    
+    # The objects used by each thread to receive and send batches of
+    # datagrams.
+    _datagram_batches = threading.local()
+    
+    # The Capture object recording messages sent and received, if any.
+    capture = None
+    
+    # The round trip times measured for requests sent to other clients.
+    round_trips = RoundTripTimer()
+    
+    def __init__(self, access_plus = 1):
+    
+        # This class is subclassed by many other classes and its
+        # functionality used by many instances, yet all share the
+        # same socket objects, therefore we must record the options
+        # set when the class is first instantiated and prevent
+        # subsequent operations from overriding them.
+        
+        if Ports.access_plus is None:
+        
+            Ports.access_plus = access_plus
+        
+        
+        try:
 
-class Translate:
+            self.socket_poll = select.poll()
 
-    present = None
-    directory = None
+        except:
 
-    def __init__(self, directory = None):
-    
-        self.directory = directory
+            self.socket_select_rlist = []
 
-        # Look for a MimeMap file in the path used to invoke this program.
-        path, _ = os.path.split(sys.argv[0])
+        # Create sockets to use for polling.
+        self._create_poll_sockets()
         
-        paths = [ "MimeMap",
-                  os.path.join(path, "MimeMap") ]
+        if Ports.access_plus == 1:
         
-        if directory is not None:
+            # Create sockets to use for listening.
+            self._create_listener_sockets()
         
-            paths.append(os.path.join(directory, os.extsep+"MimeMap"))
+        self.access_plus = access_plus
         
-        self.create_mimemap(paths)
+        # Create sockets to use for share details.
+        self._create_share_sockets()
     
-    def create_mimemap(self, paths):
+    def _set_receive_buffer(self, s):
     
-        # Compile a list of paths to check for the MimeMap file.
-        
-        f = None
-        
-        for path in paths:
+        # Ask for a larger receive buffer so that datagrams arriving from
+        # many clients at once are not dropped.
+        if RECV_BUFFER_SIZE is not None:
         
             try:
             
-                f = open(path, "r")
-                break
+                s.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE
+                    )
             
-            except IOError:
+            except socket.error:
             
-                # Loop again.
                 pass
-        
-        if f is None:
-        
-            sys.stdout.write("Failed to find MimeMap file.\n")
-            lines = []
-        
+    
+    def _unregister_socket_for_select(self, s):
+
+        if self.socket_poll != None:
+
+            try:
+                self.socket_poll.unregister(s.fileno())
+            except KeyError:
+                pass
+
+        elif s.fileno() in self.socket_select_rlist:
+
+            self.socket_select_rlist.remove(s.fileno())
+
+    def _register_socket_for_select(self, s):
+
+        if self.socket_poll != None:
+
+            self.socket_poll.register(s.fileno(), select.POLLIN)
+
         else:
+
+            self.socket_select_rlist.append(s.fileno())
+
+    def _create_poll_sockets(self):
+    
+        if self.broadcasters[32770] is None:
         
-            lines = f.readlines()
-            f.close()
-        
-        mappings = []
-        
-        # Read the lines found.    
-        for line in lines:
-        
-            # Strip leading and trailing whitespace and split the string.
-            s = line.strip()
+            self._poll_s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             
-            values = []
-            current = ""
+            # Allow the socket to broadcast packets.
+            self._poll_s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
             
-            # Ignore lines beginning with a "#" character.
-            if s[:1] == "#": continue
+            # Set the socket to be non-blocking.
+            self._poll_s.setblocking(0)
             
-            for c in s:
+            self._set_receive_buffer(self._poll_s)
             
-                if c not in string.whitespace:
-                
-                    current = current + c
-                
-                elif current != "":
-                
-                    values.append(current)
-                    current = ""
+            if sys.platform.startswith('win32'):
+
+                self._poll_s.bind((Hostaddr, 32770))
+
+            else:
+
+                self._poll_s.bind((Broadcast_addr, 32770))
             
-            if current != "":
+            Ports.broadcasters[32770] = self._poll_s
+
+            self._register_socket_for_select(Ports.broadcasters[32770])
+        
+        if self.ports[32770] is None:
+        
+            if sys.platform.startswith('win32'):
+
+                # Windows (tested with Windows XP) needs to use
+                # the same socket as the broadcaster and the listener
+                Ports.ports[32770] = Ports.broadcasters[32770]
+
+            else:
+
+                # Create a socket for listening.
+                self._poll_l = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             
-                values.append(current)
+                # Set the socket to be non-blocking.
+                self._poll_l.setblocking(0)
+                
+                self._set_receive_buffer(self._poll_l)
             
-            # The values correspond to various fields; the first is the
-            # MIME type/subtype; the second is the RISC OS name; the third
-            # is the hexadecimal value used for the filetype; the rest
-            # are the extensions to recognise:
-            if len(values) > 3:
+                self._poll_l.bind((Hostaddr, 32770))
             
-                mappings.append(
-                    { "MIME": values[0], "RISC OS name": values[1],
-                      "Hex": values[2], "Extensions": values[3:] }
-                    )
-        
-        # Store the mappings.
-        self.mimemap = mappings
-    
-    # Define dictionaries to use to translate filename.
-    to_riscos = {os.extsep: "/", " ": "\xa0", os.sep: "."}
-    from_riscos = {"/": os.extsep, "\xa0": " ", ".": os.sep}
+                Ports.ports[32770] = self._poll_l
+
+                self._register_socket_for_select(Ports.ports[32770])
     
-    def _filename(self, name, dict):
+    def _create_listener_sockets(self):
     
-        new = []
-        
-        for c in name:
+        if self.broadcasters[32771] is None:
         
-            if c in dict:
+            self._listen_s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             
-                new.append(dict[c])
+            # Allow the socket to broadcast packets.
+            self._listen_s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
             
-            else:
+            # Set the socket to be non-blocking.
+            self._listen_s.setblocking(0)
             
-                new.append(c)
-        
-        return "".join(new)
-    
-    def to_riscos_filename(self, name):
-    
-        return self._filename(name, self.to_riscos)
-    
-    def from_riscos_filename(self, name):
-    
-        return self._filename(name, self.from_riscos)
-    
-    def suffix_to_filetype(self, filename, path = None):
-    
-        # Check if the filetype is appended after a comma
-        at = filename.rfind(DEFAULT_FILETYPE_SEPARATOR)
-        filetype = None
-        
-        if sys.platform.startswith('win32'):
-
-            try:
+            self._set_receive_buffer(self._listen_s)
+            
+            if sys.platform.startswith('win32'):
 
-                if path != None:
+                self._listen_s.bind((Hostaddr, 32771))
 
-                    localpath = path + os.sep + filename
+            else:
 
-                with open(localpath + ":riscos", "r") as f:
+                self._listen_s.bind((Broadcast_addr, 32771))
+            
+            Ports.broadcasters[32771] = self._listen_s
 
-                    filetype = f.read()
-                    if at != -1:
+            self._register_socket_for_select(Ports.broadcasters[32771])
+        
+        if self.ports[32771] is None:
+        
+            if sys.platform.startswith('win32'):
 
-                        fname = filename[:at]
+                # Windows (tested with Windows XP) needs to use
+                # the same socket as the broadcaster and the listener
+                Ports.ports[32771] = Ports.broadcasters[32771]
 
-                    else:
+            else:
 
-                        fname = filename
+                # Linux either needs separate sockets for broadcaster
+                # and listener, or it needs to bind to Hostaddr ''
+                # otherwise it will totally fail to receive broadcast messages
+                # Create a socket for listening.
+                self._listen_l = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            
+                # Set the socket to be non-blocking.
+                self._listen_l.setblocking(0)
+                
+                self._set_receive_buffer(self._listen_l)
+            
+                self._listen_l.bind((Hostaddr, 32771))
+            
+                Ports.ports[32771] = self._listen_l
 
-                    return int(filetype, 16), None, self.to_riscos_filename(fname)
+                self._register_socket_for_select(Ports.ports[32771])
+    
+    def _create_share_sockets(self):
+    
+        if self.broadcasters[49171] is None:
+        
+            self._share_s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            
+            # Allow the socket to broadcast packets.
+            self._share_s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            
+            # Set the socket to be non-blocking.
+            self._share_s.setblocking(0)
+            
+            self._set_receive_buffer(self._share_s)
+            
+            if sys.platform.startswith('win32'):
 
-            except:
+                self._share_s.bind((Hostaddr, 49171))
 
-                pass
+            else:
 
-        if at != -1:
-            filetype = self.filetype
-            loadexec = None
-            # comma separated suffix
-            suffix = filename[at+len(DEFAULT_FILETYPE_SEPARATOR):]
-            hyphen = suffix.find('-')
-            try:
-
-                if len(suffix) == 3:
-                    filetype = int(suffix, 16)
-                elif hyphen != -1:
-                    load_addr = int(suffix[:hyphen], 16)
-                    exec_addr = int(suffix[hyphen+1:], 16)
-                    loadexec = (load_addr, exec_addr)
+                self._share_s.bind((Broadcast_addr, 49171))
+            
+            Ports.broadcasters[49171] = self._share_s
 
-            except:
+            self._register_socket_for_select(Ports.broadcasters[49171])
+        
+        if self.ports[49171] is None:
+        
+            if sys.platform.startswith('win32'):
 
-                # Use default values
-                pass
+                # Windows (tested with Windows XP) needs to use
+                # the same socket as the broadcaster and the listener
+                Ports.ports[49171] = Ports.broadcasters[49171]
 
-            return filetype, loadexec, self.to_riscos_filename(filename[:at])
+            else:
 
-        # Find the appropriate filetype to use for the filename given.
-        at = filename.rfind(os.extsep)
+                # Create a socket for listening.
+                self._share_l = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            
+                # Set the socket to be non-blocking.
+                self._share_l.setblocking(0)
+                
+                self._set_receive_buffer(self._share_l)
+            
+                self._share_l.bind((Hostaddr, 49171))
+            
+                Ports.ports[49171] = self._share_l
 
-        if at == -1:
+                self._register_socket_for_select(Ports.ports[49171])
+    
+    def _encode(self, l):
+    
+        """
+        string = _encode(self, list)
         
-            # No suffix: return the default filetype.
-            return self.filetype, None, self.to_riscos_filename(filename)
+        Join together the elements in the list supplied to form a string
+        which is acceptable to the other Access+ clients.
+        """
         
-        # The suffix includes the "." character. Remove this platform's
-        # separator and replace it with a ".".
-        suffix = "." + filename[at+len(os.extsep):].lower()
+        parts = []
+        words = []
         
-        # Find the suffix in the list of mappings.
-        for mapping in self.mimemap:
+        for item in l:
         
-            if suffix in mapping["Extensions"]:
+            item_type = type(item)
             
-                # Return the corresponding filetype for this suffix.
-                try:
+            if item_type is int or item_type is longtype:
+            
+                # Collect consecutive words to pack together.
+                words.append(item & 0xffffffff)
+                continue
+            
+            if words:
+            
+                parts.append(self._words(len(words)).pack(*words))
+                words = []
+            
+            if item_type is tuple:
+            
+                if item[0] == NO_PAD:
                 
-                    if self.present == "truncate":
+                    # This is a chunk of file being sent to a client.
+                    # Don't pad it
+                    data = item[1]
                     
-                        # Remove the suffix before presenting it to RISC OS.
-                        return int(mapping["Hex"], 16), \
-                            None, self.to_riscos_filename(filename)[:at]
+                    if str is bytes and type(data) is memoryview:
                     
-                    else:
+                        data = data.tobytes()
                     
-                        return int(mapping["Hex"], 16), \
-                            None, self.to_riscos_filename(filename)
-                   
-                except ValueError:
+                    parts.append(data)
+            
+            else:
+            
+                # Pad the string with zeros to fit an integer number of
+                # words. If the string is to be terminated by a particular
+                # character, it should have been included with the string.
+                if item_type is str and str is not bytes:
                 
-                    # The value found was not in a valid hexadecimal
-                    # representation. Return the default filetype.
-                    return self.filetype, \
-                        None, self.to_riscos_filename(filename)
-        
-        # Check whether the filename included a hexadecimal suffix.
-        try:
-        
-            value = int(suffix[len(os.extsep):], 16)
+                    item = item.encode("latin-1")
+                
+                parts.append(item)
+                parts.append(PADDING[len(item) & 3])
         
-        except ValueError:
+        if words:
         
-            # No mappings declared the suffix used.
-            return self.filetype, None, self.to_riscos_filename(filename)
+            parts.append(self._words(len(words)).pack(*words))
         
-        # A hexadecimal suffix was used.
-        if self.present == "truncate":
+        return b"".join(parts)
+    
+    def _words(self, n):
+    
+        # Return a compiled structure for the number of words given.
+        try:
         
-            # Remove the suffix before presenting it to RISC OS.
-            return value, None, self.to_riscos_filename(filename)[:at]
+            return Ports._word_structs[n]
         
-        else:
+        except KeyError:
         
-            return value, None, self.to_riscos_filename(filename)
+            layout = Ports._word_structs[n] = struct.Struct("<%iI" % n)
+            return layout
     
-    def filetype_to_suffix(self, filename, filetype):
+#    def _decode(self, s, format):
+#    
+#        """
+#        list = _decode(self, string, format)
+#        
+#        Extract the elements from the string supplied using the format
+#        list to a list.
+#        """
+#    
+#        output = []
+#        c = 0
+#        
+#        for i in range(0, len(format)):
+#        
+#            if type(format[i]item) == types.IntType:
+#            
+#                output.append(self.number(4, item))
+#            
+#            else:
+#            
+#                # Pad the string to fit an integer number of words.
+#                padding = 4 - (len(item) % 4)
+#                
+#                if padding == 4: padding = 0
+#                
+#                padded = item + (padding * "\000")
+#                
+#                output.append(padded)
+#        
+#        return "".join(output)
     
-        # Find the appropriate filetype to use for the filename given.
-        #at = string.rfind(filename, "/")
-        #
-        #if at != -1 and self.present == "suffix":
-        if self.present == "suffix":
-        
-            # The suffix includes the "/" character. Replace it with this
-            # platform's separator and ignore the filetype.
-            return self.from_riscos_filename(filename)
+    def _recvfrom(self, s, bufsize):
+    
+        """string, address = _recvfrom(self, socket, bufsize)
         
-        # Otherwise append a suffix to the filename to represent the
-        # filetype.
+        Receive data of maximum length given by "bufsize" from the socket in
+        a string and determine the address it originated from, filtering out
+        data from machines not on the local subnet.
+        """
         
-        # Find a choice of suffixes to use in the list of mappings.
-        suffixes = None
+        data, addr = s.recvfrom(bufsize)
         
-        for mapping in self.mimemap:
+        if self._accept_address(addr):
         
-            # Convert the MimeMap entry's filetype to a string.
-            if filetype == int(mapping["Hex"], 16):
+            capture = Ports.capture
             
-                # Return the first corresponding suffix.
-                try:
-                
-                    suffixes = mapping["Extensions"]
-                    
-                    if len(suffixes) > 0:
-                    
-                        break
-                
-                except KeyError:
-                
-                    pass
-        
-        if suffixes is not None:
-        
-            # Choose the first available suffix.
-            return self.from_riscos_filename(filename) + \
-                os.extsep + suffixes[0][1:]
+            if capture is not None:
+            
+                capture.write(time.time(), addr, s.getsockname(), data)
+            
+            return data, addr
         
-        elif sys.platform.startswith('win32'):
-
-            return self.from_riscos_filename(filename)
-
         else:
         
-            # No mappings declared the filetype used. Append a suffix
-            # containing the three digit hexadecimal filetype value to the
-            # end of the name.
-            return self.from_riscos_filename(filename) + DEFAULT_FILETYPE_SEPARATOR + \
-                "%03x" % filetype
+            return None, None
     
-    def find_relevant_file(self, path, suffix = None):
+    def _recv_batch(self, s):
     
-        """find_relevant_file(self, path, suffix = None)
-        
-        Given a path for a file without a suffix from RISC OS, find the
-        relevant file on our machine. This relies on the bodies of the
-        filenames being unique.
+        """list = _recv_batch(self, socket)
         
-        If a suffix is passed this makes the job much easier.
+        Receive the datagrams waiting on the socket, up to RECV_BATCH_SIZE of
+        them, returning a list of (string, address) tuples for those which
+        originated from machines whose data is accepted.
         """
         
-        if suffix is None:
-        
-            suffix = ""
-            
-        paths = [path + suffix, path + DEFAULT_SUFFIX, path + os.extsep + "*", path + DEFAULT_FILETYPE_SEPARATOR + "*"]
-        
-        # Look for a file with any suffix that matches
-        # the path given.
+        batch = self._datagram_batch()
+        received = []
+        capture = Ports.capture
+        t = time.time()
         
-        path = None
+        for data, addr in batch.receive(s):
         
-        for path in paths:
-        
-            files = glob.glob(path)
+            if self._accept_address(addr):
             
-            if len(files) == 1:
-            
-                # Unique match
-                return files[0]
+                if capture is not None:
+                
+                    capture.write(t, addr, s.getsockname(), data)
+                
+                received.append((data, addr))
         
-        return None
+        return received
     
-    def construct_directory_name(self, elements):
+    def _datagram_batch(self):
     
-        built = ""
+        batch = getattr(Ports._datagram_batches, "batch", None)
         
-        for element in elements:
+        if batch is None:
         
-            built = os.path.join(built, element)
+            batch = Ports._datagram_batches.batch = DatagramBatch()
         
-        return built
+        return batch
     
-    def read_mode(self, path):
+    def _accept_address(self, addr):
     
-        """mode = read_mode(self, path)
+        """accept = _accept_address(self, address)
         
-        Return the access mode for the path given or None if the path is
-        invalid.
+        Return whether data from the address given should be accepted,
+        filtering out data from machines not on the local subnet or on one
+        of the remote networks added with fwaddnet.
         """
         
-        try:
-        
-            return os.stat(path)[os.path.stat.ST_MODE]
-        
-        except OSError:
-        
-            return None
+        return self.address_filter.accept(addr[0])
     
-    def to_riscos_access(self, mode = None, path = None):
+    def _send_list(self, l, s, to_addr):
     
-        """word = to_riscos_access(self, mode = None, path = None)
-        
-        Return a word representing the RISC OS access flags roughly
-        equivalent to the read, write and execute flags for a local file,
-        given as an octal number in integer form.
-        
-        If a path is given then its mode is determined and used instead.
+        """send_list(self, list, socket, to_addr)
         
-        If no valid mode value can be determined then 0o444 is used.
+        Encode the list as a string suitable for other Access+ clients
+        using the _encode method then send it on the socket provided.
         """
         
-        if path is not None:
-        
-            mode = self.read_mode(path)
+        self.log("sent", l, to_addr, level = LOG_PROTOCOL)
         
-        if mode is None:
+        parts = self._scatter(l)
         
-            mode = 0o444
+        # Record the time before sending so that replies are never captured
+        # before the messages they answer.
+        if parts is None:
         
-        # Owner permissions
-        owner_read = (mode & os.path.stat.S_IRUSR) != 0
-        owner_write = ((mode & os.path.stat.S_IWUSR) != 0) << 1
-        owner_execute = ((mode & os.path.stat.S_IXUSR) != 0) << 2
+            data = self._encode(l)
+            t = time.time()
+            sent = self._sendto(data, s, to_addr)
         
-        owner = owner_read | owner_write | owner_execute
+        else:
         
-        # Ignore group permissions.
+            t = time.time()
+            sent = self._sendmsg(parts, s, to_addr)
         
-        # Permissions for others
-        others_read = ((mode & os.path.stat.S_IROTH) != 0) << 4
-        others_write = ((mode & os.path.stat.S_IWOTH) != 0) << 5
-        #others_execute = (mode & os.path.stat.S_IXOTH) != 0
+        capture = Ports.capture
         
-        others = others_read | others_write
+        if sent and capture is not None:
         
-        return owner | others
+            if parts is not None:
+            
+                data = self._join_parts(parts)
+            
+            capture.write(t, s.getsockname(), to_addr, data)
     
-    def from_riscos_access(self, word):
+    def _scatter(self, l, size = SCATTER_SIZE):
     
-        """mode = from_riscos_access(self, word)
+        """parts = _scatter(self, list, size = SCATTER_SIZE)
         
-        Return a mode value representing the read, write and execute flags
-        for a local file, given as an octal number in integer form roughly
-        equivalent to the RISC OS access flags.
+        Encode the list given as a list of parts to be sent together in one
+        datagram, leaving unpadded data of at least the size given in the
+        buffers holding it rather than copying it. Return None if there is
+        no such data in the list.
         """
         
-        # Owner permissions
-        owner_read = ((word & 0x01) != 0) * os.path.stat.S_IRUSR
-        owner_write = ((word & 0x02) != 0) * os.path.stat.S_IWUSR
-        owner_execute = ((word & 0x04) != 0) * os.path.stat.S_IXUSR
+        parts = None
+        start = 0
         
-        owner = owner_read | owner_write | owner_execute
+        for i in range(len(l)):
         
-        # Permissions for others
-        others_read = ((word & 0x10) != 0) * os.path.stat.S_IROTH
-        others_write = ((word & 0x20) != 0) * os.path.stat.S_IWOTH
+            item = l[i]
+            
+            if type(item) is tuple and item[0] == NO_PAD and \
+               len(item[1]) >= size:
+            
+                if parts is None:
+                
+                    parts = []
+                
+                if start < i:
+                
+                    parts.append(self._encode(l[start:i]))
+                
+                parts.append(item[1])
+                start = i + 1
         
-        others = others_read | others_write
+        if parts is not None and start < len(l):
         
-        # Group permissions
-        group = others
+            parts.append(self._encode(l[start:]))
         
-        return owner | group | others
+        return parts
     
-    def repr_mode(self, mode):
+    def _join_parts(self, parts):
     
-        """string = repr_mode(self, mode)
+        # Return the parts of a datagram joined together.
+        return b"".join([
+            type(part) is memoryview and part.tobytes() or bytes(part)
+            for part in parts
+            ])
+    
+    def _send_datagrams(self, datagrams, s, to_addr):
+    
+        """_send_datagrams(self, datagrams, socket, to_addr)
         
-        Returns a string showing the access permissions for a file, given
-        as an octal number in integer form.
+        Send the encoded messages given to the address on the socket
+        provided, passing them to the system together where sendmmsg is
+        available. Each message is a string or a list of parts returned by
+        the _scatter method.
         """
         
-        # Use shortcuts to construct a string with as little code as
-        # possible.
+        t = time.time()
         
-        # Owner permissions
-        ow_r = ["-", "r"][(mode & os.path.stat.S_IRUSR) != 0]
-        ow_w = ["-", "w"][(mode & os.path.stat.S_IWUSR) != 0]
-        ow_e = ["-", "x"][(mode & os.path.stat.S_IXUSR) != 0]
+        count = self._datagram_batch().send(s, datagrams, to_addr)
+        capture = Ports.capture
         
-        owner = ow_r + ow_w + ow_e
+        for i in range(len(datagrams)):
         
-        # Group permissions.
-        g_r = ["-", "r"][(mode & os.path.stat.S_IRGRP) != 0]
-        g_w = ["-", "w"][(mode & os.path.stat.S_IWGRP) != 0]
-        g_e = ["-", "x"][(mode & os.path.stat.S_IXGRP) != 0]
+            data = datagrams[i]
+            
+            # Send any messages which could not be sent together.
+            if type(data) is list:
+            
+                sent = i < count or self._sendmsg(data, s, to_addr)
+                
+                if sent and capture is not None:
+                
+                    data = self._join_parts(data)
+            
+            else:
+            
+                sent = i < count or self._sendto(data, s, to_addr)
+            
+            if sent and capture is not None:
+            
+                capture.write(t, s.getsockname(), to_addr, data)
+    
+    def _sendmsg(self, parts, s, to_addr):
+    
+        # Send the parts of a datagram without joining them where the socket
+        # supports it, trying again a few times if the socket's buffer is
+        # full, and return whether it was sent.
+        if not hasattr(s, "sendmsg"):
         
-        group = g_r + g_w + g_e
+            return self._sendto(self._join_parts(parts), s, to_addr)
         
-        # Permissions for others
-        ot_r = ["-", "r"][(mode & os.path.stat.S_IROTH) != 0]
-        ot_w = ["-", "w"][(mode & os.path.stat.S_IWOTH) != 0]
-        ot_e = ["-", "x"][(mode & os.path.stat.S_IXOTH) != 0]
+        count = 5
         
-        others = ot_r + ot_w + ot_e
+        while count > 0:
         
-        return owner + group + others
+            try:
+            
+                s.sendmsg(parts, [], 0, to_addr)
+                return True
+            
+            except socket.error as excpt:
+            
+                if excpt.errno != errno.EAGAIN:
+                
+                    break
+                
+                count -= 1
+            
+            except:
+            
+                break
+        
+        return False
     
-    def to_riscos_objtype(self, path):
+    def _sendto(self, data, s, to_addr):
     
-        if not os.path.exists(path):
+        # Send the data, trying again a few times if the socket's buffer is
+        # full, and return whether it was sent.
+        sent = False
+        count = 5
         
-            return 0
+        while sent == False and count > 0:
+
+            try:
+
+                s.sendto(data, to_addr)
+                sent = True
+
+            except socket.error as excpt:
+
+                if excpt.errno == errno.EAGAIN or \
+                    (sys.platform.startswith('win32') and excpt.errno == errno.WSAEWOULDBLOCK):
+
+                    count -= 1
+
+                else:
+
+                    break
+
+            except:
+
+                break
         
-        elif os.path.isfile(path):
+        return sent
+    
+    def _send_and_expect_reply(self, _socket, msg, host, new_id, commands,
+                      tries = 5, delay = 1.0):
+    
+        # Add an entry to the Messages object so that replies to this message
+        # can be collected rather than being discarded. This requires that
+        # the derived class has an attribute called "share_messages" which
+        # refers to a Messages instance. Reuse an entry held by the caller
+        # for a series of messages with the same ID so that replies which
+        # arrive between them are kept.
+        held = (host, new_id) in self.share_messages.messages
         
-            return 0x0101
+        if not held:
         
-        elif os.path.isdir(path):
+            self.share_messages.add_entry(host, new_id)
         
-            return 0x2
+        # Wait for a reply for a time based on the round trip times measured
+        # for the host, giving up after the time allowed for all the tries.
+        timer = Ports.round_trips
+        timeout = timer.start(host)
         
-        else:
+        # Send the request.
+        t0 = time.time()
+        self._send_list(msg, _socket, (host, 49171))
         
-            return 0
+        if held:
+        
+            # Look for replies which arrived before this message was sent.
+            self.share_messages.signal_event(host, new_id)
+
+        replied = 0
+        retransmitted = False
+        resend_time = t0 + timeout
+        end_time = t0 + tries * delay
+        
+        while 1:
+        
+            now = time.time()
+            
+            if now >= end_time:
+            
+                break
+            
+            if self.share_messages.wait_for_event(
+                host, new_id, min(resend_time, end_time) - now):
+
+                # See if the response has arrived.
+                replied, data = \
+                    self.share_messages._scan_messages(host, new_id, commands)
+
+                # If a message was found or an error occurred then return
+                # immediately.
+                if replied != 0:
+                
+                    # Only measure the round trip time if the request was
+                    # sent once, since a reply to a request sent again could
+                    # be for either copy.
+                    if not retransmitted:
+                    
+                        timer.measure(host, time.time() - t0)
+            
+                    # Remove the entry in the Messages object for replies to this
+                    # message.
+                    if not held:
+                    
+                        self.share_messages.remove_entry(host, new_id)
+                
+                    return replied, data
+
+            elif time.time() < end_time:
+            
+                # Send the request again, waiting longer for a reply.
+                self._send_list(msg, _socket, (host, 49171))
+                
+                retransmitted = True
+                resend_time = time.time() + timer.back_off(host)
+        
+        timer.lose(host)
+        
+        # Remove the entry in the Messages object for replies to this
+        # message.
+        if not held:
+        
+            self.share_messages.remove_entry(host, new_id)
+        
+        # Return a negative result.
+        return 0, (0, "The machine containing the shared disc does not respond")
     
-    def from_riscos_path(self, ros_path, find_obj = 1):
+    def new_id(self):
     
-        # Construct a path to the object below the shared directory.
-        path = self.from_riscos_filename(ros_path)
+        if not hasattr(self, "_id"):
         
-        # Append this path to the shared directory's path.
-        path = os.path.join(self.directory, path)
+            self._id = 1
         
-        if find_obj == 1:
+        else:
         
-            # Look for a suitable file.
-            path = self.find_relevant_file(path)
+            self._id = self._id + 0x1001
+            if self._id > 0xffffff:
+                self._id = 1
         
-        return path
+        return "%s" % (self.replyid2str(self.number(3, self._id)))
     
-    def read_path_info(self, path, Need_handle = 0):
+    def _send_request(self, msg, host, commands, new_id = None, tries = 5,
+                      delay = 1.0):
     
-        handle = None
-
-        # Determine the file's relevant filetype and
-        # date words.
-        filetype, date = self.make_riscos_filetype_date(path)
+        """replied, data = _send_reqest(self, msg)
         
-        # Find the length of the file.
-        if os.path.isdir(path):
+        Send a message via the non-broadcast share port to a remote client
+        and wait for a reply.
+        """
+        # Use the non-broadcast socket.
+        if not 49171 in self.ports:
         
-            length = ROS_DIR_LENGTH
+            print("No socket to use for port %i" % 49171)
+            return 0, []
         
-        else:
+        s = self.ports[49171]
         
-            length = os.path.getsize(path)
+        if new_id is None:
         
-        # Construct access attributes for the other client.
-        access_attr = self.to_riscos_access(path = path)
+            # Use a new ID for this message.
+            new_id = self.new_id()
         
-        # Use a default value for the object type.
-        object_type = self.to_riscos_objtype(path = path)
+        # Create the command to send. The three bytes following the
+        # command character are used to identify the response from the
+        # other client (it passes them back in its response).
+        msg[0] = msg[0] + new_id
         
-        if Need_handle == 1:
-            handle = get_next_handle()
-
-        return filetype, date, length, access_attr, object_type, handle
+        # Wait for a reply.
+        replied, data = \
+            self._send_and_expect_reply(s, msg, host, new_id, commands, tries, delay)
+        
+        #if replied == 1:
+        #
+        #    self.log("received", data, (host, 49171))
+        #
+        #else:
+        #
+        #    # The data value is a tuple if an error occurs.
+        #    self.log("received", data[1], (host, 49171))
+        
+        return replied, data
+    
+    def log(self, direction, data, address, level = 0):
+    
+        if DEBUG == 0: return
+        if LOG_LEVEL > level: return
+        
+        if direction[0] in "sr":
+        
+            # Encode messages now as the lists describing them, and the
+            # buffers holding them, may be reused. They are interpreted
+            # when they are written.
+            if type(data) == list:
+            
+                data = self._encode(data)
+            
+            elif type(data) == str and str is not bytes:
+            
+                data = data.encode("latin-1")
+            
+            elif type(data) != bytes:
+            
+                data = bytes(data)
+        
+        Log.record(direction, data, address)
     
+    def write_log(self, path = None):
+    
+        # Write any queued records to the log file.
+        Log.flush()
 
 
-class Share(Ports, Translate):
 
-    """Share
+class HandleError(Exception):
+
+    pass
+
+class HandleTable:
+
+    """HandleTable(tag = 0, capacity = 1 << HANDLE_SLOT_BITS)
     
-    A class encapsulating a share on a local or remote machine.
+    Map the file handles given to other clients to the File and Directory
+    objects they refer to. Each handle holds the index of a slot in the
+    table, a tag identifying the process which allocated it and a generation
+    count which is incremented each time the slot is reused, so that a stale
+    handle is not mistaken for a new one. Free slots are kept on a list, so
+    handles are allocated, freed and looked up in constant time, and the
+    handles used by each host are indexed so that they can be released
+    together when the host goes away.
     """
     
-
-    def __init__(self, name, directory, mode, delay, present, filetype, key,
-                 share_type, file_handler):
+    # The value of a slot which has been allocated but not yet given an
+    # object.
+    RESERVED = object()
     
-        # Call the initialisation methods of the base classes.
-        Ports.__init__(self)
-        Translate.__init__(self, directory = directory)
+    def __init__(self, tag = 0, capacity = 1 << HANDLE_SLOT_BITS):
+    
+        self.tag = tag
+        self.capacity = capacity
         
-        # Keep a reference to the parent objects file handler.
-        self.file_handler = file_handler
+        # The object and current handle for each slot, the free slots and
+        # the set of handles used by each host.
+        self.objects = []
+        self.handles = []
+        self.free = []
+        self.hosts = {}
+        self.used = 0
+        self.lock = threading.Lock()
         
-        self.share_type = share_type
-        if key != 0:
-            self.share_type = SHARE_TYPE_DIRECTORY
-
-        # Determine the protected flag to broadcast by examining the
-        # other users write bit.
-        if (mode & os.path.stat.S_IWOTH) == 0:
+        # Counters for the statistics.
+        self.allocated = 0
+        self.released = 0
+        self.exhausted = 0
+        self.peak = 0
+    
+    def allocate(self):
+    
+        """handle = allocate(self)
         
-            if self.share_type == SHARE_TYPE_NORMAL or self.share_type == SHARE_TYPE_DIRECTORY:
-                self.share_type |= SHARE_TYPE_PROTECTED
-            self.read_mask = PROTECTED_READ
-            self.write_mask = PROTECTED_WRITE
+        Reserve a slot and return its handle, raising HandleError if all the
+        slots are in use. The handle should be given an object or freed.
+        """
         
-        else:
+        self.lock.acquire()
         
-            self.read_mask = UNPROTECTED_READ
-            self.write_mask = UNPROTECTED_WRITE
+        try:
         
-        # Determine the current time to use for the date of creation.
-        date = time.localtime(time.time())
+            if self.free:
+            
+                slot = self.free.pop()
+                generation = (self.handles[slot] >> HANDLE_GENERATION_SHIFT) \
+                             % HANDLE_GENERATIONS + 1
+            
+            elif len(self.objects) < self.capacity:
+            
+                slot = len(self.objects)
+                self.objects.append(None)
+                self.handles.append(0)
+                generation = 1
+            
+            else:
+            
+                self.exhausted += 1
+                raise HandleError("All file handles are in use")
+            
+            handle = (generation << HANDLE_GENERATION_SHIFT) | \
+                     (self.tag << HANDLE_SLOT_BITS) | slot
+            
+            self.handles[slot] = handle
+            self.objects[slot] = self.RESERVED
+            self.used += 1
+            self.allocated += 1
+            self.peak = max(self.peak, self.used)
+            
+            return handle
         
-        # Record the relevant information about the share.
+        finally:
         
-        self.name = name
-        self.directory = directory
-        self.date = date
-        self.mode = mode
-        self.present = present
-        self.filetype = filetype
-        self.delay = delay
-        self.key = key
+            self.lock.release()
+    
+    def _slot(self, handle):
+    
+        # Return the slot used by a handle which is in use, or raise
+        # KeyError.
+        try:
         
-        # The filetype of the share directory itself.
-        self.share_filetype = 0xfcd
+            slot = handle & HANDLE_SLOT_MASK
+            
+            if self.handles[slot] == handle and self.objects[slot] is not None:
+            
+                return slot
         
-        # Convert the share's mode mask to a file attribute mask.
-        self.access_attr = self.to_riscos_access(mode = mode)
+        except (IndexError, TypeError):
         
-        # Create an event to use to inform the share that it must be
-        # removed.
-        self.event = threading.Event()
+            pass
         
-        # Create a thread to run the share broadcast loop.
-        self.thread = threading.Thread(
-            group = None, target = self.broadcast_share,
-            name = 'Share "%s"' % self.name
-            )
+        raise KeyError(handle)
+    
+    def __getitem__(self, handle):
+    
+        obj = self.objects[self._slot(handle)]
         
-        # Start the thread.
-        self.thread.start()
+        if obj is self.RESERVED:
+        
+            raise KeyError(handle)
+        
+        return obj
     
-    def cleanup_handles(self, host):
-
-        for handle in self.file_handler.keys():
- 
-            if self.file_handler[handle].user == host:
-
-                self.file_handler[handle].close()
-                del self.file_handler[handle]
-
-    def get_key(self):
-        return self.key
-
-    def _send_secure_share(self, dest):
-
-        if self.get_key() == 0:
-            return
-
-        if not 32771 in self.ports:
+    def __setitem__(self, handle, obj):
+    
+        self.lock.acquire()
         
-            print("No socket to use for port %i" % 32771)
-            return
+        try:
         
-        s = self.ports[32771]
+            slot = self._slot(handle)
+            self._unindex(handle, self.objects[slot])
+            self.objects[slot] = obj
+            self.hosts.setdefault(getattr(obj, "user", None), set()).add(handle)
         
-        shrtype = ""
-
-        # If the share is a username@host share, then append the share_type
-        # to the share name, otherwise leave the share_type off.
-        if '@' in self.name:
-
-            shrtype = chr(self.share_type)
-
-        data = \
-        [
-            0x00010004, 0x00010001, 0x00010000 | len(self.name),
-            self.get_key(),
-            self.name + shrtype
-        ]
+        finally:
         
-        self._send_list(data, s, dest)
-
-    def broadcast_share(self):
+            self.lock.release()
     
-        """broadcast_share(self)
+    def __delitem__(self, handle):
+    
+        self.free_handle(handle)
+    
+    def __contains__(self, handle):
+    
+        try:
         
-        Broadcast the availability of a share every few seconds.
-        """
+            return self.objects[self._slot(handle)] is not self.RESERVED
         
-        # Broadcast the availability of the share on the polling socket.
+        except KeyError:
         
-        if self.key != 0:
-            return
-
-        if not 32770 in self.broadcasters:
+            return False
+    
+    has_key = __contains__
+    
+    def __len__(self):
+    
+        return sum([len(handles) for handles in self.hosts.values()])
+    
+    def _unindex(self, handle, obj):
+    
+        if obj is None or obj is self.RESERVED:
         
-            print("No socket to use for port %i" % 32770)
             return
         
-        s = self.broadcasters[32770]
-        
-        data = \
-        [
-            0x00010002, 0x00010000, 0x00010000 | len(self.name),
-            self.name + chr(self.share_type)
-        ]
-        
-        self._send_list(data, s, (Broadcast_addr, 32770))
+        host = getattr(obj, "user", None)
+        handles = self.hosts.get(host)
         
-        # Advertise the share on the share socket.
+        if handles is not None:
         
-        if not 49171 in self.broadcasters:
+            handles.discard(handle)
+            
+            if not handles:
+            
+                del self.hosts[host]
+    
+    def free_handle(self, handle):
+    
+        """free_handle(self, handle)
         
-            print("No socket to use for port %i" % 49171)
-            return
+        Release the handle given, whether or not it has been given an
+        object, so that its slot can be reused. Raise KeyError if the handle
+        is not in use.
+        """
         
-        s = self.broadcasters[49171]
+        self.lock.acquire()
         
-        # Create a string to send.
-        data = [0x00000046, 0x00000013, 0x00000000]
+        try:
         
-        # Broadcast a notification to other clients.
+            slot = self._slot(handle)
+            self._unindex(handle, self.objects[slot])
+            self.objects[slot] = None
+            self.free.append(slot)
+            self.used -= 1
+            self.released += 1
         
-        for i in range(0, 5):
+        finally:
         
-            self._send_list(data, s, (Broadcast_addr, 49171))
-            
-            time.sleep(1)
+            self.lock.release()
+    
+    def get(self, handle, default = None):
+    
+        try:
         
-        # Remind other clients of the availability of this share.
+            return self[handle]
         
-        s = self.broadcasters[32770]
+        except KeyError:
         
-        data = \
-        [
-            0x00010004, 0x00010000, 0x00010000 | len(self.name),
-            self.name + chr(self.share_type)
-        ]
+            return default
+    
+    def host_handles(self, host):
+    
+        """handles = host_handles(self, host)
         
-        if self.key != 0:
-            # We only want to broadcast the secure share once
-            return
-
-        while 1:
+        Return a list of the handles used by the host given.
+        """
         
-            self._send_list(data, s, (Broadcast_addr, 32770))
-            
-            self.event.wait(self.delay)
-            if self.event.isSet():
-                break
+        return list(self.hosts.get(host, ()))
+    
+    def items(self):
+    
+        return [(handle, self[handle]) for handle in self.keys()]
+    
+    def keys(self):
+    
+        handles = []
         
-        # Broadcast that the share has now been removed.
+        for host_handles in list(self.hosts.values()):
         
-        s = self.broadcasters[32770]
+            handles.extend(host_handles)
         
-        data = \
-        [
-            0x00010003, 0x00010000, 0x00010000 | len(self.name),
-            self.name + chr(self.share_type)
-        ]
-
-        self._send_list(data, s, (Broadcast_addr, 32770))
+        return handles
     
-    #def notify_share_users(self, 
+    def values(self):
     
-    def descend_path(self, path, names = None, share_check_mode = 0, check_mode = PROTECTED_READ):
+        return [obj for handle, obj in self.items()]
     
-        """path = descend_path(self, path, names = None)
-        
-        Descend the path as far as the share's access attributes will allow.
-        If this is not far enough then return None.
+    def statistics(self):
+    
+        """statistics = statistics(self)
         
-        Similarly, if the path takes us outside the share then return None.
-
-        check_mode is the permissions that the file needs
-        share_check_mode is the permissions that the share needs
-
-        check_mode and share_check_mode are usually the same, but can be
-        different for operations that change a file's metadata
+        Return a dictionary containing the number of slots in the table
+        ("capacity"), the number of handles in use ("open"), the number
+        allocated but not given an object, which may have leaked
+        ("reserved"), the largest number in use at once ("peak"), the
+        numbers allocated and released so far ("allocated" and "released"),
+        the number of allocations which failed because all the slots were
+        in use ("exhausted") and a dictionary of the number of handles used
+        by each host ("hosts").
         """
         
-        if names is None: names = []
+        self.lock.acquire()
         
-        if path == self.directory:
+        try:
         
-            mode = self.read_mode(self.directory)
-            if share_check_mode == 0:
+            hosts = {}
+            
+            for host, handles in self.hosts.items():
+            
+                hosts[host] = len(handles)
+            
+            open_handles = sum(hosts.values())
+            
+            return {
+                "capacity": self.capacity, "open": open_handles,
+                "reserved": self.used - open_handles, "peak": self.peak,
+                "allocated": self.allocated, "released": self.released,
+                "exhausted": self.exhausted, "hosts": hosts
+                }
+        
+        finally:
+        
+            self.lock.release()
 
-                share_check_mode = check_mode
 
-            if mode is None or (mode & share_check_mode & self.mode) == 0:
+class Transfer(object):
 
-                return self.directory, None 
- 
-            return self.directory, names
+    # A transfer of a file to or from another client, run by a thread or
+    # a coroutine once the TransferScheduler allows it.
+    __slots__ = ("path", "host", "key", "exclusive", "event", "steps",
+                 "name", "size", "runner")
+    
+    def __init__(self, path, host, key, exclusive, event, steps, name,
+                 size = 0):
+    
+        self.path = path
+        self.host = host
+        self.key = key
+        self.exclusive = exclusive
+        self.event = event
+        self.steps = steps
+        self.name = name
+        self.size = size
+        self.runner = None
+
+class TransferScheduler:
+
+    """TransferScheduler(per_host = None)
+    
+    Decide when each transfer involving a path can run. Transfers which only
+    read a path run alongside each other while those which change it run
+    alone, in the order they were requested. A transfer with the same key as
+    one which is waiting or running, such as a request sent again by a
+    client, is ignored. If a number of transfers per host is given then each
+    host can only run that many at once, and waiting transfers are started
+    for the hosts running the fewest transfers first. By default, the
+    number given by TRANSFERS_PER_HOST is used.
+    """
+    
+    def __init__(self, per_host = None):
+    
+        if per_host is None:
         
-        # Split the path into two parts.
-        path1, path2 = os.path.split(path)
+            per_host = TRANSFERS_PER_HOST
         
-        # Recurse with a path and a list of names to descend into.
-        path, names = self.descend_path(path1, [path2] + names, share_check_mode = share_check_mode, check_mode = check_mode)
+        self.per_host = per_host
         
-        # Try to descend the directory structure.
+        # Transfers waiting to run in the order they were requested, the
+        # transfers running for each path and the number for each host.
+        self.waiting = []
+        self.running = {}
+        self.hosts = {}
         
-        # If there are no names to add to the path then just return the path
-        # and an empty list.
-        if names == [] or names == None:
+        # Map keys to waiting and running transfers.
+        self.keys = {}
         
-            return path, []
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.counters = {"started": 0, "queued": 0, "coalesced": 0}
+    
+    def submit(self, transfer, start):
+    
+        """accepted = submit(self, transfer, start)
         
-        # Join the first name to the path.
-        next_path = os.path.join(path, names[0])
+        Add a transfer, calling the start function with each transfer which
+        can then run. Return False if the transfer was ignored.
+        """
         
-        mode = self.read_mode(next_path)
+        self.lock.acquire()
         
-        if mode is None or (mode & check_mode & self.mode) == 0:
+        try:
         
-            # We cannot read this object. Return the unextended path and the
-            # names which were not added.
-            return path, names
+            if self.stopped or (transfer.key is not None and
+                                transfer.key in self.keys):
+            
+                self.counters["coalesced"] += 1
+                return False
+            
+            if transfer.key is not None:
+            
+                self.keys[transfer.key] = transfer
+            
+            self.waiting.append(transfer)
+            ready = self._ready()
+            
+            if transfer not in ready:
+            
+                self.counters["queued"] += 1
         
-        # We can read this object so return the combined path and a shortened
-        # list of names.
-        return next_path, names[1:]
+        finally:
+        
+            self.lock.release()
+        
+        for item in ready:
+        
+            start(item)
+        
+        return True
     
-    def open_path(self, ros_path, host, mode):
+    def finish(self, transfer, start):
     
-        self.log("comment", "Original path: %s" % ros_path, "", level = LOG_API)
+        """finish(self, transfer, start)
         
-        # Convert the RISC OS style path to a path within the share.
-        path = self.from_riscos_path(ros_path)
+        Remove a transfer which has finished, calling the start function with
+        each waiting transfer which can then run.
+        """
         
-        if ros_path == "":
+        self.lock.acquire()
         
-            # Check the permissions of the share
-            path, rest = self.descend_path(self.directory, check_mode = self.read_mask)
-            if rest == None:
-                return None, path
-
-            # Return information about the share itself.
-            cs = self.to_riscos_time()
-            
-            filetype_word, date_word = \
-                self._make_riscos_filetype_date(self.share_filetype, cs)
+        try:
+        
+            running = self.running.get(transfer.path, [])
             
-            # Mask the access attributes of this file with the share's access
-            # mask.
-            access_attr = self.access_attr
+            if transfer in running:
             
-            # Set the filetype to be a share (0xfcd), the date as
-            # the time when the share was added, the length as
-            # a standard value, the access attributes are
-            # converted from the mode value given and the object
-            # type as a standard value.
-            return [ filetype_word, date_word, ROS_DIR_LENGTH, access_attr,
-                     0x102, 0], path
-
-        self.log("comment", "Open path: %s" % path, "", level = LOG_API)
+                running.remove(transfer)
+                self.hosts[transfer.host] -= 1
+                
+                if not running:
+                
+                    del self.running[transfer.path]
+                
+                if not self.hosts[transfer.host]:
+                
+                    del self.hosts[transfer.host]
+            
+            if self.keys.get(transfer.key) is transfer:
+            
+                del self.keys[transfer.key]
+            
+            ready = self._ready()
         
-        # Find whether the directory structure can be legitimately descended.
-        if path is not None:
+        finally:
         
-            path, rest = self.descend_path(path, check_mode = self.read_mask)
-            
-            if rest != []: path = None
+            self.lock.release()
         
-        if path is not None and os.path.isdir(path):
+        for item in ready:
         
-            # A directory
-            
-            filetype, date, length, access_attr, object_type, handle = \
-                self.read_path_info(path, Need_handle = 1)
-            
-            # Keep this handle for possible later use.
-            if not self.file_handler.has_key(handle):
-            
-                self.file_handler[handle] = Directory(path, self, host)
-            
-            else:
-            
-                # It may be necessary to report an error that the handle
-                # is in use.
-                pass
-            
-            return [ filetype, date, length, access_attr, object_type,
-                     handle ], path
+            start(item)
+    
+    def _ready(self):
+    
+        # Move the waiting transfers which can now run to the running ones
+        # and return them.
+        ready = []
         
-        elif path is not None and os.path.isfile(path):
+        while not self.stopped:
         
-            # A file
-            
-            filetype, date, length, access_attr, object_type, \
-                handle = self.read_path_info(path, Need_handle = 1)
+            chosen = None
+            seen = set()
             
-            # Keep this handle for possible later use.
-            if not self.file_handler.has_key(handle):
-            
-                try:
-
-                    self.file_handler[handle] = File(path, self, host, mode = mode)
-
-                except IOError:
-
-                    pass
-            
-            else:
+            for transfer in self.waiting:
             
-                # It may be necessary to report an error that the handle
-                # is in use.
-                fh = self.file_handler[handle]
+                # Only the first transfer waiting for each path can run.
+                if transfer.path in seen:
                 
-                if fh.user == host:
+                    continue
                 
-                    # Use the file object's length, if possible.
-                    length = fh.length()
+                seen.add(transfer.path)
                 
-                else:
+                running = self.running.get(transfer.path)
                 
-                    # If the current user is not the one recorded then
-                    # return an error.
-                    return None, path
+                if running and (transfer.exclusive or running[0].exclusive):
+                
+                    continue
+                
+                count = self.hosts.get(transfer.host, 0)
+                
+                if self.per_host and count >= self.per_host:
+                
+                    continue
+                
+                if chosen is None or count < self.hosts.get(chosen.host, 0):
+                
+                    chosen = transfer
             
-            if not self.file_handler.has_key(handle):
-
-                return None, path
-
-            return [ filetype, date, length, access_attr, object_type,
-                     handle ], path
-        
-        else:
+            if chosen is None:
+            
+                break
+            
+            self.waiting.remove(chosen)
+            self.running.setdefault(chosen.path, []).append(chosen)
+            self.hosts[chosen.host] = self.hosts.get(chosen.host, 0) + 1
+            self.counters["started"] += 1
+            ready.append(chosen)
         
-            # Reply with an error message.
-            return None, path
+        return ready
     
-    def create_file(self, ros_path, host):
+    def stop(self):
     
-        # Try to open the corresponding file.
-        info, path = self.open_path(ros_path, host, "r+b")
-        
-        if ros_path == "":
-        
-            # The share itself is being referenced.
-            return None, path
+        """running = stop(self)
         
-        if info is None:
+        Discard the transfers which are waiting, prevent any more from
+        running, and return those which are running.
+        """
         
-            # No file exists at this path.
-            
-            # Determine whether the parent directory of the file can be written
-            # to.
-            
-            # Construct a path to the object below the shared directory.
-            path = self.from_riscos_path(ros_path, find_obj = 0)
-            
-            parent_path, file = os.path.split(path)
-            
-            write_path, rest = self.descend_path(
-                parent_path, check_mode = self.write_mask
-                )
-            
-            # Return an error value if it can't.
-            if rest != []: return None, write_path
-            
-            try:
-            
-                # Create an object on the local filesystem.
-                if self.present == "truncate":
-
-                    path = path + DEFAULT_SUFFIX
-
-                open(path, "wb").write(b"")
-                os.chmod(path, self.mode | FILE_ATTR)
-            
-            except IOError:
-            
-                return None, path
-            
-            except OSError:
-            
-                os.remove(path)
-                return None, path
+        self.lock.acquire()
         
-        else:
+        try:
         
-            # A file already exists at this path.
-            
-            # Find whether the object can be legitimately overwritten.
-            path, rest = self.descend_path(path, check_mode = self.write_mask)
+            self.stopped = True
             
-            # Return an error value if it can't.
-            if rest != []: return None, path
+            for transfer in self.waiting:
             
-            try:
+                transfer.steps.close()
             
-                # Create an object on the local filesystem.
-                open(path, "wb").write(b"")
-                os.chmod(path, self.mode | FILE_ATTR)
+            self.waiting = []
             
-            except IOError:
+            running = []
             
-                return None, path
+            for transfers in self.running.values():
             
-            except OSError:
+                running.extend(transfers)
             
-                os.remove(path)
-                return None, path
+            return running
         
-        self.log("comment", "Actual path: %s" % path, "", level = LOG_API)
+        finally:
         
-        # Try to find the details of the object.
+            self.lock.release()
+    
+    def statistics(self):
+    
+        self.lock.acquire()
         
-        if os.path.isdir(path):
+        try:
         
-            # A directory
-            
-            filetype, date, length, access_attr, object_type, \
-                handle = self.read_path_info(path, Need_handle = 1)
-            
-            # Keep this handle for possible later use.
-            if not self.file_handler.has_key(handle):
-            
-                self.file_handler[handle] = Directory(path, self, host)
-            
-            return [ filetype, date, length, access_attr, object_type,
-                     handle ], path
+            stats = dict(self.counters)
+            stats["waiting"] = len(self.waiting)
+            stats["running"] = sum(map(len, self.running.values()))
+            stats["hosts"] = dict(self.hosts)
+            return stats
         
-        elif os.path.isfile(path):
+        finally:
         
-            # A file
-            
-            filetype, date, length, access_attr, object_type, \
-                handle = self.read_path_info(path, Need_handle = 1)
-            
-            # Keep this handle for possible later use.
-            if not self.file_handler.has_key(handle):
-            
-                try:
-
-                    self.file_handler[handle] = File(path, self, host)
-
-                except IOError:
+            self.lock.release()
 
-                    pass
-            
-            else:
-            
-                # It may be necessary to report an error that the handle
-                # is in use.
-                fh = self.file_handler[handle]
-                
-                # Use the file object's length, if possible.
-                length = fh.length()
-            
-            if not self.file_handler.has_key(handle):
 
-                return None, path
+class TransferPool:
 
-            return [ long(0xdeaddead), long(0xdeaddead), length, 0x33, object_type,
-                     handle ], path
-        
-        else:
-        
-            # Reply with an error message.
-            return None, path
+    """TransferPool(run, size = TRANSFER_THREADS)
     
-    def delete_path(self, ros_path):
+    Run transfers using a fixed number of threads, started as they are
+    needed, by calling the function given with each transfer. Transfers of
+    up to TRANSFER_BULK_SIZE bytes are run before larger ones, and transfers
+    of each kind in the order they were added. The time taken by recent
+    transfers is recorded so that their throughput can be shown.
+    """
     
-        # Convert the RISC OS style path to a path within the share.
-        path = self.from_riscos_path(ros_path)
-        
-        if ros_path == "":
-        
-            # The share itself is being referenced.
-            return None, path
-        
-        if path is None:
+    def __init__(self, run, size = TRANSFER_THREADS):
+    
+        self.run = run
+        self.size = size
         
-            return None, path
+        # Queued transfers as (priority, sequence, transfer) tuples, the
+        # threads started and the number of them running transfers.
+        self.queue = []
+        self.sequence = 0
+        self.threads = []
+        self.active = 0
         
-        # Find whether the directory structure can be legitimately descended.
-        path, rest = self.descend_path(path, check_mode = self.write_mask)
+        # The transfers running, with the times they started, and the
+        # names, sizes and durations of those which finished recently.
+        self.running = {}
+        self.recent = collections.deque(maxlen = 32)
+        self.counters = {"completed": 0, "bytes": 0}
         
-        if rest != []:
+        self.stopped = False
+        self.condition = threading.Condition()
+    
+    def put(self, transfer):
+    
+        """put(self, transfer)
         
-            return None, path
+        Queue a transfer to be run by the next free thread, starting a new
+        thread if none are free and fewer than the maximum are running.
+        """
         
-        self.log("comment", "Delete request: %s" % path, "", level = LOG_API)
+        priority = int(transfer.size > TRANSFER_BULK_SIZE)
         
-        filetype, date, length, access_attr, object_type, \
-            handle = self.read_path_info(path)
+        self.condition.acquire()
         
         try:
         
-            if os.path.isfile(path):
+            if self.stopped:
             
-                os.remove(path)
-            
-            elif os.path.isdir(path):
+                transfer.steps.close()
+                return
             
-                os.rmdir(path)
+            heapq.heappush(self.queue, (priority, self.sequence, transfer))
+            self.sequence += 1
             
-            else:
+            if self.active + len(self.queue) > len(self.threads) and \
+               len(self.threads) < self.size:
             
-                return None, path
+                thread = threading.Thread(
+                    group = None, target = self._serve,
+                    name = "Transfer thread %i" % (len(self.threads) + 1)
+                    )
+                thread.daemon = True
+                self.threads.append(thread)
+                thread.start()
             
-            return [ filetype, date, length, access_attr,
-                     object_type ], path
+            self.condition.notify()
         
-        except OSError:
+        finally:
         
-            return None, path
+            self.condition.release()
     
-    def set_access_attr(self, ros_path, access_attr):
+    def _serve(self):
     
-        # Convert the RISC OS style path to a path within the share.
-        path = self.from_riscos_path(ros_path)
-        
-        if ros_path == "":
-        
-            # The share itself is being referenced.
-            return None, path
+        self.condition.acquire()
         
-        if path is None:
-        
-            return None, path
+        try:
         
-        # Find whether the directory structure can be legitimately descended.
-        # check_mode should be read | write.  Permissions can be changed
-        # on read-only files on writable shares
-        path, rest = self.descend_path(path, share_check_mode = PROTECTED_WRITE, check_mode = self.write_mask | self.read_mask)
-        
-        if rest != []:
-        
-            return None, path
-        
-        # Convert the RISC OS attributes to a mode value.
-        mode = self.from_riscos_access(access_attr)
-        
-        # Try to change the permissions on the object.
-        try:
-        
-            if os.path.isfile(path):
+            while 1:
             
-                # Ensure that the remote client doesn't mess up the file
-                # access attributes by making the file unreadable.
-                mode = (
-                    (mode & 0x1c0) | ((mode & 0x1c0) >> 3) | \
-                    ((mode & 0x1c0) >> 6)
-                    )
+                while not self.stopped and not self.queue:
                 
-                mode = (mode & self.mode) | FILE_ATTR
+                    self.condition.wait()
                 
-                os.chmod(path, mode)
-            
-            elif os.path.isdir(path):
-            
-                # Ensure that the remote client doesn't mess up the
-                # directory access attributes.
-                mode = self.mode | DIR_EXEC
+                if self.stopped:
                 
-                os.chmod(path, mode)
-            
-            # Construct the new details for the object.
-            filetype, date, length, access_attr, object_type, \
-                handle = self.read_path_info(path)
-            
-            return [filetype, date, length, access_attr, object_type], path
+                    return
+                
+                priority, sequence, transfer = heapq.heappop(self.queue)
+                transfer.runner = threading.current_thread()
+                self.active += 1
+                
+                t0 = time.time()
+                self.running[transfer] = t0
+                
+                self.condition.release()
+                
+                try:
+                
+                    self.run(transfer)
+                
+                except Exception:
+                
+                    # Report the error as an unhandled one in a thread would
+                    # be, but keep the thread.
+                    sys.excepthook(*sys.exc_info())
+                
+                finally:
+                
+                    self.condition.acquire()
+                    
+                    self.active -= 1
+                    del self.running[transfer]
+                    
+                    self.recent.append(
+                        (transfer.name, transfer.size, time.time() - t0)
+                        )
+                    self.counters["completed"] += 1
+                    self.counters["bytes"] += transfer.size
         
-        except OSError:
+        finally:
         
-            return None, path
+            self.condition.release()
     
-    def rename_path(self, event, reply_id, pos, amount, buf, ros_path,
-                    _socket, address, fn):
+    def stop(self):
     
-        # Convert the RISC OS style path to a path within the share.
-        path = self.from_riscos_path(ros_path)
-        
-        if ros_path == "":
-        
-            # The share itself is being referenced.
-            return
-        
-        if path is None: return
-        
-        # Find whether the directory structure can be legitimately descended.
-        path, rest = self.descend_path(path, check_mode = self.write_mask)
-        
-        if rest != []: return None
-        
-        if self.present == "truncate":
-        
-            # Check for a file suffix to determine the filetype of the file.
-            # We will need to remember this when we rename the file in order
-            # to maintain the correct type.
-            at = path.rfind(".")
-            
-            if at != -1:
-            
-                suffix = path[at:]
-            
-            else:
-            
-                suffix = ""
+        """stop(self)
         
-        # Call the function to receive the filename.
-        share_name, new_ros_path = fn(
-            event, reply_id, pos, amount, buf, _socket, address
-            )
+        Discard any queued transfers and wait for the running ones to
+        finish, then stop the threads.
+        """
         
-        if share_name != self.name: return None
+        self.condition.acquire()
         
-        if new_ros_path is None: return None
+        self.stopped = True
         
-        # Convert the RISC OS style path to a path within the share.
-        new_path = self.from_riscos_path(new_ros_path, find_obj = 0)
+        for priority, sequence, transfer in self.queue:
         
-        if new_ros_path == "":
+            transfer.steps.close()
         
-            # The share itself is being referenced.
-            return None
+        self.queue = []
+        self.condition.notify_all()
         
-        if new_path is None: return None
+        threads = self.threads
+        self.threads = []
         
-        # Find whether the directory structure can be legitimately descended.
-        parent_path, file = os.path.split(new_path)
+        self.condition.release()
         
-        write_path, rest = self.descend_path(
-            parent_path, check_mode = self.write_mask
-            )
+        for thread in threads:
         
-        if rest != []: return None
+            if thread is not threading.current_thread():
+            
+                thread.join()
+    
+    def statistics(self):
+    
+        """stats = statistics(self)
         
-        if self.present == "truncate":
+        Return a dictionary describing the threads and queue, with lists of
+        (name, size, seconds) tuples for the running and recently finished
+        transfers.
+        """
         
-            # Append the suffix recorded before to the new path.
-            new_path = new_path + suffix
+        self.condition.acquire()
         
         try:
         
-            os.rename(path, new_path)
-        
-        except OSError:
-        
-            pass
-    
-    def set_filetype(self, fh, handle, filetype_word, date_word):
-    
-        # Find the filetype and date from the words given.
-        filetype, date = \
-            self.take_riscos_filetype_date(filetype_word, date_word)
+            now = time.time()
             
-        # Only change the filename to change the filetype if we are using
-        # a presentation policy based on truncating filenames before their
-        # suffixes.
+            stats = dict(self.counters)
+            stats["threads"] = len(self.threads)
+            stats["active"] = self.active
+            stats["queued"] = len(self.queue)
+            stats["bulk queued"] = len(
+                [item for item in self.queue if item[0] > 0]
+                )
+            stats["running"] = [
+                (transfer.name, transfer.size, now - t0)
+                for transfer, t0 in self.running.items()
+                ]
+            stats["recent"] = list(self.recent)
+            return stats
         
-        if os.path.isfile(fh.path) and self.present == "truncate":
+        finally:
         
-            # Convert the file's path to a RISC OS style filetype and path.
-            _, _, ros_path = self.suffix_to_filetype(fh.path)
-            
-            if sys.platform.startswith("win32"):
-
-                try:
-
-                    # Win32 stores filetypes in the :riscos alternate data stream
-                    with open(fh.path + ":riscos", "w") as f:
-
-                        f.write(hex(int(filetype)))
-
-                except:
+            self.condition.release()
 
-                    return None
 
-            else:
+class WorkerStore:
 
-                # Determine the correct suffix to use for the file.
-                new_path = self.filetype_to_suffix(ros_path, filetype)
-            
-                self.log("comment", "Renaming %s to %s" % (fh.path, new_path), "", level = LOG_API)
-            
-                if fh.path != new_path:
-            
-                    try:
-                
-                        # Try to rename the object.
-                        os.rename(fh.path, new_path)
-                
-                    except OSError:
-                
-                        return None
-            
-                fh.path = new_path
+    """WorkerStore(slots = WORKER_TRANSFER_SLOTS)
+    
+    Hold the state shared by worker processes serving shares in shared
+    memory, created before the workers are forked: a table of the processes
+    owning the transfers of each path. Paths are hashed into the table, so
+    transfers of two paths which share a slot are also run one after the
+    other. File handles are not shared; each worker tags the handles it
+    allocates so that they are unique.
+    """
+    
+    def __init__(self, slots = WORKER_TRANSFER_SLOTS):
+    
+        import multiprocessing
         
-        # Stamp with the correct access and modification date
-        t = time.mktime(date)
-        os.utime(fh.path, (t, t))
-
-        # Construct the new details for the object.
-        filetype, date, length, access_attr, object_type, \
-            hnd = self.read_path_info(fh.path, Need_handle = 0)
+        self.lock = multiprocessing.Lock()
         
-        # Keep the length from the original file.
-        length = fh.length()
+        # Processes waiting for slots wait on this until one is released.
+        self.condition = multiprocessing.Condition(self.lock)
         
-        return [filetype, date, length, access_attr, object_type, handle]
+        # The process owning each slot and the number of its transfers
+        # using it.
+        self.owners = multiprocessing.RawArray("l", slots)
+        self.counts = multiprocessing.RawArray("l", slots)
     
-    def catalogue_path(self, ros_path):
+    def claim(self, path, event = None):
     
-        # This should return data in 2048 byte chunks max 
-
-        # Convert the RISC OS style path to a path within the share.
-        path = self.from_riscos_path(ros_path)
-        
-        if path is None:
+        """claimed = claim(self, path, event = None)
         
-            return None, "Not found", path, None
+        Wait until no other process owns transfers of the path given, then
+        record the current process as an owner. Return False without
+        claiming the path if the event given is set while waiting.
+        """
         
-        if not os.path.isdir(path):
+        i = jenkins_one_at_a_time_hash(path) % len(self.owners)
+        pid = os.getpid()
         
-            # The path given did not refer to a directory.
-            return None, "Not a directory", path, None
+        self.condition.acquire()
         
-        # Find whether the directory structure can be legitimately descended.
-        path, rest = self.descend_path(path, check_mode = self.read_mask)
+        try:
         
-        if rest != []:
+            while 1:
+            
+                owner = self.owners[i]
+                
+                if owner != 0 and owner != pid and not self._alive(owner):
+                
+                    # The owner exited without releasing the slot.
+                    owner = self.counts[i] = 0
+                
+                if owner == 0 or owner == pid:
+                
+                    self.owners[i] = pid
+                    self.counts[i] = self.counts[i] + 1
+                    return True
+                
+                if event is not None and event.isSet():
+                
+                    return False
+                
+                # Wait until a slot is released, waking occasionally to
+                # check the event and the owner.
+                self.condition.wait(WORKER_CLAIM_WAIT)
         
-            return None, "Access denied", path, None
+        finally:
         
-        try:
+            self.condition.release()
+    
+    def release(self, path):
+    
+        """release(self, path)
         
-            # For unprotected shares, return a catalogue to the client.
-            files = os.listdir(path)
+        Release a claim made by the current process on the path given.
+        """
         
-        except OSError:
+        i = jenkins_one_at_a_time_hash(path) % len(self.owners)
         
-            return None, "Not found", path, None
+        self.condition.acquire()
         
-        # Write the catalogue information.
+        try:
         
-        infolist = []
-        info = []
+            if self.owners[i] == os.getpid():
+            
+                self.counts[i] = self.counts[i] - 1
+                
+                if self.counts[i] <= 0:
+                
+                    self.owners[i] = self.counts[i] = 0
+                    
+                    # Wake the processes waiting for slots.
+                    self.condition.notify_all()
         
-        # The first word is the length of the directory structure
-        # information.
-        # Calculate this later.
-        info.append(0)
+        finally:
         
-        # The next word is the length of the following share
-        # information.
-        info.append(0x24)
+            self.condition.release()
+    
+    def _alive(self, pid):
+    
+        try:
         
-        dir_length = 0
-        chunk_length = 0
+            os.kill(pid, 0)
         
-        n_files = 0
+        except OSError as exc:
         
-        for file in files:
+            return exc.errno != errno.ESRCH
         
-            # Omit files which begin with a suffix separator ("." on
-            # Linux, for example).
-            if file.find(os.extsep) == 0:
-            
-                continue
-            
-            file_info = []
-            length = 0
-            
-            # Construct the path to the file.
-            this_path = os.path.join(path, file)
-            
-            try:
-            
-                ros_access = self.to_riscos_access(path = this_path) & self.access_attr
-                # Don't show private files
-                if (ros_access & ROS_PUBLIC_READ) == 0:
-                    continue;
+        return True
 
-                # Filetype word
-                filetype, loadexec, filename = \
-                    self.suffix_to_filetype(file, path = path)
 
-                # Construct the filetype and date words.
-                
-                # The number of seconds since the last modification
-                # to the file is read.
-                if loadexec == None:
-                    seconds = os.stat(this_path)[os.path.stat.ST_MTIME]
-                
-                    # Convert this to the RISC OS date format.
-                    cs = self.to_riscos_time(seconds = seconds)
-                
-                    filetype_word = long(
-                        long(0xfff00000) | (filetype << 8) | \
-                        ((cs & long(0xff00000000)) >> 32)
-                        )
-                
-                    file_info.append(filetype_word)
-                
-                    length = length + 4
-                
-                    # Date word
-                    file_info.append(cs & long(0xffffffff))
-                    length = length + 4
-                else:
+class Mailbox(object):
 
-                    file_info.append(loadexec[0])
-                    length = length + 4
-                    file_info.append(loadexec[1])
-                    length = length + 4
-                
-                # Length word (0x800 for directory)
-                if os.path.isdir(this_path):
-                
-                    file_info.append(ROS_DIR_LENGTH)
-                
-                else:
-                
-                    file_info.append(os.path.getsize(this_path))
-                
-                length = length + 4
-                
-                # Access attributes (masked by the share's access mask)
-                file_info.append(
-                    ros_access
-                    )
-                
-                length = length + 4
-                
-                # Object type (0x2 for directory)
-                if os.path.isdir(this_path):
-                
-                    file_info.append(0x02)
-                    # suffix_to_filetype will have stripped any extension
-                    # from the directory.  We want to return the full
-                    # directory name, though
-                    filename = self.to_riscos_filename(file)
-                
-                else:
-                
-                    file_info.append(0x01)
-                
-                length = length + 4
-                
-                # Convert the name into a form suitable for the
-                # other client.
-                #file_name = self.to_riscos_filename(file)
-                
-                # Zero terminated name string
-                name_string = self._encode([filename + "\x00"])
-                
-                file_info.append(name_string)
-                
-                length = length + len(name_string)
-                
-                n_files = n_files + 1
-            
-            except OSError:
-            
-                file_info = []
-                length = 0
-            
-            if chunk_length + length > 2048:
-                # Fill in the directory length.
-                info[0] = chunk_length
-                infolist.append(info)
-                chunk_length = 0
-                info = []
-                info.append(0x0)
-                info.append(0x0c)
+    """Mailbox
+    
+    The replies received for a request, indexed by their command character,
+    and the event used to signal their arrival.
+    """
+    
+    __slots__ = ("replies", "event")
+    
+    def __init__(self, event):
+    
+        self.replies = {}
+        self.event = event
+    
+    def queue(self, command):
+    
+        # Return the queue of replies for the command, creating it if
+        # necessary. dict.setdefault is atomic so no lock is needed.
+        return self.replies.setdefault(command, collections.deque())
 
-            info = info + file_info
-            dir_length = dir_length + length
-            chunk_length = chunk_length + length
-        
-        if len(infolist) == 0 and chunk_length == 0:
-            info[0] = 0
-            infolist.append(info)
-        elif chunk_length > 0:
-            info[0] = chunk_length
-            infolist.append(info)
+class Messages(Common):
 
-        # The data following the directory structure is concerned
-        # with the share and is like a return value from a share
-        # open request but with a "B" command word like a
-        # catalogue request.
-        
-        # Use a hash value for the handle
-        handle = jenkins_one_at_a_time_hash(path)
-        
-        share_value = (handle & long(0xffffff00)) ^ long(0xffffff02)
-        
-        marker = long(0xffffffff)
-        if len(infolist) > 1:
-            marker = long(0x00000055)
+    """Messages
+    
+    Replies to outstanding requests, indexed by the host and reply ID of each
+    request. Each entry has a mailbox holding a queue of replies for each
+    command character so that a reply can be claimed without scanning the
+    others, and an event which is set when a reply arrives. Appending to and
+    popping from deques are atomic, so no global lock is taken.
+    """
 
-        trailer = \
-        [
-#           The first two words should be filetype and timestamp
-            long(0xffffcd00), long(0x00000000),
-            round_up(dir_length, 2048),
-            long(0x00000013), # Read only for others (0x10); read write for owner
-            share_value, # common value for directories in this share
-            handle, # handle of object as with info returned for opening
-            infolist[0][0], # number of words used to describe the directory
-                        # contents
-            marker
-        ]
-        
-        # Return the lists used to construct the message, the path
-        # catalogued, and the handle
-        return infolist, trailer, path, handle
+    def __init__(self):
     
-    def send_file(self, fh, pos, length):
+        self.messages = {}
     
-        # Determine the length of the file.
-        file_length = fh.length()
-        
-        # Determine the amount of information we can send.
-        amount = min(length, SEND_GET_SIZE)
-        
-        # Find the relevant part of the file.
-        fh.seek(pos, 0)
+    def __getitem__(self, item):
+    
+        # Return the item as in a normal dictionary.
+        return self.messages[item]
+    
+    def __setitem__(self, item, value):
+    
+        # Add an entry as in a normal messages.
+        self.messages[item] = value
+    
+    def __delitem__(self, item):
+    
+        del self.messages[item]
+    
+    def __len__(self):
+    
+        return len(self.messages)
+    
+    def clear(self):
+    
+        return self.messages.clear()
+    
+    def copy(self):
+    
+        return self.messages.copy()
+    
+    def get(self, item, default = None):
+    
+        return self.messages.get(item, default)
+    
+    def has_key(self, item):
+    
+        return item in self.messages
+    
+    def items(self):
+    
+        return self.messages.items()
+    
+    def keys(self):
+    
+        return self.messages.keys()
+    
+    def popitem(self):
+    
+        return self.messages.popitem()
+    
+    def setdefault(self, item, default = None):
+    
+        return self.messages.setdefault(item, default)
+    
+    def update(self, dict):
+    
+        return self.messages.update(dict)
+    
+    def values(self):
+    
+        return self.messages.values()
+    
+    def append(self, hostdata):
+    
+        (host, data) = hostdata
+        # Take the reply ID of the message and store the message in the
+        # mailbox for that ID if one exists.
+        key = self.replyid2str(data[1:4])
         
-        # Read the amount of data required.
-        file_data = fh.read(amount)
+        mailbox = self.messages.get((host, key))
         
-        # Calculate the new offset into the file.
-        new_pos = pos + len(file_data)
+        if mailbox is None:
         
-        # Write the message header.
-        header = [len(file_data), 0xc]
+            return
         
-        self.log("comment", "Wrote return header: %s" % header, "", level = LOG_API)
+        mailbox.queue(self.cmd2str(data[0])).append(data)
+        mailbox.event.set()
+    
+    def remove(self, hostdata):
+    
+        (host, data) = hostdata
+        # Take the reply ID of the message and remove the message from the
+        # mailbox for that ID if it exists.
+        key = self.replyid2str(data[1:4])
         
-        # Encode the header, adding padding if necessary.
-        header = self._encode(header)
+        mailbox = self.messages.get((host, key))
         
-        self.log("comment", "Wrote %i bytes of data" % len(file_data), "", level = LOG_API)
+        if mailbox is None:
         
-        # Add a 12 byte trailer onto the end of the data
-        # containing the amount of data sent and the new
-        # offset into the file being read.
-        trailer = [len(file_data), new_pos]
+            return
         
-        self.log("comment", "Wrote return trailer: %s" % trailer, "", level = LOG_API)
+        try:
         
-        # Encode the trailer, adding padding if necessary.
-        trailer = self._encode(trailer)
+            mailbox.replies[self.cmd2str(data[0])].remove(data)
         
-        # Construct the information string.
-        info = header + file_data
+        except (KeyError, ValueError):
         
-        return info, trailer, new_pos
+            pass
     
-    def create_directory(self, ros_path, host):
+    def add_entry(self, host, new_id, event = None):
     
-        # Construct a path to the object below the shared directory.
-        path = self.from_riscos_path(ros_path, find_obj = 0)
+        # Add a mailbox for expected messages with this ID. An event with
+        # set, clear and wait methods can be supplied by callers which do
+        # not wait for messages in a thread of their own.
         
-        if ros_path == "":
+        if event is None:
         
-            # The share itself is being referenced.
-            return None, path
+            event = threading.Event()
         
-        # Return if the path could not be translated.
-        if path is None:
+        self.messages[(host, new_id)] = Mailbox(event)
+    
+    def remove_entry(self, host, new_id):
+    
+        # Remove the mailbox for messages which are no longer valid.
+        self.messages.pop((host, new_id), None)
+
+    def wait_for_event(self, host, new_id, delay):
+
+        evt = self.messages[(host, new_id)].event
+
+        if not evt.is_set():
+
+            evt.wait(delay)
+
+        return evt.is_set()
+
+    def signal_event(self, host, new_id):
+ 
+        mailbox = self.messages.get((host, new_id))
         
-            return None, path
+        if mailbox is not None:
         
-        # Determine whether the parent directory of the file can be written
-        # to.
-        parent_path, file = os.path.split(path)
+            mailbox.event.set()
+ 
+    def _scan_messages(self, host, new_id, commands):
+    
+        mailbox = self.messages[(host, new_id)]
         
-        write_path, rest = self.descend_path(
-            parent_path, check_mode = self.write_mask
-            )
+        # Clear the event before looking for replies so that a reply which
+        # arrives while we look sets it again, rather than leaving it set
+        # for replies that nobody is waiting for.
+        mailbox.event.clear()
         
-        # Return an error value if it can't.
-        if rest != []: return None, write_path
+        for command in commands:
         
-        try:
+            queue = mailbox.replies.get(command)
+            
+            if queue:
+            
+                try:
+                
+                    # Claim the reply, indicating that valid data was
+                    # received.
+                    return 1, queue.popleft()
+                
+                except IndexError:
+                
+                    pass
         
-            # Create a drectory on the local filesystem.
-            os.mkdir(path)
+        queue = mailbox.replies.get("E")
         
-        except OSError:
+        if queue:
         
-            return None, path
+            try:
+            
+                data = queue.popleft()
+                
+                #print('Error: "%s"' % data[8:])
+                return -1, (self.str2num(4, data[4:8]), data[8:])
+            
+            except IndexError:
+            
+                pass
         
+        # Return a negative result.
+        return 0, (0, "The machine containing the shared disc does not respond")
+    
+    def _all_messages(self, host, new_id, commands):
+    
         try:
         
-            # Make the directory executable by everyone but retain the
-            # other mode attributes for this share.
-            os.chmod(path, self.mode | DIR_EXEC)
-        
-        except OSError:
+            mailbox = self.messages[(host, new_id)]
         
-            os.rmdir(path)
-            return None, path
+        except KeyError:
         
-        self.log("comment", "Actual path: %s" % path, "", level = LOG_API)
-        self.log(
-            "comment",
-            "%s has permissions: %s" % \
-                (path, oct(os.stat(path)[os.path.stat.ST_MODE])),
-            "",
-            level = LOG_API
-            )
+            return []
         
-        # Try to find the details of the directory.
+        messages = []
         
-        filetype, date, length, access_attr, object_type, \
-            handle = self.read_path_info(path, Need_handle = 1)
+        for command in commands:
         
-        # Keep this handle for possible later use.
-        if not self.file_handler.has_key(handle):
+            queue = mailbox.replies.get(command)
+            
+            # Claim each message in turn, adding it to the list of messages
+            # found.
+            while queue:
+            
+                try:
+                
+                    messages.append(queue.popleft())
+                
+                except IndexError:
+                
+                    break
         
-            self.file_handler[handle] = Directory(path, self, host)
-        
-        return [ filetype, date, length, access_attr, object_type,
-                 handle ], path
+        return messages
     
 
 
 
-class RemoteShare(Ports, Translate):
+class ConfigError(Exception):
 
-    def __init__(self, name, host, messages):
-    
-        # Call the initialisation methods of the base classes.
-        Ports.__init__(self)
-        Translate.__init__(self)
-        
-        self.name = name
-        
-        # Determine the IP address of the host.
-        self.host = socket.gethostbyname(host)
-        
-        # Keep a reference to the messages object passed by the Peer.
-        self.share_messages = messages
-        
-        # Use truncation when sending and receiving files from this
-        # share as a client.
-        self.present = "truncate"
+    pass
+
+
+
+class File:
+
+    # Files holding data which has not been written, indexed by path, so
+    # that it can be written before other requests use the files.
+    held = {}
+    held_lock = threading.Lock()
     
-    def _read_file_info(self, data):
+    def __init__(self, path, share, user, mode="r+b"):
     
-        # Read the information on the object.
-        filetype_word = self.str2num(4, data[4:8])
-        filetype = (filetype_word & 0xfff00) >> 8
-        date_num = ((self.str2num(4, data[4:8]) & 0xff) << 32) | \
-                   (self.str2num(4, data[8:12]))
+        self.pieces = []
+        self.ptr = 0
+        self.path = path
         
-        date = self.from_riscos_time(date_num)
+        # Let this object see data held by others for the same file.
+        File.flush_held(path)
         
-        length = self.str2num(4, data[12:16])
-        access_attr = self.str2num(4, data[16:20])
-        object_type = self.str2num(4, data[20:24])
+        # Record the current user of this file (their host).
+        self.user = user
         
-        info = { "filetype": filetype, "date": date,
-                 "length": length,
-                 "access": access_attr, "type": object_type,
-                 "isdir": ((object_type & 0x2) != 0) }
+        # The share the file is stored in.
+        self.share = share
         
-        if len(data) > 24:
+        if not os.path.exists(path):
         
-            handle = self.str2num(4, data[24:28])
-            
-            info["handle"] = handle
+            if mode == "r+b":
+
+                # Create the object.
+                open(path, "wb").write("")
         
-        return info
+        # Open the file.
+        self.fh = open(path, mode)
+        
+        # Readers used to send the file to other clients which are not in
+        # use, kept so that they can continue reading ahead.
+        self.readers = []
+        
+        # Data written but not yet passed to the system, and whether any
+        # has been since the file was opened. The lock is held while the
+        # data is changed, as other threads may write it.
+        self.writes = WriteBehind()
+        self.written = False
+        self.lock = threading.RLock()
+        
+        # Send large files opened for reading from buffers holding a block
+        # each rather than from buffers shared with other transfers. The
+        # file is not mapped into memory, since another process could
+        # truncate it while it was being sent.
+        self.direct = mode == "rb" and \
+            os.fstat(self.fh.fileno()).st_size >= DIRECT_READ_SIZE
+    
+    # The pointer holds the position in the file, since data may be held
+    # before it is written.
+    def tell(self):
     
-    def get_key(self):
-        return 0
-
-    def open(self, ros_path):
+        return self.ptr
     
-        """open(self, name)
+    def seek(self, ptr, from_end):
+    
+        if from_end == 0:
         
-        Open a resource of a given name in the share.
-        """
+            self.ptr = ptr
         
-        name = self.name
+        elif from_end == 1:
         
-        if ros_path != "":
+            self.ptr = self.ptr + ptr
         
-            name = name + "." + ros_path
+        else:
         
-        msg = ["A", 1, 0, name+"\x00"]
+            self.ptr = self.length() + ptr
+    
+    def read(self, length):
+    
+        # Write any data held so that it can be read.
+        self.flush()
         
-        # Send the request.
-        replied, data = self._send_request(msg, self.host, ["R"])
+        self.fh.seek(self.ptr, 0)
+        data = self.fh.read(length)
         
-        if replied != 1:
+        self.ptr = self.ptr + len(data)
+        return data
+    
+    def write(self, data):
+    
+        self.lock.acquire()
         
-            return None
+        try:
         
-        else:
+            if not self.writes.pending:
+            
+                self._hold(True)
+            
+            # Hold the data with any written before it, writing the data
+            # held first if the new data overlaps it.
+            if not self.writes.add(self.ptr, data):
+            
+                self.flush()
+                self._hold(True)
+                self.writes.add(self.ptr, data)
+            
+            self.ptr = self.ptr + len(data)
+            
+            if self.writes.pending >= WRITE_BEHIND_SIZE:
+            
+                self.flush()
         
-            pass
-            #print('Successfully opened "%s"' % name)
+        finally:
         
-        # Return the information on the item.
-        return self._read_file_info(data)
+            self.lock.release()
     
-    def catalogue(self, ros_path):
+    def flush(self):
     
-        """lines = catalogue(self, ros_path)
+        """flush(self)
         
-        Return a catalogue of the files in the named share.
+        Write any data held for the file, synchronising it with the disk if
+        the WRITE_SYNC setting is "flush".
         """
         
-        name = self.name
+        self.lock.acquire()
         
-        if ros_path != "":
+        try:
         
-            name = name + "." + ros_path
+            if not self.writes.pending:
+            
+                return
+            
+            # Any data read ahead, and the catalogue of the directory
+            # holding the file, may no longer match the file.
+            self.discard_read_ahead()
+            self.share.forget_catalogue(self.path)
+            
+            self.writes.flush(self.fh)
+            self.written = True
+            self._hold(False)
+            
+            if WRITE_SYNC == "flush":
+            
+                os.fsync(self.fh.fileno())
         
-        msg = ["B", 3, long(0xffffffff), 0, name+"\x00"]
+        finally:
         
-        # Send the request.
-        replied, data = self._send_request(msg, self.host, ["S"])
+            self.lock.release()
+    
+    def _hold(self, holding):
+    
+        # Record whether this object holds data for its path.
+        File.held_lock.acquire()
         
-        if replied != 1:
+        files = File.held.setdefault(self.path, [])
         
-            return
+        if holding and self not in files:
         
-        # Read the catalogue information.
-        c = 4
+            files.append(self)
         
-        # The first word is the length of the directory structure in bytes
-        # beginning with the next word.
-        dir_length = self.str2num(4, data[c:c+4])
-        c = c + 4
+        elif not holding and self in files:
         
-        start = c
+            files.remove(self)
         
-        # The next word is the directory name.
-        c = c + 4
+        if not files:
         
-        lines = []
-        files = []
+            del File.held[self.path]
         
-        while c < (start + dir_length):
+        File.held_lock.release()
+    
+    @classmethod
+    def flush_held(cls, path, directory = False):
+    
+        """flush_held(cls, path, directory = False)
         
-            # Filetype word
-            filetype_word = self.str2num(4, data[c:c+4])
-            filetype = long((filetype_word & 0xfff00) >> 8)
-            c = c + 4
-            
-            # Unknown word
-            date_num = ((filetype_word & 0xff) << 32) | \
-                        self.str2num(4, data[c:c+4])
-            
-            date = self.from_riscos_time(date_num)
-            
-            c = c + 4
-            
-            # Length word (0x800 for directory)
-            length = self.str2num(4, data[c:c+4])
-            c = c + 4
-            
-            # Access attributes
-            access_attr = self.str2num(4, data[c:c+4])
-            c = c + 4
-            
-            # Object type (0x2 for directory)
-            object_type = self.str2num(4, data[c:c+4])
-            c = c + 4
-            
-            # Zero terminated name string
-            name = self.read_string(
-                data, offset = c, ending = "\000", include = 0
-                )
+        Write the data held by File objects for the file at the path given,
+        or for the files in the directory at the path if directory is True.
+        Errors are left to be reported to the users of the files.
+        """
+        
+        cls.held_lock.acquire()
+        
+        try:
+        
+            if not cls.held:
             
-            c = c + len(name) + 1
+                return
             
-            if c % 4 != 0:
+            if directory:
             
-                c = c + 4 - (c % 4)
+                path = os.path.normpath(path)
+                files = []
+                
+                for held_path, held_files in cls.held.items():
+                
+                    if os.path.dirname(os.path.normpath(held_path)) == path:
+                    
+                        files.extend(held_files)
             
-            files.append( (
-                filetype_word, date, length, access_attr, object_type, name
-                ) )
+            else:
             
-            lines.append(
-                "%s\t:\t%03x\t(%i bytes)\t%s\t%i\t%s" % (
-                    name, filetype, length,
-                    self.repr_mode(self.from_riscos_access(access_attr)),
-                    object_type,
-                    time.asctime(date)
-                    )
-                )
+                files = list(cls.held.get(path, ()))
         
-        for line in lines:
+        finally:
         
-            sys.stdout.write(line.expandtabs(4)+"\n")
+            cls.held_lock.release()
         
-        # The data following the directory structure is concerned
-        # with the share and is like a return value from a share
-        # open request but with a "B" command word like a
-        # catalogue request.
+        for fh in files:
         
-        # Return the catalogue information.
-        return files
-    
-    cat = catalogue
+            try:
+            
+                fh.flush()
+            
+            except EnvironmentError:
+            
+                pass
     
-    def get(self, name):
+    def allocate(self, start, amount):
     
-        # Read the object's information.
-        info = self.open(name)
+        # Reserve space for the data about to be written to the range given
+        # without changing the file's length.
+        if WRITE_ALLOCATE:
         
-        if info is None:
+            self.writes.reserve(self.fh, start, amount)
+    
+    def read_ahead(self):
+    
+        """reader = read_ahead(self)
         
-            return
+        Return a ReadAheadReader for reading blocks of the file to send to
+        other clients, sharing the data read ahead with any other transfers
+        of the file. The reader must be passed to finish_reading when it is
+        no longer needed.
+        """
         
-        # Use the file handle obtained from the information retrieved about
-        # this object.
-        handle = info["handle"]
+        # Read large files directly into buffers of their own.
+        if self.direct:
         
-        file_data = []
-        pos = 0
+            return DirectFileReader(self.path)
         
-        # Request packets smaller than the receive buffer size.
-        packet_size = RECV_GET_SIZE
+        # Ensure that data written is visible to the reader.
+        self.flush()
         
-        while pos < info["length"]:
+        # Popping from a list is atomic, so no lock is taken.
+        while self.readers:
         
-            msg = ["B", 0xb, handle, pos, packet_size]
-            
-            # Send the request.
-            replied, data = self._send_request(msg, self.host, ["S"])
-            
-            if replied != 1:
-            
-                print("The machine containing the shared disc does not respond")
-                return
+            try:
             
-            # Read the header.
-            length = self.str2num(4, data[4:8])
-            trailer_length = self.str2num(4, data[8:12])
+                reader = self.readers.pop()
             
-            file_data.append(data[12:12+length])
+            except IndexError:
             
-            #print(length, trailer_length, len(data))
+                break
             
-            pos = pos + length
+            # Only use readers which other transfers can share, since those
+            # which cannot have been replaced after the file changed.
+            if ReadAhead.shared.get(self.path) is reader.read_ahead:
             
-            if len(data[12+length:]) == trailer_length:
+                return reader
             
-                returned = self.str2num(4, data[12+length+4:12+length+8])
-                new_pos = self.str2num(4, data[12+length+8:12+length+12])
-                
-                # We have found the packet's trailer.
-                sys.stdout.write(
-                    "\rRead %i/%i bytes of file %s" % (
-                        new_pos, info["length"], name
-                        )
-                    )
-                sys.stdout.flush()
+            reader.close()
         
+        return ReadAhead.open_shared(
+            self.path, SEND_PGET_SIZE, SEND_WINDOW_SIZE * 2
+            )
+    
+    def finish_reading(self, reader):
+    
+        if isinstance(reader, DirectFileReader):
         
-        # Ensure that the whole file has been read.
-        msg = ["B", 0xb, handle, info["length"], 0]
-        replied, data = self._send_request(msg, self.host, ["S"])
+            reader.close()
+            return
         
-        if replied != 1:
+        # Keep the reader for the next transfer without letting it hold on
+        # to the data read ahead in the meantime.
+        reader.pause()
+        self.readers.append(reader)
+    
+    def discard_read_ahead(self):
+    
+        # Stop using data read ahead before the file changed.
+        ReadAhead.forget(self.path)
         
-            return None
+        while self.readers:
         
-        else:
+            self.readers.pop().close()
+    
+    def length(self):
+    
+        # Determine the actual file's length, including any data held.
+        return max(os.path.getsize(self.path), self.writes.end())
+    
+    def close(self):
+    
+        while self.readers:
         
-            length = self.str2num(4, data[4:8])
-            trailer_length = self.str2num(4, data[8:12])
+            self.readers.pop().close()
+        
+        try:
+        
+            # Ensure that no data is still to be read or written.
+            self.flush()
+            self.fh.flush()
             
-            if len(data[12+length:]) == trailer_length:
+            if self.written and WRITE_SYNC == "close":
             
-                returned = self.str2num(4, data[12+length+4:12+length+8])
-                new_pos = self.str2num(4, data[12+length+8:12+length+12])
-                
-                # We have found the packet's trailer.
-                sys.stdout.write(
-                    "\rFile %s (%i bytes) read successfully" % (
-                        name, new_pos
-                        )
-                    )
-                sys.stdout.flush()
+                os.fsync(self.fh.fileno())
         
-        # Close the resource.
-        self._close(handle)
+        finally:
         
-        return b"".join(file_data)
+            # Close the file descriptor even if the data could not be
+            # written, forgetting any data still held.
+            self._hold(False)
+            self.fh.close()
     
-    def pget(self, name):
+    def truncate(self, length = None):
     
-        # Read the object's information.
-        info = self.open(name)
+        self.flush()
+        self.discard_read_ahead()
+        self.share.forget_catalogue(self.path)
         
-        if info is None:
+        if length is None:
         
-            return
+            length = self.ptr
         
-        # Use the file handle obtained from the information retrieved about
-        # this object.
-        handle = info["handle"]
+        self.fh.truncate(length)
+
+
+class WriteBehind:
+
+    """WriteBehind()
+    
+    Data written to a file but not yet passed to the system, held as runs of
+    consecutive bytes indexed by their offsets in the file. Data continuing
+    or preceding a run is joined to it, so that data received in order is
+    written in one call however many messages it arrived in.
+    """
+    
+    # The C library, loaded when space is first reserved, or None if
+    # fallocate is not available.
+    libc = False
+    
+    def __init__(self):
+    
+        # The offsets of the runs in ascending order, and the runs indexed
+        # by offset.
+        self.starts = []
+        self.runs = {}
+        self.pending = 0
+    
+    def add(self, offset, data):
+    
+        """added = add(self, offset, data)
         
-        file_data = []
-        pos = 0
+        Hold the data given for writing at the offset given, returning
+        False without holding it if it overlaps data already held.
+        """
         
-        # Request packets smaller than the receive buffer size.
-        packet_size = RECV_PGET_SIZE
+        if not data:
         
-        start_addr = 0
+            return True
         
-        while start_addr < info["length"]:
+        starts = self.starts
+        end = offset + len(data)
+        i = bisect.bisect_right(starts, offset)
         
-            next_addr = min(start_addr + packet_size, info["length"])
-            
-            msg = ["A", 0xb, handle, start_addr, next_addr - start_addr]
-            
-            # Send the request.
-            replied, data = self._send_request(msg, self.host, ["D"])
-            
-            if replied != 1:
-            
-                print("The machine containing the shared disc does not respond")
-                return
-            
-            from_addr = start_addr
-            
-            while 1:
-            
-                # Read the header.
-                command = self.cmd2str(data[0])
-                reply_id = self.replyid2str(data[1:4])
-            
-                if command == "D" and len(data) > 8:
-                
-                    from_addr = self.str2num(4, data[4:8]) + start_addr
-
-                    file_data.append(data[8:])
-                    
-                    from_addr = from_addr + len(data) - 8
-
-                elif command == "D":
-                
-                    data_pos = self.str2num(4, data[4:8]) + start_addr
-
-                    if data_pos == next_addr:
-                    
-                        break
-                
-                elif command == "R" and from_addr == next_addr:
-                
-                    break
-                
-                msg = ["r", from_addr - start_addr, next_addr - start_addr]
-                
-                # Send the request.
-                replied, data = self._send_request(
-                    msg, self.host, ["D", "R"], new_id = self.replyid2str(reply_id)
-                    )
-                
-                if replied != 1:
-                
-                    print("The machine containing the shared disc does not respond")
-                    return
-            
-            sys.stdout.write(
-                "\rRead %i/%i bytes of file %s" % (
-                    from_addr, info["length"], name
-                    )
-                )
-            sys.stdout.flush()
-            
-            # Increase the start position.
-            start_addr = next_addr
+        if i > 0:
         
-        sys.stdout.write(
-            "\rFile %s (%i bytes) read successfully" % (
-                name, info["length"]
-                )
-            )
-        sys.stdout.flush()
+            before = self.runs[starts[i - 1]]
+            before_end = starts[i - 1] + len(before)
         
-        # Close the resource.
-        self._close(handle)
+        else:
         
-        return b"".join(file_data)
-    
-    def _close(self, handle):
-    
-        #if handle is None:
-        #
-        #    # Read the object's information.
-        #    info = self.open(name, host)
-        #    
-        #    if info is None:
-        #    
-        #        return
-        #    
-        #    # Use the file handle obtained from the information retrieved about
-        #    # this object to close the resource.
-        #    handle = info["handle"]
+            before_end = None
         
-        msg = ["A", 0xa, handle]
-        replied, data = self._send_request(msg, self.host, ["R"])
+        if (before_end is not None and before_end > offset) or \
+           (i < len(starts) and starts[i] < end):
         
-        if replied != 1:
+            return False
         
-            return None
+        if before_end == offset:
+        
+            # Continue the preceding run.
+            run = before
+            run.extend(data)
+        
+        else:
+        
+            run = self.runs[offset] = bytearray(data)
+            starts.insert(i, offset)
+            i += 1
+        
+        # Join the following run to this one if the data reaches it.
+        if i < len(starts) and starts[i] == end:
+        
+            run.extend(self.runs.pop(starts.pop(i)))
+        
+        self.pending += len(data)
+        return True
     
-    def put(self, path, ros_path):
+    def end(self):
     
-        # Use the non-broadcast socket.
-        if not 49171 in self.ports:
+        # Return the offset of the end of the data held.
+        if not self.starts:
         
-            print("No socket to use for port %i" % 49171)
-            return 0, []
+            return 0
         
-        s = self.ports[49171]
+        start = self.starts[-1]
+        return start + len(self.runs[start])
+    
+    def flush(self, fh):
+    
+        """flush(self, fh)
         
-        try:
+        Write the data held to the file object given in order of offset,
+        then flush the file object.
+        """
         
-            # Determine the file's relevant filetype and
-            # date words.
-            filetype_word, date_word = self.make_riscos_filetype_date(path)
-            
-            # Find the length of the file.
-            length = os.path.getsize(path)
-            
-            # Construct access attributes for the other client.
-            access_attr = self.to_riscos_access(path = path)
-            
-            # Use a default value for the object type.
-            object_type = 0x0101
+        for start in self.starts:
         
-        except OSError:
+            fh.seek(start, 0)
+            fh.write(self.runs[start])
         
-            print("Failed to find file: %s" % path)
-            return
+        fh.flush()
         
-        # Convert the filename into a RISC OS filename on the share.
-        directory, file = os.path.split(path)
+        self.starts = []
+        self.runs = {}
+        self.pending = 0
+    
+    def reserve(self, fh, start, amount):
+    
+        """reserve(self, fh, start, amount)
         
-        self.log("comment", "File to put: %s" % file, "", level = LOG_API)
+        Ask the system to allocate space for the range of the file object
+        given without changing its length, so that data written to it later
+        is stored together. Nothing is done where this is not supported.
+        """
         
-        _, _, ros_file = self.suffix_to_filetype(file)
+        if WriteBehind.libc is False:
         
-        self.log("comment", "Remote file: %s" % ros_file, "", level = LOG_API)
+            WriteBehind.libc = self._load()
         
-        # Determine whether the share path supplied refers to a file
-        # or a directory.
+        if WriteBehind.libc is None or amount <= 0:
         
-        info = self.open(ros_path)
+            return
         
-        if info is not None:
+        # FALLOC_FL_KEEP_SIZE leaves the length of the file unchanged, so
+        # that a transfer which fails does not leave it extended. Failures
+        # are ignored.
+        WriteBehind.libc.fallocate64(fh.fileno(), 1, start, amount)
+    
+    def _load(self):
+    
+        if not sys.platform.startswith("linux"):
         
-            self._close(info["handle"])
-            
-            if info["isdir"]:
-            
-                # A directory
-                
-                # Prefix the path in the share with the share name and append
-                # the filename to obtain a full share path to the object.
-                if ros_path != "":
-                
-                    ros_path = ros_path + "." + ros_file
-                
-                else:
-                
-                    ros_path = ros_file
-                
-                full_path = self.name + "." + ros_path
-            
-            else:
-            
-                # A file
-                
-                # Use the share path given and ignore the filename derived
-                # from the local path.
-                
-                full_path = self.name + "." + ros_path
+            return None
         
-        else:
+        try:
         
-            # No existing object
+            import ctypes.util
             
-            # Use the share path given and ignore the filename derived
-            # from the local path.
+            libc = ctypes.CDLL(
+                ctypes.util.find_library("c") or "libc.so.6", use_errno = True
+                )
             
-            full_path = self.name + "." + ros_path
+            libc.fallocate64.argtypes = [
+                ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64
+                ]
         
-        self.log("comment", "Remote path: %s" % ros_path, "", level = LOG_API)
+        except (OSError, AttributeError):
         
-        # Create a file on the remote server using the full path.
-        msg = ["A", 0x4, 0, full_path+"\x00"]
+            return None
         
-        # Send the request.
-        replied, data = self._send_request(msg, self.host, ["R"])
+        return libc
+
+
+class Buffer:
+
+    """Buffer()
+    
+    An in-memory file which data can be written to at any offset, holding
+    its contents in a single bytearray. Data written over data already held
+    replaces it, and gaps left between pieces of data are filled with zeros.
+    """
+    
+    def __init__(self):
+    
+        self.data = bytearray()
+        self.ptr = 0
+        self._length = 0
+    
+    def read(self):
+    
+        # Return the whole contents of the buffer.
+        return bytes(self.view())
+    
+    def view(self):
+    
+        """view = view(self)
         
-        if replied != 1:
+        Return a memoryview of the contents of the buffer. Writing to the
+        buffer while the view is in use may change the data it shows, or
+        leave it showing the old contents if the buffer grows.
+        """
         
-            return
+        self._extend(self._length)
+        return memoryview(self.data)[:self._length]
+    
+    def readinto(self, b):
+    
+        """count = readinto(self, b)
         
-        # The data returned represents the information about the newly
-        # created remote file.
-        info = self._read_file_info(data)
+        Read data from the current position into the buffer object given,
+        returning the number of bytes read.
+        """
         
-        if info is None or not info.has_key("handle"):
+        self._extend(self._length)
         
-            print("Cannot send file to client.")
-            return
+        count = max(0, min(len(b), self._length - self.ptr))
+        b[:count] = memoryview(self.data)[self.ptr:self.ptr + count]
+        self.ptr = self.ptr + count
         
-        # Send the file, from the start to  its length.
-        msg = ["A", 0xc, info["handle"], 0, length]
+        return count
+    
+    def write(self, data):
+    
+        end = self.ptr + len(data)
         
-        # Send the request.
-        replied, data = self._send_request(msg, self.host, ["w"])
+        # Extend the bytearray to hold the data, filling any gap before it
+        # with zeros, then replace the data held in its range.
+        self._extend(end)
+        self.data[self.ptr:end] = data
         
-        if replied != 1:
+        self.ptr = end
+        self._length = max(self.ptr, self._length)
+    
+    def _extend(self, length):
+    
+        # Fill the buffer with zeros up to the length given.
+        if len(self.data) < length:
         
-            # Tidy up.
-            self._close(info["handle"])
+            try:
             
-            # Use the share path rather than the full share path as the
-            # delete method will prepend the share name.
-            self.delete(ros_path)
-            return
+                self.data.extend(bytearray(length - len(self.data)))
+            
+            except BufferError:
+            
+                # Views of the contents are still in use, so extend a copy
+                # instead, leaving them referring to the old contents.
+                self.data = self.data + bytearray(length - len(self.data))
+    
+    def seek(self, ptr, from_end):
+    
+        if from_end == 0:
         
-        # A reply containing two words was returned. Presumably, the
-        # second is the length of the data to be sent and the first is
-        # the position in the file of the data requested (like the
-        # get method's "B" ... 0xb message.
-        reply_id = data[1:4]
-        from_addr = self.str2num(4, data[4:8])
-        to_addr = self.str2num(4, data[12:16])
-        amount = min(SEND_SIZE, to_addr - from_addr)
+            self.ptr = ptr
+        
+        elif from_end == 1:
+        
+            self.ptr = self.ptr + ptr
+        
+        else:
         
+            self.ptr = self._length - ptr
+    
+    def length(self):
+    
+        return self._length
+    
+    def set_length(self, length):
+    
+        # Discard any data beyond the new length, using a copy if views of
+        # the contents are still in use.
         try:
         
-            f = open(path, "rb")
+            del self.data[length:]
+        
+        except BufferError:
+        
+            self.data = self.data[:length]
+        
+        self._length = length
+    
+    def allocate(self, start, amount):
+    
+        # Do nothing.
+        return
+    
+    def flush(self):
+    
+        # Do nothing.
+        return
+    
+    def close(self):
+    
+        # Do nothing.
+        return
+
+class ReadAhead:
+
+    """ReadAhead(path, block_size = SEND_PPUT_SIZE, blocks = READ_AHEAD_BLOCKS)
+    
+    Read a local file ahead of its use in a background thread, filling a ring
+    of buffers with consecutive blocks using readinto. Requests for data which
+    has already been read are answered immediately; requests outside the data
+    being read ahead are read directly and the read-ahead restarted after
+    them, unless another reader is using it. Use the open_shared method to
+    obtain a reader sharing the data read ahead with other readers of the
+    same file.
+    """
+    
+    # Objects reading files ahead for more than one reader, indexed by path.
+    shared = {}
+    lock = threading.Lock()
+    
+    def __init__(self, path, block_size = SEND_PPUT_SIZE,
+                 blocks = READ_AHEAD_BLOCKS):
+    
+        # Use one file object for reading ahead and another for reading
+        # directly so that neither disturbs the other's position.
+        self.fh = open(path, "rb")
+        self.direct = open(path, "rb")
+        self.direct_lock = threading.Lock()
+        
+        st = os.fstat(self.fh.fileno())
+        self.length = st.st_size
+        self.block_size = block_size
+        
+        # The state of the file when it was opened, and the offsets last
+        # requested by each reader, which need the data from there on to be
+        # kept.
+        self.key = (block_size, blocks, st.st_size,
+                    getattr(st, "st_mtime_ns", st.st_mtime))
+        self.positions = {}
+        self.users = 0
+        
+        # Buffers not holding any data, and the buffers holding consecutive
+        # blocks of the file as (offset, length, buffer) tuples.
+        self.free = [bytearray(block_size) for i in range(blocks)]
+        self.filled = collections.deque()
+        
+        # Data between the base and next offsets is either held in the
+        # filled buffers or being read into a buffer.
+        self.base = 0
+        self.next = 0
+        
+        # Count restarts so that blocks read before a restart are discarded.
+        self.generation = 0
+        
+        self.error = None
+        self.closed = False
+        self.condition = threading.Condition()
+        
+        self.thread = threading.Thread(
+            group = None, target = self._read_ahead,
+            name = 'Read ahead "%s"' % path
+            )
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def _read_ahead(self):
+    
+        while 1:
+        
+            self.condition.acquire()
             
-            while from_addr < length:
+            try:
             
-                f.seek(from_addr, 0)
-                
-                # Send a message with the offset of that data within the
-                # file.
-                msg = ["d"+reply_id, from_addr]
-                
-                # Read the data to be sent.
-                file_data = f.read(amount)
-                
-                # Don't pad the data sent.
-                msg = self._encode(msg) + file_data
-                self.log(
-                    "comment",
-                    "%i bytes of data sent in message." % len(file_data),
-                    "",
-                    level = LOG_API
-                    )
+                # Wait for a free buffer and more of the file to read.
+                while not self.closed and \
+                      (not self.free or self.next >= self.length):
                 
-                # Wait for messages to arrive with the same ID as
-                # the one used to specify the file to be uploaded.
-                replied, data = self._send_and_expect_reply(
-                    s, msg, self.host, reply_id, ["w", "R"]
-                    )
+                    self.condition.wait()
                 
-                if replied != 1:
+                if self.closed:
                 
-                    # Tidy up.
-                    self._close(info["handle"])
-                    
-                    # Use the share path rather than the full share path as the
-                    # delete method will prepend the share name.
-                    self.delete(ros_path)
-                    
-                    f.close()
-                    
-                    print("Uploading was terminated.")
                     return
                 
-                command = self.cmd2str(data[0])
-                #pos = pos + amount
-                if command == "w":
-                
-                    # More data requested.
-                    reply_id = self.replyid2str(data[1:4])
-                    from_addr = self.str2num(4, data[4:8])
-                    to_addr = self.str2num(4, data[12:16])
-                    amount = min(SEND_SIZE, to_addr - from_addr)
-                
-                elif command == "R":
-                
-                    from_addr = self.str2num(4, data[4:8])
-                    total_length = self.str2num(4, data[8:12])
-                    break
-                
-                sys.stdout.write(
-                    "\rWritten %i/%i bytes of file %s" % (
-                        from_addr, length, ros_path
-                        )
-                    )
-                sys.stdout.flush()
+                buf = self.free.pop()
+                offset = self.next
+                generation = self.generation
+                self.next = offset + self.block_size
             
-            # When all the data has been sent, send an empty "d" message.
-            msg = ["d"+reply_id, length]
+            finally:
             
-            self._send_list(msg, s, (self.host, 49171))
+                self.condition.release()
             
-            sys.stdout.write(
-                '\rFile "%s" (%i bytes) successfully written to "%s"' % (
-                    path, length, ros_path
-                    )
-                )
-            sys.stdout.flush()
-        
-        except IOError:
-        
-            # Tidy up.
-            self._close(info["handle"])
+            # Read outside the lock so that buffered data can be used while
+            # the disk is busy.
+            try:
             
-            # Use the share path rather than the full share path as the
-            # delete method will prepend the share name.
-            self.delete(ros_path)
+                self.fh.seek(offset, 0)
+                n = self.fh.readinto(buf)
+                error = None
             
-            print("Uploading was terminated.")
-            return
+            except IOError:
+            
+                n = 0
+                error = sys.exc_info()[1]
+            
+            self.condition.acquire()
+            
+            if generation != self.generation:
+            
+                # The read-ahead was restarted while this block was read.
+                self.free.append(buf)
+            
+            elif error is not None:
+            
+                self.free.append(buf)
+                self.error = error
+            
+            else:
+            
+                self.filled.append((offset, n, buf))
+            
+            self.condition.notify_all()
+            self.condition.release()
+    
+    @classmethod
+    def open_shared(cls, path, block_size = SEND_PPUT_SIZE,
+                    blocks = READ_AHEAD_BLOCKS):
+    
+        """reader = open_shared(cls, path, block_size = SEND_PPUT_SIZE,
+                                blocks = READ_AHEAD_BLOCKS)
         
-        # Set the filetype and date stamp.
-        msg = [ "A", 0x10, info["handle"], filetype_word, date_word ]
+        Return a ReadAheadReader for the file at the path given, sharing the
+        data read ahead with any other readers of the file unless it has
+        been modified since they started. The reader must be closed when it
+        is no longer needed.
+        """
         
-        # Send the request.
-        replied, data = self._send_request(msg, self.host, ["R"])
+        st = os.stat(path)
+        key = (block_size, blocks, st.st_size,
+               getattr(st, "st_mtime_ns", st.st_mtime))
         
-        if replied != 1:
+        cls.lock.acquire()
         
-            # Tidy up.
-            self._close(info["handle"])
+        try:
+        
+            read_ahead = cls.shared.get(path)
             
-            # Use the share path rather than the full share path as the
-            # delete method will prepend the share name.
-            self.delete(ros_path)
-            return
+            if read_ahead is None or read_ahead.key != key:
+            
+                read_ahead = cls.shared[path] = cls(path, block_size, blocks)
+            
+            read_ahead.users += 1
+            return ReadAheadReader(read_ahead)
         
-        # Tidy up.
-        self._close(info["handle"])
+        finally:
+        
+            cls.lock.release()
     
-    def pput(self, path, ros_path):
+    @classmethod
+    def forget(cls, path):
     
-        # Use the non-broadcast socket.
-        if not 49171 in self.ports:
+        # Stop sharing the data read ahead for the path given with new
+        # readers, as the file has changed.
+        cls.lock.acquire()
+        cls.shared.pop(path, None)
+        cls.lock.release()
+    
+    def pause(self, reader):
+    
+        # Forget the offset last requested by the reader given until it
+        # reads again.
+        self.condition.acquire()
+        self.positions.pop(reader, None)
+        self.condition.notify_all()
+        self.condition.release()
+    
+    def release(self, reader):
+    
+        """release(self, reader)
         
-            print("No socket to use for port %i" % 49171)
-            return 0, []
+        Remove a reader obtained using open_shared, closing this object when
+        it has no readers left.
+        """
         
-        s = self.ports[49171]
+        self.pause(reader)
+        
+        ReadAhead.lock.acquire()
         
         try:
         
-            # Determine the file's relevant filetype and
-            # date words.
-            filetype_word, date_word = self.make_riscos_filetype_date(path)
+            self.users -= 1
             
-            # Find the length of the file.
-            length = os.path.getsize(path)
+            if self.users > 0:
             
-            # Construct access attributes for the other client.
-            access_attr = self.to_riscos_access(path = path)
+                return
             
-            # Use a default value for the object type.
-            object_type = 0x0101
-        
-        except OSError:
-        
-            print("Failed to find file: %s" % path)
-            return
-        
-        # Convert the filename into a RISC OS filename on the share.
-        directory, file = os.path.split(path)
+            for path, read_ahead in list(ReadAhead.shared.items()):
+            
+                if read_ahead is self:
+                
+                    del ReadAhead.shared[path]
         
-        self.log("comment", "File to put: %s" % file, "", level = LOG_API)
+        finally:
         
-        _, _, ros_file = \
-            self.suffix_to_filetype(file)
+            ReadAhead.lock.release()
         
-        self.log("comment", "Remote file: %s" % ros_file, "", level = LOG_API)
+        self.close()
+    
+    def read(self, offset, amount, reader = None):
+    
+        """data = read(self, offset, amount, reader = None)
         
-        # Determine whether the share path supplied refers to a file
-        # or a directory.
+        Return up to the amount of data requested from the offset given.
+        Less data is returned if the data requested crosses the end of a
+        block. Data returned from a buffer is valid until the next call for
+        the same reader.
+        """
         
-        info = self.open(ros_path)
+        self.condition.acquire()
         
-        if info is not None:
+        try:
         
-            self._close(info["handle"])
+            self.positions[reader] = offset
             
-            if info["isdir"]:
+            while 1:
             
-                # A directory
+                # Release buffers holding data before the offsets requested
+                # by all the readers, assuming that it will not be requested
+                # again.
+                lowest = min(self.positions.values())
                 
-                # Prefix the path in the share with the share name and append
-                # the filename to obtain a full share path to the object.
-                if ros_path != "":
+                while self.filled and \
+                      self.filled[0][0] + self.filled[0][1] <= lowest:
                 
-                    ros_path = ros_path + "." + ros_file
+                    o, n, buf = self.filled.popleft()
+                    self.free.append(buf)
+                    self.base = o + self.block_size
+                    self.condition.notify_all()
                 
-                else:
+                for o, n, buf in self.filled:
                 
-                    ros_path = ros_file
+                    if o <= offset < o + n:
+                    
+                        end = min(offset + amount, o + n)
+                        return memoryview(buf)[offset - o:end - o]
                 
-                full_path = self.name + "." + ros_path
-            
-            else:
-            
-                # A file
+                # Wait for the data if it is being read, otherwise read it
+                # directly.
+                if self.error is not None or \
+                   not (self.base <= offset < min(self.next, self.length)):
                 
-                # Use the share path given and ignore the filename derived
-                # from the local path.
+                    break
                 
-                full_path = self.name + "." + ros_path
+                self.condition.wait()
         
-        else:
+        finally:
         
-            # No existing object
-            
-            # Use the share path given and ignore the filename derived
-            # from the local path.
-            
-            full_path = self.name + "." + ros_path
+            self.condition.release()
         
-        self.log("comment", "Remote path: %s" % ros_path, "", level = LOG_API)
+        self.direct_lock.acquire()
         
-        # Create a file on the remote server using the full share path.
-        msg = ["A", 0x4, 0, full_path+"\x00"]
+        try:
         
-        # Send the request.
-        replied, data = self._send_request(msg, self.host, ["R"])
+            self.direct.seek(offset, 0)
+            data = self.direct.read(amount)
         
-        if replied != 1:
+        finally:
         
-            return
+            self.direct_lock.release()
         
-        # The data returned represents the information about the newly
-        # created remote file.
-        info = self._read_file_info(data)
+        self.condition.acquire()
         
-        if info is None or not info.has_key("handle"):
+        # Restart reading ahead from the end of the data read unless another
+        # reader is using the data being read ahead.
+        for other, position in self.positions.items():
         
-            print("Cannot send file to client.")
-            return
+            if other is not reader and self.base <= position < self.next:
+            
+                break
         
-        try:
+        else:
         
-            f = open(path, "rb")
+            self.generation = self.generation + 1
             
-            start_addr = 0
+            while self.filled:
             
-            while start_addr < length:
+                self.free.append(self.filled.popleft()[2])
             
-                # Send the file, from the start to  its length.
-                next_addr = min(length, start_addr + SEND_PPUT_SIZE)
-                
-                # Send the start offset into the file and the amount of data
-                # to be transferred.
-                msg = [ "A", 0xc, info["handle"], start_addr,
-                        next_addr - start_addr ]
-                
-                # Send the request.
-                replied, data = self._send_request(msg, self.host, ["w"])
-                
-                if replied != 1:
-                
-                    # Tidy up.
-                    self._close(info["handle"])
-                    
-                    # Use the share path rather than the full share path as the
-                    # delete method will prepend the share name.
-                    self.delete(ros_path)
-                    return
-                
-                # A reply containing two words was returned. These are the
-                # start and end offsets into the file relative to the
-                # start offset we gave previously.
-                
-                from_addr = start_addr
-                
-                while 1:
-                
-                    command = self.cmd2str(data[0])
-                    if command == "w":
-                    
-                        # More data requested.
-                        reply_id = self.replyid2str(data[1:4])
-                        
-                        # Convert the relative addresses into absolute ones.
-                        from_addr = start_addr + self.str2num(4, data[4:8])
-                        
-                        to_addr = start_addr + \
-                            min(self.str2num(4, data[12:16]), next_addr)
-                            
-                        amount = min(SEND_SIZE, to_addr - from_addr)
-                    
-                    elif command == "R":
-                    
-                        # Convert the relative addresses into absolute ones.
-                        from_addr = start_addr + self.str2num(4, data[4:8])
-                        #total_length = start_addr + self.str2num(4, data[8:12])
-                        break
-                    
-                    f.seek(from_addr, 0)
-                    
-                    # Send a message with the offset of that data within the
-                    # file. The address sent is relative to the start of the
-                    # block specified.
-                    msg = ["d"+reply_id, from_addr - start_addr]
-                    
-                    # Read the data to be sent.
-                    file_data = f.read(amount)
-                    
-                    # Don't pad the data sent.
-                    msg = self._encode(msg) + file_data
-                    self.log(
-                        "comment",
-                        "%i bytes of data sent in message." % len(file_data),
-                        "",
-                        level = LOG_API
-                        )
-                    
-                    # Send the reply as a string.
-                    s.sendto(msg, (self.host, 49171))
-                    
-                    # Send a message with the amount of data specified.
-                    # The address sent is relative to the start of the
-                    # block specified.
-                    msg = ["d", from_addr - start_addr]
-    
-                    # Wait for messages to arrive with the same ID as
-                    # the one used to specify the file to be uploaded.
-                    replied, data = self._send_request(
-                        msg, self.host, ["w", "R"], new_id = reply_id
-                        )
-                    
-                    if replied != 1:
-                    
-                        # Tidy up.
-                        self._close(info["handle"])
-                        
-                        # Use the share path rather than the full share path as the
-                        # delete method will prepend the share name.
-                        self.delete(ros_path)
-                        
-                        f.close()
-                        
-                        print("Uploading was terminated.")
-                        return
-                
-                #pos = pos + amount
-                sys.stdout.write(
-                    "\rWritten %i/%i bytes of file %s" % (
-                        from_addr, length, ros_path
-                        )
-                    )
-                sys.stdout.flush()
-                
-                # Increase the start position.
-                start_addr = next_addr
-            
-            # When all the data has been sent, send an empty "d" message.
-            msg = ["d"+reply_id, length]
-            
-            self._send_list(msg, s, (self.host, 49171))
+            self.base = self.next = offset + len(data)
+            self.error = None
             
-            sys.stdout.write(
-                '\rFile "%s" (%i bytes) successfully written to "%s"' % (
-                    path, length, ros_path
-                    )
-                )
-            sys.stdout.flush()
-        
-        except IOError:
-        
-            # Tidy up.
-            self._close(info["handle"])
-            
-            # Use the share path rather than the full share path as the
-            # delete method will prepend the share name.
-            self.delete(ros_path)
-            
-            print("Uploading was terminated.")
-            return
-        
-        # Set the filetype and date stamp.
-        msg = [ "A", 0x10, info["handle"], filetype_word, date_word ]
+            self.condition.notify_all()
         
-        # Send the request.
-        replied, data = self._send_request(msg, self.host, ["R"])
+        self.condition.release()
         
-        if replied != 1:
+        return data
+    
+    def close(self):
+    
+        self.condition.acquire()
+        self.closed = True
+        self.condition.notify_all()
+        self.condition.release()
         
-            # Tidy up.
-            self._close(info["handle"])
-            
-            # Use the share path rather than the full share path as the
-            # delete method will prepend the share name.
-            self.delete(ros_path)
-            return
+        self.thread.join()
         
-        # Tidy up.
-        self._close(info["handle"])
+        self.fh.close()
+        self.direct.close()
+
+class ReadAheadReader(object):
+
+    """ReadAheadReader(read_ahead)
     
-    def delete(self, ros_path):
+    A reader of a file using the data read ahead by a shared ReadAhead
+    object, keeping its own position in the file.
+    """
     
-        """delete(self, ros_path)
-        
-        Delete the named file on the specified host.
-        """
+    __slots__ = ("read_ahead",)
+    
+    # The data returned is only valid until the next read.
+    persistent = False
+    
+    def __init__(self, read_ahead):
+    
+        self.read_ahead = read_ahead
+    
+    def read(self, offset, amount):
+    
+        return self.read_ahead.read(offset, amount, self)
+    
+    def pause(self):
+    
+        # Let the data read ahead be released until the next read.
+        self.read_ahead.pause(self)
+    
+    def close(self):
+    
+        if self.read_ahead is not None:
         
-        name = self.name
+            self.read_ahead.release(self)
+            self.read_ahead = None
+
+class DirectFileReader(object):
+
+    """DirectFileReader(path)
+    
+    A reader of a local file which reads each block requested into a buffer
+    of its own, returning views of the buffers which remain valid after
+    further reads.
+    """
+    
+    __slots__ = ("fh",)
+    
+    # The data returned remains valid until it is discarded.
+    persistent = True
+    
+    def __init__(self, path):
+    
+        self.fh = open(path, "rb")
+    
+    def read(self, offset, amount):
+    
+        buf = bytearray(amount)
         
-        if ros_path != "":
+        self.fh.seek(offset, 0)
+        n = self.fh.readinto(buf)
         
-            name = name + "." + ros_path
+        return memoryview(buf)[:n]
+    
+    def pause(self):
+    
+        # Do nothing.
+        return
+    
+    def close(self):
+    
+        self.fh.close()
+
+class CatalogueCache:
+
+    """CatalogueCache(size = CATALOGUE_CACHE_SIZE)
+    
+    Catalogues of directories, indexed by path, which are kept only while
+    the directories are watched for changes to the objects in them, and
+    which are valid until the device, inode or modification time of a
+    directory changes. The least recently used catalogues are discarded to
+    keep the total size of their encoded entries below the size given.
+    """
+    
+    def __init__(self, size = CATALOGUE_CACHE_SIZE):
+    
+        self.size = size
+        self.used = 0
         
-        msg = ["A", 0x6, 0, name + "\x00"]
+        # Map paths to (key, catalogue, size) tuples in order of use.
+        self.catalogues = collections.OrderedDict()
         
-        replied, data = self._send_request(msg, self.host, ["R"])
+        # Map watched paths to the number of times their catalogues have
+        # been discarded.
+        self.watched = {}
+        self.lock = threading.Lock()
+    
+    def watch(self, path):
+    
+        """watch(self, path)
         
-        if replied == 1:
+        Allow catalogues of the path to be kept now that changes to it are
+        reported by calling the discard method.
+        """
         
-            sys.stdout.write('Deleted "%s" on "%s"' % (name, self.host))
-            sys.stdout.flush()
+        self.lock.acquire()
+        self.watched.setdefault(path, 0)
+        self.lock.release()
     
-    def rename(self, name1, name2):
+    def unwatch(self, path):
     
-        msg = ["A", 0x9, len(name2), 0, name1 + "\x00"]
+        """unwatch(self, path)
         
-        replied, data = self._send_request(msg, self.host, ["R"])
+        Discard the catalogue of the path and stop keeping catalogues of it
+        because changes to it are no longer reported.
+        """
         
-        if replied != 1:
+        self.lock.acquire()
         
-            return
+        try:
         
-        # The data returned represents the information about the file.
-        info = self._read_file_info(data)
+            self.watched.pop(path, None)
+            self._remove(path)
         
+        finally:
         
+            self.lock.release()
     
-    def setmode(self, ros_path, mode):
+    def generation(self, path):
     
-        name = self.name
-        
-        if ros_path != "":
+        """generation = generation(self, path)
         
-            name = name + "." + ros_path
+        Return a value to pass to the put method with a catalogue of the path
+        made after calling this method, or None if the path is not watched.
+        """
         
-        access_attr = self.to_riscos_access(mode = mode)
+        return self.watched.get(path)
+    
+    def get(self, path, key):
+    
+        """catalogue = get(self, path, key)
         
-        msg = ["A", 0x7, access_attr, 0, name+"\x00"]
+        Return the catalogue for the path if it was stored with the same key,
+        otherwise return None.
+        """
         
-        replied, data = self._send_request(msg, self.host, ["R"])
+        self.lock.acquire()
         
-        if replied != 1:
+        try:
         
-            return
+            item = self.catalogues.pop(path, None)
+            
+            if item is None:
+            
+                return None
+            
+            if item[0] != key:
+            
+                # The directory has changed.
+                self.used = self.used - item[2]
+                return None
+            
+            # Move the catalogue to the most recently used end.
+            self.catalogues[path] = item
+            return item[1]
         
-        # Read the information returned.
-        info = self._read_file_info(data)
+        finally:
         
-        return info
+            self.lock.release()
     
-    def settype(self, ros_path, filetype):
+    def put(self, path, key, catalogue, size, generation):
     
-        #name = self.name
-        #
-        #if ros_path != "":
-        #
-        #    name = name + "." + ros_path
+        self.lock.acquire()
         
-        # Prefixing the path with the share name does not always work.
-        name = ros_path
+        try:
         
-        # Obtain information on the file (open it).
-        info = self.open(name)
+            self._remove(path)
+            
+            # Only keep the catalogue if the path is still watched and has
+            # not changed since the catalogue was started.
+            if generation is None or self.watched.get(path) != generation:
+            
+                return
+            
+            if size > self.size:
+            
+                return
+            
+            self.catalogues[path] = (key, catalogue, size)
+            self.used = self.used + size
+            
+            # Discard the least recently used catalogues.
+            while self.used > self.size:
+            
+                old_path, old = self.catalogues.popitem(last = False)
+                self.used = self.used - old[2]
         
-        cs = self.to_riscos_time(ttuple = info["date"])
+        finally:
         
-        filetype_word, date_word = \
-            self._make_riscos_filetype_date(filetype, cs)
+            self.lock.release()
+    
+    def discard(self, path):
+    
+        self.lock.acquire()
         
-        msg = ["A", 0x10, info["handle"], filetype_word, date_word]
+        try:
         
-        replied, data = self._send_request(msg, self.host, ["R"])
+            self._remove(path)
+            
+            if path in self.watched:
+            
+                # Catalogues started before now may be out of date.
+                self.watched[path] = self.watched[path] + 1
         
-        if replied != 1:
+        finally:
         
-            # RISC OS 5 always returns a "Not Found" error.  I don't know why.
-            if replied == -1 and data[1].startswith("Not found"):
-
-                pass
+            self.lock.release()
+    
+    def clear(self):
+    
+        self.lock.acquire()
+        self.catalogues.clear()
+        self.watched.clear()
+        self.used = 0
+        self.lock.release()
+    
+    def _remove(self, path):
+    
+        old = self.catalogues.pop(path, None)
+        
+        if old is not None:
+        
+            self.used = self.used - old[2]
 
-            else:
+class DirectoryIndex(object):
 
-                return
-        
-        self._close(info["handle"])
+    """DirectoryIndex(names)
     
-    def create_directory(self, ros_path):
+    The names of the objects in a directory, indexed by each stem which
+    comes before an extension or filetype separator in them, so that the
+    object for a name from RISC OS can be found without listing the
+    directory again.
+    """
     
-        """create_directory(self, ros_path)
-        
-        Create a directory at a location within the share.
-        """
+    __slots__ = ("names", "stems", "found")
+    
+    def __init__(self, names):
+    
+        # Map names to themselves and (separator, stem) pairs to the names
+        # which start with them, comparing names as the filesystem does.
+        self.names = {}
+        self.stems = {}
         
-        name = self.name
+        # Remember the results of previous searches.
+        self.found = {}
         
-        if ros_path != "":
+        for name in names:
         
-            name = name + "." + ros_path
+            key = os.path.normcase(name)
+            self.names[key] = name
+            
+            for separator in (os.extsep, DEFAULT_FILETYPE_SEPARATOR):
+            
+                at = key.find(separator)
+                
+                while at != -1:
+                
+                    self.stems.setdefault((separator, key[:at]), []).append(name)
+                    at = key.find(separator, at + 1)
+    
+    def find(self, stem, suffix = ""):
+    
+        """name = find(self, stem, suffix = "")
         
-        msg = ["A", 0x5, 0, name + "\x00"]
+        Return the name of the object with the stem and suffix given, with
+        the default suffix, or with any single extension or filetype suffix,
+        in that order, or None if there is no unique match.
+        """
         
-        replied, data = self._send_request(msg, self.host, ["R"])
+        key = (stem, suffix)
         
-        if replied != 1:
+        try:
         
-            return None
+            return self.found[key]
         
-        sys.stdout.write('Created "%s" on share "%s"' % (name, self.host))
-        sys.stdout.flush()
+        except KeyError:
         
-        # Read the information returned.
-        info = self._read_file_info(data)
+            pass
         
-        return info
-
-
-
-class PrinterError(Exception):
-
-    pass
+        name = None
+        
+        for candidate in (stem + suffix, stem + DEFAULT_SUFFIX):
+        
+            name = self.names.get(os.path.normcase(candidate))
+            
+            if name is not None:
+            
+                break
+        
+        else:
+        
+            for separator in (os.extsep, DEFAULT_FILETYPE_SEPARATOR):
+            
+                names = self.stems.get((separator, os.path.normcase(stem)))
+                
+                if names is not None and len(names) == 1:
+                
+                    # Unique match
+                    name = names[0]
+                    break
+        
+        self.found[key] = name
+        return name
 
-class Printer(Ports):
+class PathResolver:
 
-    def __init__(self, name, directory, defn, description, delay, command):
+    """PathResolver(size = RESOLVE_CACHE_SIZE, ttl = RESOLVE_CACHE_TTL)
     
-        # Call the initialisation method of the base classes.
-        Ports.__init__(self)
+    Indexes of the names in directories, which are valid until the device,
+    inode or modification time of each directory changes, and the results
+    of checking the permissions along paths, which are also only valid for
+    the time given since changing the permissions of an object does not
+    change its directory. The least recently used indexes are discarded to
+    keep the number of directories below the size given.
+    """
+    
+    def __init__(self, size = RESOLVE_CACHE_SIZE, ttl = RESOLVE_CACHE_TTL):
+    
+        self.size = size
+        self.ttl = ttl
         
-        self.name = name
-        self.directory = directory
-        self.defn = defn
-        self.description = description
-        self.delay = delay
-        self.command = command
+        # Map directory paths to (key, index) tuples in order of use.
+        self.indexes = collections.OrderedDict()
         
-        # Ensure that the directory structure is correctly set up.
-        self.setup()
+        # Map (path, share_check_mode, check_mode) tuples to
+        # (expiry, key, path, names) tuples.
+        self.verdicts = {}
+        self.lock = threading.Lock()
         
-        # Create an event to use to inform the share that it must be
-        # removed.
-        self.event = threading.Event()
+        self.counters = {"hits": 0, "misses": 0, "verdict hits": 0,
+                         "verdict misses": 0}
+    
+    def _key(self, path):
+    
+        # Return the key identifying the current state of a directory, and
+        # whether the directory has stayed unmodified long enough for the
+        # key to change if it is modified again, or None if it cannot be
+        # read.
+        try:
         
-        # Create a thread to run the printer broadcast loop.
-        self.thread = threading.Thread(
-            group = None, target = self.broadcast_printer,
-            name = 'Printer "%s"' % self.name
-            )
+            st = os.stat(path)
         
-        # Start the thread.
-        self.thread.start()
+        except OSError:
+        
+            return None, 0
+        
+        key = (st.st_dev, st.st_ino, getattr(st, "st_mtime_ns", st.st_mtime))
+        return key, time.time() - st.st_mtime > CATALOGUE_CACHE_SETTLE
     
-    def setup(self):
+    def index(self, directory):
     
-        # Copy the printer definition file into the printer share directory.
-        try:
+        """index = index(self, directory)
         
-            new_path = os.path.join(self.directory, self.name) + \
-                os.extsep + "fc6"
-            
-            open(new_path, "wb").write(open(self.defn, "rb").read())
+        Return the index of the names in the directory given, or None if it
+        cannot be read.
+        """
         
-        except IOError:
+        key, settled = self._key(directory)
         
-            raise PrinterError("Definition file not found.")
+        if key is None:
+        
+            return None
+        
+        self.lock.acquire()
         
-        # Create the RemQueue and RemSpool directories inside the printer
-        # share directory.
         try:
         
-            os.chmod(new_path, UNPROTECTED_READ | UNPROTECTED_WRITE | FILE_ATTR)
-            
-            if not os.path.isdir(os.path.join(self.directory, "RemQueue")):
-            
-                os.mkdir(os.path.join(self.directory, "RemQueue"))
+            item = self.indexes.pop(directory, None)
             
-            os.chmod(
-                os.path.join(self.directory, "RemQueue"),
-                DIR_EXEC | UNPROTECTED_READ | USER_WRITE
-                )
+            if item is not None and item[0] == key:
             
-            if not os.path.isdir(os.path.join(self.directory, "RemSpool")):
-            
-                os.mkdir(os.path.join(self.directory, "RemSpool"))
+                # Move the index to the most recently used end.
+                self.indexes[directory] = item
+                self.counters["hits"] += 1
+                return item[1]
             
-            os.chmod(
-                os.path.join(self.directory, "RemSpool"),
-                DIR_EXEC | UNPROTECTED_READ | USER_WRITE
-                )
+            self.counters["misses"] += 1
         
-        except OSError:
+        finally:
         
-            raise PrinterError("Failed to create printer share subdirectories.")
-    
-    def broadcast_printer(self):
-    
-        """broadcast_printer(self)
+            self.lock.release()
         
-        Broadcast the availability of a printer every few seconds.
-        """
+        try:
         
-        # Broadcast the availability of the printer on the polling socket.
+            index = DirectoryIndex(os.listdir(directory))
         
-        if not 32770 in self.broadcasters:
+        except OSError:
         
-            print("No socket to use for port %i" % 32770)
-            return
+            return None
         
-        s = self.broadcasters[32770]
+        # Keep the index unless the directory was modified so recently that
+        # a further change might not alter its modification time.
+        if settled:
         
-        data = \
-        [
-            0x00020002, 0x00010000,
-            (len(self.description) << 16) | len(self.name),
-            self.name + self.description
-        ]
+            self.lock.acquire()
+            self.indexes[directory] = (key, index)
+            
+            while len(self.indexes) > self.size:
+            
+                self.indexes.popitem(last = False)
+            
+            self.lock.release()
         
-        self._send_list(data, s, (Broadcast_addr, 32770))
+        return index
+    
+    def verdict(self, check):
+    
+        """path, names = verdict(self, check)
         
-        data = \
-        [
-            0x00020004, 0x00010000,
-            (len(self.description) << 16) | len(self.name),
-            self.name + self.description
-        ]
+        Return the result of descending a path recorded for the check given,
+        as a (path, names) tuple, or None if there is no valid result.
+        """
         
-        while 1:
+        self.lock.acquire()
         
-            self.event.wait(self.delay)
-            if self.event.isSet(): return
-            
-            self._send_list(data, s, (Broadcast_addr, 32770))
+        try:
         
-        # Broadcast that the share has now been removed.
+            item = self.verdicts.get(check)
         
-        s = self.broadcasters[32770]
+        finally:
         
-        data = \
-        [
-            0x00020003, 0x00010000, 0x00010000 | len(self.name),
-            self.name + chr(self.share_type)
-        ]
+            self.lock.release()
         
-        self._send_list(data, s, (Broadcast_addr, 32770))
+        # The result is only valid while the directory containing the path
+        # is unchanged.
+        if item is None or item[0] < time.time() or \
+            item[1] != self._key(os.path.dirname(check[0]))[0]:
+        
+            self.counters["verdict misses"] += 1
+            return None
+        
+        self.counters["verdict hits"] += 1
+        return item[2], item[3]
     
-
-
-
-class Peer(Ports):
-
-    def __init__(self, access_plus = 1):
+    def keep_verdict(self, check, path, names):
     
-        # Call the initialisation method of the base classes.
-        Ports.__init__(self, access_plus)
+        key, settled = self._key(os.path.dirname(check[0]))
         
-        # Record the ports in use.
-        self.use_ports = []
+        if key is None or not settled:
         
-        for port, value in self.ports.items():
+            return
         
-            if value is not None:
-            
-                self.use_ports.append(port)
+        now = time.time()
         
-        # ---------------------------------------------------------------------
-        # Socket configuration
+        self.lock.acquire()
         
-        self.identity = self.number(4, id(self))
+        try:
         
-        # ---------------------------------------------------------------------
-        # Thread configuration
+            if len(self.verdicts) >= self.size:
+            
+                # Discard expired results, or all of them if none have expired.
+                for old_check, item in list(self.verdicts.items()):
+                
+                    if item[0] < now:
+                    
+                        del self.verdicts[old_check]
+                
+                if len(self.verdicts) >= self.size:
+                
+                    self.verdicts.clear()
+            
+            self.verdicts[check] = (now + self.ttl, key, path, names)
         
-        # Create an event to use to terminate the polling thread.
-        self.poll_event = threading.Event()
+        finally:
         
-        # Create a thread to call the broadcast_poll method of the
-        # access object.
-        self.poll_thread = threading.Thread(
-            group = None, target = self.broadcast_poll,
-            name = "Poller", args = (self.poll_event,)
-            )
+            self.lock.release()
+    
+    def forget(self, directory = None):
+    
+        """forget(self, directory = None)
         
-        # Create an event to use to inform the listening thread that it
-        # must terminate.
-        self.listen_event = threading.Event()
+        Discard the index of the directory given, or all indexes if no
+        directory is given, and the results of all permission checks.
+        """
         
-        # Create a thread to use to listen for packets sent directly to
-        # our machine.
-        self.listen_thread = threading.Thread(
-            group = None, target = self.listen,
-            name = "Listener", args = (self.listen_event,)
-            )
+        self.lock.acquire()
         
-        # ---------------------------------------------------------------------
-        # Resources configuration
+        if directory is None:
         
-        self._log = []
+            self.indexes.clear()
         
-        # Maintain a dictionary of known clients, shares and printers.
-        # Each of these will use a separate thread.
-        self.clients = {}
-        self.shares = {}
-        self.printers = {}
-        self.transfers = {}
+        else:
         
-        # Keep a dictionary of events to use to communicate with threads.
-        self.printer_events = {}
-        self.transfer_events = {}
+            self.indexes.pop(directory, None)
         
-        # Keep a cache for the directory catalogue
-        self.catalogue_cache = {}
-        self.cache_send_info = {}
-
-        # Create lists of messages sent to each listening socket.
+        self.verdicts.clear()
+        self.lock.release()
+    
+    def statistics(self):
+    
+        self.lock.acquire()
         
-        # General messages.
-        self.general_messages = Messages()
+        try:
         
-        # Messages about shares.
-        self.share_messages = Messages()
+            stats = dict(self.counters)
+            stats["directories"] = len(self.indexes)
+            stats["verdicts"] = len(self.verdicts)
+            return stats
         
-        # Use an object to manage the file handles used by shares owned by
-        # this Peer.
-        self.file_handler = Files()
-
-        # Use an object to record all catalogued paths
-        self.catalogued_paths = {}
-        self.catalogued_paths_lock = threading.Lock()
+        finally:
         
-        # Maintain a dictionary of open shares, on the local host or
-        # on other hosts.
-        # Each entry in this dictionary is referenced by a tuple containing
-        # the name of the share and the host it resides on and contains the
-        # ID value used to open it.
-        self.open_shares = {}
+            self.lock.release()
 
-        # Maintain a dictionary of usernames we have logged on as
-        # Each entry contains the password key
-        self.access_users = {}
+class Listing(object):
 
-        # List of hosts on different subnets that are permitted to talk to us
-        self.remote_nets = []
+    """Listing
+    
+    The encoded chunks of a catalogue being sent to another client, the
+    number of the last chunk sent and the marker sent with it.
+    """
+    
+    __slots__ = ("chunks", "sent", "marker", "size", "used")
+    
+    def __init__(self, chunks):
+    
+        self.chunks = chunks
+        self.sent = 0
+        self.marker = None
+        self.size = sum([len(data) for infolen, data in chunks])
+        self.used = time.time()
+
+class ListingCache:
+
+    """ListingCache(size = LISTING_CACHE_SIZE, ttl = LISTING_CACHE_TTL)
+    
+    Catalogues being sent to other clients in chunks, indexed by directory
+    handle and client address. Listings not used for the time given are
+    discarded, since clients may abandon them, as are the least recently
+    used listings when the total size of their chunks exceeds the size
+    given. Hits, misses and listings evicted or expired are counted.
+    """
+    
+    def __init__(self, size = LISTING_CACHE_SIZE, ttl = LISTING_CACHE_TTL):
+    
+        self.size = size
+        self.ttl = ttl
+        self.used = 0
         
-        # Start serving.
-        self.serve()
+        # Map keys to Listing objects in order of use.
+        self.listings = collections.OrderedDict()
+        self.lock = threading.Lock()
         
-        # Read the share configuration file, creating shares as required.
-        self.create_shares()
+        self.counters = {"hits": 0, "misses": 0, "evicted": 0, "expired": 0}
     
-    def __del__(self):
+    def get(self, key):
     
-        # Stop any serving threads.
-        self.stop()
+        """listing = get(self, key)
         
-        # Close all sockets.
-        for port, _socket in self.broadcasters.items():
+        Return the listing stored with the key given, or None if there is
+        none.
+        """
         
-            sys.stdout.write("Closing broadcaster socket for port %i\n" % port)
-            _socket.close()
+        self.lock.acquire()
         
-        # On Windows, port sockets are a copy of broadcast sockets,
-        # so don't bother to close them
-        if not sys.platform.startswith('win32'):
-
-            for port, _socket in self.ports.items():
+        try:
         
-                sys.stdout.write("Closing socket for port %i\n" % port)
-                _socket.close()
+            self._expire()
+            
+            listing = self.listings.pop(key, None)
+            
+            if listing is None:
+            
+                self.counters["misses"] += 1
+                return None
+            
+            # Move the listing to the most recently used end.
+            listing.used = time.time()
+            self.listings[key] = listing
+            self.counters["hits"] += 1
+            
+            return listing
+        
+        finally:
+        
+            self.lock.release()
     
-    def _encode_pin_char(self, c):
-
-        if (c.isdigit()):
-
-            return (ord(c) - ord('0')) + 1
-
-        elif c.isalpha():
-
-            v = ord(c.upper()) - ord('A')
-
-            if v > 25:
-
-                raise PasswordError("Password char is invalid: %s" % c)
-
-            return v + 11
-
-        else:
-
-            raise PasswordError("Password char is invalid: %s" % c)
-
-        return 0
-
-    def _make_pin(self, str):
-
-        if len(str) > 6:
-
-            return None
-
-        pin = ctypes.c_uint(0)
-
-        for c in str:
-
-            pin.value = (pin.value * 0x25) + self._encode_pin_char(c)
-
-        return int(pin.value)
-
-    def cleanup_handles(self, host):
-
-        for share in self.shares.values():
-
-            if isinstance(share, Share):
-
-                share.cleanup_handles(host)
-
-        for handle, (path, mtime, hosts) in self.catalogued_paths.items():
-
-            if host in hosts:
-
-                hosts[:] = [h for h in hosts if h != host]
-                if len(hosts) == 0:
-
-                    self.catalogued_paths_lock.acquire()
-                    del self.catalogued_paths[handle]
-                    self.catalogued_paths_lock.release()
-
-
-    def create_shares(self):
+    def put(self, key, chunks):
     
-        """creates_shares(self)
+        """put(self, key, chunks)
         
-        Create shares on the local machine from a list in the .access
-        configuration file. This file has the following format:
+        Store a listing of the chunks given, as (length, string) tuples,
+        with the key given.
+        """
         
-        Directory/disc shares
+        listing = Listing(chunks)
         
-        Each line of the .access file describing directory/disc shares must
-        conform to the following syntax:
+        self.lock.acquire()
         
-        <share> <path> <mode> <delay> <translation> <filetype> <key>
+        try:
         
-        The "share" parameter is the name by which other clients
-        refer to the contents of the shared directory.
+            self._discard(key)
+            self._expire()
+            
+            if listing.size > self.size:
+            
+                self.counters["evicted"] += 1
+                return
+            
+            self.listings[key] = listing
+            self.used = self.used + listing.size
+            
+            # Discard the least recently used listings.
+            while self.used > self.size:
+            
+                old_key, old = self.listings.popitem(last = False)
+                self.used = self.used - old.size
+                self.counters["evicted"] += 1
         
-        The "path" is the path on the local filesystem which can be
-        navigated by other clients.
+        finally:
         
-        The "mode" is an octal value describing a mask to apply to
-        the files and directories in the shared directory. This
-        is loosely translated into a value for the protected flag
-        which is understood by RISC OS clients.
+            self.lock.release()
+    
+    def discard(self, key):
+    
+        self.lock.acquire()
         
-        The "delay" parameter sets the delay between availability
-        broadcasts on the network. This can be disabled by supplying
-        the value "off" (without quotes) or set to the default value
-        using the value "default".
+        try:
         
-        The "translation" parameter is either "suffix" or "truncate"
-        indicating that filename suffixes are either to be presented
-        to other clients or truncated.
+            self._discard(key)
         
-        A "filetype" parameter is the default filetype to be used for
-        files whose type cannot be determined using the MimeMap
-        file. This should take the form of a twelve bit integer in
-        Python or C hexadecimal form, e.g. 0xfff.
+        finally:
         
-        myshare /home/user/myfile 0o644 off truncate 0xffd
-
-        The "key" parameter is the Access+ key
+            self.lock.release()
+    
+    def discard_host(self, host):
+    
+        """discard_host(self, host)
         
-        Access+ shares
-
-        When a share is named "<Access+>" (without quotes) in the .access
-        file, the standard Access+ shares (Apps@Hostname, Boot@Hostname)
-        will be created.  User shares are not yet created.
-
-        The line describing the Access+ shares conforms to the following syntax:
-
-        <Access+> /path_to_access_plus_dir
-
-        Apps@Hostname will be created if /path_to_access_plus_dir/Apps exists.
-        Boot@Hostname will be created if /path_to_access_plus_dir/Boot exists.
-
-        Printer shares
+        Discard the listings being sent to the host given.
+        """
         
-        When the share is named "<Printer>" (without quotes) in the .access
-        file, a share will be created with the appropriate name for the
-        printer share on this machine and the availability of the
-        corresponding local printer will be broadcast. All printer shares
-        start with this pseudonym.
+        self.lock.acquire()
         
-        Each line describing a printer must conform to the following syntax:
+        try:
         
-        "<Printer>" <name> <path> <definition file> <delay> <filetype> \
-        <description> <command>
+            for key in list(self.listings.keys()):
+            
+                if key[1][0] == host:
+                
+                    self._discard(key)
         
-        Here, the share name is predetermined and the path must point to
-        a world writable directory. The "delay", "translation" and "filetype"
-        parameters are as described above.
+        finally:
         
-        The "description" parameter is a quoted string containing a short
-        description of the printer.
+            self.lock.release()
+    
+    def _discard(self, key):
+    
+        old = self.listings.pop(key, None)
         
-        The "command" parameter is a quoted string containing a suitable
-        command for performing the printing of the files in the printer share.
+        if old is not None:
+        
+            self.used = self.used - old.size
+    
+    def _expire(self):
+    
+        # The least recently used listings are the oldest.
+        limit = time.time() - self.ttl
+        
+        while self.listings:
+        
+            key, listing = next(iter(self.listings.items()))
+            
+            if listing.used > limit:
+            
+                break
+            
+            self._discard(key)
+            self.counters["expired"] += 1
+    
+    def statistics(self):
+    
+        """statistics = statistics(self)
+        
+        Return a dictionary containing the number of listings held
+        ("listings"), the size of their chunks ("size"), and the numbers of
+        hits, misses, and listings evicted to make space or expired.
         """
-        # Compile a list of paths to check for the .access file.
         
-        # Start with the current directory.
-        paths = [""]
+        self.lock.acquire()
         
-        # Look for a file in the path used to invoke this program.
-        path, file = os.path.split(sys.argv[0])
-        paths.append(path)
+        try:
         
-        # Add the user's home directory.
-        home = os.getenv("HOME")
-        if home:
-            paths.append(home)
-
-        # Try Windows home directory as well.
-        home = os.getenv("USERPROFILE")
-        if home:
-            paths.append(home)
-
+            stats = dict(self.counters)
+            stats["listings"] = len(self.listings)
+            stats["size"] = self.used
+            return stats
         
-        f = None
+        finally:
         
-        for path in paths:
+            self.lock.release()
+
+class Directory:
+
+    def __init__(self, path, share, user):
+    
+        if not os.path.exists(path):
         
             try:
             
-                f = open(os.path.join(path, ".access"), "r")
-                break
+                os.mkdir(path)
+                os.chmod(path, share.mode | DIR_EXEC)
+                self.log(
+                    "comment",
+                    "Created %s with permissions: %s" % \
+                        (path, oct(share.mode | DIR_EXEC)),
+                    "",
+                    level = LOG_INFO
+                    )
             
-            except IOError:
+            except OSError:
             
-                # Loop again.
                 pass
         
-        if f is None:
+        self.path = path
+        self.share = share
+        self.user = user
+    
+    def length(self):
+    
+        return ROS_DIR_LENGTH
+    
+    def close(self):
+    
+        pass
+
+
+
+class Unused(Common):
+
+    def _read_port(self, port):
+    
+        if not self.ports.has_key(port):
         
-            sys.stdout.write("Failed to find access.cfg file.\n")
-            lines = []
+            print("No socket to use for port %i" % port)
+            return []
         
-        else:
+        s = self.ports[port]
         
-            lines = f.readlines()
-            f.close()
+        try:
         
-        # Read the lines found.
-        quoted = 0
+            data, address = self._recvfrom(s, RECV_SIZE)
+            
+            #lines = ["From: %s:%i" % address]
+            #lines = lines + self.interpret(data)
         
-        for line in lines:
+        except socket.error:
         
-            # Strip leading and trailing whitespace.
-            s = line.strip()
-            
-            values = []
-            current = ""
-            
-            # Ignore lines beginning with a "#" character.
-            if s[:1] == "#": continue
-            
-            for c in s:
+            lines = []
+        
+        return lines
+    
+    def read_port(self, ports = [32770, 32771, 49171]):
+    
+        t0 = time.time()
+        
+        log = []
+        
+        try:
+        
+            while 1:
             
-                if c == '"':
-                
-                    quoted = 1 - quoted
-                
-                elif c not in string.whitespace:
-                
-                    current = current + c
-                
-                elif c in string.whitespace and quoted == 1:
-                
-                    current = current + c
+                t = int(time.time() - t0)
                 
-                elif current != "":
+                for port in ports:
                 
-                    values.append(current)
-                    current = ""
+                    lines = self._read_port(port)
+                    
+                    if lines != []:
+                    
+                        for line in lines:
+                        
+                            print(line)
+                            log.append(line)
+                        
+                        print("")
+                        log.append("")
+        
+        except KeyboardInterrupt:
+        
+            pass
+        
+        return log
+
+
+
+class ShareError(Exception):
+
+    pass
+
+class PasswordError(Exception):
+
+    pass
+
+class MimeMap:
+
+    """MimeMap(path = None)
+    
+    The mappings between MIME types, RISC OS filetypes and filename suffixes
+    read from a MimeMap file, compiled into dictionaries mapping suffixes to
+    filetypes and filetypes to the first suffix declared for them. Use the
+    find method to obtain an instance shared by all objects using the same
+    file.
+    """
+    
+    # Compiled MimeMap files, indexed by path, with the modification times
+    # of the files when they were read.
+    cache = {}
+    lock = threading.Lock()
+    
+    def __init__(self, path = None):
+    
+        self.path = path
+        self.mappings = []
+        
+        # Map suffixes, including a leading ".", to filetypes, or to None if
+        # the filetype given for a suffix is invalid.
+        self.filetypes = {}
+        
+        # Map filetypes to the first suffix declared for them.
+        self.suffixes = {}
+        
+        if path is not None:
+        
+            f = open(path, "r")
             
-            if current != "":
+            try:
             
-                values.append(current)
+                self.read(f)
             
-            if quoted == 1:
+            finally:
             
-                sys.stderr.write(
-                    "Quotes do not match: %s\n" % line
-                    )
+                f.close()
+    
+    def read(self, f):
+    
+        # Read the lines found.
+        for line in f:
+        
+            # Ignore lines beginning with a "#" character.
+            if line.strip()[:1] == "#": continue
             
-            elif len(values) == 6 and values[0] != "<Printer>":
+            values = line.split()
             
-                name, path, mode, delay, present, filetype = values[0:6]
-                
-                # Try to create this share.
-                try:
-                
-                    self.add_share(name, path, mode, delay, present, filetype, 0, SHARE_TYPE_NORMAL)
-                
-                except ShareError:
-                
-                    sys.stderr.write("Could not add share: %s\n" % name)
-                    sys.stderr.flush()
+            # The values correspond to various fields; the first is the
+            # MIME type/subtype; the second is the RISC OS name; the third
+            # is the hexadecimal value used for the filetype; the rest
+            # are the extensions to recognise:
+            if len(values) <= 3:
             
-            elif len(values) == 7 and values[0] != "<Printer>":
+                continue
             
-                name, path, mode, delay, present, filetype, key = values[0:7]
-                
-                # Try to create this share.
-                try:
-                
-                    self.add_share(name, path, mode, delay, present, filetype, key, SHARE_TYPE_NORMAL)
-                
-                except ShareError:
-                
-                    sys.stderr.write("Could not add share: %s\n" % name)
-                    sys.stderr.flush()
+            self.mappings.append(
+                { "MIME": values[0], "RISC OS name": values[1],
+                  "Hex": values[2], "Extensions": values[3:] }
+                )
             
-            elif len(values) == 8 and values[0] == "<Printer>":
+            try:
             
-                name, path, defn, delay, filetype, description, command = \
-                    values[1:8]
-                
-                # Try to create this share.
-                try:
-                
-                    self.add_printer(
-                        name, path, defn, description, delay, filetype, command
-                        )
-                
-                except ShareError:
-                
-                    sys.stderr.write("Could not add printer: %s\n" % name)
-                    sys.stderr.flush()
+                filetype = int(values[2], 16)
             
-            elif len(values) == 2 and values[0] == "<Access+>":
-
-                sh = [("Apps", SHARE_TYPE_APP), ("Boot", SHARE_TYPE_HIDDEN | SHARE_TYPE_PROTECTED), ("cdrom", SHARE_TYPE_CDROM), ("dir", SHARE_TYPE_DIRECTORY)]
-                pth = values[1]
-                for s in sh:
-                    p = pth + "/" + s[0]
-                    if os.path.isdir(p):
-                        self.add_share(s[0] + "@" + Hostname, p, 0o644, 30.0, "truncate", 0xfff, 0, s[1])
-
-            elif len(values) > 0:
+            except ValueError:
             
-                sys.stderr.write(
-                    "Bad or incomplete share description: %s\n" % line
-                    )
-
-        f = None
+                filetype = None
+            
+            # Earlier mappings take precedence over later ones.
+            for suffix in values[3:]:
+            
+                self.filetypes.setdefault(suffix, filetype)
+            
+            if filetype is not None:
+            
+                self.suffixes.setdefault(filetype, values[3])
+    
+    @classmethod
+    def find(cls, paths):
+    
+        """mimemap = find(cls, paths)
+        
+        Return the compiled form of the first MimeMap file found in the list
+        of paths given, reading it again only if it has been modified since
+        it was last read. If none is found then an empty MimeMap is
+        returned.
+        """
         
         for path in paths:
         
             try:
             
-                f = open(os.path.join(path, ".access.fwaddnet"), "r")
-                break
+                mtime = os.stat(path)[os.path.stat.ST_MTIME]
             
-            except IOError:
+            except OSError:
             
                 # Loop again.
-                pass
+                continue
+            
+            cls.lock.acquire()
+            
+            try:
+            
+                cached = cls.cache.get(path)
+                
+                if cached is not None and cached[0] == mtime:
+                
+                    return cached[1]
+                
+                try:
+                
+                    mimemap = cls(path)
+                
+                except IOError:
+                
+                    continue
+                
+                cls.cache[path] = (mtime, mimemap)
+                return mimemap
+            
+            finally:
+            
+                cls.lock.release()
         
-        if f:
+        sys.stdout.write("Failed to find MimeMap file.\n")
         
-            lines = f.readlines()
-            f.close()
+        return cls()
 
-            for l in lines:
 
-                self.remote_nets.append(l.strip())
-        
-    
-    def read_share_path(self, _string):
-    
-        path = self.read_string(
-            _string, ending = "\x00", include = 0
-            )
-        
-        # Split the path up into elements.
-        path_elements = path.split(".")
-        
-        # The first element is the share name.
-        share_name = path_elements[0]
-        
-        return share_name.lower(), ".".join(path_elements[1:])
-    
-    def broadcast_startup(self):
+class Translate:
+
+    present = None
+    directory = None
+
+    def __init__(self, directory = None):
     
-        """broadcast_startup(self)
-        
-        Broadcast startup/availability messages on port 32770.
-        """
+        self.directory = directory
         
-        if not 32770 in self.broadcasters:
+        # Keep indexes of the directories used to find local files.
+        self.resolver = PathResolver()
+
+        # Look for a MimeMap file in the path used to invoke this program.
+        path, _ = os.path.split(sys.argv[0])
         
-            print("No socket to use for port %i" % 32770)
-            return
+        paths = [ "MimeMap",
+                  os.path.join(path, "MimeMap") ]
         
-        s = self.broadcasters[32770]
+        if directory is not None:
         
-        # Create the first message to send.
-        data = [0x00010001, 0x00000000]
+            paths.append(os.path.join(directory, os.extsep+"MimeMap"))
         
-        self._send_list(data, s, (Broadcast_addr, 32770))
+        self.create_mimemap(paths)
+    
+    def create_mimemap(self, paths):
+    
+        # Use the compiled form of the first MimeMap file found, shared with
+        # other objects using the same file.
+        self.mimemap_table = MimeMap.find(paths)
         
-        # Create the second message to send.
-        data = [0x00050001, 0x00000000]
+        # Store the mappings.
+        self.mimemap = self.mimemap_table.mappings
+    
+    # Define dictionaries to use to translate filename.
+    to_riscos = {os.extsep: "/", " ": "\xa0", os.sep: "."}
+    from_riscos = {"/": os.extsep, "\xa0": " ", ".": os.sep}
+    
+    def _filename(self, name, dict):
+    
+        new = []
         
-        self._send_list(data, s, (Broadcast_addr, 32770))
+        for c in name:
         
-        # Create the host broadcast string.
-        data = \
-        [
-            0x00050002, 0x00010000,
-            (len(self.identity) << 16) | len(Hostname),
-            Hostname + str(self.identity)
-        ]
+            if c in dict:
+            
+                new.append(dict[c])
+            
+            else:
+            
+                new.append(c)
         
-        self._send_list(data, s, (Broadcast_addr, 32770))
+        return "".join(new)
     
-    def broadcast_poll(self, event, delay = 30):
+    def to_riscos_filename(self, name):
     
-        """broadcast_poll(self)
-        
-        Broadcast a poll on port 32770 every few seconds. Never exits.
-        """
-        
-        if not 32770 in self.broadcasters:
-        
-            print("No socket to use for port %i" % 32770)
-            return
-        
-        s = self.broadcasters[32770]
-        
-        # Create a string to send.
-        data = \
-        [
-            0x00050004, 0x00010000,
-            (len(self.identity) << 16) | len(Hostname),
-            Hostname + str(self.identity)
-        ]
-        
-        b = self.broadcasters[49171]
- 
-        while 1:
+        return self._filename(name, self.to_riscos)
+    
+    def from_riscos_filename(self, name):
+    
+        return self._filename(name, self.from_riscos)
+    
+    def suffix_to_filetype(self, filename, path = None):
+    
+        # Check if the filetype is appended after a comma
+        at = filename.rfind(DEFAULT_FILETYPE_SEPARATOR)
+        filetype = None
         
-            self._send_list(data, s, (Broadcast_addr, 32770))
+        if sys.platform.startswith('win32'):
 
-            # Find any secure shares on the network
-            for k in self.access_users.items():
+            try:
 
-                self._request_secure_share(k)
+                if path != None:
 
-            # Broadcast any directories that have been updated
-            # There must be a better way to do this.  Possibly
-            # inotify on Linux.
-            handles_to_delete = []
-            for handle, (path, mtime, hosts) in self.catalogued_paths.items():
+                    localpath = path + os.sep + filename
 
-                try:
+                with open(localpath + ":riscos", "r") as f:
+
+                    filetype = f.read()
+                    if at != -1:
 
-                    m = os.stat(path)[os.path.stat.ST_MTIME]
+                        fname = filename[:at]
 
-                    if (m != mtime):
+                    else:
 
-                        update = [0x00000046, 0x00000013, handle]
-                        self._send_list(update, b, (Broadcast_addr, 49171))
-                        self.catalogued_paths_lock.acquire()
+                        fname = filename
 
-                        if handle in self.catalogued_paths:
+                    return int(filetype, 16), None, self.to_riscos_filename(fname)
 
-                            # Don't re-add if this has just been deleted
-                            self.catalogued_paths[handle] = (path, m, hosts)
+            except:
 
-                        self.catalogued_paths_lock.release()
+                pass
 
-                except OSError:
+        if at != -1:
+            filetype = self.filetype
+            loadexec = None
+            # comma separated suffix
+            suffix = filename[at+len(DEFAULT_FILETYPE_SEPARATOR):]
+            hyphen = suffix.find('-')
+            try:
 
-                    # The directory has probably been deleted
-                    handles_to_delete.append(handle)
+                if len(suffix) == 3:
+                    filetype = int(suffix, 16)
+                elif hyphen != -1:
+                    load_addr = int(suffix[:hyphen], 16)
+                    exec_addr = int(suffix[hyphen+1:], 16)
+                    loadexec = (load_addr, exec_addr)
 
-            self.catalogued_paths_lock.acquire()
+            except:
 
-            for handlhandle in handles_to_delete:
+                # Use default values
+                pass
 
-                if handle in self.catalogued_paths:
+            return filetype, loadexec, self.to_riscos_filename(filename[:at])
 
-                    del self.catalogued_paths[handle]
+        # Find the appropriate filetype to use for the filename given.
+        at = filename.rfind(os.extsep)
 
-            self.catalogued_paths_lock.release()
+        if at == -1:
+        
+            # No suffix: return the default filetype.
+            return self.filetype, None, self.to_riscos_filename(filename)
+        
+        # The suffix includes the "." character. Remove this platform's
+        # separator and replace it with a ".".
+        suffix = "." + filename[at+len(os.extsep):].lower()
+        
+        # Find the suffix in the mappings.
+        filetypes = self.mimemap_table.filetypes
+        
+        if suffix in filetypes:
+        
+            # Return the corresponding filetype for this suffix.
+            filetype = filetypes[suffix]
             
-            event.wait(delay)
-            if event.isSet(): return
+            if filetype is None:
+            
+                # The value found was not in a valid hexadecimal
+                # representation. Return the default filetype.
+                return self.filetype, \
+                    None, self.to_riscos_filename(filename)
+            
+            elif self.present == "truncate":
+            
+                # Remove the suffix before presenting it to RISC OS.
+                return filetype, None, self.to_riscos_filename(filename)[:at]
+            
+            else:
+            
+                return filetype, None, self.to_riscos_filename(filename)
         
-        # Create a string to send.
-        data = \
-        [
-            0x00050003, 0x00010000,
-            (len(self.identity) << 16) | len(Hostname),
-            Hostname + self.identity
-        ]
+        # Check whether the filename included a hexadecimal suffix.
+        try:
         
-        self._send_list(data, s, (Broadcast_addr, 32770))
-    
-    def broadcast_directory_share(self, name, event, protected = 0, delay = 30):
-    
-        """broadcast_share(self, name, event, protected = 0, delay = 30)
+            value = int(suffix[len(os.extsep):], 16)
         
-        Broadcast the availability of a share every few seconds.
-        """
+        except ValueError:
         
-        # Broadcast the availability of the share on the polling socket.
+            # No mappings declared the suffix used.
+            return self.filetype, None, self.to_riscos_filename(filename)
         
-        if not 32771 in self.broadcasters:
+        # A hexadecimal suffix was used.
+        if self.present == "truncate":
         
-            print("No socket to use for port %i" % 32771)
-            return
+            # Remove the suffix before presenting it to RISC OS.
+            return value, None, self.to_riscos_filename(filename)[:at]
         
-        s = self.broadcasters[32771]
+        else:
         
-        data = \
-        [
-            0x00010002, 0x00010001, 0x00000000
-        ]
+            return value, None, self.to_riscos_filename(filename)
+    
+    def filetype_to_suffix(self, filename, filetype):
+    
+        # Find the appropriate filetype to use for the filename given.
+        #at = string.rfind(filename, "/")
+        #
+        #if at != -1 and self.present == "suffix":
+        if self.present == "suffix":
         
-        self._send_list(data, s, (Broadcast_addr, 32771))
+            # The suffix includes the "/" character. Replace it with this
+            # platform's separator and ignore the filetype.
+            return self.from_riscos_filename(filename)
         
-        # Advertise the share on the share socket.
+        # Otherwise append a suffix to the filename to represent the
+        # filetype.
         
-        if not 49171 in self.broadcasters:
+        # Find the first suffix declared for the filetype in the mappings.
+        suffix = self.mimemap_table.suffixes.get(filetype)
         
-            print("No socket to use for port %i" % 49171)
-            return
+        if suffix is not None:
         
-        s = self.broadcasters[49171]
+            return self.from_riscos_filename(filename) + \
+                os.extsep + suffix[1:]
         
-        # Create a string to send.
-        data = [0x00000046, 0x00000013, 0x00000000]
+        elif sys.platform.startswith('win32'):
+
+            return self.from_riscos_filename(filename)
+
+        else:
         
-        # Broadcast a notification to other clients.
+            # No mappings declared the filetype used. Append a suffix
+            # containing the three digit hexadecimal filetype value to the
+            # end of the name.
+            return self.from_riscos_filename(filename) + DEFAULT_FILETYPE_SEPARATOR + \
+                "%03x" % filetype
+    
+    def find_relevant_file(self, path, suffix = None):
+    
+        """find_relevant_file(self, path, suffix = None)
         
-        for i in range(0, 5):
+        Given a path for a file without a suffix from RISC OS, find the
+        relevant file on our machine. This relies on the bodies of the
+        filenames being unique.
         
-            self._send_list(data, s, (Broadcast_addr, 49171))
-            
-            time.sleep(1)
+        If a suffix is passed this makes the job much easier.
+        """
         
-        while 1:
+        if suffix is None:
         
-            self._send_list(data, s, (Broadcast_addr, 32770))
+            suffix = ""
+        
+        directory, stem = os.path.split(path)
+        
+        if stem in ("", os.curdir, os.pardir):
+        
+            # Directories do not list themselves or their parents.
+            if os.path.lexists(path + suffix):
             
-            time.sleep(delay)
+                return path + suffix
             
-            if event.isSet(): return
+            return None
         
-        # Broadcast that the share has now been removed.
+        # Look for a file with any suffix that matches the path given in the
+        # index of the directory containing it.
+        index = self.resolver.index(directory or os.curdir)
         
-        s = self.broadcasters[32771]
+        if index is None:
         
-        data = \
-        [
-            0x00010003, 0x00010001, 0x00000000
-        ]
-
-    def _request_secure_share(self, key):
+            return None
         
-        """_request_secure_share(self, key)
-        Ask peers for any secure shares with password matching the supplied key
-        """
-
-        s = self.broadcasters[32771]
- 
-        data = \
-        [
-            0x00010001, 0x00010001, key
-        ]
-
-        self._send_list(data, s, (Broadcast_addr, 32771))
-
-        s = self.ports[32771]
-
-        # log on to remote hosts
-        for addr in self.remote_nets:
-
-            self._send_list(data, s, (addr, 32771))
-
-    def send_query(self, host):
-    
-        if not 32770 in self.broadcasters:
+        name = index.find(stem, suffix)
         
-            print("No socket to use for port %i" % 32770)
-            return
+        if name is None:
         
-        s = self.broadcasters[32770]
+            return None
         
-        # Create a string to send.
-        data = \
-        [
-            0x00050003, 0x00010000,
-            (len(self.identity) << 16) | len(Hostname),
-            Hostname + self.identity
-        ]
+        return os.path.join(directory, name)
+    
+    def construct_directory_name(self, elements):
+    
+        built = ""
         
-        self._send_list(data, s, (host, 32770))
+        for element in elements:
         
-        self.read_port(self.use_ports)
-    
-    # Method used in thread for transferring files
+            built = os.path.join(built, element)
+        
+        return built
     
-    def receive_file(self, event, reply_id, start, amount, fh, _socket,
-                      address):
+    def read_mode(self, path):
     
-        # This method should only get called once by the thread it belongs
-        # to, then the thread should terminate.
+        """mode = read_mode(self, path)
         
-        self.log(
-            "comment",
-            "Receiving file: start = %i, amount = %i" % (start, amount),
-            "",
-            level = LOG_API
-            )
+        Return the access mode for the path given or None if the path is
+        invalid.
+        """
         
-        pos = start
+        try:
         
-        end = start + amount
+            return os.stat(path)[os.path.stat.ST_MODE]
         
-        #self.log("comment", "Position: %i" % pos, "")
-        #self.log("comment", "Expected amount of data: %i" % amount, "")
+        except OSError:
+        
+            return None
+    
+    def to_riscos_access(self, mode = None, path = None):
+    
+        """word = to_riscos_access(self, mode = None, path = None)
+        
+        Return a word representing the RISC OS access flags roughly
+        equivalent to the read, write and execute flags for a local file,
+        given as an octal number in integer form.
+        
+        If a path is given then its mode is determined and used instead.
+        
+        If no valid mode value can be determined then 0o444 is used.
+        """
+        
+        if path is not None:
+        
+            mode = self.read_mode(path)
+        
+        if mode is None:
+        
+            mode = 0o444
+        
+        # Owner permissions
+        owner_read = (mode & os.path.stat.S_IRUSR) != 0
+        owner_write = ((mode & os.path.stat.S_IWUSR) != 0) << 1
+        owner_execute = ((mode & os.path.stat.S_IXUSR) != 0) << 2
+        
+        owner = owner_read | owner_write | owner_execute
+        
+        # Ignore group permissions.
+        
+        # Permissions for others
+        others_read = ((mode & os.path.stat.S_IROTH) != 0) << 4
+        others_write = ((mode & os.path.stat.S_IWOTH) != 0) << 5
+        #others_execute = (mode & os.path.stat.S_IXOTH) != 0
+        
+        others = others_read | others_write
+        
+        return owner | others
+    
+    def from_riscos_access(self, word):
+    
+        """mode = from_riscos_access(self, word)
+        
+        Return a mode value representing the read, write and execute flags
+        for a local file, given as an octal number in integer form roughly
+        equivalent to the RISC OS access flags.
+        """
+        
+        # Owner permissions
+        owner_read = ((word & 0x01) != 0) * os.path.stat.S_IRUSR
+        owner_write = ((word & 0x02) != 0) * os.path.stat.S_IWUSR
+        owner_execute = ((word & 0x04) != 0) * os.path.stat.S_IXUSR
+        
+        owner = owner_read | owner_write | owner_execute
+        
+        # Permissions for others
+        others_read = ((word & 0x10) != 0) * os.path.stat.S_IROTH
+        others_write = ((word & 0x20) != 0) * os.path.stat.S_IWOTH
+        
+        others = others_read | others_write
+        
+        # Group permissions
+        group = others
+        
+        return owner | group | others
+    
+    def repr_mode(self, mode):
+    
+        """string = repr_mode(self, mode)
+        
+        Returns a string showing the access permissions for a file, given
+        as an octal number in integer form.
+        """
+        
+        # Use shortcuts to construct a string with as little code as
+        # possible.
+        
+        # Owner permissions
+        ow_r = ["-", "r"][(mode & os.path.stat.S_IRUSR) != 0]
+        ow_w = ["-", "w"][(mode & os.path.stat.S_IWUSR) != 0]
+        ow_e = ["-", "x"][(mode & os.path.stat.S_IXUSR) != 0]
+        
+        owner = ow_r + ow_w + ow_e
+        
+        # Group permissions.
+        g_r = ["-", "r"][(mode & os.path.stat.S_IRGRP) != 0]
+        g_w = ["-", "w"][(mode & os.path.stat.S_IWGRP) != 0]
+        g_e = ["-", "x"][(mode & os.path.stat.S_IXGRP) != 0]
+        
+        group = g_r + g_w + g_e
+        
+        # Permissions for others
+        ot_r = ["-", "r"][(mode & os.path.stat.S_IROTH) != 0]
+        ot_w = ["-", "w"][(mode & os.path.stat.S_IWOTH) != 0]
+        ot_e = ["-", "x"][(mode & os.path.stat.S_IXOTH) != 0]
+        
+        others = ot_r + ot_w + ot_e
+        
+        return owner + group + others
+    
+    def to_riscos_objtype(self, path):
+    
+        if not os.path.exists(path):
+        
+            return 0
+        
+        elif os.path.isfile(path):
+        
+            return 0x0101
+        
+        elif os.path.isdir(path):
+        
+            return 0x2
+        
+        else:
+        
+            return 0
+    
+    def from_riscos_path(self, ros_path, find_obj = 1):
+    
+        # Construct a path to the object below the shared directory.
+        path = self.from_riscos_filename(ros_path)
+        
+        # Append this path to the shared directory's path.
+        path = os.path.join(self.directory, path)
+        
+        if find_obj == 1:
+        
+            # Look for a suitable file.
+            path = self.find_relevant_file(path)
+        
+        return path
+    
+    def read_path_info(self, path, Need_handle = 0):
+    
+        handle = None
+        
+        # Write any data held for the file so that its length and date are
+        # up to date.
+        File.flush_held(path)
+
+        # Determine the file's relevant filetype and
+        # date words.
+        filetype, date = self.make_riscos_filetype_date(path)
+        
+        # Find the length of the file.
+        if os.path.isdir(path):
+        
+            length = ROS_DIR_LENGTH
+        
+        else:
+        
+            length = os.path.getsize(path)
+        
+        # Construct access attributes for the other client.
+        access_attr = self.to_riscos_access(path = path)
+        
+        # Use a default value for the object type.
+        object_type = self.to_riscos_objtype(path = path)
+        
+        if Need_handle == 1:
+            handle = self.file_handler.allocate()
+
+        return filetype, date, length, access_attr, object_type, handle
+    
+
+
+class Share(Ports, Translate):
+
+    """Share
+    
+    A class encapsulating a share on a local or remote machine.
+    """
+    
+
+    def __init__(self, name, directory, mode, delay, present, filetype, key,
+                 share_type, file_handler, engine = None):
+    
+        # Call the initialisation methods of the base classes.
+        Ports.__init__(self)
+        Translate.__init__(self, directory = directory)
+        
+        # Keep a reference to the parent objects file handler.
+        self.file_handler = file_handler
+        
+        self.share_type = share_type
+        if key != 0:
+            self.share_type = SHARE_TYPE_DIRECTORY
+
+        # Determine the protected flag to broadcast by examining the
+        # other users write bit.
+        if (mode & os.path.stat.S_IWOTH) == 0:
+        
+            if self.share_type == SHARE_TYPE_NORMAL or self.share_type == SHARE_TYPE_DIRECTORY:
+                self.share_type |= SHARE_TYPE_PROTECTED
+            self.read_mask = PROTECTED_READ
+            self.write_mask = PROTECTED_WRITE
+        
+        else:
+        
+            self.read_mask = UNPROTECTED_READ
+            self.write_mask = UNPROTECTED_WRITE
+        
+        # Determine the current time to use for the date of creation.
+        date = time.localtime(time.time())
+        
+        # Record the relevant information about the share.
+        
+        self.name = name
+        self.directory = directory
+        self.date = date
+        self.mode = mode
+        self.present = present
+        self.filetype = filetype
+        self.delay = delay
+        self.key = key
+        
+        # The filetype of the share directory itself.
+        self.share_filetype = 0xfcd
+        
+        # Convert the share's mode mask to a file attribute mask.
+        self.access_attr = self.to_riscos_access(mode = mode)
+        
+        # Keep the catalogues of directories in the share until they change.
+        self.catalogues = CatalogueCache()
+        
+        # Create an event to use to inform the share that it must be
+        # removed.
+        self.event = threading.Event()
+        
+        self.engine = engine
+        
+        if engine is not None:
+        
+            # Let the event loop schedule the share's broadcasts when it is
+            # started.
+            self.thread = None
+            return
+        
+        # Create a thread to run the share broadcast loop.
+        self.thread = threading.Thread(
+            group = None, target = self.broadcast_share,
+            name = 'Share "%s"' % self.name
+            )
+    
+    def start(self):
+    
+        """start(self)
+        
+        Start broadcasting the availability of the share.
+        """
+        
+        if self.engine is not None:
+        
+            self.engine.add_share(self)
+        
+        else:
+        
+            self.thread.start()
+    
+    def stop(self):
+    
+        """stop(self)
+        
+        Stop broadcasting the availability of the share and announce that
+        it has been removed.
+        """
+        
+        self.event.set()
+        
+        if self.thread is not None:
+        
+            # Wait until the thread terminates if it was started.
+            if self.thread.ident is not None:
+            
+                self.thread.join()
+        
+        else:
+        
+            self.engine.remove(self)
+    
+    def cleanup_handles(self, host):
+
+        # Close the files and directories in this share used by the host.
+        for handle in self.file_handler.host_handles(host):
+
+            fh = self.file_handler.get(handle)
+
+            if fh is not None and fh.share is self:
+
+                fh.close()
+                del self.file_handler[handle]
+
+    def get_key(self):
+        return self.key
+
+    def _send_secure_share(self, dest):
+
+        if self.get_key() == 0:
+            return
+
+        if not 32771 in self.ports:
+        
+            print("No socket to use for port %i" % 32771)
+            return
+        
+        s = self.ports[32771]
+        
+        shrtype = ""
+
+        # If the share is a username@host share, then append the share_type
+        # to the share name, otherwise leave the share_type off.
+        if '@' in self.name:
+
+            shrtype = chr(self.share_type)
+
+        data = \
+        [
+            0x00010004, 0x00010001, 0x00010000 | len(self.name),
+            self.get_key(),
+            self.name + shrtype
+        ]
+        
+        self._send_list(data, s, dest)
+
+    def broadcast_share(self):
+    
+        """broadcast_share(self)
+        
+        Broadcast the availability of a share every few seconds.
+        """
+        
+        if not self._broadcast_available():
+        
+            return
+        
+        # Broadcast a notification to other clients.
+        
+        for i in range(0, 5):
+        
+            self._broadcast_notification()
+            
+            time.sleep(1)
+        
+        # Remind other clients of the availability of this share.
+        
+        while 1:
+        
+            self._broadcast_reminder()
+            
+            self.event.wait(self.delay)
+            if self.event.isSet():
+                break
+        
+        # Broadcast that the share has now been removed.
+        self._broadcast_removal()
+    
+    def _broadcast_available(self):
+    
+        # Broadcast the availability of the share on the polling socket,
+        # returning whether further broadcasts should be made.
+        
+        if self.key != 0:
+            # Secure shares are not broadcast.
+            return False
+
+        for port in 32770, 49171:
+        
+            if self.broadcasters.get(port) is None:
+            
+                print("No socket to use for port %i" % port)
+                return False
+        
+        s = self.broadcasters[32770]
+        
+        data = \
+        [
+            0x00010002, 0x00010000, 0x00010000 | len(self.name),
+            self.name + chr(self.share_type)
+        ]
+        
+        self._send_list(data, s, (Broadcast_addr, 32770))
+        
+        return True
+    
+    def _broadcast_notification(self):
+    
+        # Advertise the share on the share socket.
+        s = self.broadcasters[49171]
+        
+        # Create a string to send.
+        data = [0x00000046, 0x00000013, 0x00000000]
+        
+        self._send_list(data, s, (Broadcast_addr, 49171))
+    
+    def _broadcast_reminder(self):
+    
+        # Remind other clients of the availability of this share.
+        s = self.broadcasters[32770]
+        
+        data = \
+        [
+            0x00010004, 0x00010000, 0x00010000 | len(self.name),
+            self.name + chr(self.share_type)
+        ]
+        
+        self._send_list(data, s, (Broadcast_addr, 32770))
+    
+    def _broadcast_removal(self):
+    
+        # Broadcast that the share has now been removed.
+        s = self.broadcasters[32770]
+        
+        data = \
+        [
+            0x00010003, 0x00010000, 0x00010000 | len(self.name),
+            self.name + chr(self.share_type)
+        ]
+
+        self._send_list(data, s, (Broadcast_addr, 32770))
+    
+    #def notify_share_users(self, 
+    
+    def descend_path(self, path, names = None, share_check_mode = 0, check_mode = PROTECTED_READ):
+    
+        """path = descend_path(self, path, names = None)
+        
+        Descend the path as far as the share's access attributes will allow.
+        If this is not far enough then return None.
+        
+        Similarly, if the path takes us outside the share then return None.
+
+        check_mode is the permissions that the file needs
+        share_check_mode is the permissions that the share needs
+
+        check_mode and share_check_mode are usually the same, but can be
+        different for operations that change a file's metadata
+        """
+        
+        if names:
+        
+            return self._descend_path(path, names, share_check_mode, check_mode)
+        
+        # Use the result of checking the same path recently if the directory
+        # containing it has not changed.
+        check = (path, share_check_mode, check_mode)
+        verdict = self.resolver.verdict(check)
+        
+        if verdict is None:
+        
+            path, names = self._descend_path(path, [], share_check_mode, check_mode)
+            self.resolver.keep_verdict(check, path, names and names[:])
+            return path, names
+        
+        # Return a copy of the names in case the caller changes them.
+        path, names = verdict
+        return path, names and names[:]
+    
+    def _descend_path(self, path, names, share_check_mode, check_mode):
+    
+        if path == self.directory:
+        
+            mode = self.read_mode(self.directory)
+            if share_check_mode == 0:
+
+                share_check_mode = check_mode
+
+            if mode is None or (mode & share_check_mode & self.mode) == 0:
+
+                return self.directory, None 
+ 
+            return self.directory, names
+        
+        # Split the path into two parts.
+        path1, path2 = os.path.split(path)
+        
+        # Recurse with a path and a list of names to descend into.
+        path, names = self._descend_path(path1, [path2] + names, share_check_mode, check_mode)
+        
+        # Try to descend the directory structure.
+        
+        # If there are no names to add to the path then just return the path
+        # and an empty list.
+        if names == [] or names == None:
+        
+            return path, []
+        
+        # Join the first name to the path.
+        next_path = os.path.join(path, names[0])
+        
+        mode = self.read_mode(next_path)
+        
+        if mode is None or (mode & check_mode & self.mode) == 0:
+        
+            # We cannot read this object. Return the unextended path and the
+            # names which were not added.
+            return path, names
+        
+        # We can read this object so return the combined path and a shortened
+        # list of names.
+        return next_path, names[1:]
+    
+    def open_path(self, ros_path, host, mode):
+    
+        self.log("comment", "Original path: %s" % ros_path, "", level = LOG_API)
+        
+        # Convert the RISC OS style path to a path within the share.
+        path = self.from_riscos_path(ros_path)
+        
+        if ros_path == "":
+        
+            # Check the permissions of the share
+            path, rest = self.descend_path(self.directory, check_mode = self.read_mask)
+            if rest == None:
+                return None, path
+
+            # Return information about the share itself.
+            cs = self.to_riscos_time()
+            
+            filetype_word, date_word = \
+                self._make_riscos_filetype_date(self.share_filetype, cs)
+            
+            # Mask the access attributes of this file with the share's access
+            # mask.
+            access_attr = self.access_attr
+            
+            # Set the filetype to be a share (0xfcd), the date as
+            # the time when the share was added, the length as
+            # a standard value, the access attributes are
+            # converted from the mode value given and the object
+            # type as a standard value.
+            return [ filetype_word, date_word, ROS_DIR_LENGTH, access_attr,
+                     0x102, 0], path
+
+        self.log("comment", "Open path: %s" % path, "", level = LOG_API)
+        
+        # Find whether the directory structure can be legitimately descended.
+        if path is not None:
+        
+            path, rest = self.descend_path(path, check_mode = self.read_mask)
+            
+            if rest != []: path = None
+        
+        if path is not None and os.path.isdir(path):
+        
+            # A directory
+            
+            filetype, date, length, access_attr, object_type, handle = \
+                self.read_path_info(path, Need_handle = 1)
+            
+            # Keep this handle for possible later use.
+            if not self.file_handler.has_key(handle):
+            
+                self.file_handler[handle] = Directory(path, self, host)
+            
+            else:
+            
+                # It may be necessary to report an error that the handle
+                # is in use.
+                pass
+            
+            return [ filetype, date, length, access_attr, object_type,
+                     handle ], path
+        
+        elif path is not None and os.path.isfile(path):
+        
+            # A file
+            
+            filetype, date, length, access_attr, object_type, \
+                handle = self.read_path_info(path, Need_handle = 1)
+            
+            # Keep this handle for possible later use.
+            if not self.file_handler.has_key(handle):
+            
+                try:
+
+                    self.file_handler[handle] = File(path, self, host, mode = mode)
+
+                except IOError:
+
+                    # Release the handle reserved for the file.
+                    self.file_handler.free_handle(handle)
+            
+            else:
+            
+                # It may be necessary to report an error that the handle
+                # is in use.
+                fh = self.file_handler[handle]
+                
+                if fh.user == host:
+                
+                    # Use the file object's length, if possible.
+                    length = fh.length()
+                
+                else:
+                
+                    # If the current user is not the one recorded then
+                    # return an error.
+                    return None, path
+            
+            if not self.file_handler.has_key(handle):
+
+                return None, path
+
+            return [ filetype, date, length, access_attr, object_type,
+                     handle ], path
+        
+        else:
+        
+            # Reply with an error message.
+            return None, path
+    
+    def create_file(self, ros_path, host):
+    
+        # Try to open the corresponding file.
+        info, path = self.open_path(ros_path, host, "r+b")
+        
+        if ros_path == "":
+        
+            # The share itself is being referenced.
+            return None, path
+        
+        if info is None:
+        
+            # No file exists at this path.
+            
+            # Determine whether the parent directory of the file can be written
+            # to.
+            
+            # Construct a path to the object below the shared directory.
+            path = self.from_riscos_path(ros_path, find_obj = 0)
+            
+            parent_path, file = os.path.split(path)
+            
+            write_path, rest = self.descend_path(
+                parent_path, check_mode = self.write_mask
+                )
+            
+            # Return an error value if it can't.
+            if rest != []: return None, write_path
+            
+            try:
+            
+                # Create an object on the local filesystem.
+                if self.present == "truncate":
+
+                    path = path + DEFAULT_SUFFIX
+
+                open(path, "wb").write(b"")
+                os.chmod(path, self.mode | FILE_ATTR)
+                self.forget_catalogue(path)
+            
+            except IOError:
+            
+                return None, path
+            
+            except OSError:
+            
+                os.remove(path)
+                return None, path
+        
+        else:
+        
+            # A file already exists at this path.
+            
+            # Find whether the object can be legitimately overwritten.
+            path, rest = self.descend_path(path, check_mode = self.write_mask)
+            
+            # Return an error value if it can't.
+            if rest != []: return None, path
+            
+            try:
+            
+                # Create an object on the local filesystem.
+                open(path, "wb").write(b"")
+                os.chmod(path, self.mode | FILE_ATTR)
+                self.forget_catalogue(path)
+            
+            except IOError:
+            
+                return None, path
+            
+            except OSError:
+            
+                os.remove(path)
+                return None, path
+        
+        self.log("comment", "Actual path: %s" % path, "", level = LOG_API)
+        
+        # Try to find the details of the object.
+        
+        if os.path.isdir(path):
+        
+            # A directory
+            
+            filetype, date, length, access_attr, object_type, \
+                handle = self.read_path_info(path, Need_handle = 1)
+            
+            # Keep this handle for possible later use.
+            if not self.file_handler.has_key(handle):
+            
+                self.file_handler[handle] = Directory(path, self, host)
+            
+            return [ filetype, date, length, access_attr, object_type,
+                     handle ], path
+        
+        elif os.path.isfile(path):
+        
+            # A file
+            
+            filetype, date, length, access_attr, object_type, \
+                handle = self.read_path_info(path, Need_handle = 1)
+            
+            # Keep this handle for possible later use.
+            if not self.file_handler.has_key(handle):
+            
+                try:
+
+                    self.file_handler[handle] = File(path, self, host)
+
+                except IOError:
+
+                    # Release the handle reserved for the file.
+                    self.file_handler.free_handle(handle)
+            
+            else:
+            
+                # It may be necessary to report an error that the handle
+                # is in use.
+                fh = self.file_handler[handle]
+                
+                # Use the file object's length, if possible.
+                length = fh.length()
+            
+            if not self.file_handler.has_key(handle):
+
+                return None, path
+
+            return [ long(0xdeaddead), long(0xdeaddead), length, 0x33, object_type,
+                     handle ], path
+        
+        else:
+        
+            # Reply with an error message.
+            return None, path
+    
+    def delete_path(self, ros_path):
+    
+        # Convert the RISC OS style path to a path within the share.
+        path = self.from_riscos_path(ros_path)
+        
+        if ros_path == "":
+        
+            # The share itself is being referenced.
+            return None, path
+        
+        if path is None:
+        
+            return None, path
+        
+        # Find whether the directory structure can be legitimately descended.
+        path, rest = self.descend_path(path, check_mode = self.write_mask)
+        
+        if rest != []:
+        
+            return None, path
+        
+        self.log("comment", "Delete request: %s" % path, "", level = LOG_API)
+        
+        filetype, date, length, access_attr, object_type, \
+            handle = self.read_path_info(path)
+        
+        try:
+        
+            if os.path.isfile(path):
+            
+                os.remove(path)
+            
+            elif os.path.isdir(path):
+            
+                os.rmdir(path)
+            
+            else:
+            
+                return None, path
+            
+            return [ filetype, date, length, access_attr,
+                     object_type ], path
+        
+        except OSError:
+        
+            return None, path
+    
+    def set_access_attr(self, ros_path, access_attr):
+    
+        # Convert the RISC OS style path to a path within the share.
+        path = self.from_riscos_path(ros_path)
+        
+        if ros_path == "":
+        
+            # The share itself is being referenced.
+            return None, path
+        
+        if path is None:
+        
+            return None, path
+        
+        # Find whether the directory structure can be legitimately descended.
+        # check_mode should be read | write.  Permissions can be changed
+        # on read-only files on writable shares
+        path, rest = self.descend_path(path, share_check_mode = PROTECTED_WRITE, check_mode = self.write_mask | self.read_mask)
+        
+        if rest != []:
+        
+            return None, path
+        
+        # Convert the RISC OS attributes to a mode value.
+        mode = self.from_riscos_access(access_attr)
+        
+        # Try to change the permissions on the object.
+        try:
+        
+            if os.path.isfile(path):
+            
+                # Ensure that the remote client doesn't mess up the file
+                # access attributes by making the file unreadable.
+                mode = (
+                    (mode & 0x1c0) | ((mode & 0x1c0) >> 3) | \
+                    ((mode & 0x1c0) >> 6)
+                    )
+                
+                mode = (mode & self.mode) | FILE_ATTR
+                
+                os.chmod(path, mode)
+                self.forget_catalogue(path)
+            
+            elif os.path.isdir(path):
+            
+                # Ensure that the remote client doesn't mess up the
+                # directory access attributes.
+                mode = self.mode | DIR_EXEC
+                
+                os.chmod(path, mode)
+            
+            # Construct the new details for the object.
+            filetype, date, length, access_attr, object_type, \
+                handle = self.read_path_info(path)
+            
+            return [filetype, date, length, access_attr, object_type], path
+        
+        except OSError:
+        
+            return None, path
+    
+    def rename_path(self, event, reply_id, pos, amount, buf, ros_path,
+                    _socket, address, fn):
+    
+        source = self._rename_source(ros_path)
+        
+        if source is None: return None
+        
+        # Call the function to receive the filename.
+        share_name, new_ros_path = fn(
+            event, reply_id, pos, amount, buf, _socket, address
+            )
+        
+        self._rename_to(source, share_name, new_ros_path)
+    
+    def _rename_source(self, ros_path):
+    
+        # Return the path of the object to be renamed and its suffix, or None
+        # if it cannot be renamed.
+        
+        # Convert the RISC OS style path to a path within the share.
+        path = self.from_riscos_path(ros_path)
+        
+        if ros_path == "":
+        
+            # The share itself is being referenced.
+            return None
+        
+        if path is None: return None
+        
+        # Find whether the directory structure can be legitimately descended.
+        path, rest = self.descend_path(path, check_mode = self.write_mask)
+        
+        if rest != []: return None
+        
+        suffix = ""
+        
+        if self.present == "truncate":
+        
+            # Check for a file suffix to determine the filetype of the file.
+            # We will need to remember this when we rename the file in order
+            # to maintain the correct type.
+            at = path.rfind(".")
+            
+            if at != -1:
+            
+                suffix = path[at:]
+        
+        return path, suffix
+    
+    def _rename_to(self, source, share_name, new_ros_path):
+    
+        # Rename the object found by _rename_source to the new path
+        # received from the client.
+        path, suffix = source
+        
+        if share_name != self.name: return None
+        
+        if new_ros_path is None: return None
+        
+        # Convert the RISC OS style path to a path within the share.
+        new_path = self.from_riscos_path(new_ros_path, find_obj = 0)
+        
+        if new_ros_path == "":
+        
+            # The share itself is being referenced.
+            return None
+        
+        if new_path is None: return None
+        
+        # Find whether the directory structure can be legitimately descended.
+        parent_path, file = os.path.split(new_path)
+        
+        write_path, rest = self.descend_path(
+            parent_path, check_mode = self.write_mask
+            )
+        
+        if rest != []: return None
+        
+        if self.present == "truncate":
+        
+            # Append the suffix recorded before to the new path.
+            new_path = new_path + suffix
+        
+        try:
+        
+            os.rename(path, new_path)
+        
+        except OSError:
+        
+            pass
+        
+        # Paths below a renamed directory no longer lead anywhere.
+        self.resolver.forget()
+    
+    def set_filetype(self, fh, handle, filetype_word, date_word):
+    
+        # Find the filetype and date from the words given.
+        filetype, date = \
+            self.take_riscos_filetype_date(filetype_word, date_word)
+            
+        # Only change the filename to change the filetype if we are using
+        # a presentation policy based on truncating filenames before their
+        # suffixes.
+        
+        if os.path.isfile(fh.path) and self.present == "truncate":
+        
+            # Convert the file's path to a RISC OS style filetype and path.
+            _, _, ros_path = self.suffix_to_filetype(fh.path)
+            
+            if sys.platform.startswith("win32"):
+
+                try:
+
+                    # Win32 stores filetypes in the :riscos alternate data stream
+                    with open(fh.path + ":riscos", "w") as f:
+
+                        f.write(hex(int(filetype)))
+
+                except:
+
+                    return None
+
+            else:
+
+                # Determine the correct suffix to use for the file.
+                new_path = self.filetype_to_suffix(ros_path, filetype)
+            
+                self.log("comment", "Renaming %s to %s" % (fh.path, new_path), "", level = LOG_API)
+            
+                if fh.path != new_path:
+            
+                    try:
+                
+                        # Try to rename the object.
+                        os.rename(fh.path, new_path)
+                
+                    except OSError:
+                
+                        return None
+            
+                fh.path = new_path
+        
+        # Stamp with the correct access and modification date
+        t = time.mktime(date)
+        os.utime(fh.path, (t, t))
+        self.forget_catalogue(fh.path)
+
+        # Construct the new details for the object.
+        filetype, date, length, access_attr, object_type, \
+            hnd = self.read_path_info(fh.path, Need_handle = 0)
+        
+        # Keep the length from the original file.
+        length = fh.length()
+        
+        return [filetype, date, length, access_attr, object_type, handle]
+    
+    def forget_catalogue(self, path):
+    
+        """forget_catalogue(self, path)
+        
+        Discard the catalogue of the directory containing the object at the
+        path given. This is needed when an object changes without changing
+        the directory itself.
+        """
+        
+        self.catalogues.discard(os.path.dirname(path))
+        self.resolver.forget(os.path.dirname(path))
+    
+    def _scan_directory(self, path):
+    
+        # Return a list of the names of the objects in the directory with
+        # the result of calling stat for each of them, or None if that
+        # fails. Use scandir where available to read the directory in a
+        # single pass.
+        entries = []
+        
+        scandir = getattr(os, "scandir", None)
+        
+        if scandir is None:
+        
+            for name in os.listdir(path):
+            
+                try:
+                
+                    st = os.stat(os.path.join(path, name))
+                
+                except OSError:
+                
+                    st = None
+                
+                entries.append((name, st))
+            
+            return entries
+        
+        for entry in scandir(path):
+        
+            try:
+            
+                st = entry.stat()
+            
+            except OSError:
+            
+                st = None
+            
+            entries.append((entry.name, st))
+        
+        return entries
+    
+    def catalogue_path(self, ros_path):
+    
+        # This should return data in 2048 byte chunks max 
+
+        # Convert the RISC OS style path to a path within the share.
+        path = self.from_riscos_path(ros_path)
+        
+        if path is None:
+        
+            return None, "Not found", path, None
+        
+        if not os.path.isdir(path):
+        
+            # The path given did not refer to a directory.
+            return None, "Not a directory", path, None
+        
+        # Find whether the directory structure can be legitimately descended.
+        path, rest = self.descend_path(path, check_mode = self.read_mask)
+        
+        if rest != []:
+        
+            return None, "Access denied", path, None
+        
+        # Write any data held for files in the directory so that their
+        # lengths are up to date.
+        File.flush_held(path, directory = True)
+        
+        # Catalogues are only kept while changes to the objects in the
+        # directory are reported, since writing to a file or changing its
+        # permissions does not alter the directory itself.
+        generation = self.catalogues.generation(path)
+        
+        try:
+        
+            # Return the catalogue made previously if the directory has not
+            # changed since.
+            st = os.stat(path)
+            key = (st.st_dev, st.st_ino, getattr(st, "st_mtime_ns", st.st_mtime))
+            
+            catalogue = self.catalogues.get(path, key)
+            
+            if catalogue is not None:
+            
+                return catalogue
+            
+            # For unprotected shares, return a catalogue to the client.
+            files = self._scan_directory(path)
+        
+        except OSError:
+        
+            return None, "Not found", path, None
+        
+        # Write the catalogue information.
+        
+        infolist = []
+        
+        # The first word is the length of the directory structure
+        # information. Calculate this later.
+        # The next word is the length of the following share
+        # information.
+        info = [0, 0x24]
+        
+        # The encoded entries in the current chunk.
+        entries = []
+        
+        dir_length = 0
+        chunk_length = 0
+        
+        n_files = 0
+        
+        for file, file_st in files:
+        
+            # Omit files which begin with a suffix separator ("." on
+            # Linux, for example).
+            if file.find(os.extsep) == 0:
+            
+                continue
+            
+            if file_st is None:
+            
+                # The object could not be examined.
+                continue
+            
+            ros_access = self.to_riscos_access(mode = file_st.st_mode) & self.access_attr
+            # Don't show private files
+            if (ros_access & ROS_PUBLIC_READ) == 0:
+                continue;
+
+            # Filetype word
+            filetype, loadexec, filename = \
+                self.suffix_to_filetype(file, path = path)
+
+            # Construct the filetype and date words.
+            
+            if loadexec == None:
+            
+                # The number of seconds since the last modification
+                # to the file is read.
+                seconds = file_st[os.path.stat.ST_MTIME]
+            
+                # Convert this to the RISC OS date format.
+                cs = self.to_riscos_time(seconds = seconds)
+            
+                filetype_word = long(
+                    long(0xfff00000) | (filetype << 8) | \
+                    ((cs & long(0xff00000000)) >> 32)
+                    )
+                
+                # Date word
+                date_word = cs & long(0xffffffff)
+            
+            else:
+            
+                filetype_word, date_word = loadexec
+            
+            if os.path.stat.S_ISDIR(file_st.st_mode):
+            
+                # Length word (0x800 for directory) and object type (0x2
+                # for directory)
+                file_length = ROS_DIR_LENGTH
+                object_type = 0x02
+                
+                # suffix_to_filetype will have stripped any extension
+                # from the directory.  We want to return the full
+                # directory name, though
+                filename = self.to_riscos_filename(file)
+            
+            else:
+            
+                file_length = file_st.st_size
+                object_type = 0x01
+            
+            # Encode the words describing the object, the access attributes
+            # masked by the share's access mask, and the zero terminated
+            # name in a form suitable for the other client.
+            entry = self._encode([
+                filetype_word, date_word, file_length, ros_access,
+                object_type, filename + "\x00"
+                ])
+            
+            length = len(entry)
+            
+            n_files = n_files + 1
+            
+            if chunk_length + length > 2048:
+                # Fill in the directory length.
+                info[0] = chunk_length
+                info.append(b"".join(entries))
+                infolist.append(info)
+                chunk_length = 0
+                info = [0x0, 0x0c]
+                entries = []
+
+            entries.append(entry)
+            dir_length = dir_length + length
+            chunk_length = chunk_length + length
+        
+        if len(infolist) == 0 and chunk_length == 0:
+            info[0] = 0
+            infolist.append(info)
+        elif chunk_length > 0:
+            info[0] = chunk_length
+            info.append(b"".join(entries))
+            infolist.append(info)
+
+        # The data following the directory structure is concerned
+        # with the share and is like a return value from a share
+        # open request but with a "B" command word like a
+        # catalogue request.
+        
+        # Use a hash value for the handle
+        handle = jenkins_one_at_a_time_hash(path)
+        
+        share_value = (handle & long(0xffffff00)) ^ long(0xffffff02)
+        
+        marker = long(0xffffffff)
+        if len(infolist) > 1:
+            marker = long(0x00000055)
+
+        trailer = \
+        [
+#           The first two words should be filetype and timestamp
+            long(0xffffcd00), long(0x00000000),
+            round_up(dir_length, 2048),
+            long(0x00000013), # Read only for others (0x10); read write for owner
+            share_value, # common value for directories in this share
+            handle, # handle of object as with info returned for opening
+            infolist[0][0], # number of words used to describe the directory
+                        # contents
+            marker
+        ]
+        
+        # Return the lists used to construct the message, the path
+        # catalogued, and the handle
+        catalogue = infolist, trailer, path, handle
+        
+        # Keep the catalogue unless the directory was modified so recently
+        # that a further change might not alter its modification time.
+        if time.time() - st.st_mtime > CATALOGUE_CACHE_SETTLE:
+        
+            self.catalogues.put(path, key, catalogue, dir_length, generation)
+        
+        return catalogue
+    
+    def send_file(self, fh, pos, length):
+    
+        # Determine the length of the file.
+        file_length = fh.length()
+        
+        # Determine the amount of information we can send.
+        amount = min(length, SEND_GET_SIZE)
+        
+        # Find the relevant part of the file.
+        fh.seek(pos, 0)
+        
+        # Read the amount of data required.
+        file_data = fh.read(amount)
+        
+        # Calculate the new offset into the file.
+        new_pos = pos + len(file_data)
+        
+        # Write the message header.
+        header = [len(file_data), 0xc]
+        
+        self.log("comment", "Wrote return header: %s" % header, "", level = LOG_API)
+        
+        # Encode the header, adding padding if necessary.
+        header = self._encode(header)
+        
+        self.log("comment", "Wrote %i bytes of data" % len(file_data), "", level = LOG_API)
+        
+        # Add a 12 byte trailer onto the end of the data
+        # containing the amount of data sent and the new
+        # offset into the file being read.
+        trailer = [len(file_data), new_pos]
+        
+        self.log("comment", "Wrote return trailer: %s" % trailer, "", level = LOG_API)
+        
+        # Encode the trailer, adding padding if necessary.
+        trailer = self._encode(trailer)
+        
+        # Construct the information string.
+        info = header + file_data
+        
+        return info, trailer, new_pos
+    
+    def create_directory(self, ros_path, host):
+    
+        # Construct a path to the object below the shared directory.
+        path = self.from_riscos_path(ros_path, find_obj = 0)
+        
+        if ros_path == "":
+        
+            # The share itself is being referenced.
+            return None, path
+        
+        # Return if the path could not be translated.
+        if path is None:
+        
+            return None, path
+        
+        # Determine whether the parent directory of the file can be written
+        # to.
+        parent_path, file = os.path.split(path)
+        
+        write_path, rest = self.descend_path(
+            parent_path, check_mode = self.write_mask
+            )
+        
+        # Return an error value if it can't.
+        if rest != []: return None, write_path
+        
+        try:
+        
+            # Create a drectory on the local filesystem.
+            os.mkdir(path)
+        
+        except OSError:
+        
+            return None, path
+        
+        try:
+        
+            # Make the directory executable by everyone but retain the
+            # other mode attributes for this share.
+            os.chmod(path, self.mode | DIR_EXEC)
+        
+        except OSError:
+        
+            os.rmdir(path)
+            return None, path
+        
+        self.log("comment", "Actual path: %s" % path, "", level = LOG_API)
+        self.log(
+            "comment",
+            "%s has permissions: %s" % \
+                (path, oct(os.stat(path)[os.path.stat.ST_MODE])),
+            "",
+            level = LOG_API
+            )
+        
+        # Try to find the details of the directory.
+        
+        filetype, date, length, access_attr, object_type, \
+            handle = self.read_path_info(path, Need_handle = 1)
+        
+        # Keep this handle for possible later use.
+        if not self.file_handler.has_key(handle):
+        
+            self.file_handler[handle] = Directory(path, self, host)
+        
+        return [ filetype, date, length, access_attr, object_type,
+                 handle ], path
+    
+
+
+
+class WindowBlock(object):
+
+    """WindowBlock
+    
+    A block of a file requested during a windowed transfer, recording the
+    reply ID used, the range of the file covered, how much of it has been
+    received and when the last progress was made.
+    """
+    
+    __slots__ = ("reply_id", "start", "end", "from_addr", "request",
+                 "time", "tries", "ranges")
+    
+    def __init__(self, reply_id, start, end, request):
+    
+        self.reply_id = reply_id
+        self.start = start
+        self.end = end
+        self.from_addr = start
+        self.request = request
+        self.time = time.time()
+        self.tries = PGET_BLOCK_TRIES
+        
+        # The ends of ranges received after a gap, indexed by their starts.
+        self.ranges = {}
+    
+    def add(self, offset, end):
+    
+        # Record the range of data given as received, advancing the
+        # position received up to only while the data is contiguous.
+        if offset > self.from_addr:
+        
+            self.ranges[offset] = max(self.ranges.get(offset, offset), end)
+            return
+        
+        self.from_addr = max(self.from_addr, end)
+        
+        # Use any ranges received earlier which the data now reaches.
+        for start in sorted(self.ranges):
+        
+            if start > self.from_addr:
+            
+                break
+            
+            self.from_addr = max(self.from_addr, self.ranges.pop(start))
+
+class RemoteShare(Ports, Translate):
+
+    def __init__(self, name, host, messages):
+    
+        # Call the initialisation methods of the base classes.
+        Ports.__init__(self)
+        Translate.__init__(self)
+        
+        self.name = name
+        
+        # Determine the IP address of the host.
+        self.host = socket.gethostbyname(host)
+        
+        # Keep a reference to the messages object passed by the Peer.
+        self.share_messages = messages
+        
+        # Use truncation when sending and receiving files from this
+        # share as a client.
+        self.present = "truncate"
+    
+    def _read_file_info(self, data):
+    
+        # Read the information on the object.
+        packet = decode_packet(data, ObjectInfo)
+        
+        filetype = (packet.filetype_word & 0xfff00) >> 8
+        date_num = ((packet.filetype_word & 0xff) << 32) | packet.date_word
+        
+        date = self.from_riscos_time(date_num)
+        
+        object_type = packet.object_type
+        
+        info = { "filetype": filetype, "date": date,
+                 "length": packet.length,
+                 "access": packet.access_attr, "type": object_type,
+                 "isdir": ((object_type & 0x2) != 0) }
+        
+        if packet.handle is not None:
+        
+            info["handle"] = packet.handle
+        
+        return info
+    
+    def get_key(self):
+        return 0
+
+    def open(self, ros_path):
+    
+        """open(self, name)
+        
+        Open a resource of a given name in the share.
+        """
+        
+        name = self.name
+        
+        if ros_path != "":
+        
+            name = name + "." + ros_path
+        
+        msg = ["A", 1, 0, name+"\x00"]
+        
+        # Send the request.
+        replied, data = self._send_request(msg, self.host, ["R"])
+        
+        if replied != 1:
+        
+            return None
+        
+        else:
+        
+            pass
+            #print('Successfully opened "%s"' % name)
+        
+        # Return the information on the item.
+        return self._read_file_info(data)
+    
+    def catalogue(self, ros_path):
+    
+        """lines = catalogue(self, ros_path)
+        
+        Return a catalogue of the files in the named share.
+        """
+        
+        name = self.name
+        
+        if ros_path != "":
+        
+            name = name + "." + ros_path
+        
+        msg = ["B", 3, long(0xffffffff), 0, name+"\x00"]
+        
+        # Send the request.
+        replied, data = self._send_request(msg, self.host, ["S"])
+        
+        if replied != 1:
+        
+            return
+        
+        # Read the catalogue information.
+        
+        # The first word is the length of the directory structure in bytes
+        # beginning with the next word.
+        dir_length = WORD.unpack_from(data, 4)[0]
+        start = 8
+        
+        # The next word is the directory name.
+        c = start + 4
+        
+        lines = []
+        files = []
+        
+        while c < (start + dir_length):
+        
+            # Each entry contains the filetype and date words, the length
+            # (0x800 for directory), access attributes, object type (0x2 for
+            # directory) and a zero terminated name string.
+            entry = CatalogueEntry(data, c)
+            c = entry.end
+            
+            filetype = long((entry.filetype_word & 0xfff00) >> 8)
+            date_num = ((entry.filetype_word & 0xff) << 32) | entry.date_word
+            
+            date = self.from_riscos_time(date_num)
+            
+            files.append( (
+                entry.filetype_word, date, entry.length, entry.access_attr,
+                entry.object_type, entry.name
+                ) )
+            
+            lines.append(
+                "%s\t:\t%03x\t(%i bytes)\t%s\t%i\t%s" % (
+                    entry.name, filetype, entry.length,
+                    self.repr_mode(self.from_riscos_access(entry.access_attr)),
+                    entry.object_type,
+                    time.asctime(date)
+                    )
+                )
+        
+        for line in lines:
+        
+            sys.stdout.write(line.expandtabs(4)+"\n")
+        
+        # The data following the directory structure is concerned
+        # with the share and is like a return value from a share
+        # open request but with a "B" command word like a
+        # catalogue request.
+        
+        # Return the catalogue information.
+        return files
+    
+    cat = catalogue
+    
+    def get(self, name):
+    
+        # Read the object's information.
+        info = self.open(name)
+        
+        if info is None:
+        
+            return
+        
+        # Use the file handle obtained from the information retrieved about
+        # this object.
+        handle = info["handle"]
+        
+        file_data = []
+        pos = 0
+        
+        # Request packets smaller than the receive buffer size.
+        packet_size = RECV_GET_SIZE
+        
+        while pos < info["length"]:
+        
+            msg = ["B", 0xb, handle, pos, packet_size]
+            
+            # Send the request.
+            replied, data = self._send_request(msg, self.host, ["S"])
+            
+            if replied != 1:
+            
+                print("The machine containing the shared disc does not respond")
+                return
+            
+            # Read the header.
+            length = self.str2num(4, data[4:8])
+            trailer_length = self.str2num(4, data[8:12])
+            
+            file_data.append(data[12:12+length])
+            
+            #print(length, trailer_length, len(data))
+            
+            pos = pos + length
+            
+            if len(data[12+length:]) == trailer_length:
+            
+                returned = self.str2num(4, data[12+length+4:12+length+8])
+                new_pos = self.str2num(4, data[12+length+8:12+length+12])
+                
+                # We have found the packet's trailer.
+                sys.stdout.write(
+                    "\rRead %i/%i bytes of file %s" % (
+                        new_pos, info["length"], name
+                        )
+                    )
+                sys.stdout.flush()
+        
+        
+        # Ensure that the whole file has been read.
+        msg = ["B", 0xb, handle, info["length"], 0]
+        replied, data = self._send_request(msg, self.host, ["S"])
+        
+        if replied != 1:
+        
+            return None
+        
+        else:
+        
+            length = self.str2num(4, data[4:8])
+            trailer_length = self.str2num(4, data[8:12])
+            
+            if len(data[12+length:]) == trailer_length:
+            
+                returned = self.str2num(4, data[12+length+4:12+length+8])
+                new_pos = self.str2num(4, data[12+length+8:12+length+12])
+                
+                # We have found the packet's trailer.
+                sys.stdout.write(
+                    "\rFile %s (%i bytes) read successfully" % (
+                        name, new_pos
+                        )
+                    )
+                sys.stdout.flush()
+        
+        # Close the resource.
+        self._close(handle)
+        
+        return b"".join(file_data)
+    
+    def pget(self, name, window = None):
+    
+        """data = pget(self, name, window = None)
+        
+        Read the named file from the share. By default each block of the
+        file is requested in turn, waiting for it to arrive before asking for
+        the next. If a window is given then up to that many blocks, but no
+        more than PGET_WINDOW_SIZE, are kept in flight at once, adapting the
+        number in flight to any losses. The sequential mode should be used
+        with peers, such as RISC OS 3, which cannot cope with concurrent
+        requests.
+        """
+        
+        if window is not None and window < 1:
+        
+            raise ValueError("Invalid window size: %s" % window)
+        
+        # Read the object's information.
+        info = self.open(name)
+        
+        if info is None:
+        
+            return
+        
+        if window is not None:
+        
+            return self._pget_windowed(
+                name, info, min(window, PGET_WINDOW_SIZE)
+                )
+        
+        # Use the file handle obtained from the information retrieved about
+        # this object.
+        handle = info["handle"]
+        
+        file_data = []
+        pos = 0
+        
+        # Request packets smaller than the receive buffer size.
+        packet_size = RECV_PGET_SIZE
+        
+        start_addr = 0
+        
+        while start_addr < info["length"]:
+        
+            next_addr = min(start_addr + packet_size, info["length"])
+            
+            msg = ["A", 0xb, handle, start_addr, next_addr - start_addr]
+            
+            # Send the request.
+            replied, data = self._send_request(msg, self.host, ["D"])
+            
+            if replied != 1:
+            
+                print("The machine containing the shared disc does not respond")
+                return
+            
+            from_addr = start_addr
+            
+            while 1:
+            
+                # Read the header.
+                command = self.cmd2str(data[0])
+                reply_id = self.replyid2str(data[1:4])
+            
+                if command == "D" and len(data) > 8:
+                
+                    from_addr = self.str2num(4, data[4:8]) + start_addr
+
+                    file_data.append(data[8:])
+                    
+                    from_addr = from_addr + len(data) - 8
+
+                elif command == "D":
+                
+                    data_pos = self.str2num(4, data[4:8]) + start_addr
+
+                    if data_pos == next_addr:
+                    
+                        break
+                
+                elif command == "R" and from_addr == next_addr:
+                
+                    break
+                
+                msg = ["r", from_addr - start_addr, next_addr - start_addr]
+                
+                # Send the request.
+                replied, data = self._send_request(
+                    msg, self.host, ["D", "R"], new_id = self.replyid2str(reply_id)
+                    )
+                
+                if replied != 1:
+                
+                    print("The machine containing the shared disc does not respond")
+                    return
+            
+            sys.stdout.write(
+                "\rRead %i/%i bytes of file %s" % (
+                    from_addr, info["length"], name
+                    )
+                )
+            sys.stdout.flush()
+            
+            # Increase the start position.
+            start_addr = next_addr
+        
+        sys.stdout.write(
+            "\rFile %s (%i bytes) read successfully" % (
+                name, info["length"]
+                )
+            )
+        sys.stdout.flush()
+        
+        # Close the resource.
+        self._close(handle)
+        
+        return b"".join(file_data)
+    
+    def _pget_windowed(self, name, info, window):
+    
+        # Use the non-broadcast socket.
+        if self.ports.get(49171) is None:
+        
+            print("No socket to use for port %i" % 49171)
+            return
+        
+        s = self.ports[49171]
+        
+        # Use the file handle obtained from the information retrieved about
+        # this object.
+        handle = info["handle"]
+        length = info["length"]
+        host = self.host
+        messages = self.share_messages
+        
+        # Reassemble the file in place as blocks arrive in any order.
+        file_data = bytearray(length)
+        
+        # Request blocks smaller than the receive buffer size, in order of
+        # their start addresses.
+        pending = collections.deque(range(0, length, RECV_PGET_SIZE))
+        in_flight = {}
+        
+        # All the blocks in flight signal the same event.
+        event = threading.Event()
+        
+        # Grow the window by one block for each block received until the
+        # threshold is reached, then by one block each time a window's worth
+        # of blocks is received. Halve it when a block times out.
+        size = float(min(PGET_INITIAL_WINDOW, window))
+        threshold = float(window)
+        last_loss = 0
+        
+        received = 0
+        retries = 0
+        error = None
+        
+        t0 = time.time()
+        
+        try:
+        
+            while (pending or in_flight) and error is None:
+            
+                # Keep as many block requests in flight as the window allows.
+                while pending and len(in_flight) < int(size):
+                
+                    start = pending.popleft()
+                    end = min(start + RECV_PGET_SIZE, length)
+                    reply_id = self.new_id()
+                    
+                    block = WindowBlock(
+                        reply_id, start, end,
+                        ["A"+reply_id, 0xb, handle, start, end - start]
+                        )
+                    
+                    messages.add_entry(host, reply_id, event)
+                    in_flight[reply_id] = block
+                    
+                    self._send_list(block.request, s, (host, 49171))
+                
+                event.wait(PGET_BLOCK_TIMEOUT / 4)
+                
+                # Clear the event before collecting replies so that replies
+                # arriving meanwhile will set it again.
+                event.clear()
+                now = time.time()
+                
+                for reply_id, block in list(in_flight.items()):
+                
+                    done = False
+                    
+                    for data in messages._all_messages(host, reply_id, ["D", "R", "E"]):
+                    
+                        command = self.cmd2str(data[0])
+                        
+                        if command == "E":
+                        
+                            error = "%s (%i)" % (
+                                self.read_string(data[8:], ending = "\000", include = 0),
+                                self.str2num(4, data[4:8])
+                                )
+                            break
+                        
+                        block.time = now
+                        
+                        if command == "D" and len(data) > 8:
+                        
+                            # Place the data at the offset given relative to
+                            # the start of the block.
+                            offset = WORD.unpack_from(data, 4)[0] + block.start
+                            chunk = data[8:8 + max(0, block.end - offset)]
+                            file_data[offset:offset + len(chunk)] = chunk
+                            block.add(offset, offset + len(chunk))
+                        
+                        elif command == "D":
+                        
+                            if WORD.unpack_from(data, 4)[0] + block.start == block.end and \
+                               block.from_addr == block.end:
+                            
+                                done = True
+                                break
+                        
+                        elif command == "R" and block.from_addr == block.end:
+                        
+                            done = True
+                            break
+                        
+                        # Ask for the rest of the block from the first part
+                        # not received.
+                        self._send_list(
+                            ["r"+reply_id, block.from_addr - block.start,
+                             block.end - block.start],
+                            s, (host, 49171)
+                            )
+                    
+                    if done:
+                    
+                        messages.remove_entry(host, reply_id)
+                        del in_flight[reply_id]
+                        received = received + block.end - block.start
+                        
+                        if size < threshold:
+                            size = min(size + 1, window)
+                        else:
+                            size = min(size + 1 / size, window)
+                        
+                        sys.stdout.write(
+                            "\rRead %i/%i bytes of file %s" % (
+                                received, length, name
+                                )
+                            )
+                        sys.stdout.flush()
+                    
+                    elif now - block.time > PGET_BLOCK_TIMEOUT:
+                    
+                        block.tries = block.tries - 1
+                        
+                        if block.tries == 0:
+                        
+                            error = "The machine containing the shared disc does not respond"
+                            break
+                        
+                        # Only reduce the window once for losses detected
+                        # within the same timeout period.
+                        if now - last_loss > PGET_BLOCK_TIMEOUT:
+                        
+                            threshold = max(1.0, size / 2)
+                            size = threshold
+                            last_loss = now
+                        
+                        retries = retries + 1
+                        block.time = now
+                        
+                        # Retry just this block, asking for the part of it
+                        # not yet received.
+                        if block.from_addr == block.start:
+                        
+                            self._send_list(block.request, s, (host, 49171))
+                        
+                        else:
+                        
+                            self._send_list(
+                                ["r"+reply_id, block.from_addr - block.start,
+                                 block.end - block.start],
+                                s, (host, 49171)
+                                )
+        
+        finally:
+        
+            for reply_id in in_flight.keys():
+            
+                messages.remove_entry(host, reply_id)
+        
+        if error is not None:
+        
+            print(error)
+            
+            # Close the resource.
+            self._close(handle)
+            return
+        
+        t = max(time.time() - t0, 1e-6)
+        
+        sys.stdout.write(
+            "\rFile %s (%i bytes) read successfully in %.2f seconds " \
+            "(%.1f KB/s, window %i, %i retries)" % (
+                name, length, t, length / t / 1024.0, int(size), retries
+                )
+            )
+        sys.stdout.flush()
+        
+        # Close the resource.
+        self._close(handle)
+        
+        return bytes(file_data)
+    
+    def _close(self, handle):
+    
+        #if handle is None:
+        #
+        #    # Read the object's information.
+        #    info = self.open(name, host)
+        #    
+        #    if info is None:
+        #    
+        #        return
+        #    
+        #    # Use the file handle obtained from the information retrieved about
+        #    # this object to close the resource.
+        #    handle = info["handle"]
+        
+        msg = ["A", 0xa, handle]
+        replied, data = self._send_request(msg, self.host, ["R"])
+        
+        if replied != 1:
+        
+            return None
+    
+    def put(self, path, ros_path):
+    
+        # Use the non-broadcast socket.
+        if not 49171 in self.ports:
+        
+            print("No socket to use for port %i" % 49171)
+            return 0, []
+        
+        s = self.ports[49171]
+        
+        try:
+        
+            # Determine the file's relevant filetype and
+            # date words.
+            filetype_word, date_word = self.make_riscos_filetype_date(path)
+            
+            # Find the length of the file.
+            length = os.path.getsize(path)
+            
+            # Construct access attributes for the other client.
+            access_attr = self.to_riscos_access(path = path)
+            
+            # Use a default value for the object type.
+            object_type = 0x0101
+        
+        except OSError:
+        
+            print("Failed to find file: %s" % path)
+            return
+        
+        # Convert the filename into a RISC OS filename on the share.
+        directory, file = os.path.split(path)
+        
+        self.log("comment", "File to put: %s" % file, "", level = LOG_API)
+        
+        _, _, ros_file = self.suffix_to_filetype(file)
+        
+        self.log("comment", "Remote file: %s" % ros_file, "", level = LOG_API)
+        
+        # Determine whether the share path supplied refers to a file
+        # or a directory.
+        
+        info = self.open(ros_path)
+        
+        if info is not None:
+        
+            self._close(info["handle"])
+            
+            if info["isdir"]:
+            
+                # A directory
+                
+                # Prefix the path in the share with the share name and append
+                # the filename to obtain a full share path to the object.
+                if ros_path != "":
+                
+                    ros_path = ros_path + "." + ros_file
+                
+                else:
+                
+                    ros_path = ros_file
+                
+                full_path = self.name + "." + ros_path
+            
+            else:
+            
+                # A file
+                
+                # Use the share path given and ignore the filename derived
+                # from the local path.
+                
+                full_path = self.name + "." + ros_path
+        
+        else:
+        
+            # No existing object
+            
+            # Use the share path given and ignore the filename derived
+            # from the local path.
+            
+            full_path = self.name + "." + ros_path
+        
+        self.log("comment", "Remote path: %s" % ros_path, "", level = LOG_API)
+        
+        # Create a file on the remote server using the full path.
+        msg = ["A", 0x4, 0, full_path+"\x00"]
+        
+        # Send the request.
+        replied, data = self._send_request(msg, self.host, ["R"])
+        
+        if replied != 1:
+        
+            return
+        
+        # The data returned represents the information about the newly
+        # created remote file.
+        info = self._read_file_info(data)
+        
+        if info is None or "handle" not in info:
+        
+            print("Cannot send file to client.")
+            return
+        
+        # Send the file, from the start to  its length.
+        msg = ["A", 0xc, info["handle"], 0, length]
+        
+        # Send the request.
+        replied, data = self._send_request(msg, self.host, ["w"])
+        
+        if replied != 1:
+        
+            # Tidy up.
+            self._close(info["handle"])
+            
+            # Use the share path rather than the full share path as the
+            # delete method will prepend the share name.
+            self.delete(ros_path)
+            return
+        
+        # A reply containing two words was returned. Presumably, the
+        # second is the length of the data to be sent and the first is
+        # the position in the file of the data requested (like the
+        # get method's "B" ... 0xb message.
+        reply_id = self.replyid2str(data[1:4])
+        from_addr = self.str2num(4, data[4:8])
+        to_addr = self.str2num(4, data[12:16])
+        amount = min(SEND_SIZE, to_addr - from_addr)
+        
+        f = None
+        
+        try:
+        
+            # Read the file ahead of the requests for its data.
+            f = ReadAhead(path, SEND_SIZE)
+            
+            while from_addr < length:
+            
+                # Read the data to be sent.
+                file_data = f.read(from_addr, amount)
+                
+                # Send a message with the offset of that data within the
+                # file. Don't pad the data sent.
+                msg = ["d"+reply_id, from_addr, (NO_PAD, file_data)]
+                self.log(
+                    "comment",
+                    "%i bytes of data sent in message." % len(file_data),
+                    "",
+                    level = LOG_API
+                    )
+                
+                # Wait for messages to arrive with the same ID as
+                # the one used to specify the file to be uploaded.
+                replied, data = self._send_and_expect_reply(
+                    s, msg, self.host, reply_id, ["w", "R"]
+                    )
+                
+                if replied != 1:
+                
+                    # Tidy up.
+                    self._close(info["handle"])
+                    
+                    # Use the share path rather than the full share path as the
+                    # delete method will prepend the share name.
+                    self.delete(ros_path)
+                    
+                    f.close()
+                    
+                    print("Uploading was terminated.")
+                    return
+                
+                command = self.cmd2str(data[0])
+                #pos = pos + amount
+                if command == "w":
+                
+                    # More data requested.
+                    reply_id = self.replyid2str(data[1:4])
+                    from_addr = self.str2num(4, data[4:8])
+                    to_addr = self.str2num(4, data[12:16])
+                    amount = min(SEND_SIZE, to_addr - from_addr)
+                
+                elif command == "R":
+                
+                    from_addr = self.str2num(4, data[4:8])
+                    total_length = self.str2num(4, data[8:12])
+                    break
+                
+                sys.stdout.write(
+                    "\rWritten %i/%i bytes of file %s" % (
+                        from_addr, length, ros_path
+                        )
+                    )
+                sys.stdout.flush()
+            
+            f.close()
+            
+            # When all the data has been sent, send an empty "d" message.
+            msg = ["d"+reply_id, length]
+            
+            self._send_list(msg, s, (self.host, 49171))
+            
+            sys.stdout.write(
+                '\rFile "%s" (%i bytes) successfully written to "%s"' % (
+                    path, length, ros_path
+                    )
+                )
+            sys.stdout.flush()
+        
+        except IOError:
+        
+            # Tidy up.
+            if f is not None:
+            
+                f.close()
+            
+            self._close(info["handle"])
+            
+            # Use the share path rather than the full share path as the
+            # delete method will prepend the share name.
+            self.delete(ros_path)
+            
+            print("Uploading was terminated.")
+            return
+        
+        # Set the filetype and date stamp.
+        msg = [ "A", 0x10, info["handle"], filetype_word, date_word ]
+        
+        # Send the request.
+        replied, data = self._send_request(msg, self.host, ["R"])
+        
+        if replied != 1:
+        
+            # Tidy up.
+            self._close(info["handle"])
+            
+            # Use the share path rather than the full share path as the
+            # delete method will prepend the share name.
+            self.delete(ros_path)
+            return
+        
+        # Tidy up.
+        self._close(info["handle"])
+    
+    def pput(self, path, ros_path):
+    
+        # Use the non-broadcast socket.
+        if not 49171 in self.ports:
+        
+            print("No socket to use for port %i" % 49171)
+            return 0, []
+        
+        s = self.ports[49171]
+        
+        try:
+        
+            # Determine the file's relevant filetype and
+            # date words.
+            filetype_word, date_word = self.make_riscos_filetype_date(path)
+            
+            # Find the length of the file.
+            length = os.path.getsize(path)
+            
+            # Construct access attributes for the other client.
+            access_attr = self.to_riscos_access(path = path)
+            
+            # Use a default value for the object type.
+            object_type = 0x0101
+        
+        except OSError:
+        
+            print("Failed to find file: %s" % path)
+            return
+        
+        # Convert the filename into a RISC OS filename on the share.
+        directory, file = os.path.split(path)
+        
+        self.log("comment", "File to put: %s" % file, "", level = LOG_API)
+        
+        _, _, ros_file = \
+            self.suffix_to_filetype(file)
+        
+        self.log("comment", "Remote file: %s" % ros_file, "", level = LOG_API)
+        
+        # Determine whether the share path supplied refers to a file
+        # or a directory.
+        
+        info = self.open(ros_path)
+        
+        if info is not None:
+        
+            self._close(info["handle"])
+            
+            if info["isdir"]:
+            
+                # A directory
+                
+                # Prefix the path in the share with the share name and append
+                # the filename to obtain a full share path to the object.
+                if ros_path != "":
+                
+                    ros_path = ros_path + "." + ros_file
+                
+                else:
+                
+                    ros_path = ros_file
+                
+                full_path = self.name + "." + ros_path
+            
+            else:
+            
+                # A file
+                
+                # Use the share path given and ignore the filename derived
+                # from the local path.
+                
+                full_path = self.name + "." + ros_path
+        
+        else:
+        
+            # No existing object
+            
+            # Use the share path given and ignore the filename derived
+            # from the local path.
+            
+            full_path = self.name + "." + ros_path
+        
+        self.log("comment", "Remote path: %s" % ros_path, "", level = LOG_API)
+        
+        # Create a file on the remote server using the full share path.
+        msg = ["A", 0x4, 0, full_path+"\x00"]
+        
+        # Send the request.
+        replied, data = self._send_request(msg, self.host, ["R"])
+        
+        if replied != 1:
+        
+            return
+        
+        # The data returned represents the information about the newly
+        # created remote file.
+        info = self._read_file_info(data)
+        
+        if info is None or "handle" not in info:
+        
+            print("Cannot send file to client.")
+            return
+        
+        f = None
+        
+        try:
+        
+            # Read the file ahead of the requests for its data so that
+            # the disk is read while waiting for the other client.
+            f = ReadAhead(path, SEND_PPUT_SIZE)
+            
+            start_addr = 0
+            
+            while start_addr < length:
+            
+                # Send the file, from the start to  its length.
+                next_addr = min(length, start_addr + SEND_PPUT_SIZE)
+                
+                # Send the start offset into the file and the amount of data
+                # to be transferred.
+                msg = [ "A", 0xc, info["handle"], start_addr,
+                        next_addr - start_addr ]
+                
+                # Send the request.
+                replied, data = self._send_request(msg, self.host, ["w"])
+                
+                if replied != 1:
+                
+                    # Tidy up.
+                    f.close()
+                    self._close(info["handle"])
+                    
+                    # Use the share path rather than the full share path as the
+                    # delete method will prepend the share name.
+                    self.delete(ros_path)
+                    return
+                
+                # A reply containing two words was returned. These are the
+                # start and end offsets into the file relative to the
+                # start offset we gave previously.
+                
+                from_addr = start_addr
+                
+                # Hold an entry for replies with the ID of this block so that
+                # the reply which ends it is kept if it arrives just after a
+                # request for more data.
+                block_id = self.replyid2str(data[1:4])
+                self.share_messages.add_entry(self.host, block_id)
+                
+                try:
+                
+                    while 1:
+                    
+                        command = self.cmd2str(data[0])
+                        if command == "w":
+                        
+                            # More data requested.
+                            reply_id = self.replyid2str(data[1:4])
+                            
+                            # Convert the relative addresses into absolute ones.
+                            from_addr = start_addr + self.str2num(4, data[4:8])
+                            
+                            to_addr = start_addr + \
+                                min(self.str2num(4, data[12:16]), next_addr)
+                                
+                            amount = min(SEND_SIZE, to_addr - from_addr)
+                        
+                        elif command == "R":
+                        
+                            # Convert the relative addresses into absolute ones.
+                            from_addr = start_addr + self.str2num(4, data[4:8])
+                            #total_length = start_addr + self.str2num(4, data[8:12])
+                            break
+                        
+                        # The other client asks for an empty block once it has
+                        # all the data for this block. Only send the header in
+                        # that case; an empty data message would be answered
+                        # before we are ready to receive the reply.
+                        if amount > 0:
+                        
+                            file_data = f.read(from_addr, amount)
+                            
+                            # Send a message with the offset of that data within the
+                            # file. The address sent is relative to the start of the
+                            # block specified. Don't pad the data sent.
+                            msg = [
+                                "d"+reply_id, from_addr - start_addr,
+                                (NO_PAD, file_data)
+                                ]
+                            
+                            self.log(
+                                "comment",
+                                "%i bytes of data sent in message." % len(file_data),
+                                "",
+                                level = LOG_API
+                                )
+                            
+                            # Send the reply.
+                            self._send_list(msg, s, (self.host, 49171))
+                        
+                        # Send a message with the amount of data specified.
+                        # The address sent is relative to the start of the
+                        # block specified.
+                        msg = ["d", from_addr - start_addr]
+        
+                        # Wait for messages to arrive with the same ID as
+                        # the one used to specify the file to be uploaded.
+                        replied, data = self._send_request(
+                            msg, self.host, ["w", "R"], new_id = reply_id
+                            )
+                        
+                        if replied != 1:
+                        
+                            # Tidy up.
+                            self._close(info["handle"])
+                            
+                            # Use the share path rather than the full share path as the
+                            # delete method will prepend the share name.
+                            self.delete(ros_path)
+                            
+                            f.close()
+                            
+                            print("Uploading was terminated.")
+                            return
+                    
+                finally:
+                
+                    self.share_messages.remove_entry(self.host, block_id)
+                
+                #pos = pos + amount
+                sys.stdout.write(
+                    "\rWritten %i/%i bytes of file %s" % (
+                        from_addr, length, ros_path
+                        )
+                    )
+                sys.stdout.flush()
+                
+                # Increase the start position.
+                start_addr = next_addr
+            
+            f.close()
+            
+            # When all the data has been sent, send an empty "d" message.
+            msg = ["d"+reply_id, length]
+            
+            self._send_list(msg, s, (self.host, 49171))
+            
+            sys.stdout.write(
+                '\rFile "%s" (%i bytes) successfully written to "%s"' % (
+                    path, length, ros_path
+                    )
+                )
+            sys.stdout.flush()
+        
+        except IOError:
+        
+            # Tidy up.
+            if f is not None:
+            
+                f.close()
+            
+            self._close(info["handle"])
+            
+            # Use the share path rather than the full share path as the
+            # delete method will prepend the share name.
+            self.delete(ros_path)
+            
+            print("Uploading was terminated.")
+            return
+        
+        # Set the filetype and date stamp.
+        msg = [ "A", 0x10, info["handle"], filetype_word, date_word ]
+        
+        # Send the request.
+        replied, data = self._send_request(msg, self.host, ["R"])
+        
+        if replied != 1:
+        
+            # Tidy up.
+            self._close(info["handle"])
+            
+            # Use the share path rather than the full share path as the
+            # delete method will prepend the share name.
+            self.delete(ros_path)
+            return
+        
+        # Tidy up.
+        self._close(info["handle"])
+    
+    def delete(self, ros_path):
+    
+        """delete(self, ros_path)
+        
+        Delete the named file on the specified host.
+        """
+        
+        name = self.name
+        
+        if ros_path != "":
+        
+            name = name + "." + ros_path
+        
+        msg = ["A", 0x6, 0, name + "\x00"]
+        
+        replied, data = self._send_request(msg, self.host, ["R"])
+        
+        if replied == 1:
+        
+            sys.stdout.write('Deleted "%s" on "%s"' % (name, self.host))
+            sys.stdout.flush()
+    
+    def rename(self, name1, name2):
+    
+        msg = ["A", 0x9, len(name2), 0, name1 + "\x00"]
+        
+        replied, data = self._send_request(msg, self.host, ["R"])
+        
+        if replied != 1:
+        
+            return
+        
+        # The data returned represents the information about the file.
+        info = self._read_file_info(data)
+        
+        
+    
+    def setmode(self, ros_path, mode):
+    
+        name = self.name
+        
+        if ros_path != "":
+        
+            name = name + "." + ros_path
+        
+        access_attr = self.to_riscos_access(mode = mode)
+        
+        msg = ["A", 0x7, access_attr, 0, name+"\x00"]
+        
+        replied, data = self._send_request(msg, self.host, ["R"])
+        
+        if replied != 1:
+        
+            return
+        
+        # Read the information returned.
+        info = self._read_file_info(data)
+        
+        return info
+    
+    def settype(self, ros_path, filetype):
+    
+        #name = self.name
+        #
+        #if ros_path != "":
+        #
+        #    name = name + "." + ros_path
+        
+        # Prefixing the path with the share name does not always work.
+        name = ros_path
+        
+        # Obtain information on the file (open it).
+        info = self.open(name)
+        
+        cs = self.to_riscos_time(ttuple = info["date"])
+        
+        filetype_word, date_word = \
+            self._make_riscos_filetype_date(filetype, cs)
+        
+        msg = ["A", 0x10, info["handle"], filetype_word, date_word]
+        
+        replied, data = self._send_request(msg, self.host, ["R"])
+        
+        if replied != 1:
+        
+            # RISC OS 5 always returns a "Not Found" error.  I don't know why.
+            if replied == -1 and data[1].startswith("Not found"):
+
+                pass
+
+            else:
+
+                return
+        
+        self._close(info["handle"])
+    
+    def create_directory(self, ros_path):
+    
+        """create_directory(self, ros_path)
+        
+        Create a directory at a location within the share.
+        """
+        
+        name = self.name
+        
+        if ros_path != "":
+        
+            name = name + "." + ros_path
+        
+        msg = ["A", 0x5, 0, name + "\x00"]
+        
+        replied, data = self._send_request(msg, self.host, ["R"])
+        
+        if replied != 1:
+        
+            return None
+        
+        sys.stdout.write('Created "%s" on share "%s"' % (name, self.host))
+        sys.stdout.flush()
+        
+        # Read the information returned.
+        info = self._read_file_info(data)
+        
+        return info
+
+
+
+class PrinterError(Exception):
+
+    pass
+
+class Printer(Ports):
+
+    def __init__(self, name, directory, defn, description, delay, command,
+                 engine = None):
+    
+        # Call the initialisation method of the base classes.
+        Ports.__init__(self)
+        
+        self.name = name
+        self.directory = directory
+        self.defn = defn
+        self.description = description
+        self.delay = delay
+        self.command = command
+        
+        # Ensure that the directory structure is correctly set up.
+        self.setup()
+        
+        # Create an event to use to inform the share that it must be
+        # removed.
+        self.event = threading.Event()
+        
+        self.engine = engine
+        
+        if engine is not None:
+        
+            # Let the event loop schedule the printer's broadcasts when it is
+            # started.
+            self.thread = None
+            return
+        
+        # Create a thread to run the printer broadcast loop.
+        self.thread = threading.Thread(
+            group = None, target = self.broadcast_printer,
+            name = 'Printer "%s"' % self.name
+            )
+    
+    def start(self):
+    
+        """start(self)
+        
+        Start broadcasting the availability of the printer.
+        """
+        
+        if self.engine is not None:
+        
+            self.engine.add_printer(self)
+        
+        else:
+        
+            self.thread.start()
+    
+    def stop(self):
+    
+        """stop(self)
+        
+        Stop broadcasting the availability of the printer.
+        """
+        
+        self.event.set()
+        
+        if self.thread is not None:
+        
+            # Wait until the thread terminates if it was started.
+            if self.thread.ident is not None:
+            
+                self.thread.join()
+        
+        else:
+        
+            self.engine.remove(self)
+    
+    def setup(self):
+    
+        # Copy the printer definition file into the printer share directory.
+        try:
+        
+            new_path = os.path.join(self.directory, self.name) + \
+                os.extsep + "fc6"
+            
+            open(new_path, "wb").write(open(self.defn, "rb").read())
+        
+        except IOError:
+        
+            raise PrinterError("Definition file not found.")
+        
+        # Create the RemQueue and RemSpool directories inside the printer
+        # share directory.
+        try:
+        
+            os.chmod(new_path, UNPROTECTED_READ | UNPROTECTED_WRITE | FILE_ATTR)
+            
+            if not os.path.isdir(os.path.join(self.directory, "RemQueue")):
+            
+                os.mkdir(os.path.join(self.directory, "RemQueue"))
+            
+            os.chmod(
+                os.path.join(self.directory, "RemQueue"),
+                DIR_EXEC | UNPROTECTED_READ | USER_WRITE
+                )
+            
+            if not os.path.isdir(os.path.join(self.directory, "RemSpool")):
+            
+                os.mkdir(os.path.join(self.directory, "RemSpool"))
+            
+            os.chmod(
+                os.path.join(self.directory, "RemSpool"),
+                DIR_EXEC | UNPROTECTED_READ | USER_WRITE
+                )
+        
+        except OSError:
+        
+            raise PrinterError("Failed to create printer share subdirectories.")
+    
+    def broadcast_printer(self):
+    
+        """broadcast_printer(self)
+        
+        Broadcast the availability of a printer every few seconds.
+        """
+        
+        if not self._broadcast_available():
+        
+            return
+        
+        while 1:
+        
+            self.event.wait(self.delay)
+            if self.event.isSet(): return
+            
+            self._broadcast_reminder()
+    
+    def _broadcast_available(self):
+    
+        # Broadcast the availability of the printer on the polling socket,
+        # returning whether further broadcasts should be made.
+        
+        if self.broadcasters.get(32770) is None:
+        
+            print("No socket to use for port %i" % 32770)
+            return False
+        
+        s = self.broadcasters[32770]
+        
+        data = \
+        [
+            0x00020002, 0x00010000,
+            (len(self.description) << 16) | len(self.name),
+            self.name + self.description
+        ]
+        
+        self._send_list(data, s, (Broadcast_addr, 32770))
+        
+        return True
+    
+    def _broadcast_reminder(self):
+    
+        # Remind other clients of the availability of this printer.
+        s = self.broadcasters[32770]
+        
+        data = \
+        [
+            0x00020004, 0x00010000,
+            (len(self.description) << 16) | len(self.name),
+            self.name + self.description
+        ]
+        
+        self._send_list(data, s, (Broadcast_addr, 32770))
+    
+
+
+
+class DirectoryWatcher:
+
+    """DirectoryWatcher(callback, delay = WATCH_COALESCE_DELAY)
+    
+    Watch directories for changes using inotify on Linux, calling the
+    function given with the set of directories which have changed and the
+    set of directories which have been removed. Changes arriving within the
+    delay given of the first one are reported together. The available
+    attribute is false if inotify cannot be used, in which case directories
+    should be polled instead.
+    """
+    
+    # Events which change the catalogue of a directory, from inotify.h.
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    
+    # Events reported without being asked for.
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    
+    IN_ONLYDIR = 0x1000000
+    
+    WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+                 IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | \
+                 IN_ONLYDIR
+    
+    # The header of each event read: watch descriptor, mask, cookie and the
+    # length of the name which follows.
+    EVENT = struct.Struct("iIII")
+    
+    def __init__(self, callback, delay = WATCH_COALESCE_DELAY):
+    
+        self.callback = callback
+        self.delay = delay
+        
+        # Map watch descriptors to paths and paths to watch descriptors.
+        self.paths = {}
+        self.watches = {}
+        self.lock = threading.Lock()
+        
+        # Create an event to use to terminate the thread.
+        self.event = threading.Event()
+        
+        self.fd = None
+        self.thread = None
+        self.available = False
+        
+        if not sys.platform.startswith("linux"):
+        
+            return
+        
+        try:
+        
+            import ctypes.util
+            
+            libc = ctypes.CDLL(
+                ctypes.util.find_library("c") or "libc.so.6", use_errno = True
+                )
+            
+            # IN_NONBLOCK has the same value as O_NONBLOCK.
+            fd = libc.inotify_init1(os.O_NONBLOCK)
+        
+        except (OSError, AttributeError):
+        
+            return
+        
+        if fd < 0:
+        
+            return
+        
+        self.libc = libc
+        self.fd = fd
+        self.available = True
+        
+        # Create a thread to read the events in.
+        self.thread = threading.Thread(
+            group = None, target = self._read_events,
+            name = "Directory watcher"
+            )
+    
+    def start(self):
+    
+        # Only start the thread once.
+        if self.thread is not None and self.thread.ident is None and \
+            not self.event.isSet():
+        
+            self.thread.start()
+    
+    def stop(self):
+    
+        self.event.set()
+        
+        if self.is_alive():
+        
+            # The thread closes the inotify file descriptor.
+            self.thread.join()
+        
+        elif self.fd is not None:
+        
+            os.close(self.fd)
+        
+        self.fd = None
+        self.available = False
+    
+    def is_alive(self):
+    
+        return self.thread is not None and self.thread.is_alive()
+    
+    def watch(self, path):
+    
+        """watched = watch(self, path)
+        
+        Start watching the directory given, returning True if it is being
+        watched or False if it must be polled.
+        """
+        
+        if not self.available:
+        
+            return False
+        
+        self.lock.acquire()
+        
+        try:
+        
+            if path in self.watches:
+            
+                return True
+            
+            name = path
+            
+            if not isinstance(name, bytes):
+            
+                name = name.encode(sys.getfilesystemencoding())
+            
+            wd = self.libc.inotify_add_watch(self.fd, name, self.WATCH_MASK)
+            
+            if wd < 0:
+            
+                # The directory may have gone, or too many are watched.
+                return False
+            
+            self.watches[path] = wd
+            self.paths[wd] = path
+            return True
+        
+        finally:
+        
+            self.lock.release()
+    
+    def unwatch(self, path):
+    
+        self.lock.acquire()
+        
+        try:
+        
+            wd = self.watches.pop(path, None)
+            
+            if wd is None:
+            
+                return
+            
+            del self.paths[wd]
+            
+            if self.fd is not None:
+            
+                self.libc.inotify_rm_watch(self.fd, wd)
+        
+        finally:
+        
+            self.lock.release()
+    
+    def watching(self, path):
+    
+        return path in self.watches
+    
+    def _read_events(self):
+    
+        changed = set()
+        removed = set()
+        
+        # The time at which to report the changes collected so far.
+        deadline = None
+        
+        try:
+        
+            while not self.event.isSet():
+            
+                if deadline is None:
+                
+                    timeout = 0.5
+                
+                else:
+                
+                    timeout = max(0, deadline - time.time())
+                
+                try:
+                
+                    r, w, e = select.select([self.fd], [], [], timeout)
+                
+                except (select.error, OSError):
+                
+                    # Interrupted by a signal.
+                    r = []
+                
+                if r:
+                
+                    try:
+                    
+                        data = os.read(self.fd, 65536)
+                    
+                    except OSError:
+                    
+                        data = b""
+                    
+                    self._read_changes(data, changed, removed)
+                    
+                    if deadline is None and (changed or removed):
+                    
+                        deadline = time.time() + self.delay
+                
+                if deadline is not None and time.time() >= deadline:
+                
+                    # Report a burst of changes at once.
+                    self.callback(changed, removed)
+                    
+                    changed = set()
+                    removed = set()
+                    deadline = None
+        
+        finally:
+        
+            os.close(self.fd)
+    
+    def _read_changes(self, data, changed, removed):
+    
+        # Add the paths of the directories referred to by the events in the
+        # data to the sets of changed and removed directories.
+        offset = 0
+        
+        self.lock.acquire()
+        
+        try:
+        
+            while offset + self.EVENT.size <= len(data):
+            
+                wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+                offset = offset + self.EVENT.size + length
+                
+                if mask & self.IN_Q_OVERFLOW:
+                
+                    # Events were lost so assume that everything changed.
+                    changed.update(self.watches.keys())
+                    continue
+                
+                path = self.paths.get(wd)
+                
+                if path is None:
+                
+                    continue
+                
+                if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF | self.IN_IGNORED):
+                
+                    # The directory itself has gone so stop watching it.
+                    removed.add(path)
+                    del self.paths[wd]
+                    del self.watches[path]
+                    
+                    if not mask & self.IN_IGNORED:
+                    
+                        self.libc.inotify_rm_watch(self.fd, wd)
+                
+                else:
+                
+                    changed.add(path)
+        
+        finally:
+        
+            self.lock.release()
+        
+        # Directories removed in this burst need not be reported as changed.
+        changed.difference_update(removed)
+
+
+class Peer(Ports):
+
+    def __init__(self, access_plus = 1, engine = None, workers = 0):
+    
+        # Call the initialisation method of the base classes.
+        Ports.__init__(self, access_plus)
+        
+        # Record the ports in use.
+        self.use_ports = []
+        
+        for port, value in self.ports.items():
+        
+            if value is not None:
+            
+                self.use_ports.append(port)
+        
+        # ---------------------------------------------------------------------
+        # Socket configuration
+        
+        self.identity = self.number(4, id(self))
+        
+        # ---------------------------------------------------------------------
+        # Event loop configuration
+        
+        # Sockets, broadcasts and transfers can optionally be handled by an
+        # asyncio event loop in a single thread instead of by a thread each.
+        if engine == "asyncio":
+        
+            try:
+            
+                import access_async
+                self.engine = access_async.Engine(self)
+            
+            except (ImportError, SyntaxError):
+            
+                sys.stderr.write("The asyncio engine is not available.\n")
+                self.engine = None
+        
+        else:
+        
+            self.engine = None
+        
+        # ---------------------------------------------------------------------
+        # Thread configuration
+        
+        # Create an event to use to terminate the polling thread.
+        self.poll_event = threading.Event()
+        
+        # Create a thread to call the broadcast_poll method of the
+        # access object.
+        self.poll_thread = threading.Thread(
+            group = None, target = self.broadcast_poll,
+            name = "Poller", args = (self.poll_event,)
+            )
+        
+        # Create an event to use to inform the listening thread that it
+        # must terminate.
+        self.listen_event = threading.Event()
+        
+        # Create a thread to use to listen for packets sent directly to
+        # our machine.
+        self.listen_thread = threading.Thread(
+            group = None, target = self.listen,
+            name = "Listener", args = (self.listen_event,)
+            )
+        
+        # ---------------------------------------------------------------------
+        # Resources configuration
+        
+        # Maintain a dictionary of known clients, shares and printers.
+        # Each of these will use a separate thread.
+        self.clients = {}
+        self.shares = {}
+        self.printers = {}
+        
+        # Decide when the transfers requested by other clients can run,
+        # and run them using a pool of threads.
+        self.transfers = TransferScheduler()
+        self.transfer_pool = TransferPool(self._run_scheduled)
+        
+        # The number of blocks sent to each client before waiting for a
+        # reply when it reads a file from one of our shares.
+        self.send_windows = {}
+        
+        # Keep the chunks of catalogues which are too long to send at once
+        # until the clients reading them ask for them.
+        self.listing_cache = ListingCache()
+
+        # Create lists of messages sent to each listening socket.
+        
+        # General messages.
+        self.general_messages = Messages()
+        
+        # Messages about shares.
+        self.share_messages = Messages()
+        
+        # Use an object to manage the file handles used by shares owned by
+        # this Peer.
+        self.file_handler = HandleTable()
+
+        # Use an object to record all catalogued paths
+        self.catalogued_paths = {}
+        self.catalogued_paths_lock = threading.Lock()
+        
+        # Watch catalogued directories for changes where possible instead
+        # of polling them.
+        self.watcher = DirectoryWatcher(self._directories_changed)
+
+        # Bind the handlers for messages received on the share port.
+        self._share_dispatch = {}
+
+        for key, name in self.share_handlers.items():
+
+            self._share_dispatch[key] = getattr(self, name)
+
+        # Maintain a dictionary of open shares, on the local host or
+        # on other hosts.
+        # Each entry in this dictionary is referenced by a tuple containing
+        # the name of the share and the host it resides on and contains the
+        # ID value used to open it.
+        self.open_shares = {}
+
+        # Maintain a dictionary of usernames we have logged on as
+        # Each entry contains the password key
+        self.access_users = {}
+
+        # List of hosts on different subnets that are permitted to talk to us
+        self.remote_nets = []
+        
+        # Filter incoming messages by the address they were sent from.
+        self.address_filter = AddressFilter()
+        
+        # The worker processes serving shares, if any, the pipes used to
+        # tell them about changes to the shares, and the state they share.
+        self.worker_pids = []
+        self.worker_pipes = []
+        self.worker_store = None
+        
+        # Shares and printers added before serving starts are started with
+        # it.
+        self.serving = False
+        
+        # Read the share configuration file, creating shares as required.
+        self.create_shares()
+        
+        # Start serving.
+        self.serve(workers)
+    
+    def __del__(self):
+    
+        # Stop any serving threads.
+        self.stop()
+        
+        # Close all sockets.
+        for port, _socket in self.broadcasters.items():
+        
+            sys.stdout.write("Closing broadcaster socket for port %i\n" % port)
+            _socket.close()
+        
+        # On Windows, port sockets are a copy of broadcast sockets,
+        # so don't bother to close them
+        if not sys.platform.startswith('win32'):
+
+            for port, _socket in self.ports.items():
+        
+                sys.stdout.write("Closing socket for port %i\n" % port)
+                _socket.close()
+    
+    def _encode_pin_char(self, c):
+
+        if (c.isdigit()):
+
+            return (ord(c) - ord('0')) + 1
+
+        elif c.isalpha():
+
+            v = ord(c.upper()) - ord('A')
+
+            if v > 25:
+
+                raise PasswordError("Password char is invalid: %s" % c)
+
+            return v + 11
+
+        else:
+
+            raise PasswordError("Password char is invalid: %s" % c)
+
+        return 0
+
+    def _make_pin(self, str):
+
+        if len(str) > 6:
+
+            return None
+
+        pin = ctypes.c_uint(0)
+
+        for c in str:
+
+            pin.value = (pin.value * 0x25) + self._encode_pin_char(c)
+
+        return int(pin.value)
+
+    def cleanup_handles(self, host):
+
+        for share in self.shares.values():
+
+            if isinstance(share, Share):
+
+                share.cleanup_handles(host)
+
+        self.listing_cache.discard_host(host)
+
+        # Stop following the directories which were only catalogued for
+        # the host.
+        unused = []
+        
+        self.catalogued_paths_lock.acquire()
+        
+        try:
+        
+            for handle, (path, mtime, hosts) in list(self.catalogued_paths.items()):
+            
+                if host in hosts:
+                
+                    hosts[:] = [h for h in hosts if h != host]
+                    if len(hosts) == 0:
+                    
+                        del self.catalogued_paths[handle]
+                        unused.append(path)
+        
+        finally:
+        
+            self.catalogued_paths_lock.release()
+        
+        for path in unused:
+        
+            self.watcher.unwatch(path)
+            self._forget_catalogues(path, watched = False)
+
+    def create_shares(self):
+    
+        """creates_shares(self)
+        
+        Create shares on the local machine from a list in the .access
+        configuration file. This file has the following format:
+        
+        Directory/disc shares
+        
+        Each line of the .access file describing directory/disc shares must
+        conform to the following syntax:
+        
+        <share> <path> <mode> <delay> <translation> <filetype> <key>
+        
+        The "share" parameter is the name by which other clients
+        refer to the contents of the shared directory.
+        
+        The "path" is the path on the local filesystem which can be
+        navigated by other clients.
+        
+        The "mode" is an octal value describing a mask to apply to
+        the files and directories in the shared directory. This
+        is loosely translated into a value for the protected flag
+        which is understood by RISC OS clients.
+        
+        The "delay" parameter sets the delay between availability
+        broadcasts on the network. This can be disabled by supplying
+        the value "off" (without quotes) or set to the default value
+        using the value "default".
+        
+        The "translation" parameter is either "suffix" or "truncate"
+        indicating that filename suffixes are either to be presented
+        to other clients or truncated.
+        
+        A "filetype" parameter is the default filetype to be used for
+        files whose type cannot be determined using the MimeMap
+        file. This should take the form of a twelve bit integer in
+        Python or C hexadecimal form, e.g. 0xfff.
+        
+        myshare /home/user/myfile 0o644 off truncate 0xffd
+
+        The "key" parameter is the Access+ key
+        
+        Access+ shares
+
+        When a share is named "<Access+>" (without quotes) in the .access
+        file, the standard Access+ shares (Apps@Hostname, Boot@Hostname)
+        will be created.  User shares are not yet created.
+
+        The line describing the Access+ shares conforms to the following syntax:
+
+        <Access+> /path_to_access_plus_dir
+
+        Apps@Hostname will be created if /path_to_access_plus_dir/Apps exists.
+        Boot@Hostname will be created if /path_to_access_plus_dir/Boot exists.
+
+        Printer shares
+        
+        When the share is named "<Printer>" (without quotes) in the .access
+        file, a share will be created with the appropriate name for the
+        printer share on this machine and the availability of the
+        corresponding local printer will be broadcast. All printer shares
+        start with this pseudonym.
+        
+        Each line describing a printer must conform to the following syntax:
+        
+        "<Printer>" <name> <path> <definition file> <delay> <filetype> \
+        <description> <command>
+        
+        Here, the share name is predetermined and the path must point to
+        a world writable directory. The "delay", "translation" and "filetype"
+        parameters are as described above.
+        
+        The "description" parameter is a quoted string containing a short
+        description of the printer.
+        
+        The "command" parameter is a quoted string containing a suitable
+        command for performing the printing of the files in the printer share.
+        """
+        # Compile a list of paths to check for the .access file.
+        
+        # Start with the current directory.
+        paths = [""]
+        
+        # Look for a file in the path used to invoke this program.
+        path, file = os.path.split(sys.argv[0])
+        paths.append(path)
+        
+        # Add the user's home directory.
+        home = os.getenv("HOME")
+        if home:
+            paths.append(home)
+
+        # Try Windows home directory as well.
+        home = os.getenv("USERPROFILE")
+        if home:
+            paths.append(home)
+
+        
+        f = None
+        
+        for path in paths:
+        
+            try:
+            
+                f = open(os.path.join(path, ".access"), "r")
+                break
+            
+            except IOError:
+            
+                # Loop again.
+                pass
+        
+        if f is None:
+        
+            sys.stdout.write("Failed to find access.cfg file.\n")
+            lines = []
+        
+        else:
+        
+            lines = f.readlines()
+            f.close()
+        
+        # Read the lines found.
+        quoted = 0
+        
+        for line in lines:
+        
+            # Strip leading and trailing whitespace.
+            s = line.strip()
+            
+            values = []
+            current = ""
+            
+            # Ignore lines beginning with a "#" character.
+            if s[:1] == "#": continue
+            
+            for c in s:
+            
+                if c == '"':
+                
+                    quoted = 1 - quoted
+                
+                elif c not in string.whitespace:
+                
+                    current = current + c
+                
+                elif c in string.whitespace and quoted == 1:
+                
+                    current = current + c
+                
+                elif current != "":
+                
+                    values.append(current)
+                    current = ""
+            
+            if current != "":
+            
+                values.append(current)
+            
+            if quoted == 1:
+            
+                sys.stderr.write(
+                    "Quotes do not match: %s\n" % line
+                    )
+            
+            elif len(values) == 6 and values[0] != "<Printer>":
+            
+                name, path, mode, delay, present, filetype = values[0:6]
+                
+                # Try to create this share.
+                try:
+                
+                    self.add_share(name, path, mode, delay, present, filetype, 0, SHARE_TYPE_NORMAL)
+                
+                except ShareError:
+                
+                    sys.stderr.write("Could not add share: %s\n" % name)
+                    sys.stderr.flush()
+            
+            elif len(values) == 7 and values[0] != "<Printer>":
+            
+                name, path, mode, delay, present, filetype, key = values[0:7]
+                
+                # Try to create this share.
+                try:
+                
+                    self.add_share(name, path, mode, delay, present, filetype, key, SHARE_TYPE_NORMAL)
+                
+                except ShareError:
+                
+                    sys.stderr.write("Could not add share: %s\n" % name)
+                    sys.stderr.flush()
+            
+            elif len(values) == 8 and values[0] == "<Printer>":
+            
+                name, path, defn, delay, filetype, description, command = \
+                    values[1:8]
+                
+                # Try to create this share.
+                try:
+                
+                    self.add_printer(
+                        name, path, defn, description, delay, filetype, command
+                        )
+                
+                except ShareError:
+                
+                    sys.stderr.write("Could not add printer: %s\n" % name)
+                    sys.stderr.flush()
+            
+            elif len(values) == 2 and values[0] == "<Access+>":
+
+                sh = [("Apps", SHARE_TYPE_APP), ("Boot", SHARE_TYPE_HIDDEN | SHARE_TYPE_PROTECTED), ("cdrom", SHARE_TYPE_CDROM), ("dir", SHARE_TYPE_DIRECTORY)]
+                pth = values[1]
+                for s in sh:
+                    p = pth + "/" + s[0]
+                    if os.path.isdir(p):
+                        self.add_share(s[0] + "@" + Hostname, p, 0o644, 30.0, "truncate", 0xfff, 0, s[1])
+
+            elif len(values) > 0:
+            
+                sys.stderr.write(
+                    "Bad or incomplete share description: %s\n" % line
+                    )
+
+        f = None
+        
+        for path in paths:
+        
+            try:
+            
+                f = open(os.path.join(path, ".access.fwaddnet"), "r")
+                break
+            
+            except IOError:
+            
+                # Loop again.
+                pass
+        
+        if f:
+        
+            lines = f.readlines()
+            f.close()
+
+            for l in lines:
+
+                if l.strip():
+
+                    self.fwaddnet(l.strip())
+        
+    
+    def read_share_path(self, _string):
+    
+        path = self.read_string(
+            _string, ending = "\x00", include = 0
+            )
+        
+        # Split the path up into elements.
+        path_elements = path.split(".")
+        
+        # The first element is the share name.
+        share_name = path_elements[0]
+        
+        return share_name.lower(), ".".join(path_elements[1:])
+    
+    def broadcast_startup(self):
+    
+        """broadcast_startup(self)
+        
+        Broadcast startup/availability messages on port 32770.
+        """
+        
+        if not 32770 in self.broadcasters:
+        
+            print("No socket to use for port %i" % 32770)
+            return
+        
+        s = self.broadcasters[32770]
+        
+        # Create the first message to send.
+        data = [0x00010001, 0x00000000]
+        
+        self._send_list(data, s, (Broadcast_addr, 32770))
+        
+        # Create the second message to send.
+        data = [0x00050001, 0x00000000]
+        
+        self._send_list(data, s, (Broadcast_addr, 32770))
+        
+        # Create the host broadcast string.
+        data = \
+        [
+            0x00050002, 0x00010000,
+            (len(self.identity) << 16) | len(Hostname),
+            Hostname + str(self.identity)
+        ]
+        
+        self._send_list(data, s, (Broadcast_addr, 32770))
+    
+    def broadcast_poll(self, event, delay = 30):
+    
+        """broadcast_poll(self)
+        
+        Broadcast a poll on port 32770 every few seconds. Never exits.
+        """
+        
+        if self.broadcasters.get(32770) is None:
+        
+            print("No socket to use for port %i" % 32770)
+            return
+        
+        while 1:
+        
+            self._broadcast_poll_once()
+            
+            event.wait(delay)
+            if event.isSet(): return
+    
+    def _broadcast_poll_once(self):
+    
+        # Broadcast a poll on port 32770 and notify other clients about any
+        # catalogued directories which have changed since the last poll.
+        
+        s = self.broadcasters[32770]
+        
+        # Create a string to send.
+        data = \
+        [
+            0x00050004, 0x00010000,
+            (len(self.identity) << 16) | len(Hostname),
+            Hostname + str(self.identity)
+        ]
+        
+        self._send_list(data, s, (Broadcast_addr, 32770))
+
+        # Find any secure shares on the network
+        for k in self.access_users.items():
+
+            self._request_secure_share(k)
+
+        self._broadcast_catalogue_changes()
+    
+    def _broadcast_catalogue_changes(self):
+    
+        # Broadcast any directories that have been updated, except for
+        # those being watched which are reported as soon as they change.
+        b = self.broadcasters[49171]
+        
+        handles_to_delete = []
+        for handle, (path, mtime, hosts) in list(self.catalogued_paths.items()):
+
+            if self.watcher.watching(path):
+
+                continue
+
+            try:
+
+                m = os.stat(path)[os.path.stat.ST_MTIME]
+
+                if (m != mtime):
+
+                    update = [0x00000046, 0x00000013, handle]
+                    self._send_list(update, b, (Broadcast_addr, 49171))
+                    self._forget_catalogues(path)
+                    self.catalogued_paths_lock.acquire()
+
+                    if handle in self.catalogued_paths:
+
+                        # Don't re-add if this has just been deleted
+                        self.catalogued_paths[handle] = (path, m, hosts)
+
+                    self.catalogued_paths_lock.release()
+
+            except OSError:
+
+                # The directory has probably been deleted
+                handles_to_delete.append(handle)
+
+        self.catalogued_paths_lock.acquire()
+
+        for handle in handles_to_delete:
+
+            if handle in self.catalogued_paths:
+
+                del self.catalogued_paths[handle]
+
+        self.catalogued_paths_lock.release()
+    
+    def _directories_changed(self, changed, removed):
+    
+        # Called by the directory watcher with the sets of catalogued
+        # directories which have changed or been removed. Notify other
+        # clients about the changed directories.
+        b = self.broadcasters.get(49171)
+        
+        for path in changed:
+        
+            self._forget_catalogues(path)
+        
+        for path in removed:
+        
+            self._forget_catalogues(path, watched = False)
+        
+        updated = []
+        
+        self.catalogued_paths_lock.acquire()
+        
+        try:
+        
+            for handle, (path, mtime, hosts) in list(self.catalogued_paths.items()):
+            
+                if path in removed:
+                
+                    del self.catalogued_paths[handle]
+                
+                elif path in changed:
+                
+                    try:
+                    
+                        m = os.stat(path)[os.path.stat.ST_MTIME]
+                    
+                    except OSError:
+                    
+                        # The directory has probably been deleted
+                        del self.catalogued_paths[handle]
+                        continue
+                    
+                    self.catalogued_paths[handle] = (path, m, hosts)
+                    updated.append(handle)
+        
+        finally:
+        
+            self.catalogued_paths_lock.release()
+        
+        if b is None: return
+        
+        for handle in updated:
+        
+            update = [0x00000046, 0x00000013, handle]
+            self._send_list(update, b, (Broadcast_addr, 49171))
+    
+    def _forget_catalogues(self, path, watched = True):
+    
+        # Discard any catalogues of the directory kept by our shares, and
+        # stop keeping them if the directory is no longer watched.
+        for share in list(self.shares.values()):
+        
+            if isinstance(share, Share):
+            
+                if watched:
+                
+                    share.catalogues.discard(path)
+                
+                else:
+                
+                    share.catalogues.unwatch(path)
+                
+                share.resolver.forget(path)
+    
+    def broadcast_directory_share(self, name, event, protected = 0, delay = 30):
+    
+        """broadcast_share(self, name, event, protected = 0, delay = 30)
+        
+        Broadcast the availability of a share every few seconds.
+        """
+        
+        # Broadcast the availability of the share on the polling socket.
+        
+        if not 32771 in self.broadcasters:
+        
+            print("No socket to use for port %i" % 32771)
+            return
+        
+        s = self.broadcasters[32771]
+        
+        data = \
+        [
+            0x00010002, 0x00010001, 0x00000000
+        ]
+        
+        self._send_list(data, s, (Broadcast_addr, 32771))
+        
+        # Advertise the share on the share socket.
+        
+        if not 49171 in self.broadcasters:
+        
+            print("No socket to use for port %i" % 49171)
+            return
+        
+        s = self.broadcasters[49171]
+        
+        # Create a string to send.
+        data = [0x00000046, 0x00000013, 0x00000000]
+        
+        # Broadcast a notification to other clients.
+        
+        for i in range(0, 5):
+        
+            self._send_list(data, s, (Broadcast_addr, 49171))
+            
+            time.sleep(1)
+        
+        while 1:
+        
+            self._send_list(data, s, (Broadcast_addr, 32770))
+            
+            time.sleep(delay)
+            
+            if event.isSet(): return
+        
+        # Broadcast that the share has now been removed.
+        
+        s = self.broadcasters[32771]
+        
+        data = \
+        [
+            0x00010003, 0x00010001, 0x00000000
+        ]
+
+    def _request_secure_share(self, key):
+        
+        """_request_secure_share(self, key)
+        Ask peers for any secure shares with password matching the supplied key
+        """
+
+        s = self.broadcasters[32771]
+ 
+        data = \
+        [
+            0x00010001, 0x00010001, key
+        ]
+
+        self._send_list(data, s, (Broadcast_addr, 32771))
+
+        s = self.ports[32771]
+
+        # log on to remote hosts, but not to whole networks
+        for addr in self.remote_nets:
+
+            if "/" not in addr:
+
+                self._send_list(data, s, (addr, 32771))
+
+    def send_query(self, host):
+    
+        if not 32770 in self.broadcasters:
+        
+            print("No socket to use for port %i" % 32770)
+            return
+        
+        s = self.broadcasters[32770]
+        
+        # Create a string to send.
+        data = \
+        [
+            0x00050003, 0x00010000,
+            (len(self.identity) << 16) | len(Hostname),
+            Hostname + self.identity
+        ]
+        
+        self._send_list(data, s, (host, 32770))
+        
+        self.read_port(self.use_ports)
+    
+    # Method used in thread for transferring files
+    
+    def _run_transfer(self, steps, path = None, event = None):
+    
+        """_run_transfer(self, steps, path = None, event = None)
+        
+        Run the steps of a transfer in the current thread, sending each
+        request yielded by the steps and passing back the reply received.
+        In a worker process, first wait for any transfer of the path given
+        by another worker to finish, unless the event given is set.
+        """
+        
+        store = self.worker_store
+        
+        if store is not None and path is not None:
+        
+            if not store.claim(path, event):
+            
+                steps.close()
+                return
+        
+        reply = None
+        
+        try:
+        
+            while 1:
+            
+                msg, host, commands, reply_id = steps.send(reply)
+                reply = self._send_request(
+                    msg, host, commands, new_id = reply_id
+                    )
+        
+        except StopIteration:
+        
+            pass
+        
+        finally:
+        
+            if store is not None and path is not None:
+            
+                store.release(path)
+    
+    def _start_transfer(self, path, host, event, name, steps, key = None,
+                        exclusive = True, size = 0):
+    
+        """_start_transfer(self, path, host, event, name, steps, key = None,
+                           exclusive = True, size = 0)
+        
+        Start a transfer involving the path given when the transfer
+        scheduler allows it, running it in the pool of transfer threads or,
+        if an event loop is being used, as a coroutine. Transfers which are
+        not exclusive only read the path and can run alongside each other. A
+        transfer with the same key as one already waiting or running is
+        ignored. Transfers of up to TRANSFER_BULK_SIZE bytes are run before
+        larger ones.
+        """
+        
+        transfer = Transfer(
+            path, host, key, exclusive, event, steps, name, size
+            )
+        
+        if self.engine is not None:
+        
+            self.engine.start_transfer(transfer)
+        
+        elif not self.transfers.submit(transfer, self._begin_transfer):
+        
+            steps.close()
+    
+    def _begin_transfer(self, transfer):
+    
+        # Run a transfer allowed by the scheduler in the next free thread.
+        self.transfer_pool.put(transfer)
+    
+    def _run_scheduled(self, transfer):
+    
+        try:
+        
+            self._run_transfer(transfer.steps, transfer.path, transfer.event)
+        
+        finally:
+        
+            # Let any transfers waiting for this one run.
+            self.transfers.finish(transfer, self._begin_transfer)
+    
+    def receive_file(self, event, reply_id, start, amount, fh, _socket,
+                      address):
+    
+        # This method should only get called once by the thread it belongs
+        # to, then the thread should terminate.
+        self._run_transfer(
+            self._receive_file_steps(
+                event, reply_id, start, amount, fh, _socket, address
+                )
+            )
+    
+    def _receive_file_steps(self, event, reply_id, start, amount, fh,
+                            _socket, address):
+    
+        # Yield the requests needed to receive a file, receiving the replies
+        # to them in return.
+        
+        self.log(
+            "comment",
+            "Receiving file: start = %i, amount = %i" % (start, amount),
+            "",
+            level = LOG_API
+            )
+        
+        pos = start
+        
+        end = start + amount
+        
+        #self.log("comment", "Position: %i" % pos, "")
+        #self.log("comment", "Expected amount of data: %i" % amount, "")
         #self.log("comment", "End at: %i" % end, "")
         
         # Read the host name from the address tuple.
         host = address[0]
         
+        # Reserve space for the data to be received.
+        fh.allocate(start, amount)
+        
         try:
         
             while 1:
@@ -5092,9 +9978,7 @@ class Peer(Ports):
                 #self.log("comment", repr(msg), "")
                 
                 # Send the request.
-                replied, data = self._send_request(
-                    msg, host, ["d"], new_id = reply_id
-                    )
+                replied, data = yield msg, host, ["d"], reply_id
                 
                 if replied == -1:
                 
@@ -5167,6 +10051,10 @@ class Peer(Ports):
                     fh.close()
                     break
             
+            # Write the data received before indicating that the transfer
+            # has finished.
+            fh.flush()
+            
             # Send a reply message to indicate that the transfer has finished.
             msg = ["R"+reply_id, start, pos]
             self._send_list(msg, _socket, address)
@@ -5192,49 +10080,101 @@ class Peer(Ports):
     
         # This method should only get called once by the thread it belongs
         # to, then the thread should terminate.
+        self._run_transfer(
+            self._send_file_steps(
+                event, reply_id, code, handle, start, length, fh, _socket,
+                address
+                )
+            )
+    
+    def _send_file_steps(self, event, reply_id, code, handle, start, length,
+                         fh, _socket, address):
+    
+        # Yield the requests needed to send a file, receiving the replies
+        # to them in return.
         
         pos = start
         
-        # Determine the amount of information we can send.
-        amount = min(length, SEND_PGET_SIZE)
-        
         end = start + length
         
+        # The other client initially asks for all the data, and later for
+        # the range given in each of its replies.
+        end_pos = end
+        
         self.log("comment", "Position: %i" % pos, "", level = LOG_API)
-        self.log("comment", "Expected amount of data: %i" % amount, ", level = LOG_API")
-        self.log("comment", "End at: %i" % end, ", level = LOG_API")
+        self.log("comment", "End at: %i" % end, "", level = LOG_API)
         
         # Read the host name from the address tuple.
         host = address[0]
         
+        s = self.ports[49171]
+        
+        # Read the file from buffers filled ahead of their use.
+        reader = fh.read_ahead()
+        
         try:
         
             while 1:
             
-                # Find the relevant part of the file.
-                fh.seek(pos, 0)
+                # Send blocks up to the end of the range requested, limited
+                # by the window used for this client, only waiting for a
+                # reply to the last one.
+                window = self.send_windows.get(host, SEND_WINDOW_SIZE)
                 
-                # Read the amount of data required.
-                file_data = fh.read(amount)
+                burst_end = min(
+                    end, max(end_pos, pos + SEND_PGET_SIZE),
+                    pos + window * SEND_PGET_SIZE
+                    )
                 
-                # Calculate the new offset into the file.
-                new_pos = pos + len(file_data)
+                new_pos = pos
                 
-                # Send the data prefixed by its offset relative to the
-                # start address within the file supplied.
-                msg = ["D", pos - start, (NO_PAD, file_data)]
+                # Encode the blocks sent before the last one as they are read,
+                # since each read may reuse the buffer holding the previous
+                # block, and send them together.
+                burst = []
                 
-                self.log(
-                    "comment",
-                    "Sent %i bytes of data (from %x beyond %x) to %s" % (
-                        len(file_data), pos - start, start, host
-                        ), "",
-                    level = LOG_API
-                    )
+                while 1:
                 
-                replied, data = self._send_request(
-                    msg, host, ["r"], new_id = reply_id
-                    )
+                    # Read the amount of data required.
+                    file_data = reader.read(
+                        new_pos, min(SEND_PGET_SIZE, burst_end - new_pos)
+                        )
+                    
+                    # Send the data prefixed by its offset relative to the
+                    # start address within the file supplied.
+                    msg = ["D", new_pos - start, (NO_PAD, file_data)]
+                    
+                    self.log(
+                        "comment",
+                        "Sent %i bytes of data (from %x beyond %x) to %s" % (
+                            len(file_data), new_pos - start, start, host
+                            ), "",
+                        level = LOG_API
+                        )
+                    
+                    # Calculate the new offset into the file.
+                    new_pos = new_pos + len(file_data)
+                    
+                    if new_pos >= burst_end or len(file_data) == 0:
+                    
+                        break
+                    
+                    msg[0] = msg[0] + reply_id
+                    self.log("sent", msg, (host, 49171), level = LOG_PROTOCOL)
+                    
+                    # Send data which remains valid from the buffer holding
+                    # it.
+                    if reader.persistent:
+                    
+                        burst.append(self._scatter(msg, 0))
+                    
+                    else:
+                    
+                        burst.append(self._encode(msg))
+                
+                self._send_datagrams(burst, s, (host, 49171))
+                
+                replied, data = yield msg, host, ["r"], reply_id
 
                 if replied != 1:
 
@@ -5248,15 +10188,14 @@ class Peer(Ports):
                 if new_pos == end:
 
                     # We're not expecting a reply for the last message
-                    self._send_list(msg, self.ports[49171], (host, 49171))
+                    msg[0] = msg[0] + reply_id
+                    self._send_list(msg, s, (host, 49171))
 
                     break
 
                 else:
 
-                    replied, data = self._send_request(
-                        msg, host, ["r"], new_id = reply_id
-                        )
+                    replied, data = yield msg, host, ["r"], reply_id
 
                 if replied == -1:
                 
@@ -5267,7 +10206,16 @@ class Peer(Ports):
                     # Read the header.
                     pos = start + self.str2num(4, data[4:8])
                     end_pos = start + self.str2num(4, data[8:12])
-                    amount = min(end - pos, max(SEND_PGET_SIZE, end_pos - pos))
+                    
+                    # Halve the window for a client which asks for data
+                    # already sent, otherwise let it grow again.
+                    if pos < new_pos:
+                    
+                        self.send_windows[host] = max(1, window // 2)
+                    
+                    elif window < SEND_WINDOW_SIZE:
+                    
+                        self.send_windows[host] = window + 1
                     
                     if pos >= end:
                     
@@ -5289,7 +10237,7 @@ class Peer(Ports):
             # We use the code and handle sent to us by the remote client.
             msg = ["R"+reply_id, end - start, end]
             
-            self._send_list(msg, self.ports[49171], (host, 49171))
+            self._send_list(msg, s, (host, 49171))
         
         except IOError:
         
@@ -5298,21 +10246,59 @@ class Peer(Ports):
             # Send a reply.
             self._send_list(msg, _socket, address)
         
+        finally:
+        
+            fh.finish_reading(reader)
+    
     def rename_path(self, event, reply_id, pos, amount, buf,
                     _socket, address):
     
         # Call the function to receive the filename.
         self.receive_file(event, reply_id, pos, amount, buf, _socket, address)
         
+        return self._read_new_name(buf)
+    
+    def _rename_steps(self, share, event, reply_id, pos, amount, buf,
+                      ros_path, _socket, address):
+    
+        # Yield the requests needed to receive a new name for an object in
+        # the share given, then rename the object.
+        source = share._rename_source(ros_path)
+        
+        if source is None: return
+        
+        # Receive the filename by passing on the requests needed.
+        steps = self._receive_file_steps(
+            event, reply_id, pos, amount, buf, _socket, address
+            )
+        
+        reply = None
+        
+        try:
+        
+            while 1:
+            
+                reply = yield steps.send(reply)
+        
+        except StopIteration:
+        
+            pass
+        
+        share_name, new_ros_path = self._read_new_name(buf)
+        
+        share._rename_to(source, share_name, new_ros_path)
+    
+    def _read_new_name(self, buf):
+    
         # We should now have the replacement file in the Buffer object
         # passed by the caller.
         value = buf.read()
         
-        cleaned = ""
+        if type(value) != str:
         
-        for c in value:
+            value = value.decode("latin-1")
         
-            if ord(c) > 31: cleaned = cleaned + c
+        cleaned = "".join([c for c in value if ord(c) > 31])
         
         # Extract the share name and share path from the new path.
         share_name, new_ros_path = self.read_share_path(cleaned)
@@ -5321,38 +10307,19 @@ class Peer(Ports):
     
     def read_poll_socket(self):
     
-        # Read the listening socket first.
-        try:
-        
-            s = self.ports[32770]
-            data, address = self._recvfrom(s, RECV_SIZE)
-            
-            if data:
-            
-                self._read_poll_socket(data, address)
-        
-        except (KeyError, socket.error):
-        
-            if sys.exc_info()[1].args[0] == 11:
-            
-                pass
-        
-        try:
+        # Read the listening socket first, handling each batch of messages
+        # waiting on it before reading the broadcasting socket.
+        for s in (self.ports[32770], self.broadcasters[32770]):
         
-            s = self.broadcasters[32770]
-            data, address = self._recvfrom(s, RECV_SIZE)
+            try:
             
-            if data:
+                for data, address in self._recv_batch(s):
+                
+                    self._read_poll_socket(data, address)
             
-                self._read_poll_socket(data, address)
-        
-        except (KeyError, socket.error):
-        
-            if sys.exc_info()[1].args[0] == 11:
+            except socket.error:
             
                 pass
-            
-            return None
     
     def _read_poll_socket(self, data, address):
     
@@ -5724,1235 +10691,1393 @@ class Peer(Ports):
                 
                     print(line)
         
-            # Clean up any handles left over from any clients
-            # that have probably been switched off
-            for (name, host), (info, expire) in self.clients.items():
-
-                if expire < time.time():
-
-                    del self.clients[(name, host)]
-                    self.cleanup_handles(host)
-                    # FIXME: delete any shares owned by this host as well
-
-        elif DEBUG == 1:
+            # Clean up any handles left over from any clients
+            # that have probably been switched off
+            for (name, host), (info, expire) in self.clients.items():
+
+                if expire < time.time():
+
+                    del self.clients[(name, host)]
+                    self.cleanup_handles(host)
+                    # FIXME: delete any shares owned by this host as well
+
+        elif DEBUG == 1:
+        
+            print("From: %s:%i" % address)
+            
+            lines = self.interpret(data)
+            
+            for line in lines:
+            
+                print(line)
+    
+    def read_listener_socket(self):
+    
+        # Read the listening socket first, handling each batch of messages
+        # waiting on it before reading the broadcasting socket.
+        for s in (self.ports[32771], self.broadcasters[32771]):
+        
+            try:
+            
+                for data, address in self._recv_batch(s):
+                
+                    self._read_listener_socket(data, address)
+            
+            except socket.error:
+            
+                pass
+    
+    def _read_listener_socket(self, data, address):
+    
+        self.log("received", data, address, level = LOG_PROTOCOL)
+        
+        request1 = self.str2num(4, data[0:4])
+        request2 = self.str2num(4, data[4:8])
+        host = address[0]
+
+        # RISCOS can send packets with no data. I think this is when
+        # a user logs into Access+ with the wrong password.
+        if request1 == 0x10001 and request2 == 0x10001 and len(data) > 11:
+
+            key = self.str2num(4, data[8:])
+
+            for s in self.shares.values():
+	
+                if s.get_key() == key:
+	
+                    s._send_secure_share(address)
+
+        else:
+
+            self._read_poll_socket(data, address)
+    
+    def read_share_socket(self):
+    
+        # Read the listening socket first, handling each batch of messages
+        # waiting on it before reading the broadcasting socket.
+        for s, name in ((self.ports[49171], "Listening socket"),
+                        (self.broadcasters[49171], "Broadcasting socket")):
+        
+            try:
+            
+                for data, address in self._recv_batch(s):
+                
+                    self.log("comment", name, "", level = LOG_PROTOCOL)
+                    self._read_share_socket(s, data, address)
+            
+            except socket.error:
+            
+                pass
+    
+    def _read_share_socket(self, _socket, data, address):
+    
+        self.log("received", data, address, level = LOG_PROTOCOL)
+        
+        # Decode the message using the layout registered for its command
+        # and code, ignoring messages we do not understand.
+        packet = decode_packet(data)
+        
+        if packet is None:
+        
+            return
+        
+        try:
+        
+            handler = self._share_dispatch[(packet.command, packet.code)]
+        
+        except KeyError:
+        
+            return
+        
+        try:
+        
+            handler(_socket, packet, address)
+        
+        except HandleError:
+        
+            # All the file handles are in use.
+            self._send_list(
+                ["E"+packet.reply_id, 0x100c0, "Too many open files"],
+                _socket, address
+                )
+    
+    # Handlers for messages received on the share port, indexed by the
+    # command character and code of each message. Replies are indexed by
+    # their command character alone.
+    
+    share_handlers = {
+        ("A", 0x1): "_share_open_read",
+        ("A", 0x2): "_share_open_update",
+        ("A", 0x4): "_share_create_file",
+        ("A", 0x5): "_share_create_directory",
+        ("A", 0x6): "_share_delete",
+        ("A", 0x7): "_share_set_access",
+        ("A", 0x8): "_share_free_space",
+        ("A", 0x9): "_share_rename",
+        ("A", 0xa): "_share_close",
+        ("A", 0xb): "_share_send_file",
+        ("A", 0xc): "_share_receive_file",
+        ("A", 0xd): "_share_next_chunk",
+        ("A", 0xe): "_share_set_length",
+        ("A", 0xf): "_share_set_length",
+        ("A", 0x10): "_share_set_filetype",
+        ("A", 0x14): "_share_ensure_size",
+        ("A", 0x16): "_share_free_space",
+        ("B", 0x3): "_share_catalogue",
+        ("B", 0xb): "_share_read_data",
+        ("B", 0xd): "_share_next_chunk",
+        ("D", None): "_share_reply",
+        ("R", None): "_share_reply",
+        ("S", None): "_share_reply",
+        ("E", None): "_share_error",
+        ("d", None): "_share_reply",
+        ("r", None): "_share_reply",
+        ("w", None): "_share_reply"
+        }
+    
+    def _share_reply(self, _socket, packet, address):
+    
+        # Replies to our own requests: requests for data to be sent ("D"),
+        # replies from successful requests ("R" and "S"), data sent to this
+        # client ("d" and "r") and requests for data to be sent to a remote
+        # client for uploading ("w").
+        self.share_messages.append((address[0], packet.data))
+    
+    def _share_error(self, _socket, packet, address):
+    
+        # Error response to a request.
+        data = packet.data
+        self.share_messages.append((address[0], data))
+        
+        print("%s (%i)" % (
+            self.read_string(data[8:], ending = "\000", include = 0),
+            self.str2num(4, data[4:8])
+            ))
+    
+    def _share_open_read(self, _socket, packet, address):
+    
+        # Open a share, directory or path for read only
+        host = address[0]
+        reply_id = packet.reply_id
+        
+        # Find the share and RISC OS path within it.
+        share_name, ros_path = self.read_share_path(packet.string())
+        self.log(
+            "comment", 'Request to open "%s" for reading in share "%s"' % (
+                ros_path, share_name
+                ), "",
+            level = LOG_API
+            )
+        
+        try:
+        
+            share = self.shares[(share_name, Hostaddr)]
+            
+            # Pass the name of the host making this request as this
+            # information will be used to prevent other users from
+            # modifying this file while it is in use.
+            info, path = share.open_path(ros_path, host, "rb")
+        
+        except KeyError:
+        
+            info = None
+        
+        if info is not None:
+        
+            msg = ["R"+reply_id] + info
+        
+        elif ros_path == "":
+        
+            # Reply with an error message.
+            msg = ["E"+reply_id, 0x163ac, "Shared disc not available."]
+        
+        else:
+        
+            # Reply with an error message.
+            msg = ["E"+reply_id, 0x100d6, "Not found"]
         
-            print("From: %s:%i" % address)
-            
-            lines = self.interpret(data)
-            
-            for line in lines:
-            
-                print(line)
+        # For unprotected shares, reply with details of the share.
+        
+        # Use the first word given but substitute "R" for "A".
+        
+        # Send a reply.
+        self._send_list(msg, _socket, address)
     
-    def read_listener_socket(self):
+    def _share_open_update(self, _socket, packet, address):
     
-        # Read the listening socket first.
+        # Open a share, directory or path for reading and writing
+        host = address[0]
+        reply_id = packet.reply_id
+        
+        # Find the share and RISC OS path within it.
+        share_name, ros_path = self.read_share_path(packet.string())
+        
+        self.log(
+            "comment", 'Request to open "%s" for read/write in share "%s"' % (
+                ros_path, share_name
+                ), "",
+            level = LOG_API
+            )
+        
         try:
         
-            s = self.ports[32771]
-            data, address = self._recvfrom(s, RECV_SIZE)
-            
-            if data:
-            
-                self._read_listener_socket(data, address)
+            share = self.shares[(share_name, Hostaddr)]
+            info, path = share.open_path(ros_path, host, "r+b")
         
-        except (KeyError, socket.error):
+        except KeyError:
         
-            if sys.exc_info()[1].args[0] == 11:
-            
-                pass
+            info = None
         
-        try:
+        if info is not None:
         
-            s = self.broadcasters[32771]
-            data, address = self._recvfrom(s, RECV_SIZE)
-            
-            if data:
-            
-                self._read_listener_socket(data, address)
+            msg = ["R"+reply_id] + info
         
-        except (KeyError, socket.error):
+        elif ros_path == "":
         
-            if sys.exc_info()[1].args[0] == 11:
-            
-                pass
-            
-            return None
+            # Reply with an error message.
+            msg = ["E"+reply_id, 0x163ac, "Shared disc not available."]
+        
+        else:
+        
+            # Reply with an error message.
+            msg = ["E"+reply_id, 0x100d6, "Not found"]
+        
+        # Send a reply.
+        self._send_list(msg, _socket, address)
     
-    def _read_listener_socket(self, data, address):
+    def _share_create_file(self, _socket, packet, address):
     
-        self.log("received", data, address, level = LOG_PROTOCOL)
+        # Create and open a share, directory or path.
+        host = address[0]
+        reply_id = packet.reply_id
         
-        request1 = self.str2num(4, data[0:4])
-        request2 = self.str2num(4, data[4:8])
+        # Find the share and RISC OS path within it.
+        share_name, ros_path = self.read_share_path(packet.string())
+        
+        self.log(
+            "comment", 'Request to create "%s" in share "%s"' % (
+                ros_path, share_name
+                ), "",
+            level = LOG_API
+            )
+        
+        try:
+        
+            share = self.shares[(share_name, Hostaddr)]
+            info, path = share.create_file(ros_path, host)
+        
+        except KeyError:
+        
+            info = None
+            path = ros_path
+        
+        if info is not None:
+        
+            msg = ["R"+reply_id] + info
+        
+        elif ros_path == "":
+        
+            msg = \
+            [
+                "E"+reply_id, 0xaf,
+                "'%s' cannot be created - " % path + \
+                "a directory with that name already exists"
+            ]
+        
+        else:
+        
+            # Reply with an error message.
+            msg = ["E"+reply_id, 0x100d6, "Not found"]
+        
+        # Send a reply.
+        self._send_list(msg, _socket, address)
+    
+    def _share_create_directory(self, _socket, packet, address):
+    
+        # Create and open a share or directory.
         host = address[0]
-
-        # RISCOS can send packets with no data. I think this is when
-        # a user logs into Access+ with the wrong password.
-        if request1 == 0x10001 and request2 == 0x10001 and len(data) > 11:
-
-            key = self.str2num(4, data[8:])
-
-            for s in self.shares.values():
-	
-                if s.get_key() == key:
-	
-                    s._send_secure_share(address)
-
+        reply_id = packet.reply_id
+        
+        # Find the share and RISC OS path within it.
+        share_name, ros_path = self.read_share_path(packet.string())
+        
+        self.log(
+            "comment", 'Request to create "%s" in share "%s"' % (
+                ros_path, share_name
+                ), "",
+            level = LOG_API
+            )
+        
+        try:
+        
+            share = self.shares[(share_name, Hostaddr)]
+            info, path = share.create_directory(ros_path, host)
+        
+        except KeyError:
+        
+            info = None
+        
+        if info is not None:
+        
+            msg = ["R"+reply_id] + info
+        
+        elif ros_path == "":
+        
+            msg = \
+            [
+                "E"+reply_id, 0xaf,
+                "'%s' cannot be created - " % ros_path + \
+                "a directory with that name already exists"
+            ]
+        
         else:
-
-            self._read_poll_socket(data, address)
+        
+            # Reply with an error message.
+            msg = ["E"+reply_id, 0x100d6, "Not found"]
+        
+        # Send a reply.
+        self._send_list(msg, _socket, address)
     
-    def read_share_socket(self):
+    def _share_delete(self, _socket, packet, address):
     
-        # Read the listening socket first.
+        # Delete request.
+        reply_id = packet.reply_id
+        
+        # Find the share and RISC OS path within it.
+        share_name, ros_path = self.read_share_path(packet.string())
+        
         try:
         
-            s = self.ports[49171]
-            data, address = self._recvfrom(s, RECV_SIZE)
+            share = self.shares[(share_name, Hostaddr)]
+            info, path = share.delete_path(ros_path)
             
-            if data:
+            if info is not None:
             
-                self.log("comment", "Listening socket", "", level = LOG_PROTOCOL)
-                self._read_share_socket(s, data, address)
+                msg = [ "R"+reply_id ] + info
+            
+            else:
+            
+                msg = ["E"+reply_id, 0x100d6, "Not found"]
         
-        except socket.error:
+        except KeyError:
+        
+            msg = ["E"+reply_id, 0x163ac, "Shared disc not available."]
+        
+        # Send a reply.
+        self._send_list(msg, _socket, address)
+    
+    def _share_set_access(self, _socket, packet, address):
+    
+        # Set access attributes
+        reply_id = packet.reply_id
+        access_attr = packet.value
+        
+        # Find the share and RISC OS path within it.
+        share_name, ros_path = self.read_share_path(packet.string())
+        
+        self.log("comment", "Setting access attributes %s for %s on %s" % (hex(access_attr), ros_path, share_name), "", level = LOG_API)
         
-            if sys.exc_info()[1].args[0] == 11:
+        try:
+        
+            share = self.shares[(share_name, Hostaddr)]
+            info, path = share.set_access_attr(ros_path, access_attr)
             
-                pass
+            if info is not None:
+            
+                # Construct a reply.
+                msg = ["R"+reply_id] + info
+            
+            else:
+            
+                msg = ["E"+reply_id, 0x100d6, "Not found"]
+        
+        except KeyError:
+        
+            msg = ["E"+reply_id, 0x163ac, "Shared disc not available."]
+        
+        # Send a reply.
+        self._send_list(msg, _socket, address)
+    
+    def _share_free_space(self, _socket, packet, address):
+    
+        # Get free space (code 0x8) or 32 bit free space (code 0x16).
+        
+        # Return message for code 0x8 should be in the form:
+        # "R"+reply_id
+        # 4 bytes free space
+        # 4 bytes largest creatable object
+        # 4 bytes total spactotal space
+        
+        # Response for code 0x16 should be in the form
+        #  R+reply_id
+        #  4 bytes free space least significant word
+        #  4 bytes free space most significant word
+        #  4 bytes largest creatable object lest significant word
+        #  4 bytes largest creatable object most significant word
+        #  4 bytes total space least significant word
+        #  4 bytes total space most significant word
+        msg = ["E"+packet.reply_id, 0x806c11, "Free space not available\x00"]
+        
+        self._send_list(msg, _socket, address)
+    
+    def _share_rename(self, _socket, packet, address):
+    
+        # Rename file on our machine.
+        reply_id = packet.reply_id
+        amount = packet.value
+        
+        # Find the share and RISC OS path within it.
+        share_name, ros_path = self.read_share_path(packet.string())
         
         try:
         
-            s = self.broadcasters[49171]
-            data, address = self._recvfrom(s, RECV_SIZE)
+            share = self.shares[(share_name, Hostaddr)]
+            
+            # Extract the host name from the address as it is assumed that
+            # communication will be through port 49171.
+            host = address[0]
             
-            if data:
+            # Create an event to use to inform the transfer that it should
+            # terminate.
+            event = threading.Event()
             
-                self.log("comment", "Broadcasting socket", "", level = LOG_PROTOCOL)
-                self._read_share_socket(s, data, address)
+            # Create a buffer to put the filename in.
+            buf = Buffer()
+            
+            # Start a transfer to receive the replacement filename, passing
+            # the necessary information to do this.
+            self._start_transfer(
+                ros_path, host, event,
+                'Rename request "%s" from %s:%i' % (
+                    ros_path, address[0], address[1]
+                    ),
+                self._rename_steps(
+                    share, event, reply_id, 0, amount, buf, ros_path,
+                    _socket, address
+                    ),
+                key = (host, reply_id), size = amount
+                )
         
-        except socket.error:
+        except KeyError:
         
-            if sys.exc_info()[1].args[0] == 11:
+            msg = ["E"+reply_id, 0x163ac, "Shared disc not available."]
             
-                pass
+            # Send a reply.
+            self._send_list(msg, _socket, address)
     
-    def _read_share_socket(self, _socket, data, address):
+    def _share_close(self, _socket, packet, address):
     
+        # Close file.
         host = address[0]
+        reply_id = packet.reply_id
+        handle = packet.handle
         
-        #print("From: %s:%i" % address)
-        #
-        #lines = self.interpret(data)
-        #
-        #for line in lines:
-        #
-        #    print(line)
-        #
-        #print("")
-        
-        self.log("received", data, address, level = LOG_PROTOCOL)
+        # If the handle is in use then remove it from the handle
+        # dictionary.
+        try:
         
-        command = self.cmd2str(data[0])
-        reply_id = self.replyid2str(data[1:4])
+            fh = self.file_handler[handle]
+            
+            if fh.user == host:
+            
+                fh.close()
+            
+            del self.file_handler[handle]
+            
+            # Reply with an short message.
+            msg = ["R"+reply_id]
         
-        if len(data) > 4:
+        except KeyError:
         
-            field_max = min(8, len(data))
-            code = self.str2num(field_max - 4, data[4:field_max])
+            # Ideally, reply with an error message about the file handle
+            # used.
+            msg = ["R"+reply_id]
         
-        else:
+        # Send a reply.
+        self._send_list(msg, _socket, address)
+    
+    def _share_send_file(self, _socket, packet, address):
+    
+        # Send file (data request)
+        reply_id = packet.reply_id
+        handle = packet.handle
+        pos = packet.pos
+        length = packet.length
         
-            code = None
+        #print("Data request", hex(handle), pos, length
         
-        msg = None
+        # Extract the host name from the address as it is assumed that
+        # communication will be through port 49171.
+        host = address[0]
         
-        # command "A", code 0xd is handled lower down.
-        if command == "A" and code != 0xd:
+        try:
         
-            if code == 0x1:
+            fh = self.file_handler[handle]
             
-                # Open a share, directory or path for read only
-                
-                # Find the share and RISC OS path within it.
-                share_name, ros_path = self.read_share_path(self.bytearray2str(data[12:]))
-                self.log(
-                    "comment", 'Request to open "%s" for reading in share "%s"' % (
-                        ros_path, share_name
-                        ), "",
-                    level = LOG_API
-                    )
-                
-                try:
-                
-                    share = self.shares[(share_name, Hostaddr)]
-                    
-                    # Pass the name of the host making this request as this
-                    # information will be used to prevent other users from
-                    # modifying this file while it is in use.
-                    info, path = share.open_path(ros_path, host, "rb")
-                
-                except KeyError:
-                
-                    info = None
-                
-                if info is not None:
-                
-                    msg = ["R"+reply_id] + info
-                
-                elif ros_path == "":
-                
-                    # Reply with an error message.
-                    msg = ["E"+reply_id, 0x163ac, "Shared disc not available."]
-                
-                else:
-                
-                    # Reply with an error message.
-                    msg = ["E"+reply_id, 0x100d6, "Not found"]
-                
-                # For unprotected shares, reply with details of the share.
-                
-                # Use the first word given but substitute "R" for "A".
-                
-                # Send a reply.
-                self._send_list(msg, _socket, address)
+            if fh.user != host: raise KeyError
             
-            elif code == 0x2:
+            path = fh.path
             
-                # Open a share, directory or path for reading and writing
-                
-                # Find the share and RISC OS path within it.
-                share_name, ros_path = self.read_share_path(self.bytearray2str(data[12:]))
-                
-                self.log(
-                    "comment", 'Request to open "%s" for read/write in share "%s"' % (
-                        ros_path, share_name
-                        ), "",
-                    level = LOG_API
-                    )
-                
-                try:
-                
-                    share = self.shares[(share_name, Hostaddr)]
-                    info, path = share.open_path(ros_path, host, "r+b")
-                
-                except KeyError:
-                
-                    info = None
-                
-                if info is not None:
-                
-                    msg = ["R"+reply_id] + info
-                
-                elif ros_path == "":
-                
-                    # Reply with an error message.
-                    self._send_list(
-                        ["E"+reply_id, 0x163ac, "Shared disc not available."],
-                        _socket, address
-                        )
-                
-                else:
-                
-                    # Reply with an error message.
-                    msg = ["E"+reply_id, 0x100d6, "Not found"]
-                
-                # Send a reply.
-                self._send_list(msg, _socket, address)
+            # Create an event to use to inform the transfer that it should
+            # terminate.
+            event = threading.Event()
             
-            elif code == 0x4:
+            # Start a transfer to send the file.
+            self._start_transfer(
+                path, host, event,
+                'Transfer "%s" to %s:%i' % (path, address[0], address[1]),
+                self._send_file_steps(
+                    event, reply_id, packet.code, handle, pos, length, fh,
+                    _socket, address
+                    ),
+                key = (host, reply_id), exclusive = False, size = length
+                )
+        
+        except KeyError:
+        
+            # Reply with an error message.
+            msg = ["E"+reply_id, 0x100d6, "Not found"]
             
-                # Create and open a share, directory or path.
-                
-                # Find the share and RISC OS path within it.
-                share_name, ros_path = self.read_share_path(self.bytearray2str(data[12:]))
-                
-                self.log(
-                    "comment", 'Request to create "%s" in share "%s"' % (
-                        ros_path, share_name
-                        ), "",
-                    level = LOG_API
-                    )
-                
-                try:
-                
-                    share = self.shares[(share_name, Hostaddr)]
-                    info, path = share.create_file(ros_path, host)
-                
-                except KeyError:
-                
-                    info = None
-                
-                if info is not None:
-                
-                    msg = ["R"+reply_id] + info
-                
-                elif ros_path == "":
-                
-                    msg = \
-                    [
-                        "E"+reply_id, 0xaf,
-                        "'%s' cannot be created - " % path + \
-                        "a directory with that name already exists"
-                    ]
-                
-                else:
-                
-                    # Reply with an error message.
-                    msg = ["E"+reply_id, 0x100d6, "Not found"]
-                
-                # Send a reply.
-                self._send_list(msg, _socket, address)
+            # Send a reply.
+            self._send_list(msg, _socket, address)
+    
+    def _share_receive_file(self, _socket, packet, address):
+    
+        # Receive file
+        host = address[0]
+        reply_id = packet.reply_id
+        
+        # The remote client has passed the handle, some word
+        # and the length of the file.
+        handle = packet.handle
+        pos = packet.pos
+        amount = packet.length
+        
+        try:
         
-            elif code == 0x5:
+            # Translate the handle into a path.
+            fh = self.file_handler[handle]
             
-                # Create and open a share or directory.
+            if fh.user == host:
+            
+                # Only receive the file if the host sending it is the
+                # user of the file handle.
                 
-                # Find the share and RISC OS path within it.
-                share_name, ros_path = self.read_share_path(self.bytearray2str(data[12:]))
+                path = fh.path
+                length = fh.length()
                 
-                self.log(
-                    "comment", 'Request to create "%s" in share "%s"' % (
-                        ros_path, share_name
-                        ), "",
-                    level = LOG_API
+                self.log("comment", "", "", level = LOG_API)
+                self.log("comment", path, "", level = LOG_API)
+                self.log("comment", "Length of file: %i" % length, "", level = LOG_API)
+                
+                # Create an event to use to inform the transfer that it
+                # should terminate.
+                event = threading.Event()
+                
+                # Start a transfer to receive the file.
+                self._start_transfer(
+                    path, host, event,
+                    'Transfer "%s" from %s:%i' % (
+                        path, address[0], address[1]
+                        ),
+                    self._receive_file_steps(
+                        event, reply_id, pos, amount, fh, _socket, address
+                        ),
+                    key = (host, reply_id), size = amount
                     )
                 
-                try:
-                
-                    share = self.shares[(share_name, Hostaddr)]
-                    info, path = share.create_directory(ros_path, host)
-                
-                except KeyError:
-                
-                    info = None
-                
-                if info is not None:
-                
-                    msg = ["R"+reply_id] + info
-                
-                elif ros_path == "":
-                
-                    msg = \
-                    [
-                        "E"+reply_id, 0xaf,
-                        "'%s' cannot be created - " % ros_path + \
-                        "a directory with that name already exists"
-                    ]
-                
-                else:
-                
-                    # Reply with an error message.
-                    msg = ["E"+reply_id, 0x100d6, "Not found"]
-                
-                # Send a reply.
-                self._send_list(msg, _socket, address)
+                # Also notify the other client that the share has been updated.
+        
+        except KeyError:
         
-            elif code == 0x6:
+            msg = ["E"+reply_id, 0x100d6, "Not found"]
             
-                # Delete request.
-                
-                # Find the share and RISC OS path within it.
-                share_name, ros_path = self.read_share_path(self.bytearray2str(data[12:]))
-                
-                try:
-                
-                    share = self.shares[(share_name, Hostaddr)]
-                    info, path = share.delete_path(ros_path)
-                    
-                    if info is not None:
-                    
-                        msg = [ "R"+reply_id ] + info
-                    
-                    else:
-                    
-                        msg = ["E"+reply_id, 0x100d6, "Not found"]
-                
-                except KeyError:
-                
-                    msg = ["E"+reply_id, 0x163ac, "Shared disc not available."]
-                
-                # Send a reply.
-                self._send_list(msg, _socket, address)
+            # Send a reply.
+            self._send_list(msg, _socket, address)
+    
+    def _share_set_length(self, _socket, packet, address):
+    
+        # Set length of file.
+        host = address[0]
+        reply_id = packet.reply_id
+        handle = packet.handle
+        new_length = packet.length
+        
+        try:
+        
+            # Find the path and previously recorded file length.
+            fh = self.file_handler[handle]
             
-            elif code == 0x7:
+            # Only allow the user of the file to set the length.
+            if fh.user != host: raise KeyError
             
-                # Set access attributes
-                
-                access_attr = self.str2num(4, data[8:12])
-                
-                # Find the share and RISC OS path within it.
-                share_name, ros_path = self.read_share_path(self.bytearray2str(data[16:]))
-                
-                self.log("comment", "Setting access attributes %s for %s on %s" % (hex(access_attr), ros_path, share_name), "", level = LOG_API)
-
-                try:
-                
-                    share = self.shares[(share_name, Hostaddr)]
-                    info, path = share.set_access_attr(ros_path, access_attr)
-                    
-                    if info is not None:
-                    
-                        # Construct a reply.
-                        msg = ["R"+reply_id] + info
-                    
-                    else:
-                    
-                        msg = ["E"+reply_id, 0x100d6, "Not found"]
-                
-                except KeyError:
-                
-                    msg = ["E"+reply_id, 0x163ac, "Shared disc not available."]
-                
-                # Send a reply.
-                self._send_list(msg, _socket, address)
+            # Find the current file length.
+            length = fh.length()
             
-            elif code == 0x8:
-                # Get free space
-
-                # Return message should be in the form:
-                # "R"+reply_id
-                # 4 bytes free space
-                # 4 bytes largest creatable object
-                # 4 bytes total spactotal space
-                handle = self.str2num(4, data[8:12])
-
-                msg = ["E"+reply_id, 0x806c11, "Free space not available\x00"]
-
-                self._send_list(msg, _socket, address)
-
-            elif code == 0x9:
+            self.log(
+                "comment",
+                "Change length from %i to %i" % (length, new_length), "",
+                level = LOG_API
+                )
             
-                # Rename file on our machine.
-                amount = self.str2num(4, data[8:12])
-                
-                # Find the share and RISC OS path within it.
-                share_name, ros_path = self.read_share_path(self.bytearray2str(data[16:]))
-                
-                try:
-                
-                    share = self.shares[(share_name, Hostaddr)]
-                    
-                    # Extract the host name from the address as it is assumed that
-                    # communication will be through port 49171.
-                    host = address[0]
-                    
-                    # Start a new thread to request and handle the incoming data.
-                    
-                    # Create a lock to prevent multiple threads working on the
-                    # same file at the same time.
-                    if ros_path in self.transfers:
-                    
-                        thread, host = self.transfers[ros_path]
-                        
-                        while thread.isAlive():
-                        
-                            pass
-                    
-                    # Create an event to use to inform the thread that it terminate.
-                    event = threading.Event()
-                    
-                    # Record the event in the transfer events dictionary.
-                    self.transfer_events[ros_path] = event
-                    
-                    # Create a buffer to put the filename in.
-                    buf = Buffer()
-                    
-                    # Create a thread to receive the replacement filename,
-                    # passing the necessary information to do this.
-                    thread = threading.Thread(
-                        group = None, target = share.rename_path,
-                        name = 'Rename request "%s" from %s:%i' % (
-                            ros_path, address[0], address[1]
-                            ),
-                        args = (
-                            event, reply_id, 0, amount, buf, ros_path,
-                            _socket, address, self.rename_path
-                            )
-                        )
-                    
-                    # Record the thread in the transfers dictionary.
-                    self.transfers[ros_path] = thread, host
-                    
-                    # Start the thread.
-                    thread.start()
-                
-                except KeyError:
-                
-                    msg = ["E"+reply_id, 0x163ac, "Shared disc not available."]
-                    
-                    # Send a reply.
-                    self._send_list(msg, _socket, address)
+            # If the length is to be changed then open the file for
+            # changing.
+            if length != new_length:
             
-            elif code == 0xa:
+                fh.truncate(new_length)
             
-                # Close file.
-                
-                handle = self.str2num(4, data[8:12])
-                
-                # If the handle is in use then remove it from the handle
-                # dictionary.
-                try:
-                
-                    fh = self.file_handler[handle]
-                    
-                    if fh.user == host:
-                    
-                        fh.close()
-                    
-                    del self.file_handler[handle]
-                    free_handle(handle)
-                    
-                    # Reply with an short message.
-                    msg = ["R"+reply_id]
-                
-                except KeyError:
-                
-                    # Ideally, reply with an error message about the file handle
-                    # used.
-                    msg = ["R"+reply_id]
-                
-                # Send a reply.
-                self._send_list(msg, _socket, address)
+            msg = ["R"+reply_id, new_length]
+        
+        except IOError:
+        
+            msg = ["E"+reply_id, 0x100d6, "Not found"]
+        
+        except KeyError:
+        
+            # We should probably complain about the file handle
+            # rather than about the path.
+            msg = ["E"+reply_id, 0x100d6, "Not found"]
+        
+        # Send a reply.
+        self._send_list(msg, _socket, address)
+    
+    def _share_set_filetype(self, _socket, packet, address):
+    
+        # Set the file type of a file on our machine.
+        host = address[0]
+        reply_id = packet.reply_id
+        handle = packet.handle
+        
+        try:
+        
+            # Read the file handle of the file on our machine.
+            fh = self.file_handler[handle]
             
-            elif code == 0xb:
+            # Only allow the user of the file to set its filetype.
+            if fh.user != host: raise IOError
             
-                # Send file (data request)
-                
-                handle = self.str2num(4, data[8:12])
-                pos = self.str2num(4, data[12:16])
-                length = self.str2num(4, data[16:20])
-                
-                #print("Data request", hex(handle), pos, length
-                
-                # Extract the host name from the address as it is assumed that
-                # communication will be through port 49171.
-                host = address[0]
-                
-                try:
-                
-                    fh = self.file_handler[handle]
-                    
-                    if fh.user != host: raise KeyError
-                    
-                    path = fh.path
-                    
-                    # Start a new thread to request and handle the incoming data.
-                    
-                    # Create a lock to prevent multiple threads working on the
-                    # same file at the same time.
-                    if path in self.transfers:
-                    
-                        thread, host = self.transfers[path]
-                        
-                        while thread.isAlive():
-                        
-                            pass
-                    
-                    # Create an event to use to inform the thread that it terminate.
-                    event = threading.Event()
-                    
-                    # Record the event in the transfer events dictionary.
-                    self.transfer_events[path] = event
-                    
-                    # Create a thread to send the file.
-                    thread = threading.Thread(
-                        group = None, target = self.send_file,
-                        name = 'Transfer "%s" to %s:%i' % (
-                            path, address[0], address[1]
-                            ),
-                        args = (
-                            event, reply_id, code, handle, pos, length, fh,
-                            _socket, address
-                            )
-                        )
-                    
-                    # Record the thread in the transfers dictionary.
-                    self.transfers[path] = thread, host
-                    
-                    # Start the thread.
-                    thread.start()
-                
-                except KeyError:
-                
-                    # Reply with an error message.
-                    msg = ["E"+reply_id, 0x100d6, "Not found"]
-                    
-                    # Send a reply.
-                    self._send_list(msg, _socket, address)
+            # Use the policy of the share in which the file resides
+            # to modify the file's attributes.
+            share = fh.share
             
-            elif code == 0xc:
+            # The handle doesn't change, so don't delete the
+            # file_handler data.
+            #del self.file_handler[handle]
             
-                # Receive file
-                
-                # The remote client has passed the handle, some word
-                # and the length of the file.
-                handle = self.str2num(4, data[8:12])
-                pos = self.str2num(4, data[12:16])
-                amount = self.str2num(4, data[16:20])
-                
-                try:
-                
-                    # Translate the handle into a path.
-                    fh = self.file_handler[handle]
-                    
-                    if fh.user == host:
-                    
-                        # Only receive the file if the host sending it is the
-                        # user of the file handle.
-                        
-                        path = fh.path
-                        length = fh.length()
-                        
-                        self.log("comment", "", "", level = LOG_API)
-                        self.log("comment", path, "", level = LOG_API)
-                        self.log("comment", "Length of file: %i" % length, "", level = LOG_API)
-                        
-                        # Extract the host name from the address as it is assumed that
-                        # communication will be through port 49171.
-                        host = address[0]
-                        
-                        # Start a new thread to request and handle the incoming data.
-                        
-                        # Create a lock to prevent multiple threads working on the
-                        # same file at the same time.
-                        if path in self.transfers:
-                        
-                            thread, host = self.transfers[path]
-                            
-                            while thread.isAlive():
-                            
-                                pass
-                        
-                        # Create an event to use to inform the thread that it terminate.
-                        event = threading.Event()
-                        
-                        # Record the event in the transfer events dictionary.
-                        self.transfer_events[path] = event
-                        
-                        # Create a thread to receive the file.
-                        thread = threading.Thread(
-                            group = None, target = self.receive_file,
-                            name = 'Transfer "%s" from %s:%i' % (
-                                path, address[0], address[1]
-                                ),
-                            args = (
-                                event, reply_id, pos, amount, fh,
-                                _socket, address
-                                )
-                            )
-                        
-                        # Record the thread in the transfers dictionary.
-                        self.transfers[path] = thread, host
-                        
-                        # Start the thread.
-                        thread.start()
-                        
-                        # Also notify the other client that the share has been updated.
+            info = share.set_filetype(
+                fh, handle, packet.filetype_word, packet.date_word
+                )
+            
+            if info is not None:
+            
+                # I don't think the last element of this list is
+                # a handle.  I'm not sure what it is, though - and
+                # I can't see it referenced ever.
+                # RISC OS 5 always returns a "Not Found" error.
+                # handle = info[-1]
                 
-                except KeyError:
+                ## Transfer the file handle to the file on the new path.
+                #self.file_handler[handle] = fh
                 
-                    msg = ["E"+reply_id, 0x100d6, "Not found"]
-                    
-                    # Send a reply.
-                    self._send_list(msg, _socket, address)
+                # Construct a reply.
+                msg = [ "R"+reply_id ] + info
             
-            #elif code == 0xe:
-            #
-            #    # Set length of file.
-            #    handle = self.str2num(4, data[8:12])
-            #    length = self.str2num(4, data[12:16])
-            #    
-            #    msg = ["D"+reply_id, 0]
-            #    self._send_list(msg, _socket, address)
-            #    
-            #    msg = ["R"+reply_id, 0x1234]
-            #    self._send_list(msg, _socket, address)
+            else:
+            
+                msg = ["E"+reply_id, 0x100d6, "Not found"]
+        
+        except IOError:
+        
+            msg = ["E"+reply_id, 0x100d6, "Not found"]
+        
+        except KeyError:
+        
+            msg = ["E"+reply_id, 0x100d6, "Not found"]
+        
+        # Send a reply.
+        self._send_list(msg, _socket, address)
+    
+    def _share_ensure_size(self, _socket, packet, address):
+    
+        # Ensure size.  Fill space with zeros?
+        # This is the same as codes 0xe and 0xf, but with an offset argument
+        host = address[0]
+        reply_id = packet.reply_id
+        handle = packet.handle
+        new_length = packet.pos + packet.length
+        
+        try:
+            # Find the path and previously recorded file length.
+            fh = self.file_handler[handle]
             
-            elif code == 0xe or code == 0xf:
+            # Only allow the user of the file to set the length.
+            if fh.user != host: raise KeyError
             
-                # Set length of file.
-                
-                handle = self.str2num(4, data[8:12])
-                new_length = self.str2num(4, data[12:16])
-                
-                try:
-                
-                    # Find the path and previously recorded file length.
-                    fh = self.file_handler[handle]
-                    
-                    # Only allow the user of the file to set the length.
-                    if fh.user != host: raise KeyError
-                    
-                    # Find the current file length.
-                    length = fh.length()
-                    
-                    self.log(
-                        "comment",
-                        "Change length from %i to %i" % (length, new_length), "",
-                        level = LOG_API
+            # Find the current file length.
+            length = fh.length()
+            
+            self.log(
+                "comment",
+                "Change length from %i to %i" % (length, new_length), "",
+                level = LOG_API
+                )
+            
+            # If the length is to be changed then open the file for
+            # changing.
+            if length < new_length:
+            
+                fh.truncate(new_length)
+            
+            msg = ["R"+reply_id, new_length]
+        
+        except IOError:
+        
+            msg = ["E"+reply_id, 0x100d6, "Not found"]
+        
+        except KeyError:
+        
+            # We should probably complain about the file handle
+            # rather than about the path.
+            msg = ["E"+reply_id, 0x100d6, "Not found"]
+        
+        # Send a reply.
+        self._send_list(msg, _socket, address)
+    
+    def _share_catalogue(self, _socket, packet, address):
+    
+        # Request for information.
+        host = address[0]
+        reply_id = packet.reply_id
+        
+        share_name, ros_path = self.read_share_path(packet.string())
+        
+        try:
+        
+            # Read the directory name associated with this share.
+            share = self.shares[(share_name, Hostaddr)]
+            infolist, trailer, path, handle = share.catalogue_path(ros_path)
+            
+            if infolist is not None:
+            
+                handle = trailer[5]
+                self.catalogued_paths_lock.acquire()
+                if not handle in self.catalogued_paths:
+
+                    self.catalogued_paths[handle] = (path, os.stat(path)[os.path.stat.ST_MTIME], [host])
+                    self.watcher.watch(path)
+
+                else:
+
+                    (path, mtime, hosts) = self.catalogued_paths[handle]
+                    if not host in hosts:
+ 
+                        hosts.append(host)
+
+                    self.catalogued_paths[handle] = (path, mtime, hosts)
+                self.catalogued_paths_lock.release()
+
+                # Let the share keep catalogues of the directory once it is
+                # told about changes to it.
+                if self.watcher.watching(path):
+
+                    share.catalogues.watch(path)
+
+                # Remember the remaining chunks, encoded, for later.
+                if len(infolist) > 1:
+                    self.listing_cache.put(
+                        (handle, address),
+                        [(info[0], self._encode(info)) for info in infolist[1:]]
                         )
-                    
-                    # If the length is to be changed then open the file for
-                    # changing.
-                    if length != new_length:
-                    
-                        fh.truncate(new_length)
-                    
-                    msg = ["R"+reply_id, new_length]
-                
-                except IOError:
-                
-                    msg = ["E"+reply_id, 0x100d6, "Not found"]
-                
-                except KeyError:
-                
-                    # We should probably complain about the file handle
-                    # rather than about the path.
-                    msg = ["E"+reply_id, 0x100d6, "Not found"]
+
+                # Write the message, starting with the code and ID word.
+                msg = ["S"+reply_id] + infolist[0] + ["B"+reply_id] + trailer
                 
-                # Send a reply.
+                # Send the reply.
                 self._send_list(msg, _socket, address)
             
-            elif code == 0x10:
+            elif trailer == "Not a directory":
+            
+                # Reply with an error message.
+                self._send_list(
+                    ["E"+reply_id, 0x163c5, "Not a Directory"],
+                    _socket, address
+                    )
+            
+            else:
+            
+                # Reply with an error message.
+                self._send_list(
+                    ["E"+reply_id, 0x100d6, "Not found"],
+                    _socket, address
+                    )
+        
+        except KeyError:
+        
+            # Reply with an error message.
+            self._send_list(
+                ["E"+reply_id, 0x163ac, "Shared disc not available."],
+                _socket, address
+                )
+    
+    def _share_read_data(self, _socket, packet, address):
+    
+        # Data request ("B")
+        host = address[0]
+        reply_id = packet.reply_id
+        pos = packet.pos
+        length = min(packet.length, SEND_SIZE)
+        
+        try:
+        
+            # Match the handle to the file to use.
+            fh = self.file_handler[packet.handle]
+            
+            # Only allow the user of the file to read its contents.
+            if fh.user != host: raise IOError
+            
+            fh.seek(pos, 0)
+            
+            file_data = fh.read(length)
             
-                # Set the file type of a file on our machine.
-                
-                handle = self.str2num(4, data[8:12])
-                filetype_word = self.str2num(4, data[12:16])
-                date_word = self.str2num(4, data[16:20])
-                
-                try:
-                
-                    # Read the file handle of the file on our machine.
-                    fh = self.file_handler[handle]
-                    
-                    # Only allow the user of the file to set its filetype.
-                    if fh.user != host: raise IOError
-                    
-                    # Use the policy of the share in which the file resides
-                    # to modify the file's attributes.
-                    share = fh.share
-                    
-                    # The handle doesn't change, so don't delete the
-                    # file_handler data.
-                    #del self.file_handler[handle]
-                    
-                    info = share.set_filetype(fh, handle, filetype_word, date_word)
-                    
-                    if info is not None:
-                    
-                        # I don't think the last element of this list is
-                        # a handle.  I'm not sure what it is, though - and
-                        # I can't see it referenced ever.
-                        # RISC OS 5 always returns a "Not Found" error.
-                        # handle = info[-1]
-                        
-                        ## Transfer the file handle to the file on the new path.
-                        #self.file_handler[handle] = fh
-                        
-                        # Construct a reply.
-                        msg = [ "R"+reply_id ] + info
-                    
-                    else:
-                    
-                        msg = ["E"+reply_id, 0x100d6, "Not found"]
-                
-                except IOError:
-                
-                    msg = ["E"+reply_id, 0x100d6, "Not found"]
-                
-                except KeyError:
-                
-                    msg = ["E"+reply_id, 0x100d6, "Not found"]
-                
-                # Send a reply.
-                self._send_list(msg, _socket, address)
+            # Calculate the new offset into the file.
+            new_pos = pos + len(file_data)
+            
+            # Write the message header, the unpadded data and a 12 byte
+            # trailer containing the amount of data sent and the new
+            # offset into the file being read. These are encoded
+            # together in a single message.
+            msg = [
+                "S"+reply_id, len(file_data), 0xc, (NO_PAD, file_data),
+                "B"+reply_id, len(file_data), new_pos
+                ]
+        
+        except (KeyError, IOError):
+        
+            # Reply with an error message.
+            msg = ["E"+reply_id, 0x100d6, "Not found"]
+        
+        # Send the message.
+        self._send_list(msg, _socket, address)
+    
+    def _share_next_chunk(self, _socket, packet, address):
+    
+        # Request for next chunk of information.
+        # Request is in the form: "B"+reply_id+0x0d 0x00 0x00 0x00
+        # 4 bytes directory handle
+        # 4 bytes something (0x55 in my trace.  Toggle for the next chunk)
+        # 4 bytes chunk size
+        reply_id = packet.reply_id
+        dir_handle = packet.dir_handle
+        something = packet.marker
 
-            elif code == 0x14:
+        key = (dir_handle, address)
+        listing = self.listing_cache.get(key)
 
-                # Ensure size.  Fill space with zeros?
-                # This is the same as codes 0xe and 0xf, but with an offset argument
+        if listing is not None and listing.marker is not None and \
+           listing.marker != something:
+            # already sent this chunk
+            return
 
-                handle = self.str2num(4, data[8:12])
-                offset = self.str2num(4, data[12:16])
-                length = self.str2num(4, data[16:20])
-                new_length = offset + length
+        try:
+            if listing is None:
+                raise KeyError
+
+            # The first chunk was sent in reply to the catalogue request.
+            chunk_no = listing.sent + 1
+            infolen, data = listing.chunks[chunk_no - 1]
+
+            # I think the marker should alternate between
+            # 0x55000000 and 0xaa000000.  It should be the opposite
+            # of the 'something' field
+            if something == long(0xaa000000):
+                marker = long(0x55000000)
+            elif something == long(0x000000aa):
+                marker = long(0x00000055)
+            elif something == long(0x00000055):
+                marker = long(0x000000aa)
+            else:
+                marker = long(0xaa000000)
 
-                try:
-                    # Find the path and previously recorded file length.
-                    fh = self.file_handler[handle]
-                    
-                    # Only allow the user of the file to set the length.
-                    if fh.user != host: raise KeyError
-                    
-                    # Find the current file length.
-                    length = fh.length()
-                    
-                    self.log(
-                        "comment",
-                        "Change length from %i to %i" % (length, new_length), "",
-                        level = LOG_API
-                        )
-                    
-                    # If the length is to be changed then open the file for
-                    # changing.
-                    if length < new_length:
-                    
-                        fh.truncate(new_length)
-                    
-                    msg = ["R"+reply_id, new_length]
-                
-                except IOError:
-                
-                    msg = ["E"+reply_id, 0x100d6, "Not found"]
-                
-                except KeyError:
-                
-                    # We should probably complain about the file handle
-                    # rather than about the path.
-                    msg = ["E"+reply_id, 0x100d6, "Not found"]
+            if chunk_no == len(listing.chunks):
+                # This is the last chunk.
+                self.listing_cache.discard(key)
+                marker = long(0xffffffff)
+            else:
+                listing.sent = chunk_no
+                listing.marker = marker
 
-                # Send a reply.
-                self._send_list(msg, _socket, address)
-                
+            trailer = [
+                infolen,
+                marker
+            ]
 
-            elif code == 0x16:
-                # Get 32 bit free space
+            # The chunk was encoded when it was stored.
+            msg = ["S"+reply_id, (NO_PAD, data), "B"+reply_id] + trailer
 
-                handle = self.str2num(4, data[8:12])
+        except KeyError:
 
-                # response should be in the form
-                #  R+reply_id
-                #  4 bytes free space least significant word
-                #  4 bytes free space most significant word
-                #  4 bytes largest creatable object lest significant word
-                #  4 bytes largest creatable object most significant word
-                #  4 bytes total space least significant word
-                #  4 bytes total space most significant word
-                msg = ["E"+reply_id, 0x806c11, "Free space not available\x00"]
+            msg = ["E"+reply_id, 0x100d6, "Not found"]
+        
+        self._send_list(msg, _socket, address)
+    
+    
+    # Method used in listening thread
+    
+    def listen(self, event):
+    
+        while 1:
+        
+            if self.socket_poll != None:
 
-                self._send_list(msg, _socket, address)
+                fired = self.socket_poll.poll(1000) # Wait 1 second
 
-        elif command == "B" and code == 0x3:
-        
-            # Request for information.
-            
-            share_name, ros_path = self.read_share_path(self.bytearray2str(data[16:]))
-            
-            try:
+                for (s, evt) in fired:
+                    if s == self.ports[32770].fileno() or s == self.broadcasters[32770].fileno():
+                        self.read_poll_socket()
+                    elif self.access_plus == 1 and (s == self.ports[32771].fileno() or s == self.broadcasters[32771].fileno()):
+                        self.read_listener_socket()
+                    elif s == self.ports[49171].fileno() or s == self.broadcasters[49171].fileno():
+                        self.read_share_socket()
             
-                # Read the directory name associated with this share.
-                share = self.shares[(share_name, Hostaddr)]
-                infolist, trailer, path, handle = share.catalogue_path(ros_path)
-                
-                if infolist is not None:
-                
-                    handle = trailer[5]
-                    self.catalogued_paths_lock.acquire()
-                    if not handle in self.catalogued_paths:
+            else:
 
-                        self.catalogued_paths[handle] = (path, os.stat(path)[os.path.stat.ST_MTIME], [host])
 
-                    else:
+                (rports, _, _) = select.select(self.socket_select_rlist, \
+                                                         [], [], 1.0)
 
-                        (path, mtime, hosts) = self.catalogued_paths[handle]
-                        if not host in hosts:
- 
-                            hosts.append(host)
+                for i in rports:
+                    if i == self.ports[32770].fileno() or \
+                       i == self.broadcasters[32770].fileno():
+                        self.read_poll_socket()
+                    if i == self.ports[32771].fileno() or \
+                       i == self.broadcasters[32771].fileno():
+                        self.read_listener_socket()
+                    if i == self.ports[49171].fileno() or \
+                       i == self.broadcasters[49171].fileno():
+                        self.read_share_socket()
 
-                        self.catalogued_paths[handle] = (path, mtime, hosts)
-                    self.catalogued_paths_lock.release()
+            if event.isSet(): return
+    
+    def serve(self, workers = 0):
+    
+        """serve(self, workers = 0)
+        
+        Make the server available and start serving, using the number of
+        worker processes given to serve requests sent to shares.
+        """
+        
+        # Start the workers before any threads, since the threads are not
+        # copied into them but any locks they hold would be.
+        if workers > 0:
+        
+            self._start_workers(workers)
+        
+        # Make the server available.
+        self.broadcast_startup()
+        
+        # Start watching catalogued directories.
+        self.watcher.start()
+        
+        if self.engine is not None:
+        
+            # Start the event loop which listens on each socket and
+            # schedules the polling broadcasts.
+            self.engine.start()
+        
+        else:
+        
+            # Start the polling thread.
+            self.poll_thread.start()
+            
+            # Start the listening thread.
+            self.listen_thread.start()
+        
+        # Start broadcasting the shares and printers already added.
+        self.serving = True
+        
+        for (name, host), share in self.shares.items():
+        
+            if host == Hostaddr:
+            
+                share.start()
+        
+        for (name, host), printer in self.printers.items():
+        
+            if host == Hostaddr:
+            
+                printer.start()
+    
+    def stop(self):
+    
+        if not self.listen_event:
 
-                    # Remember thes results for later
-                    if len(infolist) > 1:
-                        self.catalogue_cache[(handle, address)] = infolist
+            return
 
-                    # Write the message, starting with the code and ID word.
-                    msg = ["S"+reply_id] + infolist[0] + ["B"+reply_id] + trailer
-                    
-                    # Send the reply.
-                    self._send_list(msg, _socket, address)
-                    
-                    #print("")
-                    #print("Sent:")
-                    #for line in self.interpret(self._encode(msg)):
-                    #
-                    #    print(line)
-                    #print("")
-                
-                elif trailer == "Not a directory":
-                
-                    # Reply with an error message.
-                    self._send_list(
-                        ["E"+reply_id, 0x163c5, "Not a Directory"],
-                        _socket, address
-                        )
-                
-                elif trailer == "Not found":
-                
-                    # Reply with an error message.
-                    self._send_list(
-                        ["E"+reply_id, 0x100d6, "Not found"],
-                        _socket, address
-                        )
-                
-                else:
-                
-                    # Reply with an error message.
-                    self._send_list(
-                        ["E"+reply_id, 0x100d6, "Not found"],
-                        _socket, address
-                        )
+        # Stop the worker processes serving shares.
+        self._stop_workers()
+        
+        if self.engine is not None:
+        
+            # Terminate the event loop, its transfers and broadcasts.
+            sys.stdout.write("Terminating the event loop\n")
+            self.engine.stop()
+        
+        # Terminate any threads which are still running.
+        self._stop_threads()
+        
+        # Close all open files.
+        sys.stdout.write("Closing files\n")
+        
+        for handle, fh in self.file_handler.items():
+        
+            fh.close()
+        
+        self.listen_event = None
+
+        sys.stdout.write("Finished\n")
+    
+    def _stop_threads(self):
+    
+        self._stop_serving()
+        
+        # Threads for share broadcasts
+        
+        for (name, host), share in self.shares.items():
+        
+            # Only terminate threads for shares on this host.
+            if host == Hostaddr and share.thread is not None:
             
-            except KeyError:
+                sys.stdout.write("Terminating thread for share: %s\n" % name)
+                share.stop()
+        
+        # Threads for printer broadcasts
+        
+        for (name, host), printer in self.printers.items():
+        
+            # Only terminate threads for shares on this host.
+            if host == Hostaddr and printer.thread is not None:
             
-                # Reply with an error message.
-                self._send_list(
-                    ["E"+reply_id, 0x163ac, "Shared disc not available."],
-                    _socket, address
-                    )
+                sys.stdout.write("Terminating thread for printer: %s\n" % name)
+                printer.stop()
+        
+        # Terminate the polling thread.
+        if self.poll_thread.is_alive():
+        
+            sys.stdout.write("Terminating the polling thread\n")
+            self.poll_event.set()
+            
+            # Wait until the thread terminates.
+            self.poll_thread.join()
+        
+        # Stop watching catalogued directories.
+        if self.watcher.is_alive():
+        
+            sys.stdout.write("Terminating the directory watcher\n")
+        
+        self.watcher.stop()
+    
+    def _start_workers(self, count):
+    
+        """_start_workers(self, count)
+        
+        Fork the number of worker processes given to serve requests sent
+        to the share port, each with its own socket bound to the port using
+        SO_REUSEPORT so that the system shares clients between them. This
+        process keeps broadcasting polls and shares, and answering polls,
+        but no longer serves requests sent directly to the share port or
+        receives replies to its own requests to other clients. Shares added
+        or removed afterwards, and networks added, are passed on to the
+        workers through a pipe to each. Workers can only be used on systems
+        providing fork and SO_REUSEPORT, with threads rather than an event
+        loop, and must be started before serving starts.
+        """
+        
+        reuse_port = getattr(socket, "SO_REUSEPORT", None)
+        
+        if reuse_port is None or not hasattr(os, "fork") or \
+           sys.platform.startswith("win32") or self.engine is not None or \
+           self.worker_pids:
+        
+            sys.stderr.write("Worker processes are not available.\n")
+            return
         
-        elif command == "B" and code == 0xb:
+        # Each worker tags the handles it allocates with its own number.
+        count = min(count, (1 << HANDLE_TAG_BITS) - 1)
         
-            # Data request ("B")
+        self.worker_store = WorkerStore()
+        
+        # Close the share port before the workers bind to it, sending any
+        # messages on the broadcasting socket instead. No thread is
+        # listening to it yet.
+        s = Ports.ports[49171]
+        
+        if s is not Ports.broadcasters[49171]:
+        
+            self._unregister_socket_for_select(s)
+            Ports.ports[49171] = Ports.broadcasters[49171]
+            s.close()
+        
+        for index in range(count):
+        
+            # Create a pipe to send changes to the shares to the worker.
+            r, w = os.pipe()
+            
+            try:
+            
+                pid = os.fork()
+            
+            except OSError as exc:
+            
+                os.close(r)
+                os.close(w)
+                sys.stderr.write("Failed to start a worker: %s\n" % exc)
+                break
+            
+            if pid == 0:
+            
+                os.close(w)
+                self._serve_worker(index, reuse_port, r)
+            
+            os.close(r)
+            self.worker_pids.append(pid)
+            self.worker_pipes.append(w)
+    
+    def _tell_workers(self, method, *args):
+    
+        # Ask the worker processes to call the method given with the
+        # arguments given, to keep their shares and networks the same as
+        # ours.
+        if not self.worker_pipes:
+        
+            return
+        
+        import pickle
+        
+        data = pickle.dumps((method, args), 2)
+        data = struct.pack(">I", len(data)) + data
+        
+        for fd in self.worker_pipes:
+        
+            try:
+            
+                # Writes to a pipe of up to PIPE_BUF bytes are not mixed
+                # with those made by other threads.
+                os.write(fd, data)
+            
+            except OSError:
+            
+                # The worker has exited.
+                pass
+    
+    def _read_worker_changes(self, data):
+    
+        # Call the methods described by the complete messages in the data
+        # read from the pipe in a worker process, returning the rest.
+        import pickle
+        
+        while len(data) >= 4:
+        
+            length = struct.unpack(">I", data[:4])[0]
             
-            handle = self.str2num(4, data[8:12])
-            pos = self.str2num(4, data[12:16])
-            length = self.str2num(4, data[16:20])
+            if len(data) < 4 + length:
             
-            length = min(length, SEND_SIZE)
+                break
+            
+            method, args = pickle.loads(data[4:4 + length])
+            data = data[4 + length:]
+            
+            getattr(self, method)(*args)
+        
+        return data
+    
+    def _serve_worker(self, index, reuse_port, pipe):
+    
+        # Serve the share port in a newly forked worker process until the
+        # process which started it stops it or exits, then exit.
+        status = 0
+        
+        try:
+        
+            parent = os.getppid()
+            
+            # Use state of our own rather than sharing the parent's.
+            Log.reset()
+            Ports.capture = None
+            
+            for fd in self.worker_pipes:
+            
+                os.close(fd)
+            
+            self.worker_pids = []
+            self.worker_pipes = []
+            self.worker_event = threading.Event()
+            self.transfers = TransferScheduler()
+            self.transfer_pool = TransferPool(self._run_scheduled)
+            self.general_messages = Messages()
+            self.share_messages = Messages()
+            self.catalogued_paths = {}
+            self.catalogued_paths_lock = threading.Lock()
+            self.watcher = DirectoryWatcher(self._directories_changed)
+            self.file_handler.tag = index + 1
+            
+            # Bind a socket of our own to the share port and listen only to
+            # that.
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.setsockopt(socket.SOL_SOCKET, reuse_port, 1)
+            s.setblocking(0)
+            self._set_receive_buffer(s)
+            s.bind((Hostaddr, 49171))
+            
+            Ports.ports[49171] = s
+            
+            if self.socket_poll is not None:
+            
+                self.socket_poll = select.poll()
+            
+            else:
+            
+                self.socket_select_rlist = []
+            
+            self._register_socket_for_select(s)
+            
+            try:
+            
+                import signal
+                signal.signal(
+                    signal.SIGTERM, lambda n, frame: self.worker_event.set()
+                    )
+            
+            except (ImportError, ValueError):
+            
+                pass
+            
+            self.watcher.start()
+            
+            self.listen_event = threading.Event()
+            self.listen_thread = threading.Thread(
+                group = None, target = self.listen,
+                name = "Worker %i" % index, args = (self.listen_event,)
+                )
+            self.listen_thread.start()
             
-            #print("Data request", hex(handle), pos, length)
+            # Apply the changes to shares sent by the parent, and check for
+            # changes to catalogued directories which are not being watched,
+            # as the polling thread does in the parent.
+            polled = time.time()
+            pending = b""
             
-            try:
+            while not self.worker_event.isSet() and os.getppid() == parent:
             
-                # Match the handle to the file to use.
-                fh = self.file_handler[handle]
-                
-                # Only allow the user of the file to read its contents.
-                if fh.user != host: raise IOError
-                    
-                file_length = fh.length()
-                
-                fh.seek(pos, 0)
+                try:
                 
-                file_data = fh.read(length)
+                    r, w, e = select.select([pipe], [], [], 1.0)
                 
-                # Calculate the new offset into the file.
-                new_pos = pos + len(file_data)
+                except (select.error, OSError):
                 
-                # Write the message header.
-                header = ["S"+reply_id, len(file_data), 0xc]
+                    # Interrupted by a signal.
+                    r = []
                 
-                # Encode the header, adding padding if necessary.
-                header = self._encode(header)
+                if r:
                 
-                # Add a 12 byte trailer onto the end of the data
-                # containing the amount of data sent and the new
-                # offset into the file being read.
-                trailer = ["B"+reply_id, len(file_data), new_pos]
+                    data = os.read(pipe, 65536)
+                    
+                    if not data:
+                    
+                        # The parent has closed the pipe.
+                        break
+                    
+                    pending = self._read_worker_changes(pending + data)
                 
-                # Encode the trailer, adding padding if necessary.
-                trailer = self._encode(trailer)
+                if time.time() - polled > WORKER_POLL_DELAY:
                 
-                # Construct the message string.
-                msg = header + file_data + trailer
+                    polled = time.time()
+                    self._broadcast_catalogue_changes()
             
-            except (KeyError, IOError):
+            self._stop_serving()
+            self.watcher.stop()
             
-                # Reply with an error message.
-                msg = self._encode(["E"+reply_id, 0x100d6, "Not found"])
+            for handle, fh in self.file_handler.items():
             
-            self.log("sent", msg, address, level = LOG_PROTOCOL)
+                fh.close()
             
-            # Send the message.
-            _socket.sendto(msg, address)
-        
-        elif (command == "A" or command == "B") and code == 0xd:
+            Log.flush()
         
-            # Request for next chunk of information.
-            # Request is in the form: "B"+reply_id+0x0d 0x00 0x00 0x00
-            # 4 bytes directory handle
-            # 4 bytes something (0x55 in my trace.  Toggle for the next chunk)
-            # 4 bytes chunk size
-            
-            dir_handle = self.str2num(4, data[8:12])
-            something = self.str2num(4, data[12:16])
-            blocksize = self.str2num(4, data[16:20])
-
-            try:
-                sent_chunk_info = self.cache_send_info[(dir_handle, address)]
-                if sent_chunk_info[1] != something:
-                    # already sent this chunk
-                    return
-                else:
-                    chunk_no = sent_chunk_info[0] + 1
-            except KeyError:
-                chunk_no = 1
-                sent_chunk_info = [chunk_no, something]
-
-            try:
-                infolist = self.catalogue_cache[(dir_handle, address)]
-
-                info = infolist[chunk_no]
-                infolen = info[0]
-
-                # I think the marker should alternate between
-                # 0x55000000 and 0xaa000000.  It should be the opposite
-                # of the 'something' field
-                if something == long(0xaa000000):
-                    marker = long(0x55000000)
-                elif something == long(0x000000aa):
-                    marker = long(0x00000055)
-                elif something == long(0x00000055):
-                    marker = long(0x000000aa)
-                else:
-                    marker = long(0xaa000000)
-
-                if chunk_no == len(infolist) - 1:
-                    # This is the last chunk.
-                    del self.catalogue_cache[(dir_handle, address)]
-                    try:
-                        del self.cache_send_info[(dir_handle, address)]
-                    except KeyError:
-                        pass
-                    marker = long(0xffffffff)
-                else:
-                    sent_chunk_info[0] = chunk_no
-                    sent_chunk_info[1] = marker
-                    self.cache_send_info[(dir_handle, address)] = sent_chunk_info
-
-                trailer = [
-                    infolen,
-                    marker
-                ]
-
-                msg = ["S"+reply_id] + info + ["B"+reply_id] + trailer
-
-            except KeyError:
-
-                msg = ["E"+reply_id, 0x100d6, "Not found"]
-            
-            self._send_list(msg, _socket, address)
-
-        elif command == "D":
+        except:
         
-            # Request for data to be sent.
-            self.share_messages.append((host, data))
+            sys.excepthook(*sys.exc_info())
+            status = 1
         
-        elif command == "R":
+        # Don't run the exit handlers inherited from the parent process.
+        os._exit(status)
+    
+    def _stop_workers(self):
+    
+        if not self.worker_pids:
         
-            # Reply from a successful open request.
-            self.share_messages.append((host, data))
+            return
         
-        elif command == "S":
+        sys.stdout.write("Terminating the worker processes\n")
         
-            # Successful request for a catalogue.
-            self.share_messages.append((host, data))
+        import signal
         
-        elif command == "E":
+        for pid in self.worker_pids:
         
-            # Error response to a request.
-            self.share_messages.append((host, data))
+            try:
             
-            print("%s (%i)" % (
-                self.read_string(data[8:], ending = "\000", include = 0),
-                self.str2num(4, data[4:8])
-                ))
-        
-        elif command == "F":
-        
-            # Resource updated
-            pass
-        
-        elif command == "d":
-        
-            # Data sent to this client for uploading.
-            self.share_messages.append((host, data))
-        
-        elif command == "r":
-        
-            # Data sent to this client for uploading.
-            self.share_messages.append((host, data))
-        
-        elif command == "w":
-        
-            # Request for data to be sent to a remote client for uploading.
-            self.share_messages.append((host, data))
-        
-        else:
-        
-            #self.log("received", data, address, level = LOG_PROTOCOL)
-            pass
-    
-    
-    # Method used in listening thread
-    
-    def listen(self, event):
-    
-        t0 = time.time()
+                os.kill(pid, signal.SIGTERM)
+            
+            except OSError:
+            
+                pass
         
-        while 1:
+        for pid in self.worker_pids:
         
-            if self.socket_poll != None:
-
-                fired = self.socket_poll.poll(1000) # Wait 1 second
-
-                for (s, evt) in fired:
-                    if s == self.ports[32770].fileno() or s == self.broadcasters[32770].fileno():
-                        self.read_poll_socket()
-                    elif self.access_plus == 1 and (s == self.ports[32771].fileno() or s == self.broadcasters[32771].fileno()):
-                        self.read_listener_socket()
-                    elif s == self.ports[49171].fileno() or s == self.broadcasters[49171].fileno():
-                        self.read_share_socket()
+            try:
             
-            else:
-
-
-                (rports, _, _) = select.select(self.socket_select_rlist, \
-                                                         [], [], 1.0)
-
-                for i in rports:
-                    if i == self.ports[32770].fileno() or \
-                       i == self.broadcasters[32770].fileno():
-                        self.read_poll_socket()
-                    if i == self.ports[32771].fileno() or \
-                       i == self.broadcasters[32771].fileno():
-                        self.read_listener_socket()
-                    if i == self.ports[49171].fileno() or \
-                       i == self.broadcasters[49171].fileno():
-                        self.read_share_socket()
-
-            if (time.time() - t0) > TIDY_DELAY:
+                os.waitpid(pid, 0)
             
-                # Reset the timer and prune the list of transfers.
-                t0 = time.time()
-                
-                items = self.transfers.items()
-                deadthreads = []
-                
-                for path, (thread, host) in items:
-                
-                    if not thread.isAlive():
-                    
-                        deadthreads.append(path)
-
-                for path in deadthreads:
-
-                    del self.transfers[path]
-                    del self.transfer_events[path]
+            except OSError:
             
-            if event.isSet(): return
-    
-    def serve(self):
-    
-        """serve(self)
-        
-        Make the server available and start serving.
-        """
-        
-        # Make the server available.
-        self.broadcast_startup()
+                pass
         
-        # Start the polling thread.
-        self.poll_thread.start()
+        for fd in self.worker_pipes:
         
-        # Start the listening thread.
-        self.listen_thread.start()
+            os.close(fd)
         
-        return
+        self.worker_pids = []
+        self.worker_pipes = []
     
-    def stop(self):
+    def _stop_serving(self):
     
-        if not self.listen_event:
-
-            return
-
         # Terminate the listening thread.
-        sys.stdout.write("Terminating the listening thread\n")
-
-        self.listen_event.set()
+        if self.listen_thread.is_alive():
         
-        # Wait until the thread terminates.
-        while self.listen_thread.isAlive():
-        
-            pass
+            sys.stdout.write("Terminating the listening thread\n")
+            
+            self.listen_event.set()
+            
+            # Wait until the thread terminates.
+            self.listen_thread.join()
         
         # Terminate all threads.
         
         # Threads for file transfers to this host
         
-        for path, (thread, host) in self.transfers.items():
+        for transfer in self.transfers.stop():
         
             # Only terminate threads for shares on this host.
             sys.stdout.write(
-                "Terminating thread for transfer from %s to %s\n" % (host, path)
+                "Terminating thread for transfer from %s to %s\n" % (
+                    transfer.host, transfer.path
+                    )
                 )
             
             # We may wish to avoid doing this to prevent incomplete
             # transfers; we could wait until they have all finished.
-            self.transfer_events[path].set()
-            
-            # Wait until the thread terminates.
-            while thread.isAlive():
-            
-                pass
+            transfer.event.set()
         
-        # Threads for share broadcasts
-        
-        for (name, host), share in self.shares.items():
-        
-            # Only terminate threads for shares on this host.
-            if host == Hostaddr:
-            
-                sys.stdout.write("Terminating thread for share: %s\n" % name)
-                self.shares[(name, host)].event.set()
-                
-                thread = self.shares[(name, host)].thread
-                
-                # Wait until the thread terminates.
-                while thread.isAlive():
-                
-                    pass
-        
-        # Threads for printer broadcasts
-        
-        for (name, host), printer in self.printers.items():
-        
-            # Only terminate threads for shares on this host.
-            if host == Hostaddr:
-            
-                sys.stdout.write("Terminating thread for printer: %s\n" % name)
-                self.printers[(name, host)].event.set()
-                
-                thread = self.printers[(name, host)].thread
-                
-                # Wait until the thread terminates.
-                while thread.isAlive():
-                
-                    pass
-        
-        # Terminate the polling thread.
-        sys.stdout.write("Terminating the polling thread\n")
-        self.poll_event.set()
-        
-        # Wait until the thread terminates.
-        while self.poll_thread.isAlive():
-        
-            pass
-        
-        # Close all open files.
-        sys.stdout.write("Closing files\n")
-        
-        for handle, fh in self.file_handler.items():
-        
-            fh.close()
-        
-        self.listen_event = None
-
-        sys.stdout.write("Finished\n")
+        # Wait until the transfers finish and the threads terminate.
+        self.transfer_pool.stop()
     
     def logon(self, username, key):
 
@@ -7004,11 +12129,21 @@ class Peer(Ports):
 
         """fwaddnet(self)
 
-        Add a remote network address to the list of known hosts
+        Add a remote host address, or a network in the form a.b.c.d/prefix,
+        to the list of known hosts
         """
 
-        # FIXME: This should also support subnets in the form a.b.c.d/prefix
+        try:
+
+            self.address_filter.add(addr)
+
+        except (socket.error, ValueError):
+
+            sys.stderr.write("Invalid network address: %s\n" % addr)
+            return
+
         self.remote_nets.append(addr)
+        self._tell_workers("fwaddnet", addr)
 
     def fwshow(self):
     
@@ -7031,6 +12166,14 @@ class Peer(Ports):
 
         sys.stdout.write("\n")
 
+        sys.stdout.write("Messages accepted:\n")
+
+        for name, count in sorted(self.address_filter.counts().items()):
+
+            sys.stdout.write("%-20s %i\n" % (name, count))
+
+        sys.stdout.write("\n")
+
         if self.clients != {}:
         
             sys.stdout.write("Type 5 (Hosts)\n")
@@ -7073,6 +12216,123 @@ class Peer(Ports):
             
             sys.stdout.write("\n")
     
+    def handleshow(self):
+    
+        """handleshow(self)
+        
+        Show statistics about the file handles given to other clients and
+        the number in use by each client.
+        """
+        
+        stats = self.file_handler.statistics()
+        
+        sys.stdout.write("File handles:\n")
+        
+        for name in ("open", "reserved", "peak", "allocated", "released",
+                     "exhausted", "capacity"):
+        
+            sys.stdout.write("%-20s %i\n" % (name, stats[name]))
+        
+        sys.stdout.write("\n")
+        
+        if stats["hosts"]:
+        
+            sys.stdout.write("Handles in use:\n")
+            
+            for host, count in sorted(stats["hosts"].items()):
+            
+                sys.stdout.write("%-20s %i\n" % (host, count))
+            
+            sys.stdout.write("\n")
+    
+    def rttshow(self):
+    
+        """rttshow(self)
+        
+        Show the round trip times measured for requests sent to each host,
+        the time waited before sending a request again and the number of
+        requests sent again or never answered.
+        """
+        
+        stats = self.round_trips.statistics()
+        
+        if not stats:
+        
+            return
+        
+        sys.stdout.write("%-16s %8s %8s %8s %8s %8s %8s %8s\n" % (
+            "Host", "srtt ms", "var ms", "rto ms", "samples", "requests",
+            "resent", "lost"))
+        
+        for host, entry in sorted(stats.items()):
+        
+            times = []
+            
+            for name in ("srtt", "rttvar", "timeout"):
+            
+                if entry[name] is None:
+                
+                    times.append("%8s" % "-")
+                
+                else:
+                
+                    times.append("%8.1f" % (entry[name] * 1000))
+            
+            sys.stdout.write("%-16s %s %8i %8i %8i %8i\n" % (
+                host, " ".join(times), entry["samples"], entry["requests"],
+                entry["retransmitted"], entry["lost"]))
+        
+        sys.stdout.write("\n")
+    
+    def transfershow(self):
+    
+        """transfershow(self)
+        
+        Show the number of transfers waiting and running, the threads used
+        to run them, and the throughput of running and recent transfers.
+        """
+        
+        stats = self.transfers.statistics()
+        pool = self.transfer_pool.statistics()
+        
+        sys.stdout.write("Transfers:\n")
+        
+        for name, value in (
+            ("waiting", stats["waiting"]), ("queued", pool["queued"]),
+            ("bulk queued", pool["bulk queued"]), ("active", pool["active"]),
+            ("threads", pool["threads"]), ("started", stats["started"]),
+            ("coalesced", stats["coalesced"]), ("completed", pool["completed"]),
+            ("bytes", pool["bytes"])):
+        
+            sys.stdout.write("%-20s %i\n" % (name, value))
+        
+        sys.stdout.write("\n")
+        
+        for title, items in (("Running:", pool["running"]),
+                             ("Recent:", pool["recent"])):
+        
+            if not items:
+            
+                continue
+            
+            sys.stdout.write("%s\n" % title)
+            
+            for name, size, seconds in items:
+            
+                # Only finished transfers have moved all the data requested.
+                if items is pool["recent"]:
+                
+                    rate = "%10.1fK/s" % (size / max(seconds, 0.001) / 1024.0)
+                
+                else:
+                
+                    rate = "%12s" % "-"
+                
+                sys.stdout.write("%10i %8.3fs %s  %s\n" % (
+                    size, seconds, rate, name))
+            
+            sys.stdout.write("\n")
+    
     def add_share(self, name, directory, mode = 0o644, delay = 30,
                   present = "truncate", filetype = DEFAULT_FILETYPE, key = 0,
                   share_type = SHARE_TYPE_NORMAL):
@@ -7171,10 +12431,19 @@ class Peer(Ports):
             
             share = Share(
                 name, directory, mode, delay, present, filetype, key,
-                share_type, self.file_handler
+                share_type, self.file_handler, self.engine
                 )
             
             self.shares[(name, Hostaddr)] = share
+            
+            if self.serving:
+            
+                share.start()
+            
+            self._tell_workers(
+                "add_share", name, directory, mode, delay, present, filetype,
+                key, share_type
+                )
         
         except ShareError:
         
@@ -7193,20 +12462,13 @@ class Peer(Ports):
             print("Share is not currently available: %s" % name)
             return
         
-        # Set the relevant event object's flag.
-        event = self.shares[(name, Hostaddr)].event
-        
-        event.set()
-        
-        thread = self.shares[(name, Hostaddr)].thread
-        
-        # Wait until the thread terminates.
-        while thread.isAlive():
-        
-            pass
+        # Stop the share's broadcasts.
+        self.shares[(name, Hostaddr)].stop()
         
         # Remove the thread and the event from their respective dictionaries.
         del self.shares[(name, Hostaddr)]
+        
+        self._tell_workers("remove_share", name)
     
     def add_printer(self, name, directory, defn, description = "",
                     delay = DEFAULT_PRINTER_DELAY, filetype = DEFAULT_FILETYPE,
@@ -7243,7 +12505,8 @@ class Peer(Ports):
                     )
             
             printer = Printer(
-                name, directory, defn, description, delay, command
+                name, directory, defn, description, delay, command,
+                self.engine
                 )
         
         except PrinterError:
@@ -7254,6 +12517,10 @@ class Peer(Ports):
         # Add the printer to the dictionary of active printers.
         self.printers[(name, Hostaddr)] = printer
         
+        if self.serving:
+        
+            printer.start()
+        
         # If there is not currently a share for accepting print jobs then
         # create one.
         
@@ -7281,17 +12548,11 @@ class Peer(Ports):
             print("Printer is not currently available: %s" % name)
             return
         
-        # Set the relevant event object's flag.
-        self.printer_events[name].set()
+        # Stop the printer's broadcasts.
+        self.printers[(name, Hostaddr)].stop()
         
-        # Wait until the thread terminates.
-        while self.printers[(name, Hostaddr)].isAlive():
-        
-            pass
-        
-        # Remove the thread and the event from their respective dictionaries.
+        # Remove the printer from the dictionary of active printers.
         del self.printers[(name, Hostaddr)]
-        del self.printer_events[name]
     
     def open_share(self, name, host):
     
@@ -7330,17 +12591,31 @@ if __name__ == "__main__":
     sys.stdout.write("Starting...\n")
     
     want_access_plus = 1
+    engine = None
+    workers = 0
     try:
-        optlist, args = getopt.gnu_getopt(sys.argv[1:], "i:", ["interface=", "no-access-plus"])
+        optlist, args = getopt.gnu_getopt(sys.argv[1:], "i:", ["interface=", "no-access-plus", "asyncio", "capture=", "recv-buffer=", "workers=", "host-transfers=", "sync="])
         for o, a in optlist:
             if o in ("-i", "--interface"):
                 setup_net(a)
             elif o == "--no-access-plus":
                 want_access_plus = 0
+            elif o == "--asyncio":
+                engine = "asyncio"
+            elif o == "--capture":
+                capture_on(a)
+            elif o == "--recv-buffer":
+                RECV_BUFFER_SIZE = int(a) or None
+            elif o == "--workers":
+                workers = int(a)
+            elif o == "--host-transfers":
+                TRANSFERS_PER_HOST = int(a)
+            elif o == "--sync":
+                WRITE_SYNC = a
     except getopt.GetoptError as err:
         print(err)
 
-    p = Peer(access_plus = want_access_plus)
+    p = Peer(access_plus = want_access_plus, engine = engine, workers = workers)
     
     DEBUG = 0
     
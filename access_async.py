@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+
+"""
+access_async.py
+
+An asyncio event loop for the Peer class in the access module.
+
+Copyright (c) 2003-2012 David Boddie
+Copyright (c) 2012 James Woodcock <james_woodcock@yahoo.co.uk>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to
+deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+sell copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+DEALINGS IN THE SOFTWARE.
+"""
+
+import asyncio, concurrent.futures, functools, sys, threading, time
+
+# The delay between polling broadcasts, as used by Peer.broadcast_poll.
+POLL_DELAY = 30
+
+
+class Repeater:
+
+    """Repeater
+
+    Call a function on an event loop after an initial delay and then at
+    regular intervals until cancelled.
+    """
+
+    def __init__(self, loop, delay, interval, fn):
+
+        self.loop = loop
+        self.interval = interval
+        self.fn = fn
+
+        self.handle = loop.call_later(delay, self._fire)
+
+    def _fire(self):
+
+        # Schedule the next call before making this one so that a failure
+        # in the function does not stop the timer.
+        self.handle = self.loop.call_later(self.interval, self._fire)
+        self.fn()
+
+    def cancel(self):
+
+        self.handle.cancel()
+
+
+class PeerProtocol(asyncio.DatagramProtocol):
+
+    """PeerProtocol
+
+    Pass datagrams received on one of the Peer's sockets to the method
+    which handles messages for its port, recording them in any capture in
+    progress with the local address of the socket.
+    """
+
+    def __init__(self, peer, reader, local_address):
+
+        self.peer = peer
+        self.reader = reader
+        self.local_address = local_address
+
+    def datagram_received(self, data, address):
+
+        # Filter out data from machines not on the local subnet.
+        if self.peer._accept_address(address):
+
+            capture = self.peer.capture
+
+            if capture is not None:
+
+                capture.write(time.time(), address, self.local_address, data)
+
+            self.reader(data, address)
+
+    def error_received(self, exc):
+
+        # ICMP errors from earlier sends are reported here; the protocol
+        # relies on retries instead.
+        pass
+
+
+class Engine:
+
+    """Engine
+
+    Run the sockets, broadcasts and transfers of a Peer on an asyncio event
+    loop in a single thread. Datagrams are received by DatagramProtocol
+    endpoints on ports 32770, 32771 and 49171, broadcasts are scheduled as
+    timers and transfers run as coroutines.
+    """
+
+    def __init__(self, peer):
+
+        self.peer = peer
+        self.loop = asyncio.new_event_loop()
+
+        # Create a thread to run the event loop in.
+        self.thread = threading.Thread(
+            group = None, target = self._run, name = "Engine"
+            )
+
+        self.ready = threading.Event()
+
+        self.transports = []
+        self.poller = None
+
+        # Record the timers used by each share and printer and the function
+        # to call when they are removed.
+        self.timers = {}
+
+    def _run(self):
+
+        asyncio.set_event_loop(self.loop)
+
+        try:
+
+            self.loop.run_until_complete(self._open_endpoints())
+
+            # Poll for other clients at regular intervals.
+            if self.peer.broadcasters.get(32770) is None:
+
+                print("No socket to use for port %i" % 32770)
+
+            else:
+
+                self.poller = Repeater(
+                    self.loop, 0, POLL_DELAY, self.peer._broadcast_poll_once
+                    )
+
+            # Only report that the loop is ready once it is running.
+            self.loop.call_soon(self.ready.set)
+            self.loop.run_forever()
+
+        finally:
+
+            self.ready.set()
+            self.loop.close()
+
+    async def _open_endpoints(self):
+
+        peer = self.peer
+
+        readers = [
+            (32770, lambda s: peer._read_poll_socket),
+            (49171, lambda s: functools.partial(peer._read_share_socket, s))
+            ]
+
+        if peer.access_plus == 1:
+
+            readers.append((32771, lambda s: peer._read_listener_socket))
+
+        found = set()
+
+        for port, make_reader in readers:
+
+            for s in peer.ports.get(port), peer.broadcasters.get(port):
+
+                # On Windows the port socket is also the broadcaster.
+                if s is None or s.fileno() in found:
+
+                    continue
+
+                found.add(s.fileno())
+
+                # Give the event loop its own copy of the socket so that the
+                # sockets shared by the other objects stay open when the
+                # loop is stopped. Replies are still sent using the original
+                # socket.
+                transport, protocol = await self.loop.create_datagram_endpoint(
+                    functools.partial(
+                        PeerProtocol, peer, make_reader(s), s.getsockname()
+                        ),
+                    sock = s.dup()
+                    )
+
+                self.transports.append(transport)
+
+    def start(self):
+
+        """start(self)
+
+        Start the event loop, returning once it is running.
+        """
+
+        self.thread.start()
+        self.ready.wait()
+
+    def stop(self):
+
+        """stop(self)
+
+        Terminate all transfers and broadcasts, then stop the event loop.
+        """
+
+        if not self.thread.is_alive():
+
+            return
+
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def _shutdown(self):
+
+        peer = self.peer
+
+        # Ask each transfer to terminate and cancel any which are waiting
+        # for replies.
+        tasks = []
+
+        for transfer in peer.transfers.stop():
+
+            sys.stdout.write(
+                "Terminating transfer from %s to %s\n" % (
+                    transfer.host, transfer.path
+                    )
+                )
+
+            transfer.event.set()
+            transfer.runner.cancel()
+            tasks.append(transfer.runner)
+
+        if tasks:
+
+            await asyncio.gather(*tasks, return_exceptions = True)
+
+        # Stop the broadcasts for shares and printers.
+        for owner in list(self.timers.keys()):
+
+            sys.stdout.write("Terminating broadcasts for: %s\n" % owner.name)
+            self._remove(owner)
+
+        if self.poller is not None:
+
+            self.poller.cancel()
+
+        for transport in self.transports:
+
+            transport.close()
+
+        self.transports = []
+
+    def call(self, fn, *args):
+
+        """result = call(self, fn, *args)
+
+        Call the function given in the event loop's thread and return its
+        result once it has been called.
+        """
+
+        if threading.current_thread() is self.thread or \
+            not self.loop.is_running():
+
+            return fn(*args)
+
+        future = concurrent.futures.Future()
+
+        def run():
+
+            try:
+
+                future.set_result(fn(*args))
+
+            except BaseException as exc:
+
+                future.set_exception(exc)
+
+        self.loop.call_soon_threadsafe(run)
+
+        return future.result()
+
+    # Broadcasts
+
+    def add_share(self, share):
+
+        """add_share(self, share)
+
+        Schedule the broadcasts which advertise the share given.
+        """
+
+        self.call(self._add_share, share)
+
+    def _add_share(self, share):
+
+        if not share._broadcast_available():
+
+            return
+
+        # Broadcast a notification to other clients each second for five
+        # seconds.
+        timers = []
+
+        for i in range(0, 5):
+
+            timers.append(
+                self.loop.call_later(i, share._broadcast_notification)
+                )
+
+        # Then remind other clients of the availability of this share.
+        if share.delay != "off":
+
+            timers.append(
+                Repeater(
+                    self.loop, 5, share.delay, share._broadcast_reminder
+                    )
+                )
+
+        self.timers[share] = timers, share._broadcast_removal
+
+    def add_printer(self, printer):
+
+        """add_printer(self, printer)
+
+        Schedule the broadcasts which advertise the printer given.
+        """
+
+        self.call(self._add_printer, printer)
+
+    def _add_printer(self, printer):
+
+        if not printer._broadcast_available():
+
+            return
+
+        timers = []
+
+        if printer.delay != "off":
+
+            timers.append(
+                Repeater(
+                    self.loop, printer.delay, printer.delay,
+                    printer._broadcast_reminder
+                    )
+                )
+
+        self.timers[printer] = timers, None
+
+    def remove(self, owner):
+
+        """remove(self, owner)
+
+        Cancel the broadcasts for the share or printer given.
+        """
+
+        self.call(self._remove, owner)
+
+    def _remove(self, owner):
+
+        try:
+
+            timers, removed = self.timers.pop(owner)
+
+        except KeyError:
+
+            return
+
+        for timer in timers:
+
+            timer.cancel()
+
+        if removed is not None:
+
+            removed()
+
+    # Transfers
+
+    def start_transfer(self, transfer):
+
+        """start_transfer(self, transfer)
+
+        Run the steps of a transfer as a coroutine once the Peer's transfer
+        scheduler allows it.
+        """
+
+        self.call(self._start_transfer, transfer)
+
+    def _start_transfer(self, transfer):
+
+        if not self.peer.transfers.submit(transfer, self._begin_transfer):
+
+            transfer.steps.close()
+
+    def _begin_transfer(self, transfer):
+
+        task = self.loop.create_task(self._run_transfer(transfer.steps))
+        task.add_done_callback(functools.partial(self._transfer_done, transfer))
+        transfer.runner = task
+
+    def _transfer_done(self, transfer, task):
+
+        # Let any transfers waiting for this one run.
+        self.peer.transfers.finish(transfer, self._begin_transfer)
+
+    async def _run_transfer(self, steps):
+
+        reply = None
+
+        try:
+
+            while 1:
+
+                msg, host, commands, reply_id = steps.send(reply)
+                reply = await self.request(msg, host, commands, reply_id)
+
+        except StopIteration:
+
+            pass
+
+    async def request(self, msg, host, commands, reply_id, tries = 5,
+                      delay = 1.0):
+
+        """replied, data = await request(self, msg, host, commands, reply_id)
+
+        Send a message via the non-broadcast share port to a remote client
+        and wait for a reply without blocking the event loop. This is the
+        coroutine equivalent of Ports._send_request.
+        """
+
+        peer = self.peer
+
+        # Use the non-broadcast socket.
+        s = peer.ports.get(49171)
+
+        if s is None:
+
+            print("No socket to use for port %i" % 49171)
+            return 0, []
+
+        msg[0] = msg[0] + reply_id
+
+        # Collect replies to this message using an event which is set in
+        # the event loop's thread when they arrive.
+        event = asyncio.Event()
+        peer.share_messages.add_entry(host, reply_id, event)
+
+        # Wait for a reply for a time based on the round trip times measured
+        # for the host, giving up after the time allowed for all the tries.
+        timer = peer.round_trips
+        timeout = timer.start(host)
+
+        try:
+
+            t0 = time.time()
+            peer._send_list(msg, s, (host, 49171))
+
+            retransmitted = False
+            resend_time = t0 + timeout
+            end_time = t0 + tries * delay
+
+            while 1:
+
+                now = time.time()
+
+                if now >= end_time:
+
+                    break
+
+                try:
+
+                    await asyncio.wait_for(
+                        event.wait(), min(resend_time, end_time) - now
+                        )
+
+                except asyncio.TimeoutError:
+
+                    if time.time() < end_time:
+
+                        # Send the request again, waiting longer for a reply.
+                        peer._send_list(msg, s, (host, 49171))
+
+                        retransmitted = True
+                        resend_time = time.time() + timer.back_off(host)
+
+                    continue
+
+                # See if the response has arrived. This clears the event.
+                replied, data = peer.share_messages._scan_messages(
+                    host, reply_id, commands
+                    )
+
+                if replied != 0:
+
+                    # Only measure the round trip time if the request was
+                    # sent once.
+                    if not retransmitted:
+
+                        timer.measure(host, time.time() - t0)
+
+                    return replied, data
+
+            timer.lose(host)
+
+            # Return a negative result.
+            return 0, (0, "The machine containing the shared disc does not respond")
+
+        finally:
+
+            # Remove the entry in the Messages object for replies to this
+            # message.
+            peer.share_messages.remove_entry(host, reply_id)
@@ -24,6 +24,7 @@ except NameError:
 share = None
 quit = False
 current_dir = ""
+window = None
 
 def concat_path(path, leaf):
  
@@ -196,7 +197,7 @@ def get_file(p, str):
  
         return
 
-    str = share.pget(concat_path(current_dir, args[1]))
+    str = share.pget(concat_path(current_dir, args[1]), window)
     f.write(str)
     f.close()
     
@@ -273,12 +274,21 @@ if __name__ == "__main__":
 
     want_access_plus = 1
     try:
-        optlist, args = getopt.gnu_getopt(sys.argv[1:], "i:", ["interface=", "no-access-plus"])
+        optlist, args = getopt.gnu_getopt(sys.argv[1:], "i:", ["interface=", "no-access-plus", "window="])
         for o, a in optlist:
             if o in ("-i", "--interface"):
                 access.setup_net(a)
             elif o == "--no-access-plus":
                 want_access_plus = 0
+            elif o == "--window":
+                # Keep this many blocks in flight when getting files.
+                try:
+                    window = int(a)
+                except ValueError:
+                    window = 0
+                if not 1 <= window <= access.PGET_WINDOW_SIZE:
+                    print("The window must be between 1 and %i blocks" % access.PGET_WINDOW_SIZE)
+                    sys.exit(1)
     except getopt.GetoptError as err:
         print(err)
 
@@ -11,5 +11,5 @@ setup(
     author_email="david@boddie.org.uk",
     url="http://www.boddie.org.uk/david/Projects/Python/AccessPlusPython/",
     version=access.__version__,
-    py_modules=["access"]
+    py_modules=["access", "access_async"]
     )
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""
+encode.py
+
+Compare the cost of encoding typical Access+ messages with the Ports._encode
+method against the original byte-at-a-time encoder.
+"""
+
+from __future__ import print_function
+
+import os, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+import access
+
+
+class LegacyEncoder(access.Common):
+
+    # The encoder used before messages were packed with precompiled
+    # structures, kept here for comparison.
+
+    def number(self, size, n):
+    
+        s = ""
+        ba = bytearray()
+        
+        while size > 0:
+        
+            i = n % 256
+            
+            if sys.version_info > (3,):
+                ba.append(i)
+            else:
+                s = s + chr(i)
+            
+            n = n >> 8
+            size = size - 1
+        
+        if sys.version_info > (3,):
+            return bytes(ba)
+        else:
+            return s
+    
+    def _encode(self, l):
+    
+        output = []
+        
+        for item in l:
+        
+            if type(item) == int:
+                output.append(self.number(4, item))
+            elif type(item) == access.longtype:
+                output.append(self.number(4, item))
+            elif type(item) == tuple:
+                if item[0] == access.NO_PAD:
+                    output.append(item[1])
+            else:
+                padding = 4 - (len(item) % 4)
+                if padding == 4: padding = 0
+                if type(item) == str:
+                    padded = item + (padding * "\000")
+                    if sys.version_info > (3,):
+                        padded = bytes(padded, "latin-1")
+                else:
+                    padded = item + (padding * b"\000")
+                output.append(padded)
+        
+        return b"".join(output)
+
+
+class Encoder(access.Ports):
+
+    # Use the encoding methods of the Ports class without creating any
+    # sockets.
+    def __init__(self):
+        pass
+
+
+def messages():
+
+    reply_id = "\x01\x10\x00"
+    entry = [0xfffffd12, 0x3456789a, 1234, 0x13, 1, "filename\x00"]
+    
+    return {
+        "open reply": ["R"+reply_id, 0xfffffd12, 0x3456789a, 1234, 0x13, 1, 7],
+        "error": ["E"+reply_id, 0x100d6, "Not found"],
+        "data block": ["D"+reply_id, 8192, (access.NO_PAD, os.urandom(8192))],
+        "catalogue": ["S"+reply_id, 0x400, 0x24] + entry * 40 + \
+                     ["B"+reply_id, 0xffffcd00, 0, 2048, 0x13, 0xffffff02,
+                      0x1234, 0x400, 0xffffffff]
+        }
+
+
+if __name__ == "__main__":
+
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    
+    legacy = LegacyEncoder()
+    encoder = Encoder()
+    
+    print("%-12s %12s %12s %8s" % (
+        "message", "legacy us", "_encode us", "speedup"))
+    
+    for name, msg in sorted(messages().items()):
+    
+        if legacy._encode(msg) != encoder._encode(msg):
+        
+            print("Encodings differ for message: %s" % name)
+            sys.exit(1)
+        
+        t_legacy = timeit.timeit(lambda: legacy._encode(msg), number = number)
+        t_new = timeit.timeit(lambda: encoder._encode(msg), number = number)
+        
+        print("%-12s %12.2f %12.2f %7.1fx" % (
+            name, t_legacy * 1e6 / number, t_new * 1e6 / number,
+            t_legacy / t_new))
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+"""
+messages.py
+
+Stress the Messages class used to match replies to outstanding requests,
+comparing the mailbox-based implementation with the list-based one it
+replaced.
+"""
+
+from __future__ import print_function
+
+import os, random, sys, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+import access
+
+
+class LegacyMessages(access.Common):
+
+    # The implementation used before replies were indexed by command,
+    # kept here for comparison. A single lock protects a list of messages
+    # for each request which is scanned to find a reply.
+
+    def __init__(self):
+
+        self.messages = {}
+        self.events = {}
+        self.lock = threading.Semaphore()
+
+    def append(self, hostdata):
+
+        (host, data) = hostdata
+        key = self.replyid2str(data[1:4])
+
+        if key != "":
+
+            self.lock.acquire()
+
+            try:
+
+                self.messages[(host, key)].append(data)
+
+                self.lock.release()
+
+                self.signal_event(host, key)
+
+            except KeyError:
+
+                self.lock.release()
+
+    def add_entry(self, host, new_id):
+
+        self.lock.acquire()
+
+        self.messages[(host, new_id)] = []
+        self.events[(host, new_id)] = threading.Event()
+
+        self.lock.release()
+
+    def remove_entry(self, host, new_id):
+
+        self.lock.acquire()
+
+        del self.messages[(host, new_id)]
+        del self.events[(host, new_id)]
+
+        self.lock.release()
+
+    def wait_for_event(self, host, new_id, delay):
+
+        self.lock.acquire()
+
+        evt = self.events[(host, new_id)]
+
+        self.lock.release()
+
+        if not evt.is_set():
+
+            evt.wait(delay)
+
+        return evt.is_set()
+
+    def signal_event(self, host, new_id):
+
+        self.lock.acquire()
+
+        self.events[(host, new_id)].set()
+
+        self.lock.release()
+
+    def _scan_messages(self, host, new_id, commands):
+
+        self.lock.acquire()
+
+        for data in self.messages[(host, new_id)]:
+
+            for command in commands:
+
+                if self.cmd2str(data[0]) == command and self.replyid2str(data[1:4]) == new_id:
+
+                    self.messages[(host, new_id)].remove(data)
+
+                    self.lock.release()
+
+                    return 1, data
+
+            if data[:4] == "E"+new_id:
+
+                self.messages[(host, new_id)].remove(data)
+
+                self.lock.release()
+
+                return -1, (self.str2num(4, data[4:8]), data[8:])
+
+        self.lock.release()
+
+        return 0, (0, "The machine containing the shared disc does not respond")
+
+
+def make_ids(ids, hosts):
+
+    # Create reply IDs in the same way as Ports.new_id, spread over a number
+    # of hosts.
+    c = access.Common()
+    keys = []
+
+    for i in range(ids):
+
+        host = "10.0.0.%i" % (1 + (i % hosts))
+        reply_id = c.replyid2str(c.number(3, 1 + i * 0x1001))
+        keys.append((host, reply_id))
+
+    return keys
+
+def make_replies(keys, noise):
+
+    # Create a reply for each request preceded by a number of unwanted
+    # replies, such as duplicate data blocks, with the same ID.
+    replies = []
+
+    for host, reply_id in keys:
+
+        prefix = reply_id.encode("latin-1") if str is not bytes else reply_id
+
+        for i in range(noise):
+
+            replies.append((host, b"D" + prefix + b"\x00" * 8))
+
+        replies.append((host, b"R" + prefix + b"\x01\x00\x00\x00"))
+
+    return replies
+
+def match(messages, keys, replies):
+
+    # Queue all the replies, then claim them one request at a time.
+    for key in keys:
+
+        messages.add_entry(*key)
+
+    t0 = time.time()
+
+    for reply in replies:
+
+        messages.append(reply)
+
+    for host, reply_id in keys:
+
+        replied, data = messages._scan_messages(host, reply_id, ["R"])
+
+        if replied != 1:
+
+            raise RuntimeError("Reply not found for %s" % repr((host, reply_id)))
+
+    t1 = time.time()
+
+    for key in keys:
+
+        messages.remove_entry(*key)
+
+    return t1 - t0
+
+def stress(messages, keys, replies, threads):
+
+    # Add entries for all requests, then start a number of threads which
+    # each wait for replies to their share of the requests while the
+    # replies arrive in a random order.
+    for key in keys:
+
+        messages.add_entry(*key)
+
+    replies = replies[:]
+    random.shuffle(replies)
+
+    failures = []
+
+    def consume(keys):
+
+        for host, reply_id in keys:
+
+            tries = 50
+
+            while tries > 0:
+
+                if messages.wait_for_event(host, reply_id, 0.1):
+
+                    replied, data = messages._scan_messages(host, reply_id, ["R"])
+
+                    if replied == 1:
+
+                        break
+
+                else:
+
+                    tries = tries - 1
+
+            else:
+
+                failures.append((host, reply_id))
+
+    workers = []
+
+    for i in range(threads):
+
+        workers.append(threading.Thread(target = consume, args = (keys[i::threads],)))
+
+    t0 = time.time()
+
+    for worker in workers:
+
+        worker.start()
+
+    for reply in replies:
+
+        messages.append(reply)
+
+    for worker in workers:
+
+        worker.join()
+
+    t1 = time.time()
+
+    for key in keys:
+
+        messages.remove_entry(*key)
+
+    if failures:
+
+        raise RuntimeError("%i requests received no reply" % len(failures))
+
+    return t1 - t0
+
+
+if __name__ == "__main__":
+
+    ids = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    noise = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+
+    keys = make_ids(ids, 4)
+    replies = make_replies(keys, noise)
+
+    print("%i requests in flight, %i unwanted replies each, %i threads" % (
+        ids, noise, threads))
+    print("%-10s %14s %14s %8s" % ("test", "legacy s", "mailbox s", "speedup"))
+
+    for name, fn, args in (("match", match, ()), ("stress", stress, (threads,))):
+
+        t_legacy = fn(LegacyMessages(), keys, replies, *args)
+        t_new = fn(access.Messages(), keys, replies, *args)
+
+        print("%-10s %14.3f %14.3f %7.1fx" % (
+            name, t_legacy, t_new, t_legacy / t_new))
@@ -0,0 +1,692 @@
+#!/usr/bin/env python
+
+"""
+replay.py
+
+Replay the requests sent to a server in a pcap capture against a Peer which
+uses fake sockets, then compare the latency and throughput of each kind of
+request in the capture with those of the replay.
+"""
+
+from __future__ import print_function
+
+import os, socket, struct, sys, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+import access
+
+SHARE_PORT = 49171
+
+# Requests carrying a handle returned by an earlier open request in the
+# word following the code.
+HANDLE_PACKETS = (access.HandleRequest, access.TransferRequest,
+                  access.LengthRequest, access.FiletypeRequest,
+                  access.ChunkRequest)
+
+# Requests which return a handle in an object information reply.
+OPEN_CODES = (0x1, 0x2, 0x4)
+
+WORD = struct.Struct("<I")
+
+
+# Reading captures
+
+class PcapReader:
+
+    """PcapReader(path)
+
+    Read the UDP datagrams in a pcap file captured by access.capture_on or
+    by tools such as tcpdump, reassembling fragmented datagrams.
+    """
+
+    # The number of bytes before the IPv4 header for each supported link
+    # type: Ethernet, raw IP, Linux cooked and raw IPv4.
+    LINK_HEADERS = {1: 14, 101: 0, 113: 16, 228: 0}
+
+    IPV4 = struct.Struct("!BBHHHBBH4s4s")
+    UDP = struct.Struct("!HHHH")
+
+    def __init__(self, path):
+
+        self.f = open(path, "rb")
+        header = self.f.read(24)
+
+        if len(header) < 24:
+
+            raise ValueError("Not a pcap file: %s" % path)
+
+        magic = WORD.unpack_from(header)[0]
+
+        if magic in (0xa1b2c3d4, 0xa1b23c4d):
+
+            endian = "<"
+
+        elif magic in (0xd4c3b2a1, 0x4d3cb2a1):
+
+            endian = ">"
+
+        else:
+
+            raise ValueError("Not a pcap file: %s" % path)
+
+        # Timestamps are in nanoseconds rather than microseconds in files
+        # with the alternative magic number.
+        if magic in (0xa1b23c4d, 0x4d3cb2a1):
+
+            self.scale = 1e-9
+
+        else:
+
+            self.scale = 1e-6
+
+        self.record = struct.Struct(endian + "IIII")
+        linktype = struct.unpack_from(endian + "I", header, 20)[0]
+
+        try:
+
+            self.skip = self.LINK_HEADERS[linktype]
+
+        except KeyError:
+
+            raise ValueError("Unsupported link type %i in %s" % (linktype, path))
+
+        self.linktype = linktype
+
+        # Fragments of datagrams, indexed by source, destination and IP
+        # identification.
+        self.fragments = {}
+
+    def __iter__(self):
+
+        """Yield (time, source, destination, data) for each datagram."""
+
+        while 1:
+
+            header = self.f.read(self.record.size)
+
+            if len(header) < self.record.size:
+
+                break
+
+            seconds, fraction, length, original = self.record.unpack(header)
+            packet = self.f.read(length)
+            t = seconds + fraction * self.scale
+
+            if self.linktype == 1 and packet[12:14] != b"\x08\x00":
+
+                # Not an IPv4 Ethernet frame.
+                continue
+
+            datagram = self._datagram(packet[self.skip:])
+
+            if datagram is not None:
+
+                source, destination, data = datagram
+                yield t, source, destination, data
+
+        self.f.close()
+
+    def _datagram(self, ip):
+
+        if len(ip) < self.IPV4.size:
+
+            return None
+
+        (version, tos, length, ident, fragment, ttl, protocol, checksum,
+         source, destination) = self.IPV4.unpack_from(ip)
+
+        if version >> 4 != 4 or protocol != socket.IPPROTO_UDP:
+
+            return None
+
+        payload = ip[(version & 0xf) * 4:length]
+        more = fragment & 0x2000
+        offset = (fragment & 0x1fff) * 8
+
+        if more or offset:
+
+            payload = self._reassemble(
+                (source, destination, ident), offset, payload, more
+                )
+
+            if payload is None:
+
+                return None
+
+        if len(payload) < self.UDP.size:
+
+            return None
+
+        source_port, destination_port, udp_length, checksum = \
+            self.UDP.unpack_from(payload)
+
+        return ((socket.inet_ntoa(source), source_port),
+                (socket.inet_ntoa(destination), destination_port),
+                payload[self.UDP.size:udp_length])
+
+    def _reassemble(self, key, offset, payload, more):
+
+        parts, total = self.fragments.get(key, ({}, None))
+        parts[offset] = payload
+
+        if not more:
+
+            total = offset + len(payload)
+
+        self.fragments[key] = parts, total
+
+        if total is None:
+
+            return None
+
+        # Join the fragments once they cover the whole datagram.
+        data = []
+        position = 0
+
+        while position < total:
+
+            part = parts.get(position)
+
+            if part is None:
+
+                return None
+
+            data.append(part)
+            position = position + len(part)
+
+        del self.fragments[key]
+        return b"".join(data)
+
+
+# Analysing traces
+
+def label(data):
+
+    # Name a request by its command and code, and the method handling it.
+    command = data[:1].decode("latin-1")
+    code = WORD.unpack_from(data, 4)[0]
+    name = access.Peer.share_handlers.get((command, code), "")
+
+    return "%s 0x%x %s" % (command, code, name.replace("_share_", ""))
+
+def is_request(data):
+
+    return len(data) >= 8 and data[:1] in (b"A", b"B")
+
+def find_server(events):
+
+    # Use the host receiving the most requests on the share port.
+    counts = {}
+
+    for t, source, destination, data in events:
+
+        if destination[1] == SHARE_PORT and is_request(data):
+
+            counts[destination[0]] = counts.get(destination[0], 0) + 1
+
+    if not counts:
+
+        raise ValueError("No requests to the share port were captured")
+
+    return max(counts.items(), key = lambda item: item[1])[0]
+
+def analyse(events, server):
+
+    """results = analyse(events, server)
+
+    Measure the time taken by the server to reply to each request in the
+    list of (time, source, destination, data) events, the time until its
+    last message with the same reply ID, and the number of bytes sent in
+    those messages. Return a dictionary mapping the label of each kind of
+    request to a list of (latency, duration, bytes) tuples, using None for
+    the latency of requests which received no reply.
+    """
+
+    results = {}
+    pending = {}
+
+    def finish(entry):
+
+        name, t0, first, last, length = entry
+
+        if first is None:
+
+            results.setdefault(name, []).append((None, 0, 0))
+
+        else:
+
+            results.setdefault(name, []).append((first - t0, last - t0, length))
+
+    for t, source, destination, data in events:
+
+        if destination[0] == server and destination[1] == SHARE_PORT:
+
+            if is_request(data):
+
+                key = (source[0], data[1:4])
+
+                # A reply ID which is reused ends the previous request.
+                if key in pending:
+
+                    finish(pending.pop(key))
+
+                pending[key] = [label(data), t, None, t, 0]
+
+        elif source[0] == server and len(data) >= 4:
+
+            entry = pending.get((destination[0], data[1:4]))
+
+            if entry is not None:
+
+                if entry[2] is None:
+
+                    entry[2] = t
+
+                entry[3] = t
+                entry[4] = entry[4] + len(data)
+
+    for entry in pending.values():
+
+        finish(entry)
+
+    return results
+
+def percentile(values, p):
+
+    values = sorted(values)
+    return values[int(round(p * (len(values) - 1)))]
+
+def report(title, results):
+
+    print(title)
+    print("%-28s %7s %7s %9s %9s %12s %9s" % (
+        "request", "count", "lost", "p50 ms", "p99 ms", "bytes", "MB/s"))
+
+    for name in sorted(results.keys()):
+
+        items = results[name]
+        latencies = [latency for latency, duration, length in items
+                     if latency is not None]
+        lost = len(items) - len(latencies)
+        total = sum([length for latency, duration, length in items])
+        busy = sum([duration for latency, duration, length in items])
+
+        if latencies:
+
+            p50 = "%9.2f" % (percentile(latencies, 0.5) * 1000)
+            p99 = "%9.2f" % (percentile(latencies, 0.99) * 1000)
+
+        else:
+
+            p50 = p99 = "%9s" % "-"
+
+        if busy > 0:
+
+            rate = "%9.2f" % (total / busy / 1048576.0)
+
+        else:
+
+            rate = "%9s" % "-"
+
+        print("%-28s %7i %7i %s %s %12i %s" % (
+            name, len(items), lost, p50, p99, total, rate))
+
+    print()
+
+
+# Replaying requests
+
+class FakeSocket:
+
+    """FakeSocket(layer, port)
+
+    Stand in for one of the Peer's sockets, passing the messages it sends
+    to the fake socket layer instead of the network.
+    """
+
+    def __init__(self, layer, port):
+
+        self.layer = layer
+        self.port = port
+
+    def sendto(self, data, address):
+
+        # The data may be a view of a buffer which will be reused.
+        if type(data) == memoryview:
+
+            data = data.tobytes()
+
+        self.layer.sent(data, address)
+        return len(data)
+
+    def getsockname(self):
+
+        return (self.layer.server, self.port)
+
+    def fileno(self):
+
+        return -1
+
+    def setblocking(self, flag):
+
+        pass
+
+    def close(self):
+
+        pass
+
+class FakeLayer:
+
+    """FakeLayer(server)
+
+    Record the messages sent by a Peer using fake sockets, as if it were the
+    server given, and track the handles it returns so that requests using
+    handles from the capture can be rewritten.
+    """
+
+    def __init__(self, server):
+
+        self.server = server
+        self.events = []
+        self.condition = threading.Condition()
+
+        # The number of messages sent with each (host, reply ID) since the
+        # last request using it.
+        self.counts = {}
+
+        # Handles returned in the capture mapped to those returned by the
+        # Peer, and the captured handle expected in the reply to each open
+        # request in progress.
+        self.handles = {}
+        self.expected = {}
+
+    def install(self):
+
+        # Use fake sockets for all the ports so that Ports does not create
+        # real ones.
+        for port in access.Ports.ports.keys():
+
+            access.Ports.ports[port] = FakeSocket(self, port)
+            access.Ports.broadcasters[port] = FakeSocket(self, port)
+
+    def sent(self, data, address):
+
+        t = time.time()
+        key = (address[0], data[1:4])
+
+        self.condition.acquire()
+
+        try:
+
+            self.events.append((t, (self.server, SHARE_PORT), address, data))
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+            handle = self.expected.pop(key, None)
+
+            if handle is not None and data[:1] == b"R" and len(data) >= 28:
+
+                self.handles[handle] = WORD.unpack_from(data, 24)[0]
+
+            self.condition.notify_all()
+
+        finally:
+
+            self.condition.release()
+
+    def received(self, t, address, data):
+
+        self.condition.acquire()
+
+        try:
+
+            self.events.append((t, address, (self.server, SHARE_PORT), data))
+
+            if is_request(data):
+
+                self.counts[(address[0], data[1:4])] = 0
+
+        finally:
+
+            self.condition.release()
+
+    def wait_for(self, key, count, timeout):
+
+        # Wait until the Peer has sent the number of messages given with
+        # the reply ID given, or until the timeout expires.
+        end = time.time() + timeout
+
+        self.condition.acquire()
+
+        try:
+
+            while self.counts.get(key, 0) < count:
+
+                remaining = end - time.time()
+
+                if remaining <= 0:
+
+                    break
+
+                self.condition.wait(remaining)
+
+        finally:
+
+            self.condition.release()
+
+class ReplayPeer(access.Peer):
+
+    # A Peer which only serves the shares given on the command line.
+    def create_shares(self):
+
+        pass
+
+def prepare(events, server):
+
+    """messages = prepare(events, server)
+
+    Return the (time, source, data, handle, count) messages sent to the
+    server's share port. The handle is the one returned in the capture for
+    open requests and the count is, for replies from clients, the number of
+    messages the server had sent with the same reply ID before each reply.
+    """
+
+    messages = []
+    opens = {}
+    counts = {}
+
+    for t, source, destination, data in events:
+
+        if destination == (server, SHARE_PORT):
+
+            key = (source[0], data[1:4])
+
+            if is_request(data):
+
+                counts[key] = 0
+
+                if data[:1] == b"A" and WORD.unpack_from(data, 4)[0] in OPEN_CODES:
+
+                    opens[key] = len(messages)
+
+                messages.append([t, source, data, None, 0])
+
+            else:
+
+                messages.append([t, source, data, None, counts.get(key, 0)])
+
+        elif source[0] == server and len(data) >= 4:
+
+            key = (destination[0], data[1:4])
+            counts[key] = counts.get(key, 0) + 1
+            index = opens.pop(key, None)
+
+            if index is not None and data[:1] == b"R" and len(data) >= 28:
+
+                messages[index][3] = WORD.unpack_from(data, 24)[0]
+
+    return messages
+
+def replay(messages, layer, peer, speed, wait):
+
+    start = time.time()
+    first = messages[0][0]
+    share_socket = access.Ports.ports[SHARE_PORT]
+
+    for t, source, data, handle, count in messages:
+
+        key = (source[0], data[1:4])
+
+        if speed > 0:
+
+            delay = start + (t - first) / speed - time.time()
+
+            if delay > 0:
+
+                time.sleep(delay)
+
+        if count > 0:
+
+            # Only send a client's reply once the Peer has sent the message
+            # it answers.
+            layer.wait_for(key, count, wait)
+
+        packet = access.decode_packet(data)
+
+        if isinstance(packet, HANDLE_PACKETS):
+
+            captured = WORD.unpack_from(data, 8)[0]
+            data = data[:8] + WORD.pack(layer.handles.get(captured, captured)) + data[12:]
+
+        if handle is not None:
+
+            layer.expected[key] = handle
+
+        layer.received(time.time(), source, data)
+        peer._read_share_socket(share_socket, data, source)
+
+def settle(layer, quiet, limit):
+
+    # Wait until the Peer has sent nothing for a while.
+    end = time.time() + limit
+
+    while time.time() < end:
+
+        n = len(layer.events)
+        time.sleep(quiet)
+
+        if len(layer.events) == n:
+
+            break
+
+def usage():
+
+    sys.stderr.write(
+        "Usage: %s [--server <address>] [--speed <factor>] [--wait <seconds>]\n"
+        "       [--output <pcap file>] [--share <name>=<directory> ...] <pcap file>\n"
+        % sys.argv[0]
+        )
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    server = None
+    speed = 1.0
+    wait = 1.0
+    output = None
+    shares = []
+
+    try:
+
+        while len(args) > 1:
+
+            option = args.pop(0)
+
+            if option == "--server":
+
+                server = args.pop(0)
+
+            elif option == "--speed":
+
+                speed = float(args.pop(0))
+
+            elif option == "--wait":
+
+                wait = float(args.pop(0))
+
+            elif option == "--output":
+
+                output = args.pop(0)
+
+            elif option == "--share":
+
+                name, directory = args.pop(0).split("=", 1)
+                shares.append((name, directory))
+
+            else:
+
+                usage()
+
+    except (IndexError, ValueError):
+
+        usage()
+
+    if len(args) != 1:
+
+        usage()
+
+    # Messages are captured by the threads sending and receiving them, so
+    # they may not be written in the order they were sent.
+    events = list(PcapReader(args[0]))
+    events.sort(key = lambda event: event[0])
+
+    if server is None:
+
+        server = find_server(events)
+
+    messages = prepare(events, server)
+
+    if not messages:
+
+        sys.stderr.write("No messages to %s:%i were captured\n" % (server, SHARE_PORT))
+        sys.exit(1)
+
+    report("Captured from %s (%i messages)" % (server, len(messages)),
+           analyse(events, server))
+
+    access.logging_off()
+
+    layer = FakeLayer(server)
+    layer.install()
+    peer = ReplayPeer()
+
+    for name, directory in shares:
+
+        peer.add_share(name, directory)
+
+    # Let the Peer finish announcing itself and its shares.
+    time.sleep(1)
+    layer.events = []
+
+    t0 = time.time()
+    replay(messages, layer, peer, speed, wait)
+    settle(layer, 0.5, 30)
+    t1 = time.time()
+
+    peer.stop()
+
+    report("Replayed at %s in %.2fs" % (
+        speed > 0 and "%gx" % speed or "full speed", t1 - t0),
+        analyse(layer.events, server))
+
+    if output is not None:
+
+        capture = access.Capture(output)
+
+        for t, source, destination, data in layer.events:
+
+            capture.write(t, source, destination, data)
+
+        capture.close()
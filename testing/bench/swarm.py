@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+
+"""
+swarm.py
+
+Simulate a number of RISC OS clients using a share served by a Peer, each
+performing a mix of operations described by a scenario file, and report the
+rate, latency and throughput of each operation.
+"""
+
+from __future__ import print_function
+
+import multiprocessing, os, random, shutil, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+import access
+
+SHARE_NAME = "bench"
+
+# The operations a client can perform and the kind of file each one uses by
+# default.
+OPERATIONS = {
+    "open": "small", "catalogue": None, "get": "small", "pget": "large",
+    "put": None, "pput": None
+    }
+
+
+class ScenarioError(Exception):
+
+    pass
+
+class Scenario:
+
+    """Scenario(path)
+
+    Read a scenario file. Each line holds a setting name followed by its
+    values; blank lines and text following a "#" are ignored.
+
+      clients <number>            the number of clients to simulate
+      duration <seconds>          how long each client runs for
+      small <count> <size>        files served for "open" and "get"
+      large <count> <size>        files served for "pget"
+      upload <size>               the size of files sent by "put" and "pput"
+      <operation> <weight> [small|large]
+
+    Operations are chosen at random in proportion to their weights.
+    """
+
+    def __init__(self, path):
+
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.clients = 4
+        self.duration = 10.0
+        self.files = {"small": (16, 16384), "large": (1, 1048576)}
+        self.upload = 65536
+        self.operations = []
+
+        for number, line in enumerate(open(path).readlines()):
+
+            words = line.split("#", 1)[0].split()
+
+            if not words:
+
+                continue
+
+            try:
+
+                self._read(words)
+
+            except (IndexError, ValueError):
+
+                raise ScenarioError(
+                    "Invalid setting at line %i of %s: %s" % (
+                        number + 1, path, line.strip()
+                        )
+                    )
+
+        if not self.operations:
+
+            raise ScenarioError("No operations in %s" % path)
+
+    def _read(self, words):
+
+        name = words[0]
+
+        if name == "clients":
+
+            self.clients = int(words[1])
+
+        elif name == "duration":
+
+            self.duration = float(words[1])
+
+        elif name in ("small", "large"):
+
+            self.files[name] = (int(words[1]), int(words[2]))
+
+        elif name == "upload":
+
+            self.upload = int(words[1])
+
+        elif name in OPERATIONS:
+
+            kind = OPERATIONS[name]
+
+            if len(words) > 2:
+
+                kind = words[2]
+
+                if kind not in self.files:
+
+                    raise ValueError
+
+            self.operations.append((name, float(words[1]), kind))
+
+        else:
+
+            raise ValueError
+
+    def choose(self, rng):
+
+        total = sum([weight for name, weight, kind in self.operations])
+        value = rng.uniform(0, total)
+
+        for name, weight, kind in self.operations:
+
+            value = value - weight
+
+            if value <= 0:
+
+                break
+
+        return name, kind
+
+    def file_name(self, kind, rng):
+
+        count, size = self.files[kind]
+        return "%s%03i" % (kind, rng.randrange(count)), size
+
+    def create_files(self, directory):
+
+        for kind, (count, size) in self.files.items():
+
+            for i in range(count):
+
+                f = open(os.path.join(directory, "%s%03i,ffd" % (kind, i)), "wb")
+                f.write(os.urandom(size))
+                f.close()
+
+
+# Processes
+
+def quiet():
+
+    # Discard the progress messages written by the access module.
+    null = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(null, 1)
+    os.dup2(null, 2)
+
+class BenchPeer(access.Peer):
+
+    # A Peer which ignores the configuration file, sharing the directory
+    # given instead, if any, so that worker processes serve it too.
+    directory = None
+
+    def create_shares(self):
+
+        if self.directory is not None:
+
+            self.add_share(SHARE_NAME, self.directory, 0o666, 30, "truncate", 0xfff)
+
+def serve(server, directory, engine, workers, ready, stop):
+
+    quiet()
+
+    access.Hostaddr = server
+    access.logging_off()
+
+    BenchPeer.directory = directory
+    peer = BenchPeer(engine = engine, workers = workers)
+
+    ready.set()
+
+    stop.wait()
+    peer.stop()
+    os._exit(0)
+
+def client_addresses(index):
+
+    # Give each client its own loopback address, on the same subnet as the
+    # server, and an unused address for its broadcast sockets.
+    return "127.0.0.%i" % (10 + index), "127.0.1.%i" % (10 + index)
+
+def run_client(index, server, scenario, seed, start, results):
+
+    quiet()
+
+    access.Hostaddr, access.Broadcast_addr = client_addresses(index)
+    access.logging_off()
+
+    peer = BenchPeer()
+    share = access.RemoteShare(SHARE_NAME, server, peer.share_messages)
+    rng = random.Random(seed + index)
+
+    # Create a file to upload, giving its filetype as a suffix.
+    fd, upload = tempfile.mkstemp(suffix = ".ffd")
+    os.write(fd, os.urandom(scenario.upload))
+    os.close(fd)
+
+    records = []
+    start.wait()
+    end = time.time() + scenario.duration
+    n = 0
+
+    try:
+
+        while time.time() < end:
+
+            name, kind = scenario.choose(rng)
+
+            t0 = time.time()
+
+            try:
+
+                length, ok, t1 = operate(
+                    share, name, kind, scenario, rng, upload, index, n
+                    )
+
+            except Exception:
+
+                length, ok, t1 = 0, False, time.time()
+
+            # Report operations on files of another kind separately.
+            if kind != OPERATIONS[name]:
+
+                name = "%s %s" % (name, kind)
+
+            records.append((name, t1 - t0, length, ok))
+            n = n + 1
+
+    finally:
+
+        os.remove(upload)
+
+    results.put(records)
+    results.close()
+    results.join_thread()
+    os._exit(0)
+
+def operate(share, name, kind, scenario, rng, upload, index, n):
+
+    """length, ok, end = operate(share, name, kind, scenario, rng, upload,
+                                 index, n)
+
+    Perform the operation given, returning the number of bytes of file data
+    transferred, whether it succeeded and the time it finished.
+    """
+
+    if name == "open":
+
+        path, size = scenario.file_name(kind, rng)
+        info = share.open(path)
+
+        if info is None:
+
+            return 0, False, time.time()
+
+        share._close(info["handle"])
+        return 0, info["length"] == size, time.time()
+
+    elif name == "catalogue":
+
+        files = share.catalogue("")
+        return 0, files is not None, time.time()
+
+    elif name in ("get", "pget"):
+
+        path, size = scenario.file_name(kind, rng)
+
+        if name == "get":
+
+            data = share.get(path)
+
+        else:
+
+            data = share.pget(path)
+
+        end = time.time()
+
+        if data is None:
+
+            return 0, False, end
+
+        return len(data), len(data) == size, end
+
+    else:
+
+        # Upload a file then check that it arrived, without timing the
+        # check.
+        path = "c%i_%i" % (index, n % 4)
+
+        if name == "put":
+
+            share.put(upload, path)
+
+        else:
+
+            share.pput(upload, path)
+
+        end = time.time()
+        info = share.open(path)
+
+        if info is None:
+
+            return 0, False, end
+
+        share._close(info["handle"])
+        return scenario.upload, info["length"] == scenario.upload, end
+
+
+# Reporting
+
+def percentile(values, p):
+
+    values = sorted(values)
+    return values[int(round(p * (len(values) - 1)))]
+
+def report(title, records, duration):
+
+    print(title)
+    print("%-12s %7s %7s %9s %9s %9s %10s" % (
+        "operation", "count", "errors", "ops/s", "p50 ms", "p99 ms", "MB/s"))
+
+    names = sorted(set([record[0] for record in records]))
+
+    for name in names:
+
+        items = [record for record in records if record[0] == name]
+        latencies = [latency for n, latency, length, ok in items if ok]
+        errors = len(items) - len(latencies)
+        total = sum([length for n, latency, length, ok in items if ok])
+
+        if latencies:
+
+            p50 = "%9.2f" % (percentile(latencies, 0.5) * 1000)
+            p99 = "%9.2f" % (percentile(latencies, 0.99) * 1000)
+
+        else:
+
+            p50 = p99 = "%9s" % "-"
+
+        print("%-12s %7i %7i %9.1f %s %s %10.2f" % (
+            name, len(items), errors, len(latencies) / duration, p50, p99,
+            total / duration / 1048576.0))
+
+    print()
+
+def run(scenario, server, engine, workers, seed):
+
+    """records, duration = run(scenario, server, engine, workers, seed)
+
+    Serve the scenario's files from a Peer using the engine and number of
+    worker processes given, unless a server address is given, then run its
+    clients against the share.
+    """
+
+    directory = None
+    server_process = None
+    stop = multiprocessing.Event()
+
+    if server is None:
+
+        server = "127.0.0.1"
+        directory = tempfile.mkdtemp(prefix = "swarm")
+        scenario.create_files(directory)
+
+        ready = multiprocessing.Event()
+        server_process = multiprocessing.Process(
+            target = serve,
+            args = (server, directory, engine, workers, ready, stop)
+            )
+        server_process.start()
+
+        if not ready.wait(30):
+
+            raise RuntimeError("The server did not start")
+
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    clients = []
+
+    try:
+
+        for i in range(scenario.clients):
+
+            process = multiprocessing.Process(
+                target = run_client,
+                args = (i, server, scenario, seed, start, results)
+                )
+            process.start()
+            clients.append(process)
+
+        # Let the clients start their Peers before timing them.
+        time.sleep(1)
+        t0 = time.time()
+        start.set()
+
+        records = []
+
+        for process in clients:
+
+            records.extend(results.get(timeout = scenario.duration + 120))
+
+        duration = time.time() - t0
+
+        for process in clients:
+
+            process.join()
+
+    finally:
+
+        for process in clients:
+
+            if process.is_alive():
+
+                process.terminate()
+
+        if server_process is not None:
+
+            stop.set()
+            server_process.join(30)
+
+            if server_process.is_alive():
+
+                server_process.terminate()
+
+        if directory is not None:
+
+            shutil.rmtree(directory, ignore_errors = True)
+
+    return records, duration
+
+def usage():
+
+    sys.stderr.write(
+        "Usage: %s [--engine threads|asyncio ...] [--server <address>]\n"
+        "       [--workers <number>] [--clients <number>]\n"
+        "       [--duration <seconds>] [--seed <number>]\n"
+        "       <scenario file> ...\n" % sys.argv[0]
+        )
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    engines = []
+    server = None
+    workers = 0
+    clients = None
+    duration = None
+    seed = 1
+
+    try:
+
+        while args and args[0].startswith("--"):
+
+            option = args.pop(0)
+
+            if option == "--engine":
+
+                engines.append(args.pop(0))
+
+            elif option == "--server":
+
+                server = args.pop(0)
+
+            elif option == "--workers":
+
+                workers = int(args.pop(0))
+
+            elif option == "--clients":
+
+                clients = int(args.pop(0))
+
+            elif option == "--duration":
+
+                duration = float(args.pop(0))
+
+            elif option == "--seed":
+
+                seed = int(args.pop(0))
+
+            else:
+
+                usage()
+
+    except (IndexError, ValueError):
+
+        usage()
+
+    if not args:
+
+        usage()
+
+    for engine in engines:
+
+        if engine not in ("threads", "asyncio"):
+
+            usage()
+
+    if server is not None and len(engines) > 1:
+
+        sys.stderr.write("Only one engine can be used with a remote server.\n")
+        sys.exit(1)
+
+    for path in args:
+
+        try:
+
+            scenario = Scenario(path)
+
+        except (IOError, ScenarioError) as exc:
+
+            sys.stderr.write("%s\n" % exc)
+            sys.exit(1)
+
+        if clients is not None:
+
+            scenario.clients = clients
+
+        if duration is not None:
+
+            scenario.duration = duration
+
+        for engine in engines or ["threads"]:
+
+            records, elapsed = run(
+                scenario, server, engine == "asyncio" and "asyncio" or None,
+                workers, seed
+                )
+
+            if workers:
+
+                engine = "%s engine, %i workers" % (engine, workers)
+
+            else:
+
+                engine = "%s engine" % engine
+
+            report("%s: %i clients, %s, %.1fs" % (
+                scenario.name, scenario.clients, engine, elapsed),
+                records, elapsed)